@@ -17,7 +17,38 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-from interface import run_interface
+import os
+import sys
 
-run_interface()
+_ = lambda x : x
+
+if '--daemon' in sys.argv[1:]:
+    # Run headless, interfaces attach over a UNIX domain socket
+    from daemon import run_daemon
+    run_daemon()
+elif '--add' in sys.argv[1:]:
+    # Send torrent files to the running daemon, they are downloaded into the current directory
+    from bencode import Metainfo, BencodeError
+    from remote import connect
+    remote = connect()
+    if remote is None:
+        print(_('No daemon is running, start one with --daemon'), file = sys.stderr)
+        sys.exit(1)
+    status = 0
+    for path in sys.argv[sys.argv.index('--add') + 1:]:
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            Metainfo(data).check()
+            remote.add_torrent(data, os.getcwd())
+        except (OSError, BencodeError, ValueError) as e:
+            print('%s: %s' % (path, e), file = sys.stderr)
+            status = 1
+    remote.close()
+    sys.exit(status)
+else:
+    from interface import run_interface
+    from remote import connect
+    # Attach to the daemon if one is running, otherwise run a session in the interface
+    run_interface(remote = connect())
 
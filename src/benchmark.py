@@ -0,0 +1,464 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+'''
+Rendering and input benchmark for the terminal interface
+
+The interface is run in a pseudo-terminal at several sizes while
+keystroke streams are replayed into it. For each stream and size
+the frames per second, bytes written per frame, time spent redrawing
+per frame and input-to-paint latency are measured. Results can be
+saved as a JSON baseline and later runs compared against it, exiting
+with status 1 if something has regressed.
+
+    python3 src/benchmark.py --save baseline.json
+    python3 src/benchmark.py --compare baseline.json
+
+Streams can be recorded from a real session with `--record`.
+'''
+
+import os
+import sys
+import pty
+import json
+import time
+import fcntl
+import shutil
+import signal
+import struct
+import select
+import termios
+import argparse
+import tempfile
+
+
+BASELINE_VERSION = 1
+'''
+:int  The format version of saved baselines
+'''
+
+SIZES = [(24, 80), (30, 100), (50, 160), (70, 250)]
+'''
+:list<(height:int, width:int)>  The terminal sizes to run at
+'''
+
+TORRENTS = 5000
+'''
+:int  The number of torrents in the list
+'''
+
+QUIET = 0.03
+'''
+:float  Seconds without output after which a frame is assumed to be complete
+'''
+
+IDLE = 0.1
+'''
+:float  Seconds without output before each key press, longer than a frame interval so
+        that latency is not inflated by the frame rate limit
+'''
+
+KEY_INTERVAL = 0.005
+'''
+:float  Seconds between keys when measuring the frame rate, faster than frames can be drawn
+'''
+
+PAINT_TIMEOUT = 0.5
+'''
+:float  Seconds to wait for a key press to cause output
+'''
+
+TOLERANCE = 0.25
+'''
+:float  The relative change of a metric that counts as a regression
+'''
+
+SLACK = { 'latency_ms' : 2.0, 'render_ms' : 0.5, 'bytes_per_frame' : 16, 'fps' : 2.0 }
+'''
+:dict<str, float>  Absolute changes of metrics that are too small to count as regressions
+'''
+
+LOWER_IS_BETTER = ('latency_ms', 'render_ms', 'bytes_per_frame')
+HIGHER_IS_BETTER = ('fps',)
+'''
+:tuple<str>  The metrics compared against baselines
+'''
+
+(UP, DOWN, RIGHT, LEFT) = ('\033[A', '\033[B', '\033[C', '\033[D')
+(CTRL_UP, CTRL_DOWN, PAGE_UP, PAGE_DOWN) = ('\033[1;5A', '\033[1;5B', '\033[5~', '\033[6~')
+
+STREAMS = { 'tabs'   : [RIGHT, RIGHT, RIGHT, LEFT, LEFT, LEFT] * 3
+          , 'scroll' : [DOWN] * 40 + [PAGE_DOWN] * 10 + [PAGE_UP] * 10 + [UP] * 40
+          , 'sort'   : ['s', 'f', 's', 'f', 's', 'f', 's', 's', 'f', 'f', 'f', 'f']
+          , 'bars'   : [CTRL_DOWN, RIGHT, RIGHT, LEFT, CTRL_DOWN, RIGHT, CTRL_UP, CTRL_UP] * 3
+          , 'help'   : [RIGHT] * 3 + [DOWN] * 30 + [UP] * 30 + [LEFT] * 3
+          }
+'''
+:dict<str, list<str>>  Built in keystroke streams, each element is sent as one read
+'''
+
+
+def run_child(torrents, stats_path):
+    '''
+    Run the interface with a seeded torrent list, and save its redraw statistics on exit
+    
+    @param  torrents:int     The number of torrents to add
+    @param  stats_path:str   The file to write the statistics to
+    '''
+    import random
+    import interface
+    from torrents import Torrent, STATES
+    rng = random.Random(0)
+    for i in range(torrents):
+        torrent = Torrent(rng.getrandbits(160).to_bytes(20, 'big'), 'torrent %i' % rng.randrange(1 << 30),
+                          rng.randrange(1 << 34), rng.randrange(len(STATES)))
+        torrent.done = rng.randrange(torrent.size)
+        torrent.uploaded = rng.randrange(1 << 34)
+        interface.torrent_list.add(torrent)
+    redraws = []
+    redraw = interface.redraw
+    def timed_redraw(regions):
+        # The monotonic clock is shared between processes, so the benchmark can match frames to keys
+        start = time.monotonic()
+        redraw(regions)
+        redraws.append((start, time.monotonic() - start))
+    interface.redraw = timed_redraw
+    try:
+        interface.run_interface()
+    finally:
+        with open(stats_path, 'w') as file:
+            json.dump({ 'frames' : interface.screen.frames
+                      , 'bytes' : interface.screen.bytes_total
+                      , 'redraws' : redraws
+                      }, file)
+
+
+class Terminal():
+    '''
+    The interface running in a pseudo-terminal
+    '''
+    
+    def __init__(self, height, width, torrents, workdir):
+        '''
+        Start the interface
+        
+        @param  height:int    The height of the terminal
+        @param  width:int     The width of the terminal
+        @param  torrents:int  The number of torrents to add
+        @param  workdir:str   Directory for the interface's configuration and statistics
+        '''
+        self.stats_path = os.path.join(workdir, 'stats.json')
+        env = dict(os.environ)
+        for variable in ('XDG_RUNTIME_DIR', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME', 'XDG_DATA_HOME'):
+            # Never attach to a running daemon or read the user's preferences
+            env[variable] = os.path.join(workdir, variable.lower())
+            os.makedirs(env[variable], mode = 0o700, exist_ok = True)
+        env['TERM'] = 'xterm'
+        (self.pid, self.fd) = pty.fork()
+        if self.pid == 0:
+            fcntl.ioctl(1, termios.TIOCSWINSZ, struct.pack('hhhh', height, width, 0, 0))
+            os.execve(sys.executable, [sys.executable, os.path.abspath(__file__), '--child', str(torrents),
+                                       self.stats_path], env)
+        self.bytes = 0
+    
+    
+    def read(self, timeout):
+        '''
+        Read output
+        
+        @param   timeout:float  Seconds to wait for output
+        @return  :int           The number of bytes read, -1 at end of output
+        '''
+        (readable, _w, _x) = select.select([self.fd], [], [], max(timeout, 0))
+        if len(readable) == 0:
+            return 0
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError:
+            return -1
+        if len(data) == 0:
+            return -1
+        self.bytes += len(data)
+        return len(data)
+    
+    
+    def settle(self, quiet = QUIET, limit = 5.0):
+        '''
+        Read output until there is none for a while
+        
+        @param   quiet:float  Seconds without output to wait for
+        @param   limit:float  The maximum number of seconds to wait
+        @return  :float?      The time the last output was read, `None` if there was none
+        '''
+        last = None
+        deadline = time.perf_counter() + limit
+        while time.perf_counter() < deadline:
+            count = self.read(quiet)
+            if count <= 0:
+                break
+            last = time.perf_counter()
+        return last
+    
+    
+    def press(self, key):
+        '''
+        Send a key press and wait for it to be painted
+        
+        @param   key:str   The key, can be an escape sequence
+        @return  :float?   Seconds from the key press until its frame was written, `None` if
+                           nothing was painted
+        '''
+        self.settle(IDLE)
+        start = time.perf_counter()
+        os.write(self.fd, key.encode('utf-8'))
+        if self.read(PAINT_TIMEOUT) <= 0:
+            return None
+        first = time.perf_counter()
+        return (self.settle(QUIET) or first) - start
+    
+    
+    def close(self):
+        '''
+        Quit the interface and get its statistics
+        
+        @return  :dict?  The statistics written by the interface, `None` if it did not exit cleanly
+        '''
+        try:
+            os.write(self.fd, b'q')
+            while self.read(2.0) > 0:
+                pass
+        except OSError:
+            pass
+        (_pid, status) = os.waitpid(self.pid, 0)
+        os.close(self.fd)
+        try:
+            with open(self.stats_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+
+def percentile(values, fraction):
+    '''
+    @param   values:list<float>  The values
+    @param   fraction:float      The percentile, between 0 and 1
+    @return  :float              The value at the percentile, 0 if there are no values
+    '''
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def run_stream(keys, height, width, torrents):
+    '''
+    Measure one stream at one size
+    
+    The keys are first sent one at a time, each waiting for its frame,
+    to measure latency, and then in quick succession, to measure the
+    frame rate.
+    
+    @param   keys:list<str>             The keystrokes
+    @param   height:int                 The height of the terminal
+    @param   width:int                  The width of the terminal
+    @param   torrents:int               The number of torrents in the list
+    @return  :dict<str, float|int>      The metrics
+    '''
+    workdir = tempfile.mkdtemp(prefix = 'tirek-benchmark-')
+    try:
+        terminal = Terminal(height, width, torrents, workdir)
+        terminal.settle(0.3, limit = 10.0)
+        latencies = [latency for latency in map(terminal.press, keys) if latency is not None]
+        terminal.settle(IDLE)
+        burst_start = time.monotonic()
+        for key in keys:
+            os.write(terminal.fd, key.encode('utf-8'))
+            deadline = time.perf_counter() + KEY_INTERVAL
+            while terminal.read(deadline - time.perf_counter()) > 0:
+                pass
+        terminal.settle(IDLE)
+        stats = terminal.close()
+    finally:
+        shutil.rmtree(workdir)
+    if stats is None:
+        raise RuntimeError('the interface did not exit cleanly at %ix%i' % (width, height))
+    frames = max(stats['frames'], 1)
+    redraws = [duration for (_start, duration) in stats['redraws']]
+    # The frame rate is measured between the first and the last frame of the burst
+    burst = [start for (start, _duration) in stats['redraws'] if start >= burst_start]
+    burst_time = burst[-1] - burst[0] if len(burst) > 1 else 0
+    return { 'keys' : len(keys)
+           , 'frames' : stats['frames']
+           , 'painted_keys' : len(latencies)
+           , 'fps' : round((len(burst) - 1) / burst_time, 1) if burst_time > 0 else 0.0
+           , 'bytes_per_frame' : round(stats['bytes'] / frames, 1)
+           , 'latency_ms' : round(1000 * percentile(latencies, 0.5), 2)
+           , 'latency_ms_p95' : round(1000 * percentile(latencies, 0.95), 2)
+           , 'render_ms' : round(1000 * percentile(redraws, 0.5), 3)
+           , 'render_ms_p95' : round(1000 * percentile(redraws, 0.95), 3)
+           }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Find regressions against a baseline
+    
+    @param   results:dict<str, dict<str, float>>   The results of this run
+    @param   baseline:dict<str, dict<str, float>>  The results of the baseline
+    @param   tolerance:float                       The relative change that counts as a regression
+    @return  :list<str>                            Descriptions of the regressions
+    '''
+    regressions = []
+    for (name, metrics) in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if (metric not in metrics) or (metric not in old):
+                continue
+            (before, after) = (old[metric], metrics[metric])
+            if metric in LOWER_IS_BETTER:
+                worse = after > before * (1 + tolerance) + SLACK[metric]
+            else:
+                worse = after < before * (1 - tolerance) - SLACK[metric]
+            if worse:
+                regressions.append('%s: %s %s → %s' % (name, metric, before, after))
+    return regressions
+
+
+def record(path, name):
+    '''
+    Run the interface in this terminal and record the keys pressed into a stream
+    
+    @param  path:str  The JSON file with recorded streams, it is updated
+    @param  name:str  The name of the stream
+    '''
+    (height, width) = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))
+    workdir = tempfile.mkdtemp(prefix = 'tirek-benchmark-')
+    saved_stty = termios.tcgetattr(sys.stdin.fileno())
+    keys = []
+    try:
+        terminal = Terminal(height, width, TORRENTS, workdir)
+        stty = termios.tcgetattr(sys.stdin.fileno())
+        stty[3] &= ~(termios.ICANON | termios.ECHO | termios.ISIG)
+        termios.tcsetattr(sys.stdin.fileno(), termios.TCSAFLUSH, stty)
+        while True:
+            (readable, _w, _x) = select.select([sys.stdin.fileno(), terminal.fd], [], [])
+            if terminal.fd in readable:
+                try:
+                    data = os.read(terminal.fd, 1 << 16)
+                except OSError:
+                    break
+                if len(data) == 0:
+                    break
+                os.write(sys.stdout.fileno(), data)
+            if sys.stdin.fileno() in readable:
+                data = os.read(sys.stdin.fileno(), 4096)
+                if data == b'q':
+                    break
+                keys.append(data.decode('utf-8', 'replace'))
+                os.write(terminal.fd, data)
+        terminal.close()
+    finally:
+        termios.tcsetattr(sys.stdin.fileno(), termios.TCSAFLUSH, saved_stty)
+        shutil.rmtree(workdir)
+    streams = load_streams(path) if os.path.exists(path) else {}
+    streams[name] = keys
+    with open(path, 'w') as file:
+        json.dump(streams, file, indent = 1)
+    print('recorded %i keys into %s in %s' % (len(keys), name, path))
+
+
+def load_streams(path):
+    '''
+    Load recorded streams
+    
+    @param   path:str                 The JSON file with the streams
+    @return  :dict<str, list<str>>    The streams by name
+    '''
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark rendering and input handling of the interface')
+    parser.add_argument('--child', nargs = 2, help = argparse.SUPPRESS)
+    parser.add_argument('--streams', metavar = 'FILE', help = 'JSON file with additional recorded streams')
+    parser.add_argument('--only', metavar = 'NAME', action = 'append', help = 'only run this stream')
+    parser.add_argument('--sizes', metavar = 'HxW', nargs = '+', help = 'terminal sizes, e.g. 24x80')
+    parser.add_argument('--torrents', type = int, default = TORRENTS, help = 'number of torrents in the list')
+    parser.add_argument('--save', metavar = 'FILE', help = 'save the results as a baseline')
+    parser.add_argument('--compare', metavar = 'FILE', help = 'compare the results against a baseline')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE, help = 'relative change that is a regression')
+    parser.add_argument('--record', metavar = ('FILE', 'NAME'), nargs = 2, help = 'record a stream from this terminal')
+    args = parser.parse_args()
+    
+    if args.child is not None:
+        run_child(int(args.child[0]), args.child[1])
+        return
+    if args.record is not None:
+        record(*args.record)
+        return
+    
+    streams = dict(STREAMS)
+    if args.streams is not None:
+        streams.update(load_streams(args.streams))
+    if args.only:
+        streams = dict((name, streams[name]) for name in args.only)
+    sizes = SIZES
+    if args.sizes:
+        sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+    
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    results = {}
+    print('%-18s %6s %7s %9s %9s %10s %10s' % ('stream@HxW', 'frames', 'fps', 'B/frame', 'render ms',
+                                              'latency ms', 'p95 ms'))
+    for (name, keys) in sorted(streams.items()):
+        for (height, width) in sizes:
+            key = '%s@%ix%i' % (name, height, width)
+            metrics = results[key] = run_stream(keys, height, width, args.torrents)
+            print('%-18s %6i %7.1f %9.1f %9.3f %10.2f %10.2f' % ( key, metrics['frames'], metrics['fps']
+                                                                 , metrics['bytes_per_frame'], metrics['render_ms']
+                                                                 , metrics['latency_ms'], metrics['latency_ms_p95']
+                                                                 ))
+            sys.stdout.flush()
+    
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({ 'version' : BASELINE_VERSION
+                      , 'torrents' : args.torrents
+                      , 'results' : results
+                      }, file, indent = 1, sort_keys = True)
+        print('saved baseline to %s' % args.save)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('version') != BASELINE_VERSION:
+            print('%s: unsupported baseline version' % args.compare, file = sys.stderr)
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('regression: %s' % regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('no regressions against %s' % args.compare)
+
+
+if __name__ == '__main__':
+    main()
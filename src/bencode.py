@@ -0,0 +1,455 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import re
+import hashlib
+
+
+SMALL_STRING = 64
+'''
+:int  Strings up to this length are copied, as a memoryview would be larger than the copy
+'''
+
+STRING_LENGTH = re.compile(rb'(0|[1-9][0-9]*):')
+INTEGER = re.compile(rb'i(0|-?[1-9][0-9]*)e')
+'''
+:Pattern  The length prefix of a string and an integer, without leading zeros or negative zero;
+          they are matched in place, in any buffer
+'''
+
+MAX_DEPTH = 64
+'''
+:int  The deepest nesting of lists and dictionaries that is decoded, deeper data is
+      rejected rather than exhausting the stack; no torrent or KRPC message comes close
+'''
+
+LAZY_KEYS = frozenset([b'pieces', b'files'])
+'''
+:set<bytes>  Dictionary keys whose values are not decoded until they are used
+'''
+
+
+class BencodeError(Exception):
+    '''
+    Raised when data is not valid bencode
+    '''
+    pass
+
+
+class Lazy():
+    '''
+    A value that has not been decoded yet
+    '''
+    
+    __slots__ = ('raw', 'lazy_keys', 'decoded')
+    
+    def __init__(self, raw, lazy_keys):
+        '''
+        Constructor
+        
+        @param  raw:memoryview         The encoded value
+        @param  lazy_keys:set<bytes>  Keys that shall remain lazy inside the value
+        '''
+        self.raw = raw
+        self.lazy_keys = lazy_keys
+        self.decoded = None
+    
+    
+    def value(self):
+        '''
+        Decode the value, it is only decoded once
+        
+        @return  :¿V?  The decoded value
+        '''
+        if self.decoded is None:
+            self.decoded = decode(self.raw, self.lazy_keys)
+        return self.decoded
+
+
+class Decoder():
+    '''
+    Decoder that slices, rather than copies, long strings from the input
+    '''
+    
+    def __init__(self, data, lazy_keys = LAZY_KEYS):
+        '''
+        Constructor
+        
+        @param  data:bytes|bytearray|memoryview|mmap  The encoded data
+        @param  lazy_keys:set<bytes>                  Keys whose values are left as `Lazy`
+        '''
+        self.view = memoryview(data)
+        if self.view.format != 'B':
+            self.view = self.view.cast('B')
+        # Bytes are indexed and sliced directly, anything else through the view, without copying it
+        self.buf = data if isinstance(data, bytes) else self.view
+        self.lazy_keys = lazy_keys
+        self.spans = {}
+    
+    
+    def decode(self, pos = 0, record = (), depth = 0):
+        '''
+        Decode one value
+        
+        @param   pos:int              The position of the value
+        @param   record:itr<bytes>    Top-level dictionary keys whose values' spans shall be
+                                      stored in `self.spans` as `(start, end)`
+        @param   depth:int            The number of lists and dictionaries the value is in
+        @return  :(value:¿V?, end:int)  The value and the position after it
+        '''
+        (buf, view) = (self.buf, self.view)
+        if depth > MAX_DEPTH:
+            raise BencodeError('nested too deeply at %i' % pos)
+        try:
+            c = buf[pos]
+            if 48 <= c <= 57: # '0'–'9'
+                match = STRING_LENGTH.match(buf, pos)
+                if match is None:
+                    raise BencodeError('invalid string length at %i' % pos)
+                start = match.end()
+                end = start + int(match.group(1))
+                if end > len(buf):
+                    raise BencodeError('truncated string at %i' % pos)
+                if end - start < SMALL_STRING:
+                    return (bytes(buf[start : end]), end)
+                return (view[start : end], end)
+            if c == 105: # 'i'
+                match = INTEGER.match(buf, pos)
+                if match is None:
+                    raise BencodeError('invalid integer at %i' % pos)
+                return (int(match.group(1)), match.end())
+            if c == 108: # 'l'
+                (rc, pos) = ([], pos + 1)
+                while buf[pos] != 101: # 'e'
+                    (value, pos) = self.decode(pos, (), depth + 1)
+                    rc.append(value)
+                return (rc, pos + 1)
+            if c == 100: # 'd'
+                (rc, pos) = ({}, pos + 1)
+                while buf[pos] != 101: # 'e'
+                    (key, pos) = self.decode(pos, (), depth + 1)
+                    if isinstance(key, memoryview):
+                        key = key.tobytes()
+                    elif not isinstance(key, bytes):
+                        raise BencodeError('non-string dictionary key at %i' % pos)
+                    start = pos
+                    if key in self.lazy_keys:
+                        pos = self.skip(pos)
+                        rc[key] = Lazy(view[start : pos], self.lazy_keys)
+                    else:
+                        (rc[key], pos) = self.decode(pos, (), depth + 1)
+                    if key in record:
+                        self.spans[key] = (start, pos)
+                return (rc, pos + 1)
+        except (IndexError, ValueError):
+            pass
+        raise BencodeError('invalid value at %i' % pos)
+    
+    
+    def skip(self, pos):
+        '''
+        Find the end of a value without decoding it
+        
+        @param   pos:int  The position of the value
+        @return  :int     The position after the value
+        '''
+        (buf, depth) = (self.buf, 0)
+        try:
+            while True:
+                c = buf[pos]
+                if 48 <= c <= 57: # '0'–'9'
+                    match = STRING_LENGTH.match(buf, pos)
+                    pos = match.end() + int(match.group(1))
+                elif c == 105: # 'i'
+                    pos = INTEGER.match(buf, pos).end()
+                elif c == 101: # 'e'
+                    (depth, pos) = (depth - 1, pos + 1)
+                elif c in (100, 108): # 'd', 'l'
+                    (depth, pos) = (depth + 1, pos + 1)
+                else:
+                    break
+                if (depth <= 0) and (0 < pos <= len(buf)):
+                    if depth == 0:
+                        return pos
+                    break
+        except (IndexError, ValueError, AttributeError):
+            pass
+        raise BencodeError('invalid value at %i' % pos)
+
+
+def decode(data, lazy_keys = frozenset()):
+    '''
+    Decode bencoded data
+    
+    Strings longer than `SMALL_STRING` are returned as memoryviews into `data`,
+    shorter strings and dictionary keys as bytes
+    
+    @param   data:bytes|bytearray|memoryview|mmap  The encoded data
+    @param   lazy_keys:set<bytes>                  Keys whose values are left as `Lazy`
+    @return  :int|memoryview|list|dict             The decoded value
+    '''
+    decoder = Decoder(data, lazy_keys)
+    (value, end) = decoder.decode()
+    if end != len(decoder.view):
+        raise BencodeError('trailing data at %i' % end)
+    return value
+
+
+def encode(value):
+    '''
+    Bencode a value
+    
+    @param   value:int|bytes|bytearray|memoryview|str|list|tuple|dict|Lazy  The value
+    @return  :bytes                                                          The encoded value
+    '''
+    parts = []
+    encode_to(value, parts.append)
+    return b''.join(parts)
+
+
+def encode_to(value, write):
+    '''
+    Bencode a value piece by piece, strings are written without being copied
+    
+    @param  value:int|bytes|bytearray|memoryview|str|list|tuple|dict|Lazy  The value
+    @param  write:(bytes|memoryview)→void                                  Output function
+    '''
+    if isinstance(value, bool) or not isinstance(value, (int, bytes, bytearray, memoryview, str, list, tuple, dict, Lazy)):
+        raise BencodeError('cannot encode %s' % type(value).__name__)
+    if isinstance(value, int):
+        write(b'i%ie' % value)
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+        write(b'%i:' % len(value))
+        write(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        write(b'%i:' % value.nbytes if isinstance(value, memoryview) else b'%i:' % len(value))
+        write(value)
+    elif isinstance(value, Lazy):
+        write(value.raw)
+    elif isinstance(value, dict):
+        write(b'd')
+        items = [(k.encode('utf-8') if isinstance(k, str) else bytes(k), v) for (k, v) in value.items()]
+        for (key, item) in sorted(items, key = lambda kv : kv[0]):
+            write(b'%i:' % len(key))
+            write(key)
+            encode_to(item, write)
+        write(b'e')
+    else:
+        write(b'l')
+        for item in value:
+            encode_to(item, write)
+        write(b'e')
+
+
+class Metainfo():
+    '''
+    The contents of a torrent file
+    '''
+    
+    def __init__(self, data):
+        '''
+        Constructor
+        
+        @param  data:bytes|bytearray|memoryview|mmap  The contents of the torrent file,
+                                                      must remain valid while in use
+        '''
+        decoder = Decoder(data)
+        (self.root, end) = decoder.decode(0, (b'info',))
+        if not isinstance(self.root, dict) or (b'info' not in decoder.spans):
+            raise BencodeError('no info dictionary')
+        if end != len(decoder.view):
+            raise BencodeError('trailing data at %i' % end)
+        self.info = self.root[b'info']
+        (start, end) = decoder.spans[b'info']
+        self.info_raw = decoder.view[start : end]
+        self.info_hash = hashlib.sha1(self.info_raw).digest()
+    
+    
+    def check(self):
+        '''
+        Check that the info dictionary describes a payload that can be transferred,
+        `BencodeError` is raised if it does not
+        '''
+        try:
+            info = self.info
+            piece_length = info[b'piece length']
+            files = self.files()
+            lengths = [length for (_path, length) in files]
+            valid = isinstance(info[b'name'], (bytes, memoryview))
+            valid = valid and isinstance(piece_length, int) and (piece_length > 0)
+            valid = valid and all(isinstance(length, int) and (length >= 0) for length in lengths)
+            valid = valid and all(isinstance(part, bytes) for (path, _length) in files for part in path)
+            valid = valid and (len(self.pieces()) % 20 == 0)
+            valid = valid and (self.piece_count() == (sum(lengths) + piece_length - 1) // piece_length)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            valid = False
+        if not valid:
+            raise BencodeError('invalid info dictionary')
+    
+    
+    def piece_count(self):
+        '''
+        Get the number of pieces
+        
+        @return  :int  The number of pieces
+        '''
+        return len(self.pieces()) // 20
+    
+    
+    def pieces(self):
+        '''
+        Get the concatenated piece hashes, without copying them
+        
+        @return  :memoryview  The SHA-1 hash of each piece, 20 bytes each
+        '''
+        pieces = self.info[b'pieces']
+        return pieces.value() if isinstance(pieces, Lazy) else pieces
+    
+    
+    def piece_hash(self, index):
+        '''
+        Get the hash of a piece
+        
+        @param   index:int    The index of the piece
+        @return  :memoryview  The SHA-1 hash of the piece
+        '''
+        return self.pieces()[index * 20 : (index + 1) * 20]
+    
+    
+    def files(self):
+        '''
+        Get the files in the torrent, decoding the file list on first use
+        
+        @return  :list<(path:list<bytes>, length:int)>  The files, with the path relative to
+                                                        the torrent's name, empty for a
+                                                        single file torrent
+        '''
+        if b'files' not in self.info:
+            return [([], self.info[b'length'])]
+        files = self.info[b'files']
+        files = files.value() if isinstance(files, Lazy) else files
+        return [([p.tobytes() if isinstance(p, memoryview) else p for p in f[b'path']], f[b'length']) for f in files]
+    
+    
+    def web_seeds(self):
+        '''
+        Get the URLs of the torrent's web seeds, see BEP 19
+        
+        @return  :list<str>  The URLs
+        '''
+        urls = self.root.get(b'url-list', [])
+        urls = urls.value() if isinstance(urls, Lazy) else urls
+        if not isinstance(urls, list):
+            urls = [urls]
+        return [bytes(url).decode('utf-8', 'replace') for url in urls if len(url) > 0]
+    
+    
+    def trackers(self):
+        '''
+        Get the announce URLs of the torrent's trackers, the tiers of
+        `announce-list` in order if it is present, see BEP 12
+        
+        @return  :list<str>  The URLs
+        '''
+        tiers = self.root.get(b'announce-list')
+        if isinstance(tiers, list) and (len(tiers) > 0):
+            urls = [url for tier in tiers if isinstance(tier, list) for url in tier]
+        else:
+            urls = [self.root.get(b'announce', b'')]
+        urls = [bytes(url).decode('utf-8', 'replace') for url in urls if isinstance(url, (bytes, memoryview))]
+        return [url for url in urls if len(url) > 0]
+    
+    
+    def total_length(self):
+        '''
+        Get the combined size of all files
+        
+        @return  :int  The size of the torrent's payload
+        '''
+        return sum(length for (_path, length) in self.files())
+
+
+if __name__ == '__main__':
+    # Benchmark against a naive recursive decoder, with a synthetic torrent
+    import sys, time, tracemalloc
+    
+    def naive_decode(data, pos = 0):
+        c = data[pos : pos + 1]
+        if c == b'i':
+            end = data.index(b'e', pos)
+            return (int(data[pos + 1 : end]), end + 1)
+        if c == b'l' or c == b'd':
+            (items, pos) = ([], pos + 1)
+            while data[pos : pos + 1] != b'e':
+                (item, pos) = naive_decode(data, pos)
+                items.append(item)
+            return ((items if c == b'l' else dict(zip(items[::2], items[1::2]))), pos + 1)
+        colon = data.index(b':', pos)
+        end = colon + 1 + int(data[pos : colon])
+        return (data[colon + 1 : end], end)
+    
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    torrent = encode({ b'announce' : b'http://localhost/announce'
+                     , b'info'     : { b'name'         : b'benchmark'
+                                     , b'piece length' : 1 << 22
+                                     , b'pieces'       : bytes(20 * pieces)
+                                     , b'files'        : [ { b'length' : 1 << 20
+                                                           , b'path'   : [b'directory', b'file%i' % i]
+                                                           }
+                                                           for i in range(files)
+                                                         ]
+                                     }
+                     })
+    for (name, function) in (('naive', lambda : naive_decode(torrent)), ('lazy', lambda : Metainfo(torrent)),
+                             ('full', lambda : Metainfo(torrent).files())):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-6s %8.3f s  %10.1f MB peak  (%i bytes, %i files, %i pieces)' %
+              (name, elapsed, peak / (1 << 20), len(torrent), files, pieces))
+    
+    
+    # Malformed data, such as from a hostile peer or tracker, is only ever reported as a BencodeError
+    for data in (b'l' * 5000 + b'e' * 5000, b'd1:a' * 5000 + b'i0ee', b'i01e', b'5:abc', b'le1', b'd1:ai1e'):
+        try:
+            decode(data)
+        except BencodeError:
+            continue
+        raise AssertionError('%r… was accepted' % data[:16])
+    print('malformed data rejected')
+    
+    
+    # Info dictionaries that would break the payload are rejected before a torrent is added
+    valid = { b'name' : b'x', b'piece length' : 4, b'pieces' : bytes(40), b'length' : 6 }
+    Metainfo(encode({ b'info' : valid })).check()
+    for (key, value) in ( (b'piece length', 0), (b'pieces', bytes(30)), (b'length', -1), (b'length', b'6')
+                        , (b'length', 9), (b'name', 1 << 70), (b'files', [{ b'length' : 6, b'path' : [1 << 30] }])
+                        ):
+        try:
+            Metainfo(encode({ b'info' : dict(list(valid.items()) + [(key, value)]) })).check()
+        except BencodeError:
+            continue
+        raise AssertionError('%r = %r was accepted' % (key, value))
+    print('invalid info dictionaries rejected')
@@ -0,0 +1,311 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+import instrument
+
+
+BLOCK_SIZE = 16 << 10
+'''
+:int  The size of a block, the unit of transfer between peers
+'''
+
+
+HITS = instrument.counter('cache.hits', 'Blocks found in the block cache')
+MISSES = instrument.counter('cache.misses', 'Blocks not found in the block cache')
+EVICTIONS = instrument.counter('cache.evictions', 'Blocks evicted from the block cache to make room')
+FLUSHES = instrument.counter('cache.flushes', 'Pieces written out from the block cache')
+'''
+:Counter  Block cache lookups and writes, summed over all caches
+'''
+
+
+class BlockCache():
+    '''
+    Read and write-back cache of blocks, with 2Q eviction
+    
+    Blocks read for the first time enter a FIFO queue (A1in) and are
+    only promoted to the LRU queue (Am) if they are requested again
+    after being evicted from A1in, which is remembered in a queue of
+    keys only (A1out). A sequential recheck therefore only cycles
+    through A1in and does not flush the hot seeding set from Am.
+    
+    Written blocks are kept per piece and flushed once the piece is
+    complete, or when they expire or are needed to make room.
+    
+    Blocks are identified by `(torrent, piece, offset)`.
+    '''
+    
+    def __init__(self, size = 512, expiry = 60, flush = None, clock = time.monotonic):
+        '''
+        Constructor
+        
+        @param  size:int                                      The number of blocks to cache
+        @param  expiry:float                                  The number of seconds an unused block is kept
+        @param  flush:(torrent:¿K?, piece:int,
+                       blocks:list<(offset:int, data:bytes)>)→void?
+                                                              Function that writes blocks to disk, it is
+                                                              called without the cache locked
+        @param  clock:()→float                                Function that returns the current time
+        '''
+        self.size = size
+        self.expiry = expiry
+        self.flush = flush
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+        self.a1in_size = max(size // 4, 1)
+        self.a1out_size = max(size // 2, 1)
+        self.dirty = OrderedDict()
+        self.dirty_blocks = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+    
+    
+    def configure(self, p, changed = None):
+        '''
+        Apply the cache preferences
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>?       The names of the changed preferences
+        '''
+        flushes = []
+        self.lock.acquire()
+        try:
+            self.size = p.cache_size
+            self.expiry = p.cache_expiry
+            self.a1in_size = max(self.size // 4, 1)
+            self.a1out_size = max(self.size // 2, 1)
+            while len(self.a1out) > self.a1out_size:
+                self.a1out.popitem(last = False)
+            self.reclaim()
+            while (self.dirty_blocks > self.size) and (len(self.dirty) > 0):
+                flushes.append(self.take_dirty(next(iter(self.dirty))))
+        finally:
+            self.lock.release()
+        self.write_out(flushes)
+    
+    
+    def get(self, key):
+        '''
+        Look up a block
+        
+        @param   key:(torrent:¿K?, piece:int, offset:int)  The block
+        @return  :bytes?                                 The block, `None` on a miss
+        '''
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            entry = self.am.get(key)
+            if entry is not None:
+                entry[1] = now
+                self.am.move_to_end(key)
+            else:
+                entry = self.a1in.get(key)
+                if entry is None:
+                    blocks = self.dirty.get(key[:2])
+                    if (blocks is not None) and (key[2] in blocks[0]):
+                        self.hits += 1
+                        HITS.add()
+                        return blocks[0][key[2]]
+                    self.misses += 1
+                    MISSES.add()
+                    return None
+                # Keep the block from expiring, but not its place in the FIFO
+                entry[1] = now
+            self.hits += 1
+            HITS.add()
+            return entry[0]
+        finally:
+            self.lock.release()
+    
+    
+    def put(self, key, data):
+        '''
+        Add a block that has been read from disk
+        
+        @param  key:(torrent:¿K?, piece:int, offset:int)  The block
+        @param  data:bytes                              The contents of the block
+        '''
+        self.lock.acquire()
+        try:
+            self.insert(key, data)
+        finally:
+            self.lock.release()
+    
+    
+    def insert(self, key, data):
+        '''
+        Add a clean block, the cache must be locked
+        
+        @param  key:(torrent:¿K?, piece:int, offset:int)  The block
+        @param  data:bytes                              The contents of the block
+        '''
+        now = self.clock()
+        if key in self.am:
+            self.am[key] = [data, now]
+            self.am.move_to_end(key)
+        elif key in self.a1in:
+            self.a1in[key][0] = data
+        elif key in self.a1out:
+            # Requested again after leaving A1in, it is hot
+            del self.a1out[key]
+            self.am[key] = [data, now]
+        else:
+            self.a1in[key] = [data, now]
+        self.reclaim()
+    
+    
+    def reclaim(self):
+        '''
+        Evict clean blocks until the cache is within its size, the cache must be locked
+        '''
+        while len(self.a1in) + len(self.am) + self.dirty_blocks > self.size:
+            if (len(self.a1in) > self.a1in_size) or ((len(self.a1in) > 0) and (len(self.am) == 0)):
+                (key, _entry) = self.a1in.popitem(last = False)
+                self.a1out[key] = None
+                if len(self.a1out) > self.a1out_size:
+                    self.a1out.popitem(last = False)
+            elif len(self.am) > 0:
+                self.am.popitem(last = False)
+            else:
+                break
+            self.evictions += 1
+            EVICTIONS.add()
+    
+    
+    def write(self, torrent, piece, offset, data, block_count):
+        '''
+        Add a block that has been downloaded
+        
+        @param   torrent:¿K?      The torrent
+        @param   piece:int        The index of the piece
+        @param   offset:int       The offset of the block within the piece
+        @param   data:bytes       The contents of the block
+        @param   block_count:int  The number of blocks in the piece
+        @return  :bool            Whether the piece became complete and was flushed
+        '''
+        flushes = []
+        self.lock.acquire()
+        try:
+            key = (torrent, piece)
+            blocks = self.dirty.get(key)
+            if blocks is None:
+                blocks = self.dirty[key] = [{}, self.clock()]
+            if offset not in blocks[0]:
+                self.dirty_blocks += 1
+            blocks[0][offset] = data
+            complete = len(blocks[0]) >= block_count
+            if complete:
+                flushes.append(self.take_dirty(key))
+            self.reclaim()
+            # Make room by flushing the oldest partial pieces if only dirty blocks remain
+            while (self.dirty_blocks > self.size) and (len(self.dirty) > 0):
+                flushes.append(self.take_dirty(next(iter(self.dirty))))
+        finally:
+            self.lock.release()
+        self.write_out(flushes)
+        return complete
+    
+    
+    def take_dirty(self, key):
+        '''
+        Remove the written blocks of a piece and keep them for reading, the cache must be locked
+        
+        @param   key:(torrent:¿K?, piece:int)                                      The piece
+        @return  :(torrent:¿K?, piece:int, blocks:list<(offset:int, data:bytes)>)  The blocks to flush
+        '''
+        (blocks, _time) = self.dirty.pop(key)
+        self.dirty_blocks -= len(blocks)
+        blocks = sorted(blocks.items())
+        for (offset, data) in blocks:
+            self.insert(key + (offset,), data)
+        self.flushes += 1
+        FLUSHES.add()
+        return key + (blocks,)
+    
+    
+    def write_out(self, flushes):
+        '''
+        Pass pieces to the flush function, the cache must not be locked
+        
+        @param  flushes:list<(torrent:¿K?, piece:int, blocks:list<(offset:int, data:bytes)>)>  The pieces
+        '''
+        if self.flush is not None:
+            for (torrent, piece, blocks) in flushes:
+                self.flush(torrent, piece, blocks)
+    
+    
+    def expire(self):
+        '''
+        Drop blocks that have not been used within the expiry time,
+        and flush written pieces that have not been completed in time;
+        call this periodically
+        '''
+        flushes = []
+        self.lock.acquire()
+        try:
+            deadline = self.clock() - self.expiry
+            # Am is ordered by time, oldest first, but hits in A1in do not reorder it
+            while (len(self.am) > 0) and (next(iter(self.am.values()))[1] <= deadline):
+                self.am.popitem(last = False)
+                self.expirations += 1
+            for key in [key for (key, entry) in self.a1in.items() if entry[1] <= deadline]:
+                del self.a1in[key]
+                self.expirations += 1
+            while (len(self.dirty) > 0) and (next(iter(self.dirty.values()))[1] <= deadline):
+                flushes.append(self.take_dirty(next(iter(self.dirty))))
+        finally:
+            self.lock.release()
+        self.write_out(flushes)
+    
+    
+    def drop(self, torrent):
+        '''
+        Forget all blocks of a torrent, written blocks are not flushed
+        
+        @param  torrent:¿K?  The torrent
+        '''
+        self.lock.acquire()
+        try:
+            for queue in (self.a1in, self.a1out, self.am):
+                for key in [key for key in queue if key[0] == torrent]:
+                    del queue[key]
+            for key in [key for key in self.dirty if key[0] == torrent]:
+                self.dirty_blocks -= len(self.dirty.pop(key)[0])
+        finally:
+            self.lock.release()
+    
+    
+    def hit_ratio(self):
+        '''
+        Get the ratio of lookups that were hits
+        
+        @return  :float  The hit ratio, between 0 and 1
+        '''
+        return self.hits / max(self.hits + self.misses, 1)
+
@@ -0,0 +1,569 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import heapq
+import socket
+from collections import deque
+
+import instrument
+
+
+SOURCE_LSD, SOURCE_TRACKER, SOURCE_DHT, SOURCE_PEX = 1, 2, 4, 8
+'''
+:int  Where a candidate was learned from, in order of preference
+'''
+
+MAX_CANDIDATES = 4000
+'''
+:int  The maximum number of candidates kept per torrent, more are ignored
+'''
+
+RETRY_BASE = 30
+MAX_FAILURES = 5
+'''
+:float  Delay after a failed attempt, doubled for each consecutive failure;
+        after the maximum number of failures a candidate is given up
+'''
+
+RECONNECT_DELAY = 60
+'''
+:float  Delay before a peer that we have been connected to is tried again
+'''
+
+DEAD_CAPACITY = 100000
+DEAD_BITS = 1 << 20
+DEAD_HASHES = 4
+'''
+:int  The Bloom filter of given up addresses: the number of addresses it holds
+      before it is cleared, its size in bits, and the number of bits per address;
+      about one percent of other addresses are rejected by mistake when it is full
+'''
+
+ADDED = instrument.counter('candidates.added', 'Peer candidates added')
+DUPLICATES = instrument.counter('candidates.duplicates', 'Peer candidates that were already known')
+ATTEMPTS = instrument.counter('candidates.attempts', 'Connection attempts released by the dispatcher')
+'''
+:Counter  New and duplicate candidates, and connection attempts
+'''
+
+
+def pack_candidate(address):
+    '''
+    Pack an address into a compact key
+    
+    @param   address:(host:str, port:int)  The address
+    @return  :bytes?                       6 bytes for IPv4, 18 bytes for IPv6, `None` if the address is invalid
+    '''
+    (host, port) = address
+    try:
+        # Host names are not accepted, connecting to them would block while they are resolved
+        return socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host) + port.to_bytes(2, 'big')
+    except (OSError, OverflowError, AttributeError, TypeError):
+        return None
+
+
+def unpack_candidate(key):
+    '''
+    Unpack a compact key
+    
+    @param   key:bytes               The key
+    @return  :(host:str, port:int)   The address
+    '''
+    family = socket.AF_INET if len(key) == 6 else socket.AF_INET6
+    return (socket.inet_ntop(family, key[:-2]), int.from_bytes(key[-2:], 'big'))
+
+
+class BloomFilter():
+    '''
+    Set of byte strings that may report false positives, in constant memory
+    
+    The filter is cleared once it holds its capacity, so the rate of
+    false positives stays bounded and old entries eventually expire.
+    '''
+    
+    def __init__(self, capacity = DEAD_CAPACITY, bits = DEAD_BITS, hashes = DEAD_HASHES):
+        '''
+        Constructor
+        
+        @param  capacity:int  The number of entries before the filter is cleared
+        @param  bits:int      The size of the filter, a power of two
+        @param  hashes:int    The number of bits set per entry
+        '''
+        self.capacity = capacity
+        self.mask = bits - 1
+        self.hashes = hashes
+        self.bits = bytearray(bits // 8)
+        self.count = 0
+    
+    
+    def positions(self, key):
+        '''
+        Get the bits of an entry, by double hashing
+        
+        @param   key:bytes      The entry
+        @return  :itr<int>      The bit positions
+        '''
+        h = hash(key)
+        (h1, h2) = (h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1)
+        return ((h1 + i * h2) & self.mask for i in range(self.hashes))
+    
+    
+    def add(self, key):
+        '''
+        Add an entry
+        
+        @param  key:bytes  The entry
+        '''
+        if self.count >= self.capacity:
+            self.bits[:] = bytes(len(self.bits))
+            self.count = 0
+        for bit in self.positions(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+    
+    
+    def __contains__(self, key):
+        '''
+        Check whether an entry may have been added
+        
+        @param   key:bytes  The entry
+        @return  :bool      `False` if it has not been added, `True` if it probably has
+        '''
+        bits = self.bits
+        return all(bits[bit >> 3] & (1 << (bit & 7)) for bit in self.positions(key))
+
+
+class Candidate():
+    '''
+    A peer that may be connected to
+    '''
+    
+    __slots__ = ('key', 'sources', 'successes', 'failures', 'busy')
+    
+    def __init__(self, key, sources):
+        '''
+        Constructor
+        
+        @param  key:bytes     The packed address
+        @param  sources:int   Where the peer was learned from, `SOURCE_*` or:ed together
+        '''
+        self.key = key
+        self.sources = sources
+        self.successes = 0
+        self.failures = 0
+        self.busy = False
+    
+    
+    def rank(self):
+        '''
+        Get the order in which ready candidates are tried
+        
+        @return  :int  The rank, lower is tried first
+        '''
+        # Failures weigh most, then past connections, then the most preferred source
+        best = (self.sources & -self.sources).bit_length() - 1
+        return (self.failures << 4) - (min(self.successes, 3) << 2) + best
+
+
+class CandidatePool():
+    '''
+    The peer candidates of one torrent
+    
+    Candidates are kept in a dictionary by packed address, so the
+    same peer learned again from any source costs one lookup. Those
+    that may be tried now are in a heap by rank, and those backing
+    off after a failure or a recent connection are in a heap by the
+    time they may be tried again.
+    '''
+    
+    def __init__(self, info_hash):
+        '''
+        Constructor
+        
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        self.info_hash = info_hash
+        self.candidates = {}
+        self.ready = []
+        self.waiting = []
+        self.sequence = 0
+    
+    
+    def push(self, candidate, due):
+        '''
+        Queue a candidate for trying
+        
+        @param  candidate:Candidate  The candidate
+        @param  due:float?           When it may be tried, `None` for now
+        '''
+        self.sequence += 1
+        if due is None:
+            heapq.heappush(self.ready, (candidate.rank(), self.sequence, candidate))
+        else:
+            heapq.heappush(self.waiting, (due, self.sequence, candidate))
+    
+    
+    def add(self, key, source, dead):
+        '''
+        Add a candidate, or note another source of a known one
+        
+        @param   key:bytes            The packed address
+        @param   source:int           Where the peer was learned from, `SOURCE_*`
+        @param   dead:BloomFilter     Given up addresses, which are not added again
+        @return  :bool                Whether the candidate is new
+        '''
+        candidate = self.candidates.get(key)
+        if candidate is not None:
+            candidate.sources |= source
+            return False
+        # Most candidates are duplicates, so the filter is only checked for new ones
+        if (len(self.candidates) >= MAX_CANDIDATES) or (key in dead):
+            return False
+        candidate = self.candidates[key] = Candidate(key, source)
+        self.push(candidate, None)
+        return True
+    
+    
+    def next(self, now):
+        '''
+        Take the best candidate that may be tried now
+        
+        @param   now:float     The current monotonic time
+        @return  :Candidate?   The candidate, marked busy, `None` if none may be tried now
+        '''
+        while (len(self.waiting) > 0) and (self.waiting[0][0] <= now):
+            candidate = heapq.heappop(self.waiting)[2]
+            self.push(candidate, None)
+        if len(self.ready) == 0:
+            return None
+        candidate = heapq.heappop(self.ready)[2]
+        candidate.busy = True
+        return candidate
+    
+    
+    def due(self):
+        '''
+        @return  :float?  When the next backing off candidate may be tried, `None` if there is none
+        '''
+        return self.waiting[0][0] if len(self.waiting) > 0 else None
+    
+    
+    def finished(self, candidate, connected, now):
+        '''
+        Record the outcome of a connection
+        
+        @param   candidate:Candidate  The candidate
+        @param   connected:bool       Whether the connection was established
+        @param   now:float            The current monotonic time
+        @return  :bool                Whether the candidate has been given up
+        '''
+        candidate.busy = False
+        if connected:
+            candidate.successes += 1
+            candidate.failures = 0
+            self.push(candidate, now + RECONNECT_DELAY)
+            return False
+        candidate.failures += 1
+        if candidate.failures >= MAX_FAILURES:
+            del self.candidates[candidate.key]
+            return True
+        self.push(candidate, now + RETRY_BASE * 2 ** (candidate.failures - 1))
+        return False
+
+
+class Dispatcher():
+    '''
+    Merges peer candidates from all sources and releases connection
+    attempts to the peer engine
+    
+    Attempts are paced by a virtual schedule: each is due one interval
+    of the engine's connection rate after the previous one, so they
+    are spread evenly rather than let out in bursts. The half-open limit is checked for each attempt,
+    and torrents take turns. Given up addresses are remembered in a
+    Bloom filter so floods of dead peers cost no memory.
+    '''
+    
+    def __init__(self, loop, engine, clock = time.monotonic):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop       The event loop to run in
+        @param  engine:PeerEngine    The engine to connect with, its rate and half-open limits apply
+        @param  clock:()→float       Function that returns the current time
+        '''
+        self.loop = loop
+        self.engine = engine
+        self.clock = clock
+        self.pools = {}
+        self.turns = deque()
+        self.dead = BloomFilter()
+        self.sources = SOURCE_LSD | SOURCE_TRACKER | SOURCE_DHT | SOURCE_PEX
+        self.schedule = 0.0
+        self.timer = None
+        self.timer_due = None
+        self.pending = False
+        self.attempts = 0
+    
+    
+    def configure(self, p, changed = None):
+        '''
+        Apply the Network preferences, candidates from disabled sources are ignored
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>?       The names of the changed preferences
+        '''
+        self.sources = ( SOURCE_TRACKER
+                       | (SOURCE_LSD if p.lsd else 0)
+                       | (SOURCE_DHT if p.dht else 0)
+                       | (SOURCE_PEX if p.pex else 0)
+                       )
+    
+    
+    def add_torrent(self, info_hash):
+        '''
+        Start collecting candidates for a torrent
+        
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        if info_hash not in self.pools:
+            pool = self.pools[info_hash] = CandidatePool(info_hash)
+            self.turns.append(pool)
+    
+    
+    def remove_torrent(self, info_hash):
+        '''
+        Forget a torrent's candidates
+        
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        pool = self.pools.pop(info_hash, None)
+        if pool is not None:
+            self.turns.remove(pool)
+    
+    
+    def add(self, info_hash, peers, source):
+        '''
+        Add candidates for a torrent
+        
+        @param  info_hash:bytes                   The torrent's infohash
+        @param  peers:list<(host:str, port:int)>  The peers
+        @param  source:int                        Where the peers were learned from, `SOURCE_*`
+        '''
+        pool = self.pools.get(info_hash)
+        if (pool is None) or not (source & self.sources):
+            return
+        (added, dead) = (0, self.dead)
+        for address in peers:
+            key = pack_candidate(address)
+            if (key is not None) and pool.add(key, source, dead):
+                added += 1
+        ADDED.add(added)
+        DUPLICATES.add(len(peers) - added)
+        if added > 0:
+            self.pump_soon()
+    
+    
+    def connection_closed(self, info_hash, address, connected):
+        '''
+        Called by the peer engine when a connection has closed or an attempt has failed
+        
+        @param  info_hash:bytes               The torrent's infohash
+        @param  address:(host:str, port:int)  The peer's address
+        @param  connected:bool                Whether the connection was established
+        '''
+        pool = self.pools.get(info_hash)
+        key = pack_candidate(address)
+        candidate = None if (pool is None) or (key is None) else pool.candidates.get(key)
+        if (candidate is not None) and candidate.busy:
+            if pool.finished(candidate, connected, self.clock()):
+                self.dead.add(key)
+        # A half-open or connection slot may have become free
+        self.pump_soon()
+    
+    
+    def pump_soon(self):
+        '''
+        Release attempts once the current event has been handled, so
+        that a batch of candidates or closed connections is handled at once
+        '''
+        if not self.pending:
+            self.pending = True
+            self.loop.call_soon(self.pump)
+    
+    
+    def pump(self):
+        '''
+        Release the connection attempts that are due
+        '''
+        self.pending = False
+        engine = self.engine
+        now = self.clock()
+        rate = engine.attempts.rate
+        interval = 1 / rate if rate else 0.0
+        if self.schedule < now - interval:
+            # Idle time is not saved up; a timer that fires late still keeps to the schedule
+            self.schedule = now
+        (waiting, skipped) = (None, [])
+        while len(self.turns) > 0:
+            if self.schedule > now:
+                waiting = self.schedule
+                break
+            if engine.attempts.available(now) < 1:
+                # The engine has made attempts of its own, such as plaintext retries
+                waiting = now + engine.attempts.delay(1, now)
+                break
+            if engine.half_open >= engine.max_half_open:
+                # `connection_closed` continues when a slot is free
+                break
+            pool = self.turns.popleft()
+            candidate = pool.next(now) if engine.can_connect(pool.info_hash) else None
+            if candidate is None:
+                skipped.append(pool)
+                due = pool.due()
+                if (due is not None) and ((waiting is None) or (due < waiting)):
+                    waiting = due
+                continue
+            self.turns.append(pool)
+            self.schedule += interval
+            self.attempts += 1
+            ATTEMPTS.add()
+            if not engine.connect(pool.info_hash, unpack_candidate(candidate.key)):
+                if pool.finished(candidate, False, now):
+                    self.dead.add(candidate.key)
+        self.turns.extend(skipped)
+        self.set_timer(waiting)
+    
+    
+    def set_timer(self, due):
+        '''
+        Schedule the next release of attempts
+        
+        @param  due:float?  When to release attempts, `None` to wait for candidates or free slots
+        '''
+        if (self.timer is not None) and (self.timer_due != due):
+            self.timer.cancel()
+            self.timer = None
+        if (due is not None) and (self.timer is None):
+            (self.timer, self.timer_due) = (self.loop.call_later(max(due - self.clock(), 0), self.timer_fired), due)
+    
+    
+    def timer_fired(self):
+        '''
+        Release attempts when the timer is due
+        '''
+        self.timer = None
+        self.pump()
+    
+    
+    def close(self):
+        '''
+        Stop releasing attempts
+        '''
+        self.set_timer(None)
+        self.pools.clear()
+        self.turns.clear()
+
+
+if __name__ == '__main__':
+    # Benchmark: a flood of duplicate candidates from several sources, and the pacing of
+    # attempts against a stand-in engine whose connections succeed or fail at random
+    import sys, random, tracemalloc
+    from eventloop import EventLoop
+    from ratelimit import TokenBucket
+    
+    torrents = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    rate, half_open = 20, 50
+    swarm = [('10.%i.%i.%i' % (i >> 16, (i >> 8) & 255, i & 255), 6881 + i % 7) for i in range(3000)]
+    batches = [(bytes([t]) * 20, random.sample(swarm, 200), 1 << random.randrange(4))
+               for t in range(torrents) for _ in range(250)]
+    
+    class Engine():
+        def __init__(self, loop):
+            self.loop = loop
+            self.attempts = TokenBucket(rate, burst = rate)
+            self.max_half_open = half_open
+            self.half_open = self.peak = 0
+            self.closed_callback = None
+            self.dialled = []
+        def can_connect(self, info_hash):
+            return self.half_open < self.max_half_open
+        def connect(self, info_hash, address):
+            if self.attempts.consume(1, time.monotonic(), partial = False) == 0:
+                return False
+            self.half_open += 1
+            self.peak = max(self.peak, self.half_open)
+            self.dialled.append((time.monotonic(), info_hash, address))
+            self.loop.call_later(random.uniform(0.1, 4), self.done, info_hash, address, random.random() < 0.3)
+            return True
+        def done(self, info_hash, address, connected):
+            self.half_open -= 1
+            self.closed_callback(info_hash, address, connected)
+    
+    loop = EventLoop()
+    for measure in (False, True):
+        engine = Engine(loop)
+        dispatcher = Dispatcher(loop, engine)
+        engine.closed_callback = dispatcher.connection_closed
+        for t in range(torrents):
+            dispatcher.add_torrent(bytes([t]) * 20)
+        if measure:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for (info_hash, peers, source) in batches:
+            dispatcher.add(info_hash, peers, source)
+        elapsed = time.perf_counter() - start
+        if measure:
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        else:
+            add_time = elapsed
+    offered = sum(len(peers) for (_info_hash, peers, _source) in batches)
+    kept = sum(len(pool.candidates) for pool in dispatcher.pools.values())
+    print('%i candidates offered, %i kept: %.0f ns per candidate, %.0f bytes per kept candidate' %
+          (offered, kept, add_time / offered * 1e9, memory / kept))
+    
+    loop.call_later(seconds, loop.stop)
+    start = time.monotonic()
+    loop.run()
+    times = [when - start for (when, _info_hash, _address) in engine.dialled]
+    gaps = [b - a for (a, b) in zip(times, times[1:])]
+    unique = len(set((info_hash, address) for (_when, info_hash, address) in engine.dialled))
+    print('%i attempts in %.1f s (%.2f per second, configured %i), gaps %.1f..%.1f ms, peak half-open %i of %i' %
+          (len(times), seconds, len(times) / seconds, rate, min(gaps) * 1e3, max(gaps) * 1e3, engine.peak, half_open))
+    print('%i distinct peers dialled, %i dialled again after backing off' % (unique, len(times) - unique))
+    
+    # Connecting to announced peers as they arrive, until the limits refuse, with the same
+    # announces spread over the same time
+    engine = Engine(loop)
+    engine.closed_callback = lambda info_hash, address, connected : None
+    def announced(info_hash, peers):
+        for address in peers:
+            if (not engine.can_connect(info_hash)) or not engine.connect(info_hash, address):
+                break
+    for (i, (info_hash, peers, source)) in enumerate(batches):
+        loop.call_later(seconds * i / len(batches), announced, info_hash, peers)
+    loop.call_later(seconds, loop.stop)
+    loop.run()
+    times = [when for (when, _info_hash, _address) in engine.dialled]
+    per_tick = max(sum(1 for t in times if abs(t - u) < 0.005) for u in times)
+    unique = len(set((info_hash, address) for (_when, info_hash, address) in engine.dialled))
+    print('without the pool: %i attempts, up to %i at once, %i dialled again while connecting or just after failing, '
+          '%i candidates dropped' % (len(times), per_tick, len(times) - unique, offered - len(times)))
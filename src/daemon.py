@@ -0,0 +1,842 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import errno
+import signal
+import socket
+import struct
+import time
+from collections import deque
+
+import instrument
+from eventloop import EventLoop
+from stats import Statistics
+from torrents import Torrent, TorrentList, SORT_COLUMNS
+from peers import PeerTable, PeerView
+from geoip import GeoIP
+from peerwire import PeerEngine
+from preferences import Preferences
+from resume import ResumeStore
+from diskio import DiskIO
+from cache import BlockCache
+from bencode import Metainfo, BencodeError, decode, encode
+from payload import Payload
+from torrentqueue import QueueScheduler, STATE_PAUSED
+from trackers import TrackerPool, TrackerView
+from proxy import Connector, proxy_for
+from candidates import Dispatcher, SOURCE_TRACKER, SOURCE_DHT
+from dht import DHT, parse_address, stored_node_id
+from preferences import config_home
+from remote import socket_path, private_directory, pack, encode_rows, MessageReader
+from remote import MSG_VIEW, MSG_MOVE, MSG_SORT, MSG_FILTER, MSG_ADD, MSG_STATS, MSG_PROGRESS, VIEW_TORRENTS, VIEW_PEERS
+from remote import VIEW_TRACKERS
+from remote import VIEW, MOVE, ADD, STATS, PROGRESS
+
+_ = lambda x : x
+
+
+MAX_FPS = 30
+'''
+:int  The maximum number of updates per second sent to each client
+'''
+
+MAX_BACKLOG = 1 << 22
+'''
+:int  The number of unsent bytes after which a client that does not read is disconnected
+'''
+
+DHT_ROUTERS = (('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881))
+'''
+:tuple<(host:str, port:int)>  Well-known nodes to join the distributed hash table through
+'''
+
+DHT_INTERVAL = 15 * 60
+'''
+:float  The number of seconds between announces of a torrent in the distributed hash table
+'''
+
+DHT_SPACING = 2
+'''
+:float  The number of seconds between two announces in the distributed hash table
+'''
+
+CACHE_INTERVAL = 5
+'''
+:float  The number of seconds between two sweeps for expired blocks in the block cache
+'''
+
+
+class Session():
+    '''
+    The state of a running tirek, independent of any terminal
+    '''
+    
+    def __init__(self, loop):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop  The event loop to run in
+        '''
+        self.loop = loop
+        self.statistics = Statistics()
+        self.geoip = GeoIP()
+        self.peer_table = PeerTable(self.geoip)
+        self.preferences = Preferences()
+        self.resume = ResumeStore()
+        self.disk = DiskIO(loop)
+        self.cache = BlockCache(flush = lambda payload, piece, blocks : payload.flush(piece, blocks))
+        self.cache_timer = None
+        self.torrents = {}
+        self.payloads = {}
+        self.recheck = None
+        self.next_number = 0
+        self.views = []
+        self.listeners = []
+        self.engine = None
+        self.dispatcher = None
+        self.trackers = None
+        self.connectors = {}
+        self.listening = 0
+        self.dht = None
+        self.dht_path = os.path.join(config_home('XDG_CACHE_HOME', '.cache'), 'dht')
+        self.dht_queue = deque()
+        self.dht_timer = None
+        self.torrents_path = os.path.join(config_home('XDG_DATA_HOME', os.path.join('.local', 'share')), 'torrents')
+        self.queue = QueueScheduler(self.preferences.current, self.changed, self.finished)
+    
+    
+    def start(self):
+        '''
+        Load the preferences and fast-resume state, and start the peer engine and trackers
+        '''
+        self.preferences.load()
+        self.preferences.watch(self.loop)
+        self.preferences.subscribe('bandwidth', self.configure_bandwidth)
+        self.preferences.subscribe('encryption', self.configure_encryption)
+        self.preferences.subscribe('proxy', self.configure_proxy)
+        self.preferences.subscribe('network', self.configure_network)
+        self.preferences.subscribe('queue', self.queue.configure)
+        self.preferences.subscribe('geoip', self.geoip.configure)
+        self.preferences.subscribe('downloads', self.disk.configure)
+        self.preferences.subscribe('cache', self.cache.configure)
+        self.disk.configure(self.preferences.current)
+        self.cache.configure(self.preferences.current)
+        def expire():
+            self.cache.expire()
+            self.cache_timer = self.loop.call_later(CACHE_INTERVAL, expire)
+        self.cache_timer = self.loop.call_later(CACHE_INTERVAL, expire)
+        self.geoip.configure(self.preferences.current)
+        self.queue.configure(self.preferences.current)
+        self.queue.start(self.loop)
+        self.resume.open()
+        self.resume.start(self.loop)
+        p = self.preferences.current
+        # HTTP requests to web seeds and trackers can share kept-alive connections to an HTTP proxy
+        for (use, forward) in (('peer', False), ('web_seed', True), ('tracker', True)):
+            self.connectors[use] = Connector(self.loop, proxy_for(p, use), forward)
+        peer_id = b'-TK0001-' + os.urandom(12)
+        self.engine = PeerEngine(self.loop, peer_id, p.max_connections, p.upload_slots, p.download_rate,
+                                 p.upload_rate, p.max_half_open, p.connect_rate, p.ignore_local,
+                                 p.rate_limit_overhead, self.statistics, self.peer_table, p.encryption_inbound,
+                                 p.encryption_outbound, p.encryption_level, p.encrypt_entire_stream,
+                                 self.connectors['peer'])
+        self.dispatcher = Dispatcher(self.loop, self.engine)
+        self.dispatcher.configure(p)
+        self.engine.closed_callback = self.dispatcher.connection_closed
+        for info_hash in self.torrents:
+            self.dispatcher.add_torrent(info_hash)
+        for payload in self.payloads.values():
+            self.start_payload(payload)
+        (first, last) = p.incoming_ports or (0, 0)
+        listening = 0
+        for port in range(first, last + 1):
+            try:
+                listening = self.engine.listen(p.interface or '0.0.0.0', port)
+                break
+            except OSError as e:
+                if port == last:
+                    print(_('Cannot listen for peers: %s') % e, file = sys.stderr)
+        self.listening = listening
+        self.trackers = TrackerPool(self.loop, peer_id, listening, self.progress, self.peers_found,
+                                    connector = self.connectors['tracker'])
+        if p.dht:
+            self.start_dht(p)
+        self.statistics.start(self.loop)
+        self.load_torrents()
+    
+    
+    def configure_bandwidth(self, p, changed):
+        '''
+        Apply changed bandwidth preferences to the peer engine
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>        The names of the changed preferences
+        '''
+        engine = self.engine
+        engine.max_connections = p.max_connections
+        engine.upload_slots = p.upload_slots
+        engine.max_half_open = p.max_half_open
+        engine.ignore_local = p.ignore_local
+        engine.rate_limit_overhead = p.rate_limit_overhead
+        if 'download_rate' in changed:
+            engine.down.set_rate(p.download_rate)
+        if 'upload_rate' in changed:
+            engine.up.set_rate(p.upload_rate)
+        if 'connect_rate' in changed:
+            engine.attempts.set_rate(p.connect_rate, burst = max(p.connect_rate, 1))
+        self.dispatcher.pump_soon()
+    
+    
+    def configure_network(self, p, changed):
+        '''
+        Apply changed network preferences
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>        The names of the changed preferences
+        '''
+        self.dispatcher.configure(p, changed)
+        if ('dht' in changed) or (('interface' in changed) and (self.dht is not None)):
+            self.stop_dht()
+            if p.dht:
+                self.start_dht(p)
+    
+    
+    def start_dht(self, p):
+        '''
+        Join the distributed hash table on the port we accept peers on,
+        through the nodes saved last time and the well-known routers
+        
+        @param  p:preferences.Snapshot  The preferences
+        '''
+        try:
+            self.dht = DHT(self.loop, stored_node_id(self.dht_path), p.interface or '0.0.0.0', self.listening)
+        except OSError as e:
+            print(_('Cannot join the distributed hash table: %s') % e, file = sys.stderr)
+            return
+        table = self.dht.table
+        table.load(self.dht_path)
+        self.statistics.gauges['dht_nodes'] = lambda : table.node_count
+        routers = []
+        for (host, port) in DHT_ROUTERS:
+            try:
+                routers.append(socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4])
+            except (OSError, UnicodeError):
+                pass
+        # Torrents are announced one at a time, rather than all at once, from the least recently
+        # announced, once the routing table no longer holds only the possibly stale saved nodes
+        self.dht_queue = deque((0.0, info_hash) for info_hash in self.torrents)
+        self.dht.bootstrap(routers, lambda nodes, peers : self.dht_announce())
+    
+    
+    def stop_dht(self):
+        '''
+        Leave the distributed hash table, and save the routing table
+        '''
+        if self.dht is None:
+            return
+        if self.dht_timer is not None:
+            self.dht_timer.cancel()
+            self.dht_timer = None
+        try:
+            os.makedirs(os.path.dirname(self.dht_path), exist_ok = True)
+            self.dht.table.save(self.dht_path)
+        except OSError:
+            pass
+        self.dht.close()
+        self.dht = None
+        self.statistics.gauges['dht_nodes'] = lambda : 0
+    
+    
+    def dht_announce(self):
+        '''
+        Announce the next torrent that is due in the distributed hash table,
+        and add the peers found to its candidates
+        '''
+        self.dht_timer = self.loop.call_later(DHT_SPACING, self.dht_announce)
+        now = time.monotonic()
+        while (len(self.dht_queue) > 0) and (self.dht_queue[0][0] <= now):
+            (_due, info_hash) = self.dht_queue.popleft()
+            if info_hash not in self.torrents:
+                continue
+            self.dht_queue.append((now + DHT_INTERVAL, info_hash))
+            def found(peers, info_hash = info_hash):
+                if self.dispatcher is not None:
+                    self.dispatcher.add(info_hash, [parse_address(peer) for peer in peers], SOURCE_DHT)
+            self.dht.announce(info_hash, self.listening, found)
+            break
+    
+    
+    def configure_encryption(self, p, changed):
+        '''
+        Apply changed encryption preferences to the peer engine, they
+        take effect for new connections
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>        The names of the changed preferences
+        '''
+        engine = self.engine
+        engine.encryption_inbound = p.encryption_inbound
+        engine.encryption_outbound = p.encryption_outbound
+        engine.encryption_level = p.encryption_level
+        engine.prefer_rc4 = p.encrypt_entire_stream
+    
+    
+    def configure_proxy(self, p, changed):
+        '''
+        Apply changed proxy preferences, they take effect for new connections
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>        The names of the changed preferences
+        '''
+        for (use, connector) in self.connectors.items():
+            connector.set_proxy(proxy_for(p, use))
+    
+    
+    def add_torrent(self, torrent, trackers = (), metainfo = None, directory = None):
+        '''
+        Add a torrent
+        
+        @param  torrent:Torrent      The torrent
+        @param  trackers:list<str>   The announce URLs of the torrent's trackers
+        @param  metainfo:Metainfo?   The torrent's metainfo, without it no payload is transferred
+        @param  directory:str?       The directory to download into, the current directory by default
+        '''
+        torrent.number = self.next_number
+        self.next_number += 1
+        self.torrents[torrent.info_hash] = torrent
+        if metainfo is not None:
+            payload = Payload(self.loop, torrent, metainfo, directory or os.getcwd(), self.disk,
+                              self.peer_table, self.changed, self.cache)
+            self.payloads[torrent.info_hash] = payload
+            if self.engine is not None:
+                self.start_payload(payload)
+        for view in self.views:
+            view.add(torrent)
+        if torrent.state != STATE_PAUSED:
+            self.queue.add(torrent)
+        if self.dispatcher is not None:
+            self.dispatcher.add_torrent(torrent.info_hash)
+        if self.trackers is not None:
+            self.trackers.add_torrent(torrent.info_hash, trackers)
+        if self.dht is not None:
+            self.dht_queue.appendleft((0.0, torrent.info_hash))
+        self.notify()
+    
+    
+    def remove_torrent(self, torrent):
+        '''
+        Remove a torrent
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        del self.torrents[torrent.info_hash]
+        self.queue.remove(torrent)
+        payload = self.payloads.pop(torrent.info_hash, None)
+        if payload is not None:
+            if (self.engine is not None) and (torrent.info_hash in self.engine.swarms):
+                self.engine.remove_torrent(torrent.info_hash)
+            payload.close()
+            self.resume.remove(torrent.info_hash)
+            try:
+                os.unlink(os.path.join(self.torrents_path, torrent.info_hash.hex()))
+            except FileNotFoundError:
+                pass
+        if self.trackers is not None:
+            self.trackers.remove_torrent(torrent.info_hash)
+        if self.dispatcher is not None:
+            self.dispatcher.remove_torrent(torrent.info_hash)
+        for view in self.views:
+            view.remove(torrent)
+        self.notify()
+    
+    
+    def open_torrent(self, data, directory, save = True):
+        '''
+        Add a torrent from its torrent file, and remember it so it is added again
+        when the daemon restarts, `BencodeError` is raised if the file is invalid
+        
+        @param   data:bytes       The contents of the torrent file
+        @param   directory:str    The directory to download into
+        @param   save:bool        Whether to remember the torrent, it already is when it is reloaded
+        @return  :Torrent?        The torrent, `None` if it has already been added
+        '''
+        data = bytes(data)
+        metainfo = Metainfo(data)
+        metainfo.check()
+        if metainfo.info_hash in self.torrents:
+            return None
+        name = bytes(metainfo.info[b'name']).decode('utf-8', 'replace')
+        torrent = Torrent(metainfo.info_hash, name, metainfo.total_length())
+        if save:
+            path = os.path.join(self.torrents_path, metainfo.info_hash.hex())
+            temp = '%s.%i' % (path, os.getpid())
+            os.makedirs(self.torrents_path, exist_ok = True)
+            with open(temp, 'wb') as file:
+                file.write(encode({ b'directory' : os.fsencode(directory), b'metainfo' : data }))
+            os.replace(temp, path)
+        self.add_torrent(torrent, metainfo.trackers(), metainfo, directory)
+        return torrent
+    
+    
+    def load_torrents(self):
+        '''
+        Add the torrents that were added before the daemon was last stopped, in the order they were added
+        '''
+        try:
+            names = [name for name in os.listdir(self.torrents_path) if len(name) == 40]
+        except FileNotFoundError:
+            return
+        paths = [os.path.join(self.torrents_path, name) for name in names]
+        for path in sorted(paths, key = lambda path : os.stat(path).st_mtime_ns):
+            try:
+                with open(path, 'rb') as file:
+                    saved = decode(file.read())
+                self.open_torrent(saved[b'metainfo'], os.fsdecode(bytes(saved[b'directory'])), False)
+            except (OSError, BencodeError, KeyError, TypeError) as e:
+                print(_('Cannot load %s: %s') % (path, e), file = sys.stderr)
+    
+    
+    def start_payload(self, payload):
+        '''
+        Restore a torrent's complete pieces from its fast-resume record, rechecking
+        changed files, and share the payload with peers once that is done
+        
+        @param  payload:Payload  The torrent's payload
+        '''
+        info_hash = payload.info_hash
+        record = self.resume.get(info_hash)
+        if (record is None) or not payload.matches(record):
+            record = self.resume.add(info_hash, payload.piece_count, len(payload.storage.paths),
+                                     payload.blocks_per_piece)
+        def ready():
+            if (self.payloads.get(info_hash) is payload) and (self.engine is not None):
+                p = self.preferences.current
+                self.engine.add_torrent(info_hash, payload, p.torrent_max_connections, p.torrent_upload_slots,
+                                        p.torrent_download_rate, p.torrent_upload_rate)
+                payload.start_web_seeds(self.connectors['web_seed'])
+        payload.start(record, lambda done, total : self.recheck_progress(payload.torrent, done, total), ready)
+    
+    
+    def recheck_progress(self, torrent, done, total):
+        '''
+        Called with the progress of rechecking a torrent's changed files
+        
+        @param  torrent:Torrent  The torrent
+        @param  done:int         The number of checked pieces
+        @param  total:int        The number of pieces to check
+        '''
+        self.recheck = (done, total)
+        self.notify()
+    
+    
+    def changed(self, torrent):
+        '''
+        Update the views after a torrent's statistics have changed
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        for view in self.views:
+            view.changed(torrent)
+        self.notify()
+    
+    
+    def progress(self, info_hash):
+        '''
+        Get a torrent's transfer totals, for announces
+        
+        @param   info_hash:bytes                               The torrent's infohash
+        @return  :(downloaded:int, left:int, uploaded:int)  The totals
+        '''
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            return (0, 0, 0)
+        return (torrent.downloaded, torrent.size - torrent.done, torrent.uploaded)
+    
+    
+    def peers_found(self, info_hash, peers):
+        '''
+        Add peers that a tracker has given to the torrent's candidates
+        
+        @param  info_hash:bytes                   The torrent's infohash
+        @param  peers:list<(host:str, port:int)>  The peers
+        '''
+        self.dispatcher.add(info_hash, peers, SOURCE_TRACKER)
+    
+    
+    def finished(self, torrent, remove):
+        '''
+        Called when a torrent has been stopped at its share ratio
+        
+        @param  torrent:Torrent  The torrent
+        @param  remove:bool      Whether the torrent shall be removed
+        '''
+        if remove:
+            self.remove_torrent(torrent)
+    
+    
+    def notify(self):
+        '''
+        Tell the listeners that the torrents have changed
+        '''
+        for listener in self.listeners:
+            listener()
+    
+    
+    def open_view(self):
+        '''
+        Create a torrent list that is kept up to date with the session
+        
+        @return  :TorrentList  The torrent list
+        '''
+        view = TorrentList()
+        for torrent in self.torrents.values():
+            view.add(torrent)
+        self.views.append(view)
+        return view
+    
+    
+    def close_view(self, view):
+        '''
+        Stop updating a torrent list
+        
+        @param  view:TorrentList  The torrent list
+        '''
+        self.views.remove(view)
+    
+    
+    def close(self):
+        '''
+        Stop everything and save the fast-resume state
+        '''
+        self.statistics.stop()
+        if self.cache_timer is not None:
+            self.cache_timer.cancel()
+        self.queue.stop()
+        self.preferences.stop()
+        if self.trackers is not None:
+            self.trackers.close()
+        self.stop_dht()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        if self.engine is not None:
+            self.engine.close()
+        for connector in self.connectors.values():
+            connector.close()
+        # Written blocks are waited for, so the files can be stamped
+        self.disk.close()
+        for payload in self.payloads.values():
+            payload.close()
+        self.resume.close()
+        self.geoip.close()
+
+
+class Client():
+    '''
+    An attached interface
+    
+    Each client has its own sorting, filter, selection and scrolling,
+    and is sent the rows that are visible to it when they change.
+    '''
+    
+    def __init__(self, daemon, sock):
+        '''
+        Constructor
+        
+        @param  daemon:Daemon  The daemon
+        @param  sock:socket    The connected socket
+        '''
+        self.daemon = daemon
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.reader = MessageReader()
+        self.out = bytearray()
+        self.torrents = daemon.session.open_view()
+        self.peers = PeerView(daemon.session.peer_table)
+        self.trackers = TrackerView(daemon.session.trackers)
+        self.sizes = [(0, 0), (0, 0), (0, 0)]
+        self.sent = [[], [], []]
+        self.snapshot = None
+        self.recheck = None
+        daemon.loop.add_reader(self.fd, self.read_ready)
+    
+    
+    def read_ready(self):
+        '''
+        Read and act on messages from the client, the socket must be readable
+        '''
+        try:
+            data = self.sock.recv(1 << 16)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''
+        if len(data) == 0:
+            self.close()
+            return
+        try:
+            messages = self.reader.feed(data)
+        except ValueError:
+            self.close()
+            return
+        try:
+            for (msg_type, payload) in messages:
+                self.handle(msg_type, payload)
+        except (struct.error, IndexError):
+            # A malformed message, the client is out of step
+            self.close()
+            return
+        self.push()
+    
+    
+    def handle(self, msg_type, payload):
+        '''
+        Act on a message from the client, a malformed payload raises
+        `struct.error` or `IndexError`
+        
+        @param  msg_type:int   The message's type, `MSG_*`
+        @param  payload:bytes  The message's payload
+        '''
+        if msg_type == MSG_VIEW:
+            (view, height, width) = VIEW.unpack(payload)
+            if view < len(self.sizes):
+                self.sizes[view] = (height, width)
+        elif msg_type == MSG_MOVE:
+            (view, delta) = MOVE.unpack(payload)
+            if view == VIEW_TORRENTS:
+                self.torrents.move(delta)
+            elif view == VIEW_PEERS:
+                self.peers.scroll(delta, self.selected_info_hash(), self.sizes[VIEW_PEERS][0])
+        elif msg_type == MSG_SORT:
+            self.torrents.set_sort(SORT_COLUMNS[payload[0] % len(SORT_COLUMNS)])
+        elif msg_type == MSG_FILTER:
+            state_filter = payload[0] - 256 if payload[0] >= 128 else payload[0]
+            self.torrents.set_filter(None if state_filter < 0 else state_filter)
+        elif msg_type == MSG_ADD:
+            (length,) = ADD.unpack_from(payload)
+            if ADD.size + length > len(payload):
+                raise IndexError('truncated download directory')
+            directory = os.fsdecode(bytes(payload[ADD.size : ADD.size + length]))
+            try:
+                self.daemon.session.open_torrent(payload[ADD.size + length:], directory)
+            except (OSError, BencodeError) as e:
+                print(_('Cannot add torrent: %s') % e, file = sys.stderr)
+    
+    
+    def selected_info_hash(self):
+        '''
+        @return  :bytes?  The infohash of the selected torrent, `None` if no torrent is selected
+        '''
+        if self.torrents.selected is None:
+            return None
+        return self.torrents.torrents[self.torrents.selected].info_hash
+    
+    
+    def push(self):
+        '''
+        Send the changes to what the client shows
+        '''
+        messages = []
+        (height, width) = self.sizes[VIEW_TORRENTS]
+        rows = self.torrents.render(height, width) if height * width > 0 else []
+        messages.append(encode_rows(VIEW_TORRENTS, rows, self.sent[VIEW_TORRENTS]))
+        self.sent[VIEW_TORRENTS] = rows
+        (height, width) = self.sizes[VIEW_PEERS]
+        rows = [(row, False) for row in self.peers.render(self.selected_info_hash(), height, width)]
+        messages.append(encode_rows(VIEW_PEERS, rows, self.sent[VIEW_PEERS]))
+        self.sent[VIEW_PEERS] = rows
+        (height, width) = self.sizes[VIEW_TRACKERS]
+        rows = self.trackers.render(height, width)
+        messages.append(encode_rows(VIEW_TRACKERS, rows, self.sent[VIEW_TRACKERS]))
+        self.sent[VIEW_TRACKERS] = rows
+        snapshot = self.daemon.session.statistics.snapshot
+        if snapshot != self.snapshot:
+            self.snapshot = snapshot
+            messages.append(pack(MSG_STATS, STATS.pack(*snapshot)))
+        recheck = self.daemon.session.recheck
+        if recheck != self.recheck:
+            self.recheck = recheck
+            messages.append(pack(MSG_PROGRESS, PROGRESS.pack(*recheck)))
+        for message in messages:
+            if message is not None:
+                self.out += message
+        if len(self.out) > 0:
+            self.write_ready()
+    
+    
+    def write_ready(self):
+        '''
+        Send as much queued data as possible
+        '''
+        try:
+            sent = self.sock.send(self.out)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.close()
+                return
+            sent = 0
+        del self.out[:sent]
+        if len(self.out) > MAX_BACKLOG:
+            self.close()
+        elif len(self.out) > 0:
+            self.daemon.loop.add_writer(self.fd, self.write_ready)
+        else:
+            self.daemon.loop.remove_writer(self.fd)
+    
+    
+    def close(self):
+        '''
+        Detach the client
+        '''
+        if self.sock is None:
+            return
+        self.daemon.loop.remove_reader(self.fd)
+        self.daemon.loop.remove_writer(self.fd)
+        self.daemon.session.close_view(self.torrents)
+        self.daemon.clients.discard(self)
+        self.sock.close()
+        self.sock = None
+
+
+class Daemon():
+    '''
+    Serves a session to interfaces over a UNIX domain socket
+    '''
+    
+    def __init__(self, session, path = None):
+        '''
+        Constructor
+        
+        @param  session:Session  The session
+        @param  path:str?        The socket, `remote.socket_path()` by default
+        '''
+        self.session = session
+        self.loop = session.loop
+        self.path = path or socket_path()
+        self.listener = None
+        self.clients = set()
+        self.timer = None
+        session.statistics.listeners.append(lambda snapshot : self.push_soon())
+        session.listeners.append(self.push_soon)
+    
+    
+    def listen(self):
+        '''
+        Create the socket, replacing a stale socket from a daemon that is no longer running,
+        `OSError` is raised if its directory is not private
+        '''
+        private_directory(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError(errno.EADDRINUSE, _('Another daemon is running'), self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        sock.setblocking(False)
+        self.listener = sock
+        self.loop.add_reader(sock.fileno(), self.accept_ready)
+    
+    
+    def accept_ready(self):
+        '''
+        Accept all pending interfaces
+        '''
+        while True:
+            try:
+                (sock, _address) = self.listener.accept()
+            except OSError:
+                return
+            sock.setblocking(False)
+            client = Client(self, sock)
+            self.clients.add(client)
+            client.push()
+    
+    
+    def push_soon(self):
+        '''
+        Send updates to all clients, at most `MAX_FPS` times per second
+        '''
+        def push():
+            self.timer = None
+            for client in list(self.clients):
+                client.push()
+        if self.timer is None:
+            self.timer = self.loop.call_later(1 / MAX_FPS, push)
+    
+    
+    def close(self):
+        '''
+        Detach all clients and remove the socket
+        '''
+        for client in list(self.clients):
+            client.close()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def dump_instrumentation():
+    '''
+    Write the metrics to a file, on SIGUSR1
+    '''
+    try:
+        instrument.dump()
+    except OSError as e:
+        print(_('Cannot write metrics: %s') % e, file = sys.stderr)
+
+
+def run_daemon():
+    '''
+    Run a session without a terminal until SIGTERM or SIGINT
+    '''
+    loop = EventLoop()
+    session = Session(loop)
+    daemon = Daemon(session)
+    # Keep running when the terminal that started the daemon is closed
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.add_signal_handler(signal.SIGUSR1, dump_instrumentation)
+    try:
+        daemon.listen()
+        session.start()
+        loop.run()
+    finally:
+        daemon.close()
+        session.close()
+        loop.close()
@@ -0,0 +1,790 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import random
+import socket
+import struct
+import hashlib
+from array import array
+
+from bencode import BencodeError, decode, encode
+
+
+K = 8
+'''
+:int  The number of nodes in a bucket, and the number of nodes a lookup returns
+'''
+
+ALPHA = 3
+'''
+:int  The number of concurrent queries in a lookup
+'''
+
+NODE_LENGTH = 26
+'''
+:int  The length of a node in compact node info: 20 bytes ID, 4 bytes IPv4 address, 2 bytes port
+'''
+
+QUERY_TIMEOUT = 2
+'''
+:float  The number of seconds to wait for a response
+'''
+
+MAX_FAILS = 2
+'''
+:int  The number of unanswered queries after which a node may be replaced
+'''
+
+PEER_EXPIRY = 30 * 60
+'''
+:float  The number of seconds an announced peer is remembered
+'''
+
+TOKEN_ROTATION = 5 * 60
+'''
+:float  The number of seconds between changes of the secret that tokens are made from
+'''
+
+REFRESH_INTERVAL = 15 * 60
+'''
+:float  The number of seconds after which a bucket without any seen node is refreshed
+'''
+
+LOADED = float('-inf')
+'''
+:float  The time nodes loaded from a file are recorded as last seen at
+'''
+
+
+def compact_address(address):
+    '''
+    Pack an IPv4 address
+    
+    @param   address:(host:str, port:int)  The address
+    @return  :bytes                        The address in compact peer info format
+    '''
+    return socket.inet_aton(address[0]) + struct.pack('>H', address[1])
+
+
+def parse_address(data):
+    '''
+    Unpack an IPv4 address
+    
+    @param   data:bytes|memoryview  The address in compact peer info format
+    @return  :(host:str, port:int)  The address
+    '''
+    return (socket.inet_ntoa(bytes(data[:4])), int.from_bytes(data[4 : 6], 'big'))
+
+
+def stored_node_id(path):
+    '''
+    Get the node ID that a routing table was saved with, so that it can be reused
+    
+    @param   path:str  The file written by `RoutingTable.save`
+    @return  :bytes?   The node ID, `None` if there is no such file
+    '''
+    try:
+        with open(path, 'rb') as file:
+            node_id = file.read(20)
+    except OSError:
+        return None
+    return node_id if len(node_id) == 20 else None
+
+
+class Bucket():
+    '''
+    Up to `K` nodes stored as packed compact node info, least recently seen first
+    '''
+    
+    __slots__ = ('nodes', 'seen', 'fails')
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.nodes = bytearray()
+        self.seen = array('d')
+        self.fails = bytearray()
+    
+    
+    def __len__(self):
+        return len(self.nodes) // NODE_LENGTH
+    
+    
+    def find(self, node_id):
+        '''
+        Find a node in the bucket
+        
+        @param   node_id:bytes  The node's ID
+        @return  :int           The node's position, -1 if not found
+        '''
+        for i in range(len(self)):
+            if self.nodes[i * NODE_LENGTH : i * NODE_LENGTH + 20] == node_id:
+                return i
+        return -1
+    
+    
+    def remove(self, i):
+        '''
+        Remove a node
+        
+        @param   i:int   The node's position
+        @return  :bytes  The node's compact node info
+        '''
+        node = bytes(self.nodes[i * NODE_LENGTH : (i + 1) * NODE_LENGTH])
+        del self.nodes[i * NODE_LENGTH : (i + 1) * NODE_LENGTH]
+        del self.seen[i]
+        del self.fails[i]
+        return node
+    
+    
+    def append(self, node, seen, fails = 0):
+        '''
+        Add a node as the most recently seen
+        
+        @param  node:bytes  The node's compact node info
+        @param  seen:float  The time the node was last seen
+        @param  fails:int   The number of unanswered queries
+        '''
+        self.nodes += node
+        self.seen.append(seen)
+        self.fails.append(min(fails, 255))
+
+
+class RoutingTable():
+    '''
+    Kademlia routing table with one bucket per distance prefix length
+    '''
+    
+    def __init__(self, node_id):
+        '''
+        Constructor
+        
+        @param  node_id:bytes  Our node ID
+        '''
+        self.node_id = node_id
+        self.own = int.from_bytes(node_id, 'big')
+        self.buckets = [Bucket() for _ in range(160)]
+        self.node_count = 0
+    
+    
+    def bucket(self, node_id):
+        '''
+        Get the bucket a node belongs in
+        
+        @param   node_id:bytes  The node's ID
+        @return  :Bucket?       The bucket, `None` for our own ID
+        '''
+        distance = self.own ^ int.from_bytes(node_id, 'big')
+        return self.buckets[distance.bit_length() - 1] if distance else None
+    
+    
+    def seen(self, node_id, address, now):
+        '''
+        Record that a node has responded or sent a query
+        
+        @param  node_id:bytes                 The node's ID
+        @param  address:(host:str, port:int)  The node's address
+        @param  now:float                     The current time
+        '''
+        bucket = self.bucket(node_id)
+        if bucket is None:
+            return
+        node = node_id + compact_address(address)
+        i = bucket.find(node_id)
+        if i >= 0:
+            bucket.remove(i)
+            bucket.append(node, now)
+            return
+        if len(bucket) >= K:
+            # Replace the least recently seen bad node, if any: a node that has not been seen
+            # for a while is bad as soon as it does not respond, and a node loaded from a file
+            # is bad until it has been seen
+            questionable = now - REFRESH_INTERVAL
+            bad = [i for i in range(len(bucket))
+                   if (bucket.fails[i] >= MAX_FAILS) or ((bucket.seen[i] < questionable)
+                                                         and ((bucket.fails[i] > 0) or (bucket.seen[i] == LOADED)))]
+            if len(bad) == 0:
+                return
+            bucket.remove(bad[0])
+            self.node_count -= 1
+        bucket.append(node, now)
+        self.node_count += 1
+    
+    
+    def failed(self, node_id):
+        '''
+        Record that a node did not respond
+        
+        @param  node_id:bytes  The node's ID
+        '''
+        bucket = self.bucket(node_id)
+        i = -1 if bucket is None else bucket.find(node_id)
+        if i >= 0:
+            bucket.fails[i] = min(bucket.fails[i] + 1, 255)
+    
+    
+    def closest(self, target, count = K):
+        '''
+        Find the known nodes closest to an ID
+        
+        @param   target:bytes  The ID
+        @param   count:int     The maximum number of nodes
+        @return  :list<bytes>  The nodes' compact node info, closest first
+        '''
+        target = int.from_bytes(target, 'big')
+        nodes = []
+        for bucket in self.buckets:
+            for i in range(len(bucket)):
+                if bucket.fails[i] < MAX_FAILS:
+                    nodes.append(bytes(bucket.nodes[i * NODE_LENGTH : (i + 1) * NODE_LENGTH]))
+        nodes.sort(key = lambda node : int.from_bytes(node[:20], 'big') ^ target)
+        return nodes[:count]
+    
+    
+    def save(self, path):
+        '''
+        Store the table in a file, to quickly rejoin after a restart
+        
+        @param  path:str  The file
+        '''
+        data = bytearray(self.node_id)
+        for bucket in self.buckets:
+            for i in range(len(bucket)):
+                if bucket.fails[i] < MAX_FAILS:
+                    data += bucket.nodes[i * NODE_LENGTH : (i + 1) * NODE_LENGTH]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.rename(tmp, path)
+    
+    
+    def load(self, path):
+        '''
+        Add the nodes stored in a file, as if they were seen long ago
+        
+        @param   path:str  The file
+        @return  :bool     Whether the file existed and was stored with our ID
+        '''
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        if data[:20] != self.node_id:
+            return False
+        for i in range(20, len(data) - NODE_LENGTH + 1, NODE_LENGTH):
+            self.seen(data[i : i + 20], parse_address(data[i + 20 : i + NODE_LENGTH]), LOADED)
+        return True
+
+
+class PeerStore():
+    '''
+    Peers announced to us, with expiry
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.peers = {}
+    
+    
+    def add(self, info_hash, peer, now):
+        '''
+        Add a peer
+        
+        @param  info_hash:bytes  The torrent's infohash
+        @param  peer:bytes       The peer's compact peer info
+        @param  now:float        The current time
+        '''
+        self.peers.setdefault(info_hash, {})[peer] = now + PEER_EXPIRY
+    
+    
+    def get(self, info_hash, count = 50):
+        '''
+        Get peers for a torrent
+        
+        @param   info_hash:bytes  The torrent's infohash
+        @param   count:int        The maximum number of peers
+        @return  :list<bytes>     The peers' compact peer info
+        '''
+        return list(self.peers.get(info_hash, {}))[-count:]
+    
+    
+    def expire(self, now):
+        '''
+        Forget peers that have not announced themselves recently
+        
+        @param  now:float  The current time
+        '''
+        for info_hash in list(self.peers):
+            peers = self.peers[info_hash]
+            for peer in [peer for (peer, expiry) in peers.items() if expiry <= now]:
+                del peers[peer]
+            if len(peers) == 0:
+                del self.peers[info_hash]
+
+
+class Lookup():
+    '''
+    Iterative search for the nodes closest to an ID
+    '''
+    
+    def __init__(self, dht, target, query, callback):
+        '''
+        Constructor
+        
+        @param  dht:DHT                                        The DHT node
+        @param  target:bytes                                   The ID
+        @param  query:bytes                                    b'find_node' or b'get_peers'
+        @param  callback:(nodes:list<(bytes, (str, int), bytes?)>,
+                          peers:set<bytes>)→void                 Function called with the closest
+                                                               responding nodes, with their addresses
+                                                               and tokens, and the peers found
+        '''
+        self.dht = dht
+        self.target = target
+        self.target_int = int.from_bytes(target, 'big')
+        self.query = query
+        self.callback = callback
+        self.candidates = {}
+        self.queried = set()
+        self.responded = {}
+        self.peers = set()
+        self.in_flight = 0
+        self.done = False
+    
+    
+    def distance(self, node_id):
+        return int.from_bytes(node_id, 'big') ^ self.target_int
+    
+    
+    def add(self, nodes):
+        '''
+        Add candidate nodes
+        
+        @param  nodes:bytes|memoryview  Compact node info
+        '''
+        for i in range(0, len(nodes) - NODE_LENGTH + 1, NODE_LENGTH):
+            node_id = bytes(nodes[i : i + 20])
+            if (node_id not in self.candidates) and (node_id != self.dht.node_id):
+                self.candidates[node_id] = parse_address(nodes[i + 20 : i + NODE_LENGTH])
+    
+    
+    def step(self):
+        '''
+        Send queries until `ALPHA` are in flight, or finish the lookup
+        '''
+        if self.done:
+            return
+        # The lookup has converged when the closest nodes have all been queried
+        closest = sorted(self.candidates, key = self.distance)[:K]
+        for node_id in closest:
+            if self.in_flight >= ALPHA:
+                break
+            if node_id not in self.queried:
+                self.queried.add(node_id)
+                self.in_flight += 1
+                args = { b'target' if self.query == b'find_node' else b'info_hash' : self.target }
+                self.dht.query(self.candidates[node_id], self.query, args,
+                               lambda response, node_id = node_id : self.response(node_id, response))
+        if self.in_flight == 0:
+            self.done = True
+            nodes = sorted(self.responded, key = self.distance)[:K]
+            self.callback([(node_id,) + self.responded[node_id] for node_id in nodes], self.peers)
+    
+    
+    def response(self, node_id, response):
+        '''
+        Handle a response, or a timeout
+        
+        @param  node_id:bytes  The queried node
+        @param  response:dict? The response's arguments, `None` on timeout or error
+        '''
+        self.in_flight -= 1
+        if response is not None:
+            self.responded[node_id] = (self.candidates[node_id], bytes(response[b'token']) if b'token' in response else None)
+            if b'nodes' in response:
+                self.add(response[b'nodes'])
+            for peer in response.get(b'values', []):
+                if len(peer) == 6:
+                    self.peers.add(bytes(peer))
+        else:
+            self.dht.table.failed(node_id)
+            del self.candidates[node_id]
+        self.step()
+
+
+class DHT():
+    '''
+    A node in the mainline distributed hash table, over UDP on IPv4
+    '''
+    
+    def __init__(self, loop, node_id = None, host = '0.0.0.0', port = 0, clock = time.monotonic):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop   The event loop to run in
+        @param  node_id:bytes?   Our node ID, random by default
+        @param  host:str         The address to listen on
+        @param  port:int         The port to listen on, 0 for any
+        @param  clock:()→float   Function that returns the current time
+        '''
+        self.loop = loop
+        self.node_id = node_id or os.urandom(20)
+        self.clock = clock
+        self.table = RoutingTable(self.node_id)
+        self.store = PeerStore()
+        self.secrets = [os.urandom(8), os.urandom(8)]
+        self.transactions = {}
+        self.next_transaction = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.loop.add_reader(self.sock.fileno(), self.read_ready)
+        self.maintenance_timer = self.loop.call_later(TOKEN_ROTATION, self.maintain)
+    
+    
+    def close(self):
+        '''
+        Stop the node
+        '''
+        self.maintenance_timer.cancel()
+        for (_address, _callback, timer) in self.transactions.values():
+            timer.cancel()
+        self.transactions.clear()
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+    
+    
+    def maintain(self):
+        '''
+        Rotate the token secret, expire announced peers, and refresh stale buckets
+        '''
+        self.secrets = [os.urandom(8), self.secrets[0]]
+        now = self.clock()
+        self.store.expire(now)
+        self.refresh(now - REFRESH_INTERVAL)
+        self.maintenance_timer = self.loop.call_later(TOKEN_ROTATION, self.maintain)
+    
+    
+    def token(self, address, secret = 0):
+        '''
+        Create the token for announcing from an address
+        
+        @param   address:(host:str, port:int)  The address
+        @param   secret:int                    0 for the current secret, 1 for the previous
+        @return  :bytes                        The token
+        '''
+        return hashlib.sha1(self.secrets[secret] + socket.inet_aton(address[0])).digest()[:8]
+    
+    
+    def send(self, address, message):
+        '''
+        Send a message
+        
+        @param  address:(host:str, port:int)  The recipient
+        @param  message:dict                  The message
+        '''
+        try:
+            self.sock.sendto(encode(message), address)
+        except OSError:
+            pass
+    
+    
+    def query(self, address, method, args, callback):
+        '''
+        Send a query
+        
+        @param  address:(host:str, port:int)  The recipient
+        @param  method:bytes                  The query method
+        @param  args:dict                     The query arguments, without our ID
+        @param  callback:(dict?)→void         Function called with the response's arguments,
+                                              or `None` on timeout or error
+        '''
+        self.next_transaction = (self.next_transaction + 1) & 0xFFFF
+        tid = self.next_transaction.to_bytes(2, 'big')
+        old = self.transactions.pop(tid, None)
+        if old is not None:
+            old[2].cancel()
+            old[1](None)
+        args = dict(args)
+        args[b'id'] = self.node_id
+        timer = self.loop.call_later(QUERY_TIMEOUT, self.timeout, tid)
+        self.transactions[tid] = (address, callback, timer)
+        self.send(address, { b't' : tid, b'y' : b'q', b'q' : method, b'a' : args })
+    
+    
+    def timeout(self, tid):
+        '''
+        Give up on a query
+        
+        @param  tid:bytes  The transaction ID
+        '''
+        (_address, callback, _timer) = self.transactions.pop(tid)
+        callback(None)
+    
+    
+    def read_ready(self):
+        '''
+        Receive and handle all pending datagrams
+        '''
+        while True:
+            try:
+                (data, address) = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            try:
+                message = decode(data)
+            except BencodeError:
+                # Malformed, truncated or nested too deeply, drop it
+                continue
+            try:
+                self.handle(message, address)
+            except (KeyError, TypeError, AttributeError, ValueError):
+                pass
+    
+    
+    def handle(self, message, address):
+        '''
+        Handle a received message
+        
+        @param  message:dict                  The message
+        @param  address:(host:str, port:int)  The sender
+        '''
+        kind = bytes(message[b'y'])
+        tid = bytes(message[b't'])
+        now = self.clock()
+        if kind == b'q':
+            args = message[b'a']
+            sender = bytes(args[b'id'])
+            if len(sender) == 20:
+                self.table.seen(sender, address, now)
+            response = self.respond(bytes(message[b'q']), args, address, now)
+            if response is None:
+                self.send(address, { b't' : tid, b'y' : b'e', b'e' : [204, b'Method Unknown'] })
+            elif isinstance(response, list):
+                self.send(address, { b't' : tid, b'y' : b'e', b'e' : response })
+            else:
+                response[b'id'] = self.node_id
+                self.send(address, { b't' : tid, b'y' : b'r', b'r' : response })
+            return
+        transaction = self.transactions.get(tid)
+        if (transaction is None) or (transaction[0] != address):
+            return
+        del self.transactions[tid]
+        transaction[2].cancel()
+        if kind == b'r':
+            response = message[b'r']
+            responder = bytes(response[b'id'])
+            if len(responder) == 20:
+                self.table.seen(responder, address, now)
+            transaction[1](response)
+        else:
+            transaction[1](None)
+    
+    
+    def respond(self, method, args, address, now):
+        '''
+        Create the response to a query
+        
+        @param   method:bytes                  The query method
+        @param   args:dict                     The query arguments
+        @param   address:(host:str, port:int)  The sender
+        @param   now:float                     The current time
+        @return  :dict|list?                   The response arguments, an error, or `None`
+                                               if the method is unknown
+        '''
+        if method == b'ping':
+            return {}
+        if method == b'find_node':
+            return { b'nodes' : b''.join(self.table.closest(bytes(args[b'target']))) }
+        if method == b'get_peers':
+            info_hash = bytes(args[b'info_hash'])
+            response = { b'token' : self.token(address) }
+            peers = self.store.get(info_hash)
+            if len(peers) > 0:
+                response[b'values'] = peers
+            else:
+                response[b'nodes'] = b''.join(self.table.closest(info_hash))
+            return response
+        if method == b'announce_peer':
+            token = bytes(args[b'token'])
+            if token not in (self.token(address, 0), self.token(address, 1)):
+                return [203, b'Bad token']
+            port = address[1] if args.get(b'implied_port', 0) else args[b'port']
+            if not (isinstance(port, int) and (0 < port < 65536)):
+                return [203, b'Invalid port']
+            self.store.add(bytes(args[b'info_hash']), compact_address((address[0], port)), now)
+            return {}
+        return None
+    
+    
+    def bootstrap(self, addresses, callback = None):
+        '''
+        Join the network through known nodes, and refresh our neighbourhood and buckets
+        
+        @param  addresses:list<(host:str, port:int)>  Addresses of nodes in the network
+        @param  callback:(list, set)→void?            Function called when done
+        '''
+        callback = callback or (lambda nodes, peers : None)
+        def joined(nodes, peers):
+            # Our neighbourhood is known now, fill the buckets farther away
+            self.refresh(None, lambda : callback(nodes, peers))
+        lookup = Lookup(self, self.node_id, b'find_node', joined)
+        lookup.add(b''.join(self.table.closest(self.node_id)))
+        for address in addresses:
+            # The ID is not known, so use a placeholder that sorts as farthest
+            placeholder = bytes(a ^ 0xFF for a in self.node_id[:12]) + compact_address(address) + bytes(2)
+            lookup.candidates.setdefault(placeholder[:20], address)
+        lookup.step()
+    
+    
+    def refresh(self, before = None, callback = None):
+        '''
+        Look up a random ID in the range of each bucket that is not full or has not
+        been active, so that lookups do not get stuck on the side of the ID space we
+        are on; buckets closer than our nearest known neighbour are covered by the
+        lookup for our own ID and are skipped
+        
+        @param  before:float?    Only refresh buckets where no node was seen since this
+                                 time, `None` to refresh all buckets that are not full
+        @param  callback:()→void?  Function called when all lookups are done
+        '''
+        buckets = self.table.buckets
+        nearest = next((i for (i, bucket) in enumerate(buckets) if len(bucket) > 0), len(buckets))
+        pending = [1]
+        def done(nodes = None, peers = None):
+            pending[0] -= 1
+            if pending[0] == 0 and callback is not None:
+                callback()
+        for i in range(nearest, len(buckets)):
+            bucket = buckets[i]
+            if before is None:
+                if len(bucket) >= K:
+                    continue
+            elif len(bucket) > 0 and max(bucket.seen) >= before:
+                continue
+            distance = (1 << i) | random.getrandbits(i) if i > 0 else 1
+            pending[0] += 1
+            self.find_node((self.table.own ^ distance).to_bytes(20, 'big'), done)
+        done()
+    
+    
+    def find_node(self, target, callback):
+        '''
+        Find the nodes closest to an ID
+        
+        @param  target:bytes                  The ID
+        @param  callback:(list, set)→void     Function called with the result, see `Lookup`
+        '''
+        lookup = Lookup(self, target, b'find_node', callback)
+        lookup.add(b''.join(self.table.closest(target)))
+        lookup.step()
+    
+    
+    def get_peers(self, info_hash, callback):
+        '''
+        Find peers for a torrent
+        
+        @param  info_hash:bytes               The torrent's infohash
+        @param  callback:(list, set)→void     Function called with the result, see `Lookup`
+        '''
+        lookup = Lookup(self, info_hash, b'get_peers', callback)
+        lookup.add(b''.join(self.table.closest(info_hash)))
+        lookup.step()
+    
+    
+    def announce(self, info_hash, port, callback = None):
+        '''
+        Find peers for a torrent and announce that we have it
+        
+        @param  info_hash:bytes            The torrent's infohash
+        @param  port:int                   The port we accept peers on
+        @param  callback:(set<bytes>)→void?  Function called with the peers found
+        '''
+        def found(nodes, peers):
+            for (_node_id, address, token) in nodes:
+                if token is not None:
+                    args = { b'info_hash' : info_hash, b'port' : port, b'token' : token }
+                    self.query(address, b'announce_peer', args, lambda response : None)
+            if callback is not None:
+                callback(peers)
+        self.get_peers(info_hash, found)
+
+
+if __name__ == '__main__':
+    # Simulate a network of nodes on the loopback interface and measure lookups
+    import sys, tracemalloc
+    from eventloop import EventLoop
+    
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    random.seed(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    loop = EventLoop()
+    tracemalloc.start()
+    nodes = [DHT(loop, node_id = random.getrandbits(160).to_bytes(20, 'big'), host = '127.0.0.1') for _ in range(count)]
+    
+    def run_until(predicate, limit = 30):
+        deadline = time.monotonic() + limit
+        while not predicate() and time.monotonic() < deadline:
+            loop.run_once()
+    
+    # Join the nodes one after another through the first node
+    for (i, node) in enumerate(nodes[1:]):
+        pending = [True]
+        node.bootstrap([('127.0.0.1', nodes[0].port)], lambda n, p, pending = pending : pending.pop())
+        run_until(lambda : not pending)
+    memory = tracemalloc.get_traced_memory()[0]
+    table_bytes = sum(sum(len(b.nodes) + b.seen.itemsize * len(b.seen) + len(b.fails) for b in n.table.buckets) for n in nodes)
+    entries = sum(n.table.node_count for n in nodes)
+    
+    # Announce and look up torrents
+    latencies = []
+    for i in range(50):
+        info_hash = random.getrandbits(160).to_bytes(20, 'big')
+        pending = [True]
+        nodes[i % count].announce(info_hash, 6881, lambda peers, pending = pending : pending.pop())
+        run_until(lambda : not pending)
+        found = []
+        start = time.perf_counter()
+        nodes[-1 - i % count].get_peers(info_hash, lambda n, peers : found.append(peers))
+        run_until(lambda : found)
+        latencies.append(time.perf_counter() - start)
+        assert found and found[0], 'announced peer was not found'
+    latencies.sort()
+    print('%i nodes, %.1f table entries per node, %.0f bytes per entry in tables, %.1f KB process memory per node' %
+          (count, entries / count, table_bytes / max(entries, 1), memory / count / 1024))
+    print('get_peers latency: median %.1f ms, 90th percentile %.1f ms' %
+          (1000 * latencies[len(latencies) // 2], 1000 * latencies[len(latencies) * 9 // 10]))
+    
+    # Persist and reload a routing table
+    path = '/tmp/tirek-dht-benchmark'
+    nodes[1].table.save(path)
+    table = RoutingTable(nodes[1].node_id)
+    start = time.perf_counter()
+    table.load(path)
+    print('reloaded %i nodes in %.2f ms' % (table.node_count, 1000 * (time.perf_counter() - start)))
+    os.unlink(path)
+
@@ -0,0 +1,677 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import errno
+import bisect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import BLOCK_SIZE
+from stats import Counter
+import instrument
+
+
+MAX_OPEN_FILES = 256
+'''
+:int  The number of files kept open, files beyond this are closed least recently used first
+'''
+
+MAX_QUEUED = 256
+'''
+:int  The number of operations that may be queued or running before submitting more blocks
+'''
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and ('SC_IOV_MAX' in os.sysconf_names) else 1024
+'''
+:int  The maximum number of buffers in one vectored read or write
+'''
+
+class FilePool():
+    '''
+    Open files, closed least recently used first when too many are open
+    
+    Files are counted while they are in use by an operation, and are
+    only closed once no operation uses them.
+    '''
+    
+    def __init__(self, max_open = MAX_OPEN_FILES):
+        '''
+        Constructor
+        
+        @param  max_open:int  The number of files to keep open
+        '''
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.opens = 0
+    
+    
+    def acquire(self, path, write):
+        '''
+        Get a file descriptor for a file, and mark it in use
+        
+        @param   path:str    The path of the file
+        @param   write:bool  Whether the file will be written, it is then created if missing
+        @return  :int        The file descriptor
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.files.get(path)
+            if (entry is not None) and (entry[1] or not write):
+                self.files.move_to_end(path)
+                entry[2] += 1
+                return entry[0]
+        finally:
+            self.lock.release()
+        # Open without the lock held, opening can be slow
+        if write:
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+        closing = []
+        self.lock.acquire()
+        try:
+            self.opens += 1
+            entry = self.files.get(path)
+            if (entry is not None) and (entry[1] or not write):
+                # Another thread opened it meanwhile
+                closing.append(fd)
+                fd = entry[0]
+                entry[2] += 1
+                self.files.move_to_end(path)
+            else:
+                if entry is not None:
+                    # Replace a read-only descriptor, it is closed when no longer in use
+                    del self.files[path]
+                    if entry[2] == 0:
+                        closing.append(entry[0])
+                self.files[path] = [fd, write, 1]
+                closing += self.evict()
+        finally:
+            self.lock.release()
+        for old in closing:
+            os.close(old)
+        return fd
+    
+    
+    def release(self, path, fd):
+        '''
+        Mark a file as no longer in use by an operation
+        
+        @param  path:str  The path of the file
+        @param  fd:int    The file descriptor that `acquire` returned
+        '''
+        closing = []
+        self.lock.acquire()
+        try:
+            entry = self.files.get(path)
+            if (entry is not None) and (entry[0] == fd):
+                entry[2] -= 1
+                closing = self.evict()
+            else:
+                # The descriptor was replaced or evicted while in use
+                closing = [fd]
+        finally:
+            self.lock.release()
+        for old in closing:
+            os.close(old)
+    
+    
+    def evict(self):
+        '''
+        Forget the least recently used files that are not in use, the pool must be locked
+        
+        @return  :list<int>  The file descriptors to close
+        '''
+        closing = []
+        if len(self.files) <= self.max_open:
+            return closing
+        for path in list(self.files):
+            if len(self.files) <= self.max_open:
+                break
+            entry = self.files[path]
+            if entry[2] == 0:
+                del self.files[path]
+                closing.append(entry[0])
+        return closing
+    
+    
+    def close(self, prefix = None):
+        '''
+        Close all files that are not in use
+        
+        @param  prefix:str?  Only close files whose path starts with this, `None` for all
+        '''
+        closing = []
+        self.lock.acquire()
+        try:
+            for path in list(self.files):
+                entry = self.files[path]
+                if ((prefix is None) or path.startswith(prefix)) and (entry[2] == 0):
+                    del self.files[path]
+                    closing.append(entry[0])
+        finally:
+            self.lock.release()
+        for fd in closing:
+            os.close(fd)
+
+
+class Storage():
+    '''
+    The files of a torrent's payload, as one contiguous byte range
+    '''
+    
+    def __init__(self, root, files, piece_length):
+        '''
+        Constructor
+        
+        @param  root:str                            The directory the files are in
+        @param  files:list<(path:str, length:int)>  The files, with paths relative to `root`, in order
+        @param  piece_length:int                    The size of each piece but the last
+        '''
+        self.root = root
+        self.paths = [os.path.join(root, path) for (path, _length) in files]
+        self.lengths = [length for (_path, length) in files]
+        self.starts = []
+        total = 0
+        for length in self.lengths:
+            self.starts.append(total)
+            total += length
+        self.total_length = total
+        self.piece_length = piece_length
+    
+    
+    def spans(self, start, length):
+        '''
+        Get the parts of files that make up a byte range
+        
+        @param   start:int                                          The offset of the range in the payload
+        @param   length:int                                         The length of the range
+        @return  :itr<(path:str, offset:int, length:int)>  The spans, in order
+        '''
+        end = min(start + length, self.total_length)
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < end:
+            offset = start - self.starts[i]
+            length = min(self.lengths[i] - offset, end - start)
+            if length > 0:
+                yield (self.paths[i], offset, length)
+                start += length
+            i += 1
+
+
+def slice_views(views, start, length):
+    '''
+    Cut a byte range out of a sequence of buffers, without copying
+    
+    @param   views:list<memoryview>  The buffers, as one contiguous range
+    @param   start:int               The offset of the range
+    @param   length:int              The length of the range
+    @return  :list<memoryview>       The parts of the buffers in the range
+    '''
+    rc = []
+    for view in views:
+        if length <= 0:
+            break
+        if start >= len(view):
+            start -= len(view)
+            continue
+        part = view[start : start + length]
+        rc.append(part)
+        length -= len(part)
+        start = 0
+    return rc
+
+
+def write_vectored(fd, views, offset):
+    '''
+    Write buffers to a position in a file
+    
+    @param  fd:int                  The file descriptor
+    @param  views:list<memoryview>  The buffers, written contiguously
+    @param  offset:int              The position in the file
+    '''
+    while len(views) > 0:
+        batch = views[:IOV_MAX]
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, batch, offset)
+        else:
+            written = os.pwrite(fd, batch[0], offset)
+        offset += written
+        # Skip what was written, a short write leaves part of a buffer
+        views = slice_views(views, written, sum(len(view) for view in views) - written)
+
+
+def read_vectored(fd, views, offset):
+    '''
+    Fill buffers from a position in a file
+    
+    @param  fd:int                  The file descriptor
+    @param  views:list<memoryview>  The buffers, filled contiguously
+    @param  offset:int              The position in the file
+    '''
+    while len(views) > 0:
+        batch = views[:IOV_MAX]
+        if hasattr(os, 'preadv'):
+            count = os.preadv(fd, batch, offset)
+        else:
+            data = os.pread(fd, len(batch[0]), offset)
+            batch[0][: len(data)] = data
+            count = len(data)
+        if count == 0:
+            raise OSError(errno.EIO, os.strerror(errno.EIO) + ': short read')
+        offset += count
+        views = slice_views(views, count, sum(len(view) for view in views) - count)
+
+
+class DiskIO():
+    '''
+    Pool of threads that read and write payload files
+    
+    Written blocks that are adjacent are written with one `pwritev` per
+    file, and blocks are read with `preadv` into buffers that are
+    reused. Open files are shared through a `FilePool`. At most
+    `MAX_QUEUED` operations are queued, submitting more blocks until
+    one completes.
+    
+    Callbacks are called in the event loop if one is given, otherwise
+    in the worker thread.
+    '''
+    
+    def __init__(self, loop = None, workers = 4, max_open = MAX_OPEN_FILES, max_queued = MAX_QUEUED):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop?  The event loop to call callbacks in
+        @param  workers:int      The number of threads
+        @param  max_open:int     The number of files to keep open
+        @param  max_queued:int   The number of operations that may be queued or running
+        '''
+        self.loop = loop
+        self.files = FilePool(max_open)
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'disk')
+        self.slots = threading.BoundedSemaphore(max_queued)
+        self.buffers = []
+        self.buffer_lock = threading.Lock()
+        self.sparse = False
+        self.preallocate = True
+        self.latency = { 'read' : instrument.histogram('disk.read', 'Time to read blocks')
+                       , 'write' : instrument.histogram('disk.write', 'Time to write the blocks of a piece')
+                       , 'allocate' : instrument.histogram('disk.allocate', 'Time to create the files of a torrent')
+                       }
+        self.calls = Counter()
+        '''
+        :Counter  The number of vectored reads and writes
+        '''
+    
+    
+    def configure(self, p, changed = None):
+        '''
+        Apply the allocation preferences
+        
+        @param  p:preferences.Snapshot  The preferences
+        @param  changed:set<str>?       The names of the changed preferences
+        '''
+        self.sparse = p.allocation == 'sparse'
+        self.preallocate = p.preallocate
+    
+    
+    def submit(self, operation, callback, *args):
+        '''
+        Queue an operation, waiting while the queue is full
+        
+        @param  operation:(*args)→¿R?            The operation, run in a worker thread
+        @param  callback:(¿R?, OSError?)→void?  Called with the result or the error
+        @param  args:*                            The arguments of the operation
+        '''
+        self.slots.acquire()
+        self.executor.submit(self.run, operation, callback, args)
+    
+    
+    def run(self, operation, callback, args):
+        '''
+        Run an operation in a worker thread
+        
+        @param  operation:(*args)→¿R?            The operation
+        @param  callback:(¿R?, OSError?)→void?  Called with the result or the error
+        @param  args:tuple                        The arguments of the operation
+        '''
+        (result, error) = (None, None)
+        try:
+            result = operation(*args)
+        except OSError as e:
+            error = e
+        finally:
+            self.slots.release()
+        if callback is not None:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.deliver, callback, result, error)
+            else:
+                self.deliver(callback, result, error)
+    
+    
+    def deliver(self, callback, result, error):
+        '''
+        Call a callback, and reuse the buffers of a read afterwards
+        
+        @param  callback:(¿R?, OSError?)→void  The callback
+        @param  result:¿R?                     The result of the operation
+        @param  error:OSError?                 The error of the operation
+        '''
+        try:
+            callback(result, error)
+        finally:
+            if isinstance(result, ReadResult):
+                self.recycle(result.buffers)
+    
+    
+    def take_buffers(self, count):
+        '''
+        Get buffers for a read
+        
+        @param   count:int            The number of buffers
+        @return  :list<bytearray>     `BLOCK_SIZE` byte buffers
+        '''
+        self.buffer_lock.acquire()
+        try:
+            taken = self.buffers[len(self.buffers) - count:] if count <= len(self.buffers) else self.buffers[:]
+            del self.buffers[len(self.buffers) - len(taken):]
+        finally:
+            self.buffer_lock.release()
+        return taken + [bytearray(BLOCK_SIZE) for _ in range(count - len(taken))]
+    
+    
+    def recycle(self, buffers):
+        '''
+        Return buffers for reuse
+        
+        @param  buffers:list<bytearray>  The buffers
+        '''
+        self.buffer_lock.acquire()
+        try:
+            if len(self.buffers) < MAX_QUEUED * 4:
+                self.buffers += buffers
+        finally:
+            self.buffer_lock.release()
+    
+    
+    def write(self, storage, piece, blocks, callback = None):
+        '''
+        Write blocks of a piece, this function can be used as `BlockCache`'s `flush`
+        
+        @param  storage:Storage                        The torrent's files
+        @param  piece:int                              The index of the piece
+        @param  blocks:list<(offset:int, data:bytes)>  The blocks, with offsets within the piece
+        @param  callback:(void, OSError?)→void?        Called when the blocks have been written
+        '''
+        self.submit(self.write_now, callback, storage, piece, blocks)
+    
+    
+    def write_now(self, storage, piece, blocks):
+        '''
+        Write blocks of a piece, in the calling thread
+        
+        @param  storage:Storage                        The torrent's files
+        @param  piece:int                              The index of the piece
+        @param  blocks:list<(offset:int, data:bytes)>  The blocks, with offsets within the piece
+        '''
+        start = time.perf_counter()
+        base = piece * storage.piece_length
+        # Merge adjacent blocks into runs
+        runs, run_start, run_end = [], None, None
+        for (offset, data) in sorted(blocks, key = lambda block : block[0]):
+            if offset != run_end:
+                runs.append((offset, []))
+                run_end = offset
+            runs[-1][1].append(memoryview(data))
+            run_end += len(data)
+        for (offset, views) in runs:
+            length = sum(len(view) for view in views)
+            position = 0
+            for (path, file_offset, span) in storage.spans(base + offset, length):
+                fd = self.files.acquire(path, True)
+                try:
+                    write_vectored(fd, slice_views(views, position, span), file_offset)
+                    self.calls.add(1)
+                finally:
+                    self.files.release(path, fd)
+                position += span
+        self.latency['write'].record(time.perf_counter() - start)
+    
+    
+    def read(self, storage, piece, offset, length, callback):
+        '''
+        Read blocks of a piece
+        
+        The callback gets a `ReadResult` whose buffers are reused
+        once the callback returns, so data that is needed later
+        must be copied.
+        
+        @param  storage:Storage                         The torrent's files
+        @param  piece:int                               The index of the piece
+        @param  offset:int                              The offset within the piece
+        @param  length:int                              The number of bytes, normally whole blocks
+        @param  callback:(ReadResult?, OSError?)→void  Called when the blocks have been read
+        '''
+        self.submit(self.read_now, callback, storage, piece, offset, length)
+    
+    
+    def read_now(self, storage, piece, offset, length):
+        '''
+        Read blocks of a piece, in the calling thread
+        
+        @param   storage:Storage  The torrent's files
+        @param   piece:int        The index of the piece
+        @param   offset:int       The offset within the piece
+        @param   length:int       The number of bytes
+        @return  :ReadResult      The blocks
+        '''
+        start = time.perf_counter()
+        buffers = self.take_buffers((length + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        views = slice_views([memoryview(buf) for buf in buffers], 0, length)
+        position = 0
+        try:
+            for (path, file_offset, span) in storage.spans(piece * storage.piece_length + offset, length):
+                fd = self.files.acquire(path, False)
+                try:
+                    read_vectored(fd, slice_views(views, position, span), file_offset)
+                    self.calls.add(1)
+                finally:
+                    self.files.release(path, fd)
+                position += span
+        except OSError:
+            self.recycle(buffers)
+            raise
+        self.latency['read'].record(time.perf_counter() - start)
+        return ReadResult(buffers, views)
+    
+    
+    def allocate(self, storage, callback = None):
+        '''
+        Create a torrent's files, and preallocate them if the preferences say so
+        
+        With full allocation the disk space is reserved, with sparse
+        allocation the files are only extended to their full length.
+        
+        @param  storage:Storage                  The torrent's files
+        @param  callback:(void, OSError?)→void?  Called when the files have been created
+        '''
+        self.submit(self.allocate_now, callback, storage, self.preallocate, self.sparse)
+    
+    
+    def allocate_now(self, storage, preallocate, sparse):
+        '''
+        Create a torrent's files, in the calling thread
+        
+        @param  storage:Storage    The torrent's files
+        @param  preallocate:bool   Whether to extend the files to their full length
+        @param  sparse:bool        Whether to leave the files sparse rather than reserve the space
+        '''
+        start = time.perf_counter()
+        for (path, length) in zip(storage.paths, storage.lengths):
+            fd = self.files.acquire(path, True)
+            try:
+                if not preallocate:
+                    continue
+                if not sparse and hasattr(os, 'posix_fallocate') and (length > 0):
+                    try:
+                        os.posix_fallocate(fd, 0, length)
+                        continue
+                    except OSError as e:
+                        # Fall back to sparse files on file systems that cannot reserve space
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+                if os.fstat(fd).st_size < length:
+                    os.ftruncate(fd, length)
+            finally:
+                self.files.release(path, fd)
+        self.latency['allocate'].record(time.perf_counter() - start)
+    
+    
+    def close_storage(self, storage):
+        '''
+        Close the files of a torrent that are not in use
+        
+        @param  storage:Storage  The torrent's files
+        '''
+        self.files.close(storage.root + os.sep)
+    
+    
+    def close(self):
+        '''
+        Wait for queued operations and close all files
+        '''
+        self.executor.shutdown(wait = True)
+        self.files.close()
+
+
+class ReadResult():
+    '''
+    Blocks that have been read into reused buffers
+    '''
+    
+    __slots__ = ('buffers', 'views')
+    
+    def __init__(self, buffers, views):
+        '''
+        Constructor
+        
+        @param  buffers:list<bytearray>   The buffers, returned for reuse after the callback
+        @param  views:list<memoryview>    The blocks, in order, views into the buffers
+        '''
+        self.buffers = buffers
+        self.views = views
+
+
+if __name__ == '__main__':
+    # Compare writing and reading a torrent block by block with the pool, and open many small files
+    import sys, shutil, random, tempfile
+    instrument.enable()
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    file_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    root = tempfile.mkdtemp(prefix = 'tirek-diskio-')
+    try:
+        piece_length = 256 << 10
+        files = [('payload/file%02i' % i, (size_mib << 20) // 32) for i in range(32)]
+        pieces = (size_mib << 20) // piece_length
+        data = os.urandom(BLOCK_SIZE)
+        blocks = [(offset, data) for offset in range(0, piece_length, BLOCK_SIZE)]
+        # Pieces arrive in random order, as from a swarm
+        order = random.sample(range(pieces), pieces)
+        
+        naive = Storage(os.path.join(root, 'naive'), files, piece_length)
+        start = time.perf_counter()
+        calls = 0
+        for piece in order:
+            for (offset, block) in blocks:
+                for (path, file_offset, span) in naive.spans(piece * piece_length + offset, len(block)):
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+                    os.pwrite(fd, block[:span], file_offset)
+                    os.close(fd)
+                    calls += 3
+        elapsed = time.perf_counter() - start
+        print('write %i MiB, open/pwrite/close per block:  %6.0f ms, %6i system calls' %
+              (size_mib, 1000 * elapsed, calls))
+        
+        disk = DiskIO()
+        storage = Storage(os.path.join(root, 'pool'), files, piece_length)
+        start = time.perf_counter()
+        disk.allocate(storage)
+        for piece in order:
+            disk.write(storage, piece, blocks)
+        disk.executor.shutdown(wait = True)
+        elapsed = time.perf_counter() - start
+        print('write %i MiB, pooled pwritev per piece:     %6.0f ms, %6i system calls' %
+              (size_mib, 1000 * elapsed, disk.calls.value() + disk.files.opens))
+        print('  %-8s %s' % ('write', disk.latency['write']))
+        disk.close()
+        
+        start = time.perf_counter()
+        for piece in order:
+            for (offset, _block) in blocks:
+                for (path, file_offset, span) in naive.spans(piece * piece_length + offset, BLOCK_SIZE):
+                    fd = os.open(path, os.O_RDONLY)
+                    os.pread(fd, span, file_offset)
+                    os.close(fd)
+        print('read  %i MiB, open/pread/close per block:   %6.0f ms' % (size_mib, 1000 * (time.perf_counter() - start)))
+        
+        disk = DiskIO()
+        done = []
+        start = time.perf_counter()
+        for piece in order:
+            disk.read(storage, piece, 0, piece_length, lambda result, error : done.append(error))
+        disk.executor.shutdown(wait = True)
+        print('read  %i MiB, pooled preadv, reused buffers: %6.0f ms, %i errors, %i buffers allocated' %
+              (size_mib, 1000 * (time.perf_counter() - start), sum(e is not None for e in done), len(disk.buffers)))
+        print('  %-8s %s' % ('read', disk.latency['read']))
+        disk.close()
+        
+        for sparse in (False, True):
+            disk = DiskIO()
+            disk.sparse = sparse
+            storage = Storage(os.path.join(root, 'sparse' if sparse else 'full'), files, piece_length)
+            start = time.perf_counter()
+            disk.allocate(storage)
+            disk.close()
+            used = sum(os.stat(path).st_blocks * 512 for path in storage.paths)
+            print('%s allocation of %i MiB: %.1f ms, %i MiB reserved' %
+                  ('sparse' if sparse else 'full  ', size_mib, 1000 * (time.perf_counter() - start), used >> 20))
+        
+        # Many small files, with few open at a time
+        disk = DiskIO(max_open = 256)
+        many = Storage(os.path.join(root, 'many'), [('f/%i' % i, 1024) for i in range(file_count)], BLOCK_SIZE)
+        peak = [0]
+        def check(result, error):
+            peak[0] = max(peak[0], len(disk.files.files))
+        start = time.perf_counter()
+        for piece in range((many.total_length + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            disk.write(many, piece, [(0, data)], check)
+        disk.close()
+        print('%i files of 1 KiB written in %.0f ms, at most %i open (limit %i), %i opens' %
+              (file_count, 1000 * (time.perf_counter() - start), peak[0], disk.files.max_open, disk.files.opens))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,298 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import heapq
+import signal
+import selectors
+import threading
+from collections import deque
+
+
+class Timer():
+    '''
+    A callback scheduled to be called at a specific time
+    '''
+    
+    __slots__ = ('when', 'seq', 'callback', 'args', 'cancelled')
+    
+    def __init__(self, when, seq, callback, args):
+        '''
+        Constructor
+        
+        @param  when:float                 The monotonic time when the callback is due
+        @param  seq:int                    Sequence number, used to keep the scheduling order stable
+        @param  callback:(*args)→void      The function to call
+        @param  args:tuple<¿I?>            The arguments to pass to `callback`
+        '''
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+    
+    
+    def cancel(self):
+        '''
+        Prevent the callback from being called
+        '''
+        self.cancelled = True
+
+
+class EventLoop():
+    '''
+    Single-threaded event loop for file descriptors, timers and signals
+    
+    Signals are delivered through a wakeup pipe, so their callbacks are
+    called from the loop rather than from a signal handler. The same pipe
+    is used to wake the loop when other threads schedule callbacks.
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.ready = deque()
+        self.seq = 0
+        self.running = False
+        self.thread = None
+        self.signal_handlers = {}
+        self.saved_signals = {}
+        self.saved_wakeup_fd = None
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, ((self.read_wakeup, ()), None))
+    
+    
+    def add_reader(self, fd, callback, *args):
+        '''
+        Call a function whenever a file descriptor is readable
+        
+        @param  fd:int                 The file descriptor
+        @param  callback:(*args)→void  The function to call
+        @param  args:*¿I?              The arguments to pass to `callback`
+        '''
+        self.modify(fd, 0, (callback, args))
+    
+    
+    def remove_reader(self, fd):
+        '''
+        Stop watching a file descriptor for readability
+        
+        @param  fd:int  The file descriptor
+        '''
+        self.modify(fd, 0, None)
+    
+    
+    def add_writer(self, fd, callback, *args):
+        '''
+        Call a function whenever a file descriptor is writable
+        
+        @param  fd:int                 The file descriptor
+        @param  callback:(*args)→void  The function to call
+        @param  args:*¿I?              The arguments to pass to `callback`
+        '''
+        self.modify(fd, 1, (callback, args))
+    
+    
+    def remove_writer(self, fd):
+        '''
+        Stop watching a file descriptor for writability
+        
+        @param  fd:int  The file descriptor
+        '''
+        self.modify(fd, 1, None)
+    
+    
+    def modify(self, fd, index, handler):
+        '''
+        Update the registration of a file descriptor
+        
+        @param  fd:int                               The file descriptor
+        @param  index:int                            0 for the reader, 1 for the writer
+        @param  handler:(callback, args)?            The new reader or writer, `None` to remove it
+        '''
+        try:
+            handlers = list(self.selector.get_key(fd).data)
+        except KeyError:
+            handlers = [None, None]
+        handlers[index] = handler
+        events = (selectors.EVENT_READ if handlers[0] else 0) | (selectors.EVENT_WRITE if handlers[1] else 0)
+        try:
+            if events == 0:
+                self.selector.unregister(fd)
+            else:
+                self.selector.modify(fd, events, tuple(handlers))
+        except KeyError:
+            if events != 0:
+                self.selector.register(fd, events, tuple(handlers))
+    
+    
+    def call_soon(self, callback, *args):
+        '''
+        Call a function on the next iteration of the loop
+        
+        @param  callback:(*args)→void  The function to call
+        @param  args:*¿I?              The arguments to pass to `callback`
+        '''
+        self.ready.append((callback, args))
+    
+    
+    def call_soon_threadsafe(self, callback, *args):
+        '''
+        Call a function on the next iteration of the loop, from any thread
+        
+        @param  callback:(*args)→void  The function to call
+        @param  args:*¿I?              The arguments to pass to `callback`
+        '''
+        self.ready.append((callback, args))
+        if self.thread != threading.get_ident():
+            self.wakeup()
+    
+    
+    def call_later(self, delay, callback, *args):
+        '''
+        Call a function after a delay
+        
+        @param   delay:float            The delay in seconds
+        @param   callback:(*args)→void  The function to call
+        @param   args:*¿I?              The arguments to pass to `callback`
+        @return  :Timer                 Handle that can be used to cancel the call
+        '''
+        self.seq += 1
+        timer = Timer(time.monotonic() + delay, self.seq, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+    
+    
+    def add_signal_handler(self, signo, callback, *args):
+        '''
+        Call a function from the loop whenever a signal is received
+        
+        This must be done from the main thread
+        
+        @param  signo:int              The signal
+        @param  callback:(*args)→void  The function to call
+        @param  args:*¿I?              The arguments to pass to `callback`
+        '''
+        if self.saved_wakeup_fd is None:
+            self.saved_wakeup_fd = signal.set_wakeup_fd(self.wakeup_w)
+        if signo not in self.saved_signals:
+            self.saved_signals[signo] = signal.signal(signo, lambda _signal, _frame : None)
+        self.signal_handlers[signo] = (callback, args)
+    
+    
+    def wakeup(self):
+        '''
+        Interrupt the loop's wait for events
+        '''
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+    
+    
+    def read_wakeup(self):
+        '''
+        Drain the wakeup pipe and dispatch received signals
+        '''
+        try:
+            data = os.read(self.wakeup_r, 4096)
+        except BlockingIOError:
+            return
+        for signo in set(data):
+            if signo in self.signal_handlers:
+                (callback, args) = self.signal_handlers[signo]
+                callback(*args)
+    
+    
+    def stop(self):
+        '''
+        Make the loop return after the current iteration, from any thread
+        '''
+        self.running = False
+        if self.thread != threading.get_ident():
+            self.wakeup()
+    
+    
+    def run(self):
+        '''
+        Run the loop until it is stopped
+        '''
+        self.running = True
+        self.thread = threading.get_ident()
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.thread = None
+    
+    
+    def run_once(self):
+        '''
+        Wait for and dispatch one round of events
+        '''
+        # Calculate how long we may wait
+        timeout = None
+        if len(self.ready) > 0:
+            timeout = 0
+        elif len(self.timers) > 0:
+            timeout = max(self.timers[0].when - time.monotonic(), 0)
+        
+        # Dispatch file descriptors
+        for (key, events) in self.selector.select(timeout):
+            (reader, writer) = key.data
+            if (events & selectors.EVENT_READ) and reader:
+                reader[0](*reader[1])
+            if (events & selectors.EVENT_WRITE) and writer:
+                writer[0](*writer[1])
+        
+        # Move due timers to the ready queue
+        now = time.monotonic()
+        while (len(self.timers) > 0) and (self.timers[0].when <= now):
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.ready.append((timer.callback, timer.args))
+        
+        # Call all callbacks that were ready before this point
+        for _ in range(len(self.ready)):
+            (callback, args) = self.ready.popleft()
+            callback(*args)
+    
+    
+    def close(self):
+        '''
+        Release the loop's resources and restore signal handlers
+        '''
+        for (signo, handler) in self.saved_signals.items():
+            signal.signal(signo, handler)
+        if self.saved_wakeup_fd is not None:
+            signal.set_wakeup_fd(self.saved_wakeup_fd)
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
@@ -0,0 +1,339 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import mmap
+import socket
+from collections import OrderedDict
+
+
+COUNTRY_CODES = ( '--', 'AP', 'EU', 'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'CW', 'AO', 'AQ', 'AR', 'AS', 'AT'
+                , 'AU', 'AW', 'AZ', 'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BM', 'BN', 'BO', 'BR'
+                , 'BS', 'BT', 'BV', 'BW', 'BY', 'BZ', 'CA', 'CC', 'CD', 'CF', 'CG', 'CH', 'CI', 'CK', 'CL', 'CM'
+                , 'CN', 'CO', 'CR', 'CU', 'CV', 'CX', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM', 'DO', 'DZ', 'EC', 'EE'
+                , 'EG', 'EH', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FK', 'FM', 'FO', 'FR', 'SX', 'GA', 'GB', 'GD', 'GE'
+                , 'GF', 'GH', 'GI', 'GL', 'GM', 'GN', 'GP', 'GQ', 'GR', 'GS', 'GT', 'GU', 'GW', 'GY', 'HK', 'HM'
+                , 'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IN', 'IO', 'IQ', 'IR', 'IS', 'IT', 'JM', 'JO', 'JP'
+                , 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW', 'KY', 'KZ', 'LA', 'LB', 'LC', 'LI', 'LK'
+                , 'LR', 'LS', 'LT', 'LU', 'LV', 'LY', 'MA', 'MC', 'MD', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MO'
+                , 'MP', 'MQ', 'MR', 'MS', 'MT', 'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NC', 'NE', 'NF', 'NG'
+                , 'NI', 'NL', 'NO', 'NP', 'NR', 'NU', 'NZ', 'OM', 'PA', 'PE', 'PF', 'PG', 'PH', 'PK', 'PL', 'PM'
+                , 'PN', 'PR', 'PS', 'PT', 'PW', 'PY', 'QA', 'RE', 'RO', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE'
+                , 'SG', 'SH', 'SI', 'SJ', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'ST', 'SV', 'SY', 'SZ', 'TC', 'TD'
+                , 'TF', 'TG', 'TH', 'TJ', 'TK', 'TM', 'TN', 'TO', 'TL', 'TR', 'TT', 'TV', 'TW', 'TZ', 'UA', 'UG'
+                , 'UM', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VG', 'VI', 'VN', 'VU', 'WF', 'WS', 'YE', 'YT', 'RS'
+                , 'ZA', 'ZM', 'ME', 'ZW', 'A1', 'A2', 'O1', 'AX', 'GG', 'IM', 'JE', 'BL', 'MF', 'BQ', 'SS', 'O1'
+                )
+'''
+:tuple<str>  Country codes by country ID in the legacy GeoIP format, `--` is unknown
+'''
+
+COUNTRY_BEGIN = 16776960
+'''
+:int  Records at or above this are leaves, the country ID is the record minus this
+'''
+
+RECORD_LENGTH = 3
+'''
+:int  The size of a pointer in the tree, each node holds two
+'''
+
+COUNTRY_EDITION = 1
+'''
+:int  Database type of IPv4 country databases
+'''
+
+COUNTRY_EDITION_V6 = 12
+'''
+:int  Database type of IPv6 country databases
+'''
+
+STRUCTURE_INFO_MAX_SIZE = 20
+'''
+:int  The number of bytes at the end of the file in which the database type is searched
+'''
+
+CACHE_SIZE = 8192
+'''
+:int  The default number of looked up addresses to remember
+'''
+
+
+class Database():
+    '''
+    A legacy GeoIP country database, searched directly in a read-only mapping
+    '''
+    
+    def __init__(self, path):
+        '''
+        Constructor
+        
+        @param  path:str  The database file
+        '''
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.type = COUNTRY_EDITION
+        tail = self.map[-STRUCTURE_INFO_MAX_SIZE - 4:]
+        i = tail.rfind(b'\xff\xff\xff')
+        if (i >= 0) and (i + 3 < len(tail)):
+            self.type = tail[i + 3] - (105 if tail[i + 3] >= 106 else 0)
+        self.depth = 128 if self.type == COUNTRY_EDITION_V6 else 32
+    
+    
+    def lookup(self, number):
+        '''
+        Find the country of an address
+        
+        @param   number:int  The address as an integer, 32 bits for IPv4 and 128 bits for IPv6
+        @return  :int        The country ID, an index in `COUNTRY_CODES`
+        '''
+        m, offset = self.map, 0
+        size = len(m)
+        for depth in range(self.depth - 1, -1, -1):
+            pos = 2 * RECORD_LENGTH * offset + (RECORD_LENGTH if (number >> depth) & 1 else 0)
+            if pos + RECORD_LENGTH > size:
+                return 0
+            offset = m[pos] | (m[pos + 1] << 8) | (m[pos + 2] << 16)
+            if offset >= COUNTRY_BEGIN:
+                return offset - COUNTRY_BEGIN
+        return 0
+    
+    
+    def close(self):
+        '''
+        Unmap the database
+        '''
+        self.map.close()
+
+
+def open_database(path):
+    '''
+    @param   path:str     The database file
+    @return  :Database?   The database, `None` if it cannot be opened
+    '''
+    try:
+        return Database(path)
+    except (OSError, ValueError):
+        return None
+
+
+class GeoIP():
+    '''
+    Country lookup for peer addresses, with a bounded cache of recent results
+    '''
+    
+    def __init__(self, ipv4_path = None, ipv6_path = None, cache_size = CACHE_SIZE):
+        '''
+        Constructor
+        
+        @param  ipv4_path:str?   The IPv4 country database
+        @param  ipv6_path:str?   The IPv6 country database
+        @param  cache_size:int   The number of addresses to remember
+        '''
+        self.ipv4 = None
+        self.ipv6 = None
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.open(ipv4_path, ipv6_path)
+    
+    
+    def open(self, ipv4_path, ipv6_path):
+        '''
+        Replace the databases
+        
+        @param  ipv4_path:str?  The IPv4 country database
+        @param  ipv6_path:str?  The IPv6 country database
+        '''
+        self.close()
+        self.ipv4 = open_database(ipv4_path) if ipv4_path else None
+        self.ipv6 = open_database(ipv6_path) if ipv6_path else None
+    
+    
+    def configure(self, preferences, changed = None):
+        '''
+        Open the databases named in the preferences, can be used as a
+        subscriber to the ‘geoip’ section
+        
+        @param  preferences:preferences.Snapshot  The preferences
+        @param  changed:set<str>?                 The names of the changed preferences
+        '''
+        self.open(preferences.geoip_ipv4, preferences.geoip_ipv6)
+    
+    
+    def resolve(self, host):
+        '''
+        Look up an address without the cache
+        
+        @param   host:str  The address
+        @return  :str      The two letter country code, `--` if unknown
+        '''
+        try:
+            if ':' in host:
+                number = int.from_bytes(socket.inet_pton(socket.AF_INET6, host), 'big')
+                if (number >> 32) == 0xffff and self.ipv4 is not None:
+                    return COUNTRY_CODES[self.ipv4.lookup(number & 0xffffffff) & 255]
+                database = self.ipv6
+            else:
+                number = int.from_bytes(socket.inet_aton(host), 'big')
+                database = self.ipv4
+                if (database is None) and (self.ipv6 is not None):
+                    (number, database) = ((0xffff << 32) | number, self.ipv6)
+        except OSError:
+            return '--'
+        if database is None:
+            return '--'
+        return COUNTRY_CODES[database.lookup(number) & 255]
+    
+    
+    def country(self, host):
+        '''
+        Look up an address
+        
+        @param   host:str  The address
+        @return  :str      The two letter country code, `--` if unknown
+        '''
+        return self.countries([host])[0]
+    
+    
+    def countries(self, hosts):
+        '''
+        Look up many addresses, such as all peers of a torrent
+        
+        Addresses that are not cached are looked up in address order,
+        so lookups that share the upper levels of the tree touch the
+        same pages of the mapping one after another.
+        
+        @param   hosts:list<str>  The addresses
+        @return  :list<str>       The two letter country codes, `--` where unknown
+        '''
+        cache, rc, missing = self.cache, [None] * len(hosts), {}
+        for (i, host) in enumerate(hosts):
+            code = cache.get(host)
+            if code is None:
+                missing.setdefault(host, []).append(i)
+            else:
+                cache.move_to_end(host)
+                rc[i] = code
+        self.hits += len(hosts) - sum(map(len, missing.values()))
+        self.misses += len(missing)
+        for host in sorted(missing, key = address_order):
+            code = cache[host] = self.resolve(host)
+            for i in missing[host]:
+                rc[i] = code
+        while len(cache) > self.cache_size:
+            cache.popitem(last = False)
+        return rc
+    
+    
+    def close(self):
+        '''
+        Unmap the databases and forget cached results
+        '''
+        for database in (self.ipv4, self.ipv6):
+            if database is not None:
+                database.close()
+        self.ipv4 = self.ipv6 = None
+        self.cache.clear()
+
+
+def address_order(host):
+    '''
+    @param   host:str             An address
+    @return  :(int, bytes)        Sort key that orders addresses numerically, IPv4 first
+    '''
+    try:
+        if ':' in host:
+            return (1, socket.inet_pton(socket.AF_INET6, host))
+        return (0, socket.inet_aton(host))
+    except OSError:
+        return (2, b'')
+
+
+def write_database(path, networks, ipv6 = False):
+    '''
+    Write a legacy GeoIP country database, for testing
+    
+    @param  path:str                                  The output file
+    @param  networks:list<(network:str, country:str)>  Networks in CIDR notation, and their country
+                                                      codes, later networks override earlier
+    @param  ipv6:bool                                 Whether to write an IPv6 database
+    '''
+    depth = 128 if ipv6 else 32
+    leaf = lambda code : ('leaf', COUNTRY_CODES.index(code))
+    root = [leaf('--'), leaf('--')]
+    for (network, code) in networks:
+        (address, _sep, length) = network.partition('/')
+        family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        number = int.from_bytes(socket.inet_pton(family, address), 'big')
+        length = int(length or depth)
+        node = root
+        for level in range(depth - 1, depth - length, -1):
+            bit = (number >> level) & 1
+            if node[bit][0] == 'leaf':
+                node[bit] = [node[bit], node[bit]]
+            node = node[bit]
+        node[(number >> (depth - length)) & 1] = leaf(code)
+    # Number the nodes breadth first, and encode them
+    nodes, i = [root], 0
+    while i < len(nodes):
+        for child in nodes[i]:
+            if child[0] != 'leaf':
+                nodes.append(child)
+        i += 1
+    numbers = dict((id(node), n) for (n, node) in enumerate(nodes))
+    data = bytearray()
+    for node in nodes:
+        for child in node:
+            record = COUNTRY_BEGIN + child[1] if child[0] == 'leaf' else numbers[id(child)]
+            data += record.to_bytes(RECORD_LENGTH, 'little')
+    data += b'\xff\xff\xff' + bytes([COUNTRY_EDITION_V6 if ipv6 else COUNTRY_EDITION])
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+if __name__ == '__main__':
+    # Build a fixture with many networks and benchmark looking up the peers of a torrent
+    import sys, time, random, tempfile
+    directory = tempfile.mkdtemp()
+    v4, v6 = os.path.join(directory, 'GeoIP.dat'), os.path.join(directory, 'GeoIPv6.dat')
+    codes = [code for code in COUNTRY_CODES if code not in ('--', 'O1')]
+    networks = [('%i.%i.0.0/16' % (random.randrange(1, 224), random.randrange(256)), random.choice(codes))
+                for _ in range(20000)]
+    networks.append(('8.8.8.0/24', 'US'))
+    write_database(v4, networks)
+    write_database(v6, [('2001:db8::/32', 'SE')], ipv6 = True)
+    geoip = GeoIP(v4, v6)
+    assert geoip.country('8.8.8.8') == 'US'
+    assert geoip.country('2001:db8::1') == 'SE'
+    assert geoip.country('::ffff:8.8.8.8') == 'US'
+    assert geoip.country('not an address') == '--'
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    hosts = ['%i.%i.%i.%i' % (random.randrange(1, 224), random.randrange(256), random.randrange(256),
+                              random.randrange(256)) for _ in range(count)]
+    print('database: %i bytes mapped' % os.stat(v4).st_size)
+    start = time.perf_counter()
+    geoip.countries(hosts)
+    print('%i peers, cold: %.2f µs per peer' % (count, 1e6 * (time.perf_counter() - start) / count))
+    start = time.perf_counter()
+    for _i in range(100):
+        geoip.countries(hosts)
+    print('%i peers, cached: %.2f µs per peer, %.2f ms per refresh' %
+          (count, 1e4 * (time.perf_counter() - start) / count, 10 * (time.perf_counter() - start)))
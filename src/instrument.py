@@ -0,0 +1,488 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from stats import Counter as CellCounter
+
+
+enabled = os.environ.get('TIREK_INSTRUMENT', '') not in ('', '0')
+'''
+:bool  Whether metrics are recorded, when not, recording returns immediately;
+       set with `TIREK_INSTRUMENT=1` or `enable`
+'''
+
+HISTOGRAM_BUCKETS = 32
+'''
+:int  The number of latency buckets, bucket i counts operations that took less than 2ⁱ microseconds
+'''
+
+
+def enable(on = True):
+    '''
+    Start or stop recording metrics
+    
+    @param  on:bool  Whether to record metrics
+    '''
+    global enabled
+    enabled = on
+
+
+class Counter():
+    '''
+    A count of events, which any thread can add to without locking
+    '''
+    
+    kind = 'counter'
+    
+    def __init__(self, name, description):
+        '''
+        Constructor
+        
+        @param  name:str          The name of the metric
+        @param  description:str   What is counted
+        '''
+        self.name = name
+        self.description = description
+        self.cells = CellCounter()
+    
+    
+    def add(self, amount = 1):
+        '''
+        Count events
+        
+        @param  amount:int  The number of events
+        '''
+        if enabled:
+            self.cells.add(amount)
+    
+    
+    def value(self):
+        '''
+        @return  :int  The number of events
+        '''
+        return self.cells.value()
+    
+    
+    def format(self):
+        '''
+        @return  :str  The value, for the overlay
+        '''
+        return '%i' % self.value()
+
+
+class Gauge():
+    '''
+    A value that goes up and down
+    '''
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, description):
+        '''
+        Constructor
+        
+        @param  name:str          The name of the metric
+        @param  description:str   What is measured
+        '''
+        self.name = name
+        self.description = description
+        self.current = 0
+    
+    
+    def set(self, value):
+        '''
+        Set the value
+        
+        @param  value:int|float  The value
+        '''
+        if enabled:
+            self.current = value
+    
+    
+    def value(self):
+        '''
+        @return  :int|float  The value
+        '''
+        return self.current
+    
+    
+    def format(self):
+        '''
+        @return  :str  The value, for the overlay
+        '''
+        return '%g' % self.current
+
+
+class Histogram():
+    '''
+    Latency histogram with power-of-two buckets
+    '''
+    
+    kind = 'histogram'
+    
+    def __init__(self, name = '', description = ''):
+        '''
+        Constructor
+        
+        @param  name:str          The name of the metric
+        @param  description:str   What is timed
+        '''
+        self.name = name
+        self.description = description
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+    
+    
+    def start(self):
+        '''
+        Start timing an operation
+        
+        @return  :float?  The start time, `None` when not recording
+        '''
+        return time.perf_counter() if enabled else None
+    
+    
+    def stop(self, start):
+        '''
+        Finish timing an operation
+        
+        @param  start:float?  The value `start` returned
+        '''
+        if start is not None:
+            self.record(time.perf_counter() - start)
+    
+    
+    def record(self, seconds):
+        '''
+        Count an operation
+        
+        @param  seconds:float  The time the operation took
+        '''
+        if not enabled:
+            return
+        bucket = min(max(int(seconds * 1000000), 0).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.lock.acquire()
+        try:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+        finally:
+            self.lock.release()
+    
+    
+    def percentile(self, fraction):
+        '''
+        Estimate a percentile
+        
+        @param   fraction:float  The percentile, between 0 and 1
+        @return  :float          The upper bound of the bucket the percentile is in, in seconds
+        '''
+        wanted = fraction * self.count
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if (seen >= wanted) and (seen > 0):
+                return (1 << bucket) / 1000000
+        return 0.0
+    
+    
+    def mean(self):
+        '''
+        @return  :float  The mean time of an operation, in seconds
+        '''
+        return self.total / max(self.count, 1)
+    
+    
+    def value(self):
+        '''
+        @return  :dict  The count, sum and percentiles, in seconds
+        '''
+        return { 'count' : self.count
+               , 'sum' : self.total
+               , 'p50' : self.percentile(0.5)
+               , 'p99' : self.percentile(0.99)
+               , 'buckets' : list(self.buckets)
+               }
+    
+    
+    def format(self):
+        '''
+        @return  :str  The count, mean and percentiles, for the overlay
+        '''
+        return str(self)
+    
+    
+    def __str__(self):
+        '''
+        @return  :str  The count, mean and percentiles
+        '''
+        return '%i ops, mean %.0f µs, p50 < %.0f µs, p99 < %.0f µs' % ( self.count
+                                                                       , 1000000 * self.mean()
+                                                                       , 1000000 * self.percentile(0.5)
+                                                                       , 1000000 * self.percentile(0.99)
+                                                                       )
+
+
+class TimedCondition():
+    '''
+    A `threading.Condition` that measures how long it is waited for and held
+    
+    Only `acquire` and `release` are timed, time spent in `wait`
+    counts as held.
+    '''
+    
+    def __init__(self, name):
+        '''
+        Constructor
+        
+        @param  name:str  The prefix of the names of the metrics
+        '''
+        self.cond = threading.Condition()
+        self.waited = histogram(name + '.wait', 'Time waited to acquire the lock')
+        self.held = histogram(name + '.hold', 'Time the lock was held')
+        self.depth = 0
+        self.acquired = None
+        self.wait = self.cond.wait
+        self.notify = self.cond.notify
+        self.notify_all = self.cond.notify_all
+    
+    
+    def acquire(self):
+        '''
+        Acquire the lock, the lock is reentrant
+        '''
+        start = self.waited.start()
+        self.cond.acquire()
+        self.depth += 1
+        if (start is not None) and (self.depth == 1):
+            self.acquired = time.perf_counter()
+            self.waited.record(self.acquired - start)
+    
+    
+    def release(self):
+        '''
+        Release the lock
+        '''
+        self.depth -= 1
+        if self.depth == 0:
+            self.held.stop(self.acquired)
+            self.acquired = None
+        self.cond.release()
+    
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    
+    def __exit__(self, *_exc):
+        self.release()
+
+
+class Registry():
+    '''
+    All metrics, by name
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+    
+    
+    def get(self, cls, name, description):
+        '''
+        Get a metric, creating it if it does not exist
+        
+        @param   cls:type          The class of the metric
+        @param   name:str          The name of the metric, dot-separated
+        @param   description:str   What the metric measures
+        @return  :Counter|Gauge|Histogram  The metric
+        '''
+        self.lock.acquire()
+        try:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, description)
+            elif not isinstance(metric, cls):
+                raise TypeError('%s is a %s' % (name, metric.kind))
+            return metric
+        finally:
+            self.lock.release()
+    
+    
+    def snapshot(self):
+        '''
+        @return  :dict<str, int|float|dict>  The values of all metrics, by name
+        '''
+        return dict((name, metric.value()) for (name, metric) in list(self.metrics.items()))
+    
+    
+    def format_lines(self, width):
+        '''
+        Format all metrics for the overlay
+        
+        @param   width:int    The width of the lines
+        @return  :list<str>   The lines
+        '''
+        metrics = list(self.metrics.values())
+        name_width = min(max([len(metric.name) for metric in metrics] + [0]) + 2, width // 2)
+        return [('%-*s %s' % (name_width, metric.name[:name_width], metric.format()))[:width] for metric in metrics]
+    
+    
+    def prometheus(self):
+        '''
+        Format all metrics in the Prometheus text exposition format
+        
+        @return  :str  The metrics
+        '''
+        lines = []
+        for metric in list(self.metrics.values()):
+            name = 'tirek_' + metric.name.replace('.', '_').replace('-', '_')
+            if metric.kind == 'histogram':
+                name += '_seconds'
+            elif metric.kind == 'counter':
+                name += '_total'
+            lines.append('# HELP %s %s' % (name, metric.description))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            if metric.kind != 'histogram':
+                lines.append('%s %s' % (name, metric.value()))
+                continue
+            cumulative = 0
+            for (bucket, count) in enumerate(metric.buckets[:-1]):
+                cumulative += count
+                lines.append('%s_bucket{le="%g"} %i' % (name, (1 << bucket) / 1000000, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %i' % (name, metric.count))
+            lines.append('%s_sum %r' % (name, metric.total))
+            lines.append('%s_count %i' % (name, metric.count))
+        return '\n'.join(lines) + '\n'
+    
+    
+    def dump(self, path = None):
+        '''
+        Write all metrics to a file, replacing it atomically
+        
+        @param   path:str?  The file, as Prometheus text unless it ends with `.json`,
+                            `metrics_path()` by default
+        @return  :str       The file
+        '''
+        from remote import socket_path, private_directory
+        path = path or metrics_path()
+        if os.path.dirname(path) == os.path.dirname(socket_path()):
+            private_directory(os.path.dirname(path))
+        else:
+            os.makedirs(os.path.dirname(path), mode = 0o700, exist_ok = True)
+        if path.endswith('.json'):
+            data = json.dumps({ 'time' : time.time(), 'pid' : os.getpid(), 'metrics' : self.snapshot() }, indent = 1)
+        else:
+            data = self.prometheus()
+        with open(path + '.tmp', 'w') as file:
+            file.write(data)
+        os.rename(path + '.tmp', path)
+        return path
+
+
+def metrics_path():
+    '''
+    @return  :str  The file metrics are dumped to, `$TIREK_METRICS`, or `metrics-$PID.prom`
+                   next to the daemon's socket
+    '''
+    from remote import socket_path
+    return os.environ.get('TIREK_METRICS') or os.path.join(os.path.dirname(socket_path()),
+                                                           'metrics-%i.prom' % os.getpid())
+
+
+registry = Registry()
+'''
+:Registry  The metrics of this process
+'''
+
+
+def counter(name, description = ''):
+    '''
+    @param   name:str          The name of the metric, dot-separated
+    @param   description:str   What is counted
+    @return  :Counter          The counter, it is created if it does not exist
+    '''
+    return registry.get(Counter, name, description)
+
+
+def gauge(name, description = ''):
+    '''
+    @param   name:str          The name of the metric, dot-separated
+    @param   description:str   What is measured
+    @return  :Gauge            The gauge, it is created if it does not exist
+    '''
+    return registry.get(Gauge, name, description)
+
+
+def histogram(name, description = ''):
+    '''
+    @param   name:str          The name of the metric, dot-separated
+    @param   description:str   What is timed
+    @return  :Histogram        The histogram, it is created if it does not exist
+    '''
+    return registry.get(Histogram, name, description)
+
+
+def dump(path = None):
+    '''
+    Write all metrics of this process to a file, for use as a SIGUSR1 handler
+    
+    @param   path:str?  The file, `metrics_path()` by default
+    @return  :str       The file
+    '''
+    return registry.dump(path)
+
+
+if __name__ == '__main__':
+    # Measure the cost of recording, when disabled and enabled
+    import timeit
+    count = 1000000
+    timed = histogram('benchmark.timed')
+    events = counter('benchmark.events')
+    timed_cond = TimedCondition('benchmark.cond')
+    plain_cond = threading.Condition()
+    def time_operation():
+        timed.stop(timed.start())
+    def lock_timed():
+        timed_cond.acquire()
+        timed_cond.release()
+    def lock_plain():
+        plain_cond.acquire()
+        plain_cond.release()
+    baseline = timeit.timeit(lock_plain, number = count) / count
+    print('Condition acquire and release:            %4.0f ns' % (1e9 * baseline))
+    for on in (False, True):
+        enable(on)
+        state = 'enabled ' if on else 'disabled'
+        print('%s: Counter.add                   %4.0f ns' % (state, 1e9 * timeit.timeit(events.add, number = count) / count))
+        print('%s: Histogram.start and stop      %4.0f ns' % (state, 1e9 * timeit.timeit(time_operation, number = count) / count))
+        print('%s: TimedCondition acquire/release %4.0f ns' % (state, 1e9 * timeit.timeit(lock_timed, number = count) / count))
+    print()
+    print(registry.prometheus(), end = '')
@@ -24,7 +24,21 @@ import struct
 import signal
 import termios
 import threading
-
+from collections import deque
+
+import instrument
+from screen import Screen
+from layout import Fragments, display_width, truncate, fit
+from keyboard import KeyParser
+from eventloop import EventLoop
+from stats import Statistics, scale
+from torrents import TorrentList, SORT_COLUMNS, STATES
+from peers import PeerTable, PeerView
+from geoip import GeoIP
+from preferences import Preferences, SCHEMA, SECTIONS, format_value
+from trackers import TrackerView
+from remote import VIEW_PEERS
+from redraw import RedrawScheduler, REGION_TOP, REGION_PAGE, REGION_MIDDLE, REGION_BOTTOM, REGION_CLEAR, REGION_ALL
 from copyright import copyright_text
 
 _ = lambda x : x
@@ -32,12 +46,14 @@ _ = lambda x : x
 
 MIDDLE_REQUIRE_HEIGHT = 19
 
+MAX_FPS = 30
+
 top_titles = [ _('Torrents')
              , _('States and trackers')
              , _('Preferences')
              , _('Help')
              ]
-    
+
 middle_titles = [ _('Status')
                 , _('Details')
                 , _('Peers')
@@ -55,22 +71,114 @@ top_selection = 0
 middle_selection = ~0
 bottom_selection = ~0
 first_line_help = 0
+first_line_preferences = 0
+show_instrumentation = False
+drawn_page = None
 running = True
+loop = None
+
+scheduler = RedrawScheduler(MAX_FPS)
+
+fragments = Fragments()
+'''
+:Fragments  The tab bars and the page texts, as last built
+'''
+
+input_parser = KeyParser()
+pending_input = deque()
+
+status_lines = []
+'''
+:list<str>  The lines shown under the Status tab
+'''
+
+statistics = Statistics()
+'''
+:Statistics  The statistics shown in the status bar
+'''
+statistics.listeners.append(lambda snapshot : scheduler.mark(REGION_BOTTOM | instrumentation_regions()))
+
+REDRAW = instrument.histogram('interface.redraw', 'Time to draw and send a frame')
+INPUT = instrument.histogram('interface.input', 'Time to handle a key press')
+'''
+:Histogram  Time spent redrawing and handling input
+'''
+
+FRAME_BYTES = instrument.gauge('interface.frame_bytes', 'Bytes sent to the terminal for the last frame')
+'''
+:Gauge  The size of the last frame
+'''
+
+torrent_list = TorrentList()
+'''
+:TorrentList  The torrents shown in the Torrents tab
+'''
+
+geoip = GeoIP()
+'''
+:GeoIP  Country lookup for the Peers tab
+'''
+
+peer_table = PeerTable(geoip)
+'''
+:PeerTable  The connected peers of all torrents
+'''
+
+peer_view = PeerView(peer_table)
+'''
+:PeerView  The view of the selected torrent's peers in the Peers tab
+'''
+
+tracker_view = TrackerView(None)
+'''
+:TrackerView  The trackers shown in the States and trackers tab, there are
+              none unless the interface is attached to a daemon
+'''
+
+preferences = Preferences()
+'''
+:Preferences  The preferences shown in the Preferences tab
+'''
+preferences.subscribe(None, lambda snapshot, changed : scheduler.mark(REGION_PAGE if top_selection == 2 else 0))
 
-update_queue = []
-    
 
 def printf(format, *args, flush = False):
-    text = format % args
-    sys.stdout.buffer.write(text.encode('utf-8'))
+    screen.feed(format % args)
     if flush:
-        sys.stdout.buffer.flush()
+        screen.refresh()
+
+
+def write_terminal(text):
+    '''
+    Write directly to the terminal, bypassing the screen model
+    
+    @param  text:str  The text to write
+    '''
+    sys.stdout.buffer.write(text.encode('utf-8'))
+    sys.stdout.buffer.flush()
 
 
-def run_interface():
+def run_interface(event_loop = True, remote = None):
+    '''
+    Run the terminal user interface until the user quits
+    
+    @param  event_loop:bool        Whether to run input, signals and redrawing in a single
+                                   threaded event loop, rather than reading input in a
+                                   separate thread
+    @param  remote:RemoteSession?  A daemon to show, rather than a session of its own
+    '''
+    # Show the daemon's torrents, peers, trackers and statistics
+    if remote is not None:
+        global torrent_list, peer_view, tracker_view, statistics
+        (torrent_list, peer_view, tracker_view, statistics) = (remote.torrents, remote.peers, remote.trackers, remote)
+        remote.listeners.append(lambda snapshot : scheduler.mark(REGION_BOTTOM | instrumentation_regions()))
+        remote.updated = lambda view : scheduler.mark(REGION_MIDDLE if view == VIEW_PEERS else REGION_PAGE)
+        remote.progress = verify_progress
+        remote.closed = detached
+    
     # Create condition for screen refreshing
     global refresh_cond
-    refresh_cond = threading.Condition()
+    refresh_cond = instrument.TimedCondition('interface.refresh_cond')
     
     # Get current screen width and listen for updates
     global height, width
@@ -82,7 +190,19 @@ def run_interface():
             sys.exit(1)
         else:
             raise e
-    signal.signal(signal.SIGWINCH, sigwinch_handler)
+    if not event_loop:
+        signal.signal(signal.SIGWINCH, sigwinch_handler)
+        signal.signal(signal.SIGUSR1, lambda _signal, _frame : dump_instrumentation())
+    
+    # Load preferences
+    preferences.load()
+    geoip.configure(preferences.current)
+    preferences.subscribe('geoip', geoip.configure)
+    
+    # Create the model of the screen
+    global screen
+    sys.stdout.flush()
+    screen = Screen(height, width, sys.stdout.fileno())
     
     # Get TTY settings
     saved_stty = termios.tcgetattr(sys.stdout.fileno())
@@ -90,29 +210,44 @@ def run_interface():
     # Modify TTY settings
     stty[3] &= ~(termios.ICANON | termios.ECHO | termios.ISIG)
     # Initialise terminal and hide cursor
-    printf('\033[?1049h\033[?25l', flush = True)
+    write_terminal('\033[?1049h\033[?25l')
     try:
         # Apply now TTY settings
         termios.tcsetattr(sys.stdout.fileno(), termios.TCSAFLUSH, stty)
         
-        # Start input loop
-        input_thread = threading.Thread(target = input_loop)
-        input_thread.setDaemon(True)
-        input_thread.start()
-        
-        # Start interface redraw loop
-        interface_loop()
+        if event_loop:
+            # Run everything in the event loop
+            run_event_loop()
+        else:
+            # Start input loop
+            input_thread = threading.Thread(target = input_loop)
+            input_thread.setDaemon(True)
+            input_thread.start()
+            
+            # Start statistics sampling and reload preferences when they are edited
+            statistics.start_thread()
+            preferences.watch_thread()
+            
+            # Start interface redraw loop
+            interface_loop()
     finally:
         # Restore old TTY setting
         termios.tcsetattr(sys.stdout.fileno(), termios.TCSAFLUSH, saved_stty)
         # Show cursor, clear screen and terminate terminal
-        printf('\033[?25h\033[H\033[2J\033[?1049l', flush = True)
+        write_terminal('\033[?25h\033[H\033[2J\033[?1049l')
 
 
 def sigwinch_handler(_signal, _frame):
     '''
     Handler for the SIGWINCH signal
     '''
+    update_size()
+
+
+def update_size():
+    '''
+    Fetch the size of the terminal and adjust the interface to it
+    '''
     global height, width, bar_selection, top_selection, middle_selection
     (height, width) = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))
     refresh_cond.acquire()
@@ -121,112 +256,293 @@ def sigwinch_handler(_signal, _frame):
             top_selection = ~top_selection
             middle_selection = ~middle_selection
             bar_selection = 0
-        refresh_cond.notify()
     finally:
         refresh_cond.release()
+    scheduler.mark(REGION_ALL)
+
+
+def run_event_loop():
+    '''
+    Run input handling, resize handling and redrawing in one thread
+    '''
+    global loop
+    loop = EventLoop()
+    redraw_timer = None
+    
+    def read_input():
+        # The terminal is readable, so this read will not block
+        data = os.read(sys.stdin.fileno(), 4096)
+        if len(data) == 0:
+            scheduler.close()
+            loop.stop()
+            return
+        for key in input_parser.feed(data):
+            start = INPUT.start()
+            handle_input(key)
+            INPUT.stop(start)
+        if not running:
+            loop.stop()
+    
+    def redraw_when_due():
+        nonlocal redraw_timer
+        (regions, delay) = scheduler.take()
+        if regions != 0:
+            redraw(regions)
+        elif (delay > 0) and (redraw_timer is None):
+            redraw_timer = loop.call_later(delay, redraw_later)
+    
+    def redraw_later():
+        nonlocal redraw_timer
+        redraw_timer = None
+        redraw_when_due()
+    
+    loop.add_reader(sys.stdin.fileno(), read_input)
+    loop.add_signal_handler(signal.SIGWINCH, update_size)
+    loop.add_signal_handler(signal.SIGUSR1, dump_instrumentation)
+    statistics.start(loop)
+    preferences.watch(loop)
+    scheduler.wakeup = lambda : loop.call_soon_threadsafe(redraw_when_due)
+    try:
+        scheduler.mark(REGION_ALL)
+        loop.run()
+    finally:
+        statistics.stop()
+        preferences.stop()
+        scheduler.wakeup = None
+        loop.close()
+
+
+def detached():
+    '''
+    Quit when the daemon goes away
+    '''
+    global running
+    refresh_cond.acquire()
+    try:
+        running = False
+    finally:
+        refresh_cond.release()
+    scheduler.close()
+    if loop is not None:
+        loop.stop()
+
+
+def set_status(lines):
+    '''
+    Replace the contents of the Status tab, this can be done from any thread
+    
+    @param  lines:list<str>  The lines to show
+    '''
+    global status_lines
+    refresh_cond.acquire()
+    try:
+        status_lines = lines
+    finally:
+        refresh_cond.release()
+    scheduler.mark(REGION_MIDDLE)
+
+
+def verify_progress(done, total):
+    '''
+    Show the progress of a recheck in the Status tab, for use as the
+    progress callback of a `verify.Verifier` or of a daemon's `RemoteSession`
+    
+    @param  done:int   The number of checked pieces
+    @param  total:int  The total number of pieces
+    '''
+    set_status([_('Checking: %i of %i pieces (%.1f %%)') % (done, total, 100 * done / max(total, 1))])
+
+
+def instrumentation_regions():
+    '''
+    @return  :int  The regions that show instrumentation, and shall be redrawn periodically
+    '''
+    return REGION_PAGE if show_instrumentation else 0
+
+
+def dump_instrumentation():
+    '''
+    Write the metrics to a file and tell where in the Status tab
+    '''
+    try:
+        set_status([_('Metrics written to %s') % instrument.dump()])
+    except OSError as e:
+        set_status([_('Cannot write metrics: %s') % e])
+
+
+def selected_info_hash():
+    '''
+    Get the torrent selected in the Torrents tab
+    
+    @return  :bytes?  The torrent's infohash, `None` if no torrent is selected
+    '''
+    if torrent_list.selected is None:
+        return None
+    return torrent_list.torrents[torrent_list.selected].info_hash
+
+
+def bar_regions(bar):
+    '''
+    Get the screen regions that depend on a tab bar
+    
+    @param   bar:int  The index of the bar, 0 for the top, 1 for the middle, 2 for the bottom
+    @return  :int     The regions that shall be redrawn when the bar changes
+    '''
+    return (REGION_TOP | REGION_PAGE, REGION_MIDDLE, REGION_BOTTOM)[bar]
 
 
 def input_loop():
-    global running, top_selection, middle_selection, bottom_selection, bar_selection, first_line_help
     while running:
         c = next_input()
-        if c == 'q':
-            refresh_cond.acquire()
-            try:
-                running = False
-                refresh_cond.notify()
-            finally:
-                refresh_cond.release()
-        elif c == chr(ord('L') - ord('@')):
-            refresh_cond.acquire()
-            try:
-                refresh_cond.notify()
-            finally:
-                refresh_cond.release()
-        elif c in ('\033[C', '\033[1;5C'):
-            refresh_cond.acquire()
-            try:
-                if bar_selection == 0:
-                    top_selection = min(top_selection + 1, len(top_titles) - 1)
-                elif bar_selection == 1:
-                    middle_selection = min(middle_selection + 1, len(middle_titles) - 1)
-                elif bar_selection == 2:
-                    bottom_selection = min(bottom_selection + 1, len(bottom_titles) - 1)
-                update_queue.append('bar %i' % bar_selection)
-                refresh_cond.notify()
-            finally:
-                refresh_cond.release()
-        elif c in ('\033[D', '\033[1;5D'):
-            refresh_cond.acquire()
-            try:
-                if bar_selection == 0:
-                    top_selection = max(top_selection - 1, 0)
-                elif bar_selection == 1:
-                    middle_selection = max(middle_selection - 1, 0)
-                elif bar_selection == 2:
-                    bottom_selection = max(bottom_selection - 1, 0)
-                update_queue.append('bar %i' % bar_selection)
-                refresh_cond.notify()
-            finally:
-                refresh_cond.release()
-        elif c == '\033[1;5A':
-            refresh_cond.acquire()
-            try:
-                update_queue.append('bar %i' % bar_selection)
-                if bar_selection == 1:
+        start = INPUT.start()
+        handle_input(c)
+        INPUT.stop(start)
+
+
+def handle_input(c):
+    '''
+    Act on a key press
+    
+    @param  c:str  The key, can be an escape sequence
+    '''
+    global running, top_selection, middle_selection, bottom_selection, bar_selection, first_line_help
+    global first_line_preferences, show_instrumentation
+    if c == 'q':
+        refresh_cond.acquire()
+        try:
+            running = False
+        finally:
+            refresh_cond.release()
+        scheduler.close()
+    elif c == chr(ord('L') - ord('@')):
+        scheduler.mark(REGION_ALL)
+    elif c == 'i':
+        refresh_cond.acquire()
+        try:
+            show_instrumentation = not show_instrumentation
+            if show_instrumentation:
+                instrument.enable()
+        finally:
+            refresh_cond.release()
+        scheduler.mark(REGION_ALL)
+    elif c in ('\033[C', '\033[1;5C'):
+        refresh_cond.acquire()
+        try:
+            if bar_selection == 0:
+                top_selection = min(top_selection + 1, len(top_titles) - 1)
+            elif bar_selection == 1:
+                middle_selection = min(middle_selection + 1, len(middle_titles) - 1)
+            elif bar_selection == 2:
+                bottom_selection = min(bottom_selection + 1, len(bottom_titles) - 1)
+            regions = bar_regions(bar_selection)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(regions)
+    elif c in ('\033[D', '\033[1;5D'):
+        refresh_cond.acquire()
+        try:
+            if bar_selection == 0:
+                top_selection = max(top_selection - 1, 0)
+            elif bar_selection == 1:
+                middle_selection = max(middle_selection - 1, 0)
+            elif bar_selection == 2:
+                bottom_selection = max(bottom_selection - 1, 0)
+            regions = bar_regions(bar_selection)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(regions)
+    elif c == '\033[1;5A':
+        refresh_cond.acquire()
+        try:
+            regions = bar_regions(bar_selection)
+            if bar_selection == 1:
+                top_selection = ~top_selection
+                middle_selection = ~middle_selection
+                bar_selection = 0
+            elif bar_selection == 2:
+                if (height < MIDDLE_REQUIRE_HEIGHT) or (top_selection != ~0):
                     top_selection = ~top_selection
-                    middle_selection = ~middle_selection
+                    bottom_selection = ~bottom_selection
                     bar_selection = 0
-                elif bar_selection == 2:
-                    if (height < MIDDLE_REQUIRE_HEIGHT) or (top_selection != ~0):
-                        top_selection = ~top_selection
-                        bottom_selection = ~bottom_selection
-                        bar_selection = 0
-                    else:
-                        middle_selection = ~middle_selection
-                        bottom_selection = ~bottom_selection
-                        bar_selection = 1
-                update_queue.append('bar %i' % bar_selection)
-                refresh_cond.notify()
+                else:
+                    middle_selection = ~middle_selection
+                    bottom_selection = ~bottom_selection
+                    bar_selection = 1
+            regions |= bar_regions(bar_selection)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(regions)
+    elif c == '\033[1;5B':
+        refresh_cond.acquire()
+        try:
+            regions = bar_regions(bar_selection)
+            if bar_selection == 0:
+                if (height < MIDDLE_REQUIRE_HEIGHT) or (top_selection != 0):
+                    top_selection = ~top_selection
+                    bottom_selection = ~bottom_selection
+                    bar_selection = 2
+                else:
+                    top_selection = ~top_selection
+                    middle_selection = ~middle_selection
+                    bar_selection = 1
+            elif bar_selection == 1:
+                middle_selection = ~middle_selection
+                bottom_selection = ~bottom_selection
+                bar_selection = 2
+            regions |= bar_regions(bar_selection)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(regions)
+    elif (c in ('\033[A', '\033[B')) and (bar_selection == 1) and (middle_selection == 2):
+        refresh_cond.acquire()
+        try:
+            peer_view.scroll(-1 if c == '\033[A' else 1, selected_info_hash(), 9)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(REGION_MIDDLE)
+    elif (c in ('\033[A', '\033[B', '\033[5~', '\033[6~')) and (top_selection == 0):
+        refresh_cond.acquire()
+        try:
+            page = max(height - (3 if height < MIDDLE_REQUIRE_HEIGHT else 13), 1)
+            torrent_list.move({ '\033[A' : -1, '\033[B' : 1, '\033[5~' : -page, '\033[6~' : page }[c])
+        finally:
+            refresh_cond.release()
+        scheduler.mark(REGION_PAGE)
+    elif (c in ('s', 'f')) and (top_selection == 0):
+        refresh_cond.acquire()
+        try:
+            if c == 's':
+                torrent_list.set_sort(SORT_COLUMNS[(SORT_COLUMNS.index(torrent_list.column) + 1) % len(SORT_COLUMNS)])
+            else:
+                state_filter = torrent_list.state_filter
+                state_filter = 0 if state_filter is None else (None if state_filter + 1 == len(STATES) else state_filter + 1)
+                torrent_list.set_filter(state_filter)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(REGION_PAGE)
+    elif (c in ('\033[A', '\033[B')) and (top_selection == 2):
+        refresh_cond.acquire()
+        try:
+            first_line_preferences = max(first_line_preferences + (-1 if c == '\033[A' else 1), 0)
+        finally:
+            refresh_cond.release()
+        scheduler.mark(REGION_PAGE)
+    elif c == '\033[A':
+        if top_selection == 3:
+            refresh_cond.acquire()
+            try:
+                first_line_help = max(first_line_help - 1, 0)
             finally:
                 refresh_cond.release()
-        elif c == '\033[1;5B':
+            scheduler.mark(REGION_PAGE)
+    elif c == '\033[B':
+        if top_selection == 3:
             refresh_cond.acquire()
             try:
-                update_queue.append('bar %i' % bar_selection)
-                if bar_selection == 0:
-                    if (height < MIDDLE_REQUIRE_HEIGHT) or (top_selection != 0):
-                        top_selection = ~top_selection
-                        bottom_selection = ~bottom_selection
-                        bar_selection = 2
-                    else:
-                        top_selection = ~top_selection
-                        middle_selection = ~middle_selection
-                        bar_selection = 1
-                elif bar_selection == 1:
-                    middle_selection = ~middle_selection
-                    bottom_selection = ~bottom_selection
-                    bar_selection = 2
-                update_queue.append('bar %i' % bar_selection)
-                refresh_cond.notify()
+                first_line_help += 1
             finally:
                 refresh_cond.release()
-        elif c == '\033[A':
-            if top_selection == 3:
-                refresh_cond.acquire()
-                try:
-                    first_line_help = max(first_line_help - 1, 0)
-                    refresh_cond.notify()
-                finally:
-                    refresh_cond.release()
-        elif c == '\033[B':
-            if top_selection == 3:
-                refresh_cond.acquire()
-                try:
-                    first_line_help += 1
-                    refresh_cond.notify()
-                finally:
-                    refresh_cond.release()
+            scheduler.mark(REGION_PAGE)
 
 
 def next_input():
@@ -235,83 +551,200 @@ def next_input():
     
     @return  :str  The next input, can be an escape sequence
     '''
-    buf = ''
-    esc = 0
-    while True:
-        c = chr(sys.stdin.buffer.read(1)[0])
-        buf += c
-        if esc == 1:
-            if c == '[':
-                esc = 2
-            elif (len(buf) < 2) and (c == '\033'):
-                continue
-            else:
-                break
-        elif esc == 2:
-            if ('a' <= c <= 'z') or ('A' <= c <= 'Z') or (c == '~'):
-                break
-        elif c == '\033':
-            esc = 1
-        else:
-            break
-    return buf
+    while len(pending_input) == 0:
+        data = os.read(sys.stdin.fileno(), 4096)
+        if len(data) == 0:
+            raise EOFError()
+        pending_input.extend(input_parser.feed(data))
+    return pending_input.popleft()
 
 
 def interface_loop():
+    scheduler.mark(REGION_ALL)
     while running:
-        refresh_cond.acquire()
-        try:
-            if len(update_queue) == 0:
-                printf('\033[H\033[2J')
-                update_queue[:] = ['bar 0', 'bar 2']
-            
-            while len(update_queue) > 0:
-                update_message = update_queue[0]
-                update_queue[:] = update_queue[1:]
-                if update_message == 'bar 0':
-                    printf('\033[H\033[07m%s\033[27m', create_interface_top())
-                    print_page()
-                elif update_message == 'bar 1':
-                    middle = create_interface_middle()
-                    if not middle == '':
-                        printf('\033[%i;1H%s', max(height - 11, 1), middle)
-                        printf(''.join('\033[%i;1H\033[2K' % (i + height - 10) for i in range(9)))
-                elif update_message == 'bar 2':
-                    printf('\033[%i;1H%s', max(height - 1, 1), create_interface_bottom())
-            
-            printf('', flush = True)
-            refresh_cond.wait()
-        finally:
-            refresh_cond.release()
+        regions = scheduler.wait()
+        if not running:
+            break
+        redraw(regions)
+
+
+def redraw(regions):
+    '''
+    Redraw parts of the screen
+    
+    @param  regions:int  The regions to redraw, `REGION_*` or:ed together
+    '''
+    global drawn_page
+    start = REDRAW.start()
+    refresh_cond.acquire()
+    try:
+        if (screen.height, screen.width) != (height, width):
+            screen.resize(height, width)
+            regions = REGION_ALL
+        if regions & REGION_CLEAR:
+            drawn_page = None
+            printf('\033[H\033[2J')
+        if regions & REGION_TOP:
+            printf('\033[H\033[07m%s\033[27m', create_interface_top())
+        if show_instrumentation:
+            # The overlay covers the page and the middle tabs
+            if regions & REGION_PAGE:
+                drawn_page = None
+                print_instrumentation()
+            regions &= ~REGION_MIDDLE
+        elif regions & REGION_PAGE:
+            regions |= print_page()
+        if regions & REGION_MIDDLE:
+            middle = create_interface_middle()
+            if not middle == '':
+                printf('\033[%i;1H%s', max(height - 11, 1), middle)
+                printf(''.join('\033[%i;1H\033[2K' % (i + height - 10) for i in range(9)))
+                if max(middle_selection, ~middle_selection) == 0:
+                    for (i, line) in enumerate(status_lines[:9]):
+                        printf('\033[%i;1H%s', i + height - 10, truncate(line, width))
+                elif max(middle_selection, ~middle_selection) == 2:
+                    for (i, row) in enumerate(peer_view.render(selected_info_hash(), 9, width)):
+                        printf('\033[%i;1H%s', i + height - 10, row)
+        if regions & REGION_BOTTOM:
+            printf('\033[%i;1H%s', max(height - 1, 1), create_interface_bottom())
+        printf('', flush = True)
+        FRAME_BYTES.set(screen.bytes_last)
+    finally:
+        refresh_cond.release()
+    REDRAW.stop(start)
+
+
+def print_instrumentation():
+    '''
+    Draw the metrics over the body of the screen
+    '''
+    blank_lines = max(height - 3, 0)
+    printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
+    lines = ['\033[01m%s\033[00m' % truncate(_('Instrumentation, press i to close'), width)]
+    lines += instrument.registry.format_lines(width)
+    for (i, line) in enumerate(lines[:blank_lines]):
+        printf('\033[%i;1H%s', i + 2, line)
 
 
 def print_page():
+    '''
+    Draw the body of the selected master tab
+    
+    @return  :int  Additional regions that depend on the page and shall be redrawn
+    '''
+    global drawn_page
     selection = max(top_selection, ~top_selection)
     if selection == 0:
         if height < MIDDLE_REQUIRE_HEIGHT:
             blank_lines = max(height - 3, 0)
-            printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
         else:
             blank_lines = max(height - 13, 0)
-            printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
-            update_queue.append('bar 1')
+        rows = torrent_list.render(blank_lines, width)
+        top = getattr(torrent_list, 'top', None)
+        if top is None:
+            drawn_page = None
+        else:
+            # Rows may have changed even if the list was scrolled, so all are redrawn
+            scroll_page(('torrents', width), top, blank_lines)
+        printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
+        for (i, (row, selected)) in enumerate(rows):
+            printf('\033[%i;1H%s%s\033[00m', i + 2, '\033[07m' if selected else '', row)
+        if height >= MIDDLE_REQUIRE_HEIGHT:
+            return REGION_MIDDLE
     elif selection == 1:
+        drawn_page = None
         blank_lines = max(height - 3, 0)
         printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
+        for (i, (row, _selected)) in enumerate(tracker_view.render(blank_lines, width)):
+            printf('\033[%i;1H%s', i + 2, row)
     elif selection == 2:
+        global first_line_preferences
         blank_lines = max(height - 3, 0)
-        printf(''.join('\033[%i;1H\033[2K' % (i + 2) for i in range(blank_lines)))
+        key = (width, preferences.current, tuple(preferences.errors))
+        text = fragments.get('preferences', key, preference_lines)
+        if first_line_preferences + blank_lines > len(text):
+            first_line_preferences = max(len(text) - blank_lines, 0)
+        print_lines(('preferences',) + key, text, first_line_preferences, blank_lines)
     elif selection == 3:
         global first_line_help
-        text = copyright_text
-        if first_line_help + height - 3 > len(text):
-            first_line_help = max(len(text) - height + 3, 0)
-        text = text[first_line_help : first_line_help + height - 3]
-        text = '\n'.join(text)
-        printf('\033[2;1H%s', text)
+        blank_lines = max(height - 3, 0)
+        text = fragments.get('help', width, lambda : [truncate(line, width) for line in copyright_text])
+        if first_line_help + blank_lines > len(text):
+            first_line_help = max(len(text) - blank_lines, 0)
+        print_lines(('help', width), text, first_line_help, blank_lines)
+    return 0
+
+
+def print_lines(key, text, first, count):
+    '''
+    Draw a window of a text on the page, sending only the lines that were
+    not already on the screen
+    
+    @param  key:¿K?          The text, including everything it depends on
+    @param  text:list<str>   The lines of the text, fitted to the width of the screen
+    @param  first:int        The index of the first line to show
+    @param  count:int        The number of lines on the page
+    '''
+    for i in scroll_page(key, first, count):
+        line = text[first + i] if first + i < len(text) else ''
+        printf('\033[%i;1H\033[2K%s\033[00m', i + 2, line)
+
+
+def scroll_page(key, first, count):
+    '''
+    Scroll the page with a scroll region if it shows the same content as
+    when it was last drawn, moved by less than its height
+    
+    @param   key:¿K?      The content of the page, including everything it depends on
+    @param   first:int    The index of the first line of the content to show
+    @param   count:int    The number of lines on the page
+    @return  :range<int>  The lines of the page, zero-based, that have to be drawn
+    '''
+    global drawn_page
+    (previous, drawn_page) = (drawn_page, (key, first, count))
+    if (previous is None) or (previous[0] != key) or (previous[2] != count):
+        return range(count)
+    delta = first - previous[1]
+    if abs(delta) >= count:
+        return range(count)
+    # The page starts on the second line of the screen
+    screen.scroll(1, count, delta)
+    return range(count - delta, count) if delta > 0 else range(-delta)
+
+
+def preference_lines():
+    '''
+    Format the preferences for the Preferences tab
+    
+    @return  :list<str>  The lines to show
+    '''
+    lines, section = [], None
+    for error in preferences.errors:
+        lines.append('\033[01m%s\033[00m' % truncate(_('%s: %s') % (preferences.path, error), width))
+    snapshot = preferences.current
+    label_width = min(max(display_width(option.label) for option in SCHEMA) + 2, width // 2)
+    for option in SCHEMA:
+        if option.section != section:
+            section = option.section
+            lines.append('\033[01m%s\033[00m' % truncate(SECTIONS[section], width))
+        value = format_value(option, getattr(snapshot, option.name))
+        if (option.kind == 'secret') and value:
+            value = '*' * 8
+        label = fit(option.label, label_width)
+        lines.append(truncate('  %s %s' % (label, value), width))
+    return lines
 
 
 def create_interface_top():
+    '''
+    Get the master tabs for the top of the screen
+    
+    @return  :str  The text to print on the top of the screen
+    '''
+    return fragments.get('top', (width, top_selection), build_interface_top)
+
+
+def build_interface_top():
     '''
     Construct the master tabs for the top of the screen
     
@@ -329,24 +762,34 @@ def create_interface_top():
         selection = ~top_selection
     
     # Truncate the tab bar if the screen is too small
-    if len('  '.join(tabs)) > width:
+    if display_width('  '.join(tabs)) > width:
         tabs = [tabs[selection]]
         selection = 0
-        if len(tabs[0]) > width:
+        if display_width(tabs[0]) > width:
             tabs[0] = tabs[0][1 : -1]
-        if len(tabs[0]) > width:
-            tabs[0] = tabs[0][:width]
+        if display_width(tabs[0]) > width:
+            tabs[0] = truncate(tabs[0], width)
     
     # Format tabs
     ftabs = [(selected_pattern if selection == i else '%s') % tabs[i] for i in range(len(tabs))]
     
     # Pad the bar to fit the full width of the screen and format the bar
-    pad = ' ' * (width - len('  '.join(tabs)))
+    pad = ' ' * (width - display_width('  '.join(tabs)))
     top = '  '.join(ftabs)
     return '\033[07m' + top + pad + '\033[00m'
 
 
 def create_interface_middle():
+    '''
+    Get the torrent information tabs for the "middle" of the screen
+    
+    @return  :str  The text to print in the "middle" of the screen
+    '''
+    key = (width, height < MIDDLE_REQUIRE_HEIGHT, top_selection, middle_selection)
+    return fragments.get('middle', key, build_interface_middle)
+
+
+def build_interface_middle():
     '''
     Construct the torrent information tabs for the "middle" of the screen
     
@@ -372,24 +815,34 @@ def create_interface_middle():
         selection = ~middle_selection
     
     # Truncate the tab bar if the screen is too small
-    if len('  '.join(tabs)) > width:
+    if display_width('  '.join(tabs)) > width:
         tabs = [tabs[selection]]
         selection = 0
-        if len(tabs[0]) > width:
+        if display_width(tabs[0]) > width:
             tabs[0] = tabs[0][1 : -1]
-        if len(tabs[0]) > width:
-            tabs[0] = tabs[0][:width]
+        if display_width(tabs[0]) > width:
+            tabs[0] = truncate(tabs[0], width)
     
     # Format tabs
     ftabs = [(selected_pattern if selection == i else '%s') % tabs[i] for i in range(len(tabs))]
     
     # Pad the bar to fit the full width of the screen and format the bar
-    pad = ' ' * (width - len('  '.join(tabs)))
+    pad = ' ' * (width - display_width('  '.join(tabs)))
     middle = '  '.join(ftabs)
     return '\033[07m' + middle + pad + '\033[00m'
 
 
 def create_interface_bottom():
+    '''
+    Get the status bar for the bottom of the screen
+    
+    @return  :str  The text to print on the bottom of the screen
+    '''
+    key = (width, bottom_selection, statistics.snapshot)
+    return fragments.get('bottom', key, build_interface_bottom)
+
+
+def build_interface_bottom():
     '''
     Construct the status bar for the bottom of the screen
     
@@ -402,10 +855,11 @@ def create_interface_bottom():
     titles = [t for t in bottom_titles]
     
     # Status field values
-    values = [ (100, 200)
-             , (100, 'MB', 100, 'MB')
-             , (12, 12)
-             , (150)
+    snapshot = statistics.snapshot
+    values = [ (snapshot.connections, snapshot.max_connections)
+             , scale(snapshot.down_rate) + scale(snapshot.up_rate)
+             , (snapshot.protocol_down_rate / 1024, snapshot.protocol_up_rate / 1024)
+             , (snapshot.dht_nodes)
              ]
     
     # Status field patterns
@@ -422,7 +876,7 @@ def create_interface_bottom():
     titles = [t + _(': ') for t in titles] + ['']
     
     # Calculate length of the text
-    len0 = len((sep + '  ').join(fields)) + 2
+    len0 = display_width((sep + '  ').join(fields)) + 2
     
     # Truncate the status bar if the screen is not width enough
     selection = bottom_selection
@@ -433,16 +887,16 @@ def create_interface_bottom():
         patterns = [patterns[sel]]
         fields = [fields[sel]]
         selection = ~0 if bottom_selection < 0 else 0
-        len0 = len((sep + '  ').join(fields)) + 2
+        len0 = display_width((sep + '  ').join(fields)) + 2
         if len0 > width:
-            fields[0] = fields[0][:width - 2]
+            fields[0] = truncate(fields[0], width - 2)
             len0 = width
     
     # Calculate the length of the text if it was extended with:
     #   a) The title of the selected field
     #   b) The title of all fields
-    len1a = len0 + len(titles[max(selection, -1)])
-    len1b = len0 + sum(len(t) for t in titles)
+    len1a = len0 + display_width(titles[max(selection, -1)])
+    len1b = len0 + sum(display_width(t) for t in titles)
     
     # Extend the text with either the title of all fields,
     # or only the title of the select field, depending on
@@ -0,0 +1,69 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import codecs
+
+
+class KeyParser():
+    '''
+    Incremental splitter of terminal input into keys and escape sequences
+    
+    Input may be fed in arbitrary chunks; an escape sequence that is
+    cut off at the end of a chunk is kept until the rest arrives.
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.buffer = ''
+    
+    
+    def feed(self, data):
+        '''
+        Parse more input
+        
+        @param   data:bytes  The input read from the terminal
+        @return  :list<str>  The complete keys in the input, escape sequences as one string each
+        '''
+        buf = self.buffer + self.decoder.decode(data)
+        keys = []
+        (i, n) = (0, len(buf))
+        while i < n:
+            if buf[i] != '\033':
+                keys.append(buf[i])
+                i += 1
+                continue
+            if i + 1 == n:
+                break
+            if buf[i + 1] != '[':
+                keys.append(buf[i : i + 2])
+                i += 2
+                continue
+            j = i + 2
+            while (j < n) and not (('a' <= buf[j] <= 'z') or ('A' <= buf[j] <= 'Z') or (buf[j] == '~')):
+                j += 1
+            if j == n:
+                break
+            keys.append(buf[i : j + 1])
+            i = j + 1
+        self.buffer = buf[i:]
+        return keys
+
@@ -0,0 +1,123 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unicodedata
+from functools import lru_cache
+
+
+@lru_cache(maxsize = 4096)
+def char_width(c):
+    '''
+    Get the number of terminal columns a character occupies
+    
+    @param   c:str  The character
+    @return  :int   2 for wide and fullwidth East Asian characters, 0 for combining
+                    and format characters, otherwise 1
+    '''
+    if unicodedata.combining(c) or unicodedata.category(c) in ('Mn', 'Me', 'Cf'):
+        return 0
+    return 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+
+
+def display_width(text):
+    '''
+    Get the number of terminal columns a text occupies
+    
+    @param   text:str  The text, without escape sequences
+    @return  :int      The width of the text
+    '''
+    if text.isascii():
+        return len(text)
+    return sum(map(char_width, text))
+
+
+def truncate(text, width):
+    '''
+    Cut a text to fit in a number of columns
+    
+    @param   text:str    The text, without escape sequences
+    @param   width:int   The number of columns
+    @return  :str        The longest prefix of the text that fits, a wide character
+                         that would only fit by half is left out
+    '''
+    if text.isascii():
+        return text[:max(width, 0)]
+    used = 0
+    for (i, c) in enumerate(text):
+        used += char_width(c)
+        if used > width:
+            return text[:i]
+    return text
+
+
+def fit(text, width):
+    '''
+    Cut or pad a text to exactly a number of columns
+    
+    @param   text:str    The text, without escape sequences
+    @param   width:int   The number of columns
+    @return  :str        The text, truncated or padded with spaces
+    '''
+    text = truncate(text, width)
+    return text + ' ' * (width - display_width(text))
+
+
+class Fragments():
+    '''
+    Memoized rendered parts of the screen
+    
+    Each fragment is kept with the key it was built for, which shall
+    include everything it depends on, such as the width, the selection
+    and a version of its content. A fragment is only rebuilt when its
+    key changes.
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.fragments = {}
+        self.builds = 0
+        self.hits = 0
+    
+    
+    def get(self, name, key, build):
+        '''
+        Get a fragment, building it if its key has changed
+        
+        @param   name:str       The name of the fragment
+        @param   key:¿K?        Everything the fragment depends on
+        @param   build:()→¿V?   Function that builds the fragment
+        @return  :¿V?           The fragment
+        '''
+        cached = self.fragments.get(name)
+        if (cached is not None) and (cached[0] == key):
+            self.hits += 1
+            return cached[1]
+        self.builds += 1
+        value = build()
+        self.fragments[name] = (key, value)
+        return value
+    
+    
+    def clear(self):
+        '''
+        Forget all fragments
+        '''
+        self.fragments.clear()
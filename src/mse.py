@@ -0,0 +1,502 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import random
+import hashlib
+
+try:
+    import ctypes
+    import ctypes.util
+    libcrypto = ctypes.CDLL(ctypes.util.find_library('crypto') or 'libcrypto.so.3')
+    libcrypto.RC4_set_key.argtypes = (ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p)
+    libcrypto.RC4.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_void_p)
+except (ImportError, OSError, AttributeError):
+    libcrypto = None
+
+
+DH_PRIME = int( 'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+              + '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+              + '4FE1356D6D51C245E485B576625E7EC6F44C42E9A63A36210000000000090563', 16)
+'''
+:int  The prime of the Diffie–Hellman key exchange, the generator is 2
+'''
+
+DH_LENGTH = 96
+'''
+:int  The length of a public key and of the shared secret
+'''
+
+VC = bytes(8)
+'''
+:bytes  The verification constant
+'''
+
+CRYPTO_PLAINTEXT = 1
+CRYPTO_RC4 = 2
+'''
+:int  Bits of the offered and selected crypto methods, after the handshake the
+      stream is either plaintext or RC4 encrypted
+'''
+
+MAX_PAD = 512
+'''
+:int  The largest padding that is allowed
+'''
+
+DISCARD = 1024
+'''
+:int  The number of keystream bytes that are dropped before use
+'''
+
+KEYSTREAM_BLOCK = 1 << 14
+'''
+:int  The number of keystream bytes that are generated at a time without libcrypto
+'''
+
+RC4_KEY_SIZE = 258 * 8
+'''
+:int  Room for libcrypto's RC4_KEY, which is two and 256 integers of at most 8 bytes
+'''
+
+
+def crypto_methods(level):
+    '''
+    Get the crypto methods allowed by an encryption level
+    
+    @param   level:str  'handshake' for an obfuscated handshake only, 'full' for an
+                        encrypted stream, 'either' for both
+    @return  :int       `CRYPTO_*` or:ed together
+    '''
+    return { 'handshake' : CRYPTO_PLAINTEXT
+           , 'full'      : CRYPTO_RC4
+           , 'either'    : CRYPTO_PLAINTEXT | CRYPTO_RC4
+           }[level]
+
+
+def obfuscated_hash(info_hash):
+    '''
+    Get the hash that identifies a torrent in a handshake
+    
+    @param   info_hash:bytes  The torrent's infohash
+    @return  :bytes           The infohash as it is found through the handshake
+    '''
+    return hashlib.sha1(b'req2' + info_hash).digest()
+
+
+def xor(a, b):
+    '''
+    XOR two equally long byte strings
+    
+    @param   a:bytes|memoryview  One byte string
+    @param   b:bytes|memoryview  The other byte string
+    @return  :bytes              The bytewise XOR
+    '''
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class RC4():
+    '''
+    RC4 cipher of one direction of a stream
+    
+    Buffers are processed in place, in one call to libcrypto if it is
+    available, otherwise by XOR:ing with a keystream that is generated
+    a block ahead and cached.
+    '''
+    
+    def __init__(self, key):
+        '''
+        Constructor
+        
+        @param  key:bytes  The key
+        '''
+        if libcrypto is not None:
+            self.key = ctypes.create_string_buffer(RC4_KEY_SIZE)
+            libcrypto.RC4_set_key(self.key, len(key), key)
+        else:
+            self.key = None
+            state = list(range(256))
+            j = 0
+            for i in range(256):
+                j = (j + state[i] + key[i % len(key)]) & 255
+                (state[i], state[j]) = (state[j], state[i])
+            (self.state, self.i, self.j) = (state, 0, 0)
+            (self.stream, self.used) = (b'', 0)
+        self.crypt(bytearray(DISCARD))
+    
+    
+    def generate(self, n):
+        '''
+        Generate keystream without libcrypto
+        
+        @param   n:int        The number of bytes
+        @return  :bytearray   The keystream
+        '''
+        (state, i, j) = (self.state, self.i, self.j)
+        out = bytearray(n)
+        for k in range(n):
+            i = (i + 1) & 255
+            a = state[i]
+            j = (j + a) & 255
+            b = state[j]
+            (state[i], state[j]) = (b, a)
+            out[k] = state[(a + b) & 255]
+        (self.i, self.j) = (i, j)
+        return out
+    
+    
+    def keystream(self, n):
+        '''
+        Take keystream without libcrypto
+        
+        @param   n:int    The number of bytes
+        @return  :bytes   The next `n` bytes of the keystream
+        '''
+        if self.used + n > len(self.stream):
+            rest = self.stream[self.used:]
+            self.stream = bytes(rest + self.generate(max(KEYSTREAM_BLOCK, n - len(rest))))
+            self.used = 0
+        self.used += n
+        return self.stream[self.used - n : self.used]
+    
+    
+    def crypt(self, buffer):
+        '''
+        Encrypt or decrypt a buffer in place
+        
+        @param  buffer:bytearray|memoryview  The writable buffer
+        '''
+        n = len(buffer)
+        if n == 0:
+            return
+        if self.key is not None:
+            data = (ctypes.c_char * n).from_buffer(buffer)
+            libcrypto.RC4(self.key, n, data, data)
+        else:
+            buffer[:] = xor(buffer, self.keystream(n))
+
+
+class Handshake():
+    '''
+    Message stream encryption negotiation of one connection
+    
+    The negotiation reads from the connection's receive buffer and
+    decrypts what it consumes in place. When it is done, what follows
+    in the buffer is the BitTorrent handshake, decrypted if the stream
+    is encrypted, and `ciphers` gives the ciphers for the rest of the
+    connection.
+    '''
+    
+    def __init__(self, outgoing, methods, prefer_rc4, info_hash = None, initial = b'', skeys = None):
+        '''
+        Constructor
+        
+        @param  outgoing:bool                 Whether we initiated the connection
+        @param  methods:int                   The allowed `CRYPTO_*` or:ed together
+        @param  prefer_rc4:bool               Whether to select RC4 when the peer offers both methods
+        @param  info_hash:bytes?              The torrent's infohash, for outgoing connections
+        @param  initial:bytes                 Data to send along with the handshake, for outgoing connections
+        @param  skeys:dict<bytes, bytes>?     Infohash by obfuscated hash, for incoming connections
+        '''
+        self.outgoing = outgoing
+        self.methods = methods
+        self.prefer_rc4 = prefer_rc4
+        self.info_hash = info_hash
+        self.initial = initial
+        self.skeys = skeys
+        self.private = int.from_bytes(os.urandom(20), 'big')
+        self.secret = None
+        self.phase = 'key'
+        self.sync = None
+        self.window = 0
+        self.length = 0
+        self.selected = 0
+        self.encrypt = self.decrypt = None
+        self.output = []
+        self.done = False
+    
+    
+    def public(self):
+        '''
+        Get our public key with random padding
+        
+        @return  :bytes  The data to send
+        '''
+        key = pow(2, self.private, DH_PRIME).to_bytes(DH_LENGTH, 'big')
+        return key + os.urandom(random.randrange(MAX_PAD + 1))
+    
+    
+    def ciphers(self):
+        '''
+        Get the ciphers for the stream after the handshake
+        
+        @return  :(encrypt:RC4?, decrypt:RC4?)  The ciphers, `None` for plaintext
+        '''
+        if self.selected == CRYPTO_RC4:
+            return (self.encrypt, self.decrypt)
+        return (None, None)
+    
+    
+    def keys(self, view, pos):
+        '''
+        Compute the shared secret from the peer's public key
+        
+        @param  view:memoryview  The receive buffer
+        @param  pos:int          The position of the public key
+        '''
+        key = int.from_bytes(view[pos : pos + DH_LENGTH], 'big')
+        self.secret = pow(key, self.private, DH_PRIME).to_bytes(DH_LENGTH, 'big')
+    
+    
+    def start_ciphers(self):
+        '''
+        Create the ciphers once the shared secret and the infohash are known
+        '''
+        a = RC4(hashlib.sha1(b'keyA' + self.secret + self.info_hash).digest())
+        b = RC4(hashlib.sha1(b'keyB' + self.secret + self.info_hash).digest())
+        (self.encrypt, self.decrypt) = (a, b) if self.outgoing else (b, a)
+    
+    
+    def select(self, offered):
+        '''
+        Select the crypto method for the stream
+        
+        @param   offered:int  The methods offered by the peer
+        @return  :int         The selected method, 0 if none is acceptable
+        '''
+        common = offered & self.methods
+        if (common & CRYPTO_RC4) and (self.prefer_rc4 or not (common & CRYPTO_PLAINTEXT)):
+            return CRYPTO_RC4
+        return common & CRYPTO_PLAINTEXT
+    
+    
+    def receive(self, view, pos, end):
+        '''
+        Consume received data
+        
+        Data to send is appended to `output`.
+        
+        @param   view:memoryview            The receive buffer
+        @param   pos:int                    The position of the first unconsumed byte
+        @param   end:int                    The end of the received data
+        @return  :(pos:int, needed:int)?    The position of the first unconsumed byte and the number
+                                            of bytes needed from there to continue, `None` if the
+                                            handshake failed
+        '''
+        while not self.done:
+            phase = self.phase
+            if phase == 'sync':
+                # Look for the marker after the peer's padding
+                found = bytes(view[pos : min(end, pos + self.window)]).find(self.sync)
+                if found < 0:
+                    if end - pos >= self.window:
+                        return None
+                    # Keep the bytes that may be the beginning of the marker
+                    skip = max(end - pos - len(self.sync) + 1, 0)
+                    (pos, self.window) = (pos + skip, self.window - skip)
+                    return (pos, end - pos + 1)
+                pos += found + len(self.sync)
+                self.phase = 'skey' if not self.outgoing else 'select'
+                continue
+            needed = { 'key'     : DH_LENGTH
+                     , 'skey'    : 20
+                     , 'provide' : 14
+                     , 'select'  : 6
+                     , 'pad'     : self.length
+                     , 'initial' : self.length
+                     }[phase]
+            if end - pos < needed:
+                return (pos, needed)
+            if phase == 'key':
+                self.keys(view, pos)
+                pos += DH_LENGTH
+                if self.outgoing:
+                    self.start_ciphers()
+                    header = bytearray(VC + self.methods.to_bytes(4, 'big') + bytes(2)
+                                       + len(self.initial).to_bytes(2, 'big') + self.initial)
+                    self.encrypt.crypt(header)
+                    self.output += [ hashlib.sha1(b'req1' + self.secret).digest()
+                                   , xor(obfuscated_hash(self.info_hash), hashlib.sha1(b'req3' + self.secret).digest())
+                                   , header
+                                   ]
+                    self.sync = bytearray(VC)
+                    self.decrypt.crypt(self.sync)
+                    self.sync = bytes(self.sync)
+                else:
+                    self.output.append(self.public())
+                    self.sync = hashlib.sha1(b'req1' + self.secret).digest()
+                self.window = MAX_PAD + len(self.sync)
+                self.phase = 'sync'
+            elif phase == 'skey':
+                skey = xor(view[pos : pos + 20], hashlib.sha1(b'req3' + self.secret).digest())
+                self.info_hash = self.skeys.get(skey)
+                if self.info_hash is None:
+                    return None
+                self.start_ciphers()
+                pos += 20
+                self.phase = 'provide'
+            elif phase == 'provide':
+                self.decrypt.crypt(view[pos : pos + 14])
+                if view[pos : pos + 8] != VC:
+                    return None
+                self.selected = self.select(int.from_bytes(view[pos + 8 : pos + 12], 'big'))
+                self.length = int.from_bytes(view[pos + 12 : pos + 14], 'big') + 2
+                if (self.selected == 0) or (self.length > MAX_PAD + 2):
+                    return None
+                pos += 14
+                self.phase = 'pad'
+            elif phase == 'select':
+                self.decrypt.crypt(view[pos : pos + 6])
+                self.selected = int.from_bytes(view[pos : pos + 4], 'big')
+                self.length = int.from_bytes(view[pos + 4 : pos + 6], 'big')
+                if (self.selected not in (CRYPTO_PLAINTEXT, CRYPTO_RC4)) or not (self.selected & self.methods):
+                    return None
+                if self.length > MAX_PAD:
+                    return None
+                pos += 6
+                self.phase = 'pad'
+            elif phase == 'pad':
+                self.decrypt.crypt(view[pos : pos + needed])
+                pos += needed
+                if self.outgoing:
+                    self.done = True
+                else:
+                    # The padding is followed by the length of the initial payload
+                    self.length = int.from_bytes(view[pos - 2 : pos], 'big')
+                    self.phase = 'initial'
+            elif phase == 'initial':
+                # The initial payload is the beginning of the stream, it is decrypted but not consumed
+                self.decrypt.crypt(view[pos : pos + needed])
+                header = bytearray(VC + self.selected.to_bytes(4, 'big') + bytes(2))
+                self.encrypt.crypt(header)
+                self.output.append(header)
+                if self.selected == CRYPTO_RC4:
+                    self.decrypt.crypt(view[pos + needed : end])
+                self.done = True
+                return (pos, 0)
+        if self.selected == CRYPTO_RC4:
+            self.decrypt.crypt(view[pos : end])
+        return (pos, 0)
+
+
+if __name__ == '__main__':
+    # Benchmark: cipher throughput, and encrypted pieces streamed over the loopback
+    # interface to a peer engine, for one connection and for many at once
+    import sys, time, socket, threading, selectors
+    from eventloop import EventLoop
+    from peerwire import PeerEngine, SwarmHandler, PROTOCOL, MESSAGE_HEADER, MSG_PIECE, SEGMENT
+    
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    
+    for (name, library) in (('libcrypto', libcrypto), ('python', None)):
+        if (name == 'libcrypto') and (library is None):
+            continue
+        (saved, libcrypto) = (libcrypto, library)
+        (cipher, buf) = (RC4(os.urandom(20)), bytearray(SEGMENT))
+        (start, n) = (time.perf_counter(), 0)
+        while time.perf_counter() - start < 1:
+            cipher.crypt(buf)
+            n += len(buf)
+        print('RC4 with %s: %.1f MB/s on one core' % (name, n / (1 << 20) / (time.perf_counter() - start)))
+        libcrypto = saved
+    (start, n) = (time.perf_counter(), 0)
+    while time.perf_counter() - start < 1:
+        handshake = Handshake(True, CRYPTO_RC4, True, bytes(20))
+        pow(int.from_bytes(handshake.public()[:DH_LENGTH], 'big'), handshake.private, DH_PRIME)
+        n += 1
+    print('Key exchange: %.2f ms per connection' % (1000 * (time.perf_counter() - start) / n))
+    
+    def stream(connections, level):
+        info_hash = os.urandom(20)
+        pieces = max(megabytes * 64 // connections, 1)
+        block = MESSAGE_HEADER.pack(9 + SEGMENT, MSG_PIECE) + bytes(8 + SEGMENT)
+        
+        class Counter(SwarmHandler):
+            def __init__(self):
+                self.messages = 0
+                self.first = None
+            def message(self, connection, msg_id, payload):
+                if self.first is None:
+                    self.first = time.monotonic()
+                self.messages += 1
+                if self.messages == connections * pieces:
+                    loop.stop()
+        
+        def fake_peers(port):
+            (socks, streams) = ([], [])
+            for _ in range(connections):
+                # Negotiate as the initiating side, sending the BitTorrent handshake along
+                sock = socket.create_connection(('127.0.0.1', port))
+                handshake = Handshake(True, crypto_methods(level), True, info_hash,
+                                      PROTOCOL + bytes(8) + info_hash + os.urandom(20))
+                sock.sendall(handshake.public())
+                (buf, pos) = (bytearray(), 0)
+                while not handshake.done:
+                    buf += sock.recv(1 << 16)
+                    with memoryview(buf) as view:
+                        (pos, _needed) = handshake.receive(view, pos, len(buf))
+                    sock.sendall(b''.join(handshake.output))
+                    handshake.output = []
+                data = bytearray(block * pieces)
+                if handshake.ciphers()[0] is not None:
+                    handshake.ciphers()[0].crypt(data)
+                sock.setblocking(False)
+                socks.append(sock)
+                streams.append(memoryview(data))
+            selector = selectors.DefaultSelector()
+            for (sock, data) in zip(socks, streams):
+                selector.register(sock, selectors.EVENT_WRITE, [data])
+            remaining = connections
+            while remaining > 0:
+                for (key, _events) in selector.select(1):
+                    data = key.data
+                    try:
+                        n = key.fileobj.send(data[0][: 1 << 16])
+                    except BlockingIOError:
+                        continue
+                    data[0] = data[0][n:]
+                    if len(data[0]) == 0:
+                        selector.unregister(key.fileobj)
+                        remaining -= 1
+            time.sleep(60)
+        
+        inbound = 'forced' if level == 'full' else 'enabled'
+        engine = PeerEngine(loop, os.urandom(20), max_connections = connections, ignore_local = False,
+                            encryption_inbound = inbound, encryption_level = level)
+        handler = Counter()
+        engine.add_torrent(info_hash, handler)
+        port = engine.listen('127.0.0.1', 0)
+        threading.Thread(target = fake_peers, args = (port,), daemon = True).start()
+        cpu = time.process_time()
+        timeout = loop.call_later(300, loop.stop)
+        loop.run()
+        timeout.cancel()
+        (elapsed, cpu) = (time.monotonic() - handler.first, time.process_time() - cpu)
+        megabytes_received = connections * pieces * len(block) / (1 << 20)
+        rate = megabytes_received / elapsed
+        print('%-11s %5i connections: %7.1f MB/s aggregate, %7.1f MB/s per connection, %.1f ms CPU per MB (both threads)' %
+              ('RC4' if level == 'full' else 'plaintext', connections, rate, rate / connections,
+               1000 * cpu / megabytes_received))
+        engine.close()
+    
+    loop = EventLoop()
+    for connections in (1, peers):
+        for level in ('handshake', 'full'):
+            stream(connections, level)
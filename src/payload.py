@@ -0,0 +1,746 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import os
+import struct
+import hashlib
+
+from cache import BLOCK_SIZE
+from diskio import Storage
+from picker import PiecePicker
+from resume import restore
+from peerwire import SwarmHandler, MSG_CHOKE, MSG_UNCHOKE, MSG_INTERESTED, MSG_NOT_INTERESTED
+from peerwire import MSG_HAVE, MSG_BITFIELD, MSG_REQUEST, MSG_PIECE, MSG_CANCEL
+from webseed import WebSeed, WebSeedHandler
+
+
+PIPELINE = 16
+'''
+:int  The number of blocks requested from a peer at a time
+'''
+
+MAX_REQUEST = 1 << 17
+'''
+:int  The largest block a peer may request
+'''
+
+HAVE = struct.Struct('>I')
+'''
+:Struct  The payload of a HAVE message: the index of the piece
+'''
+
+REQUEST = struct.Struct('>III')
+'''
+:Struct  The payload of a REQUEST or CANCEL message: the index of the piece, the offset and the length
+'''
+
+PIECE = struct.Struct('>II')
+'''
+:Struct  The beginning of a PIECE message's payload: the index of the piece and the offset, the block follows
+'''
+
+
+def safe_path(name, parts):
+    '''
+    Join the path of a file in a torrent, without components that could leave the download directory
+    
+    @param   name:bytes         The torrent's name
+    @param   parts:list<bytes>  The path of the file within the torrent, empty for a single file torrent
+    @return  :str               The relative path
+    '''
+    parts = [part.decode('utf-8', 'replace').replace(os.sep, '_') for part in [name] + parts]
+    return os.path.join(*[part for part in parts if part not in ('', '.', '..')] or ['_'])
+
+
+class Download():
+    '''
+    The blocks of a piece that is being downloaded
+    '''
+    
+    __slots__ = ('count', 'received', 'requested', 'flushed', 'written')
+    
+    def __init__(self, count):
+        '''
+        Constructor
+        
+        @param  count:int  The number of blocks in the piece
+        '''
+        self.count = count
+        self.received = set()
+        self.requested = set()
+        self.flushed = 0
+        self.written = 0
+
+
+class Peer():
+    '''
+    The state of a connected peer
+    '''
+    
+    __slots__ = ('pieces', 'requests')
+    
+    def __init__(self, pieces):
+        '''
+        Constructor
+        
+        @param  pieces:PeerPieces  The pieces the peer has
+        '''
+        self.pieces = pieces
+        self.requests = set()
+
+
+class Payload(SwarmHandler, WebSeedHandler):
+    '''
+    A torrent's pieces on disk, and their exchange with the torrent's peers and web seeds
+    
+    Blocks are requested rarest piece first, a few at a time from each
+    peer, and written as they arrive, or once their piece is complete
+    if there is a block cache, which then also serves blocks that are
+    requested repeatedly by peers. Each written block is remembered
+    in the fast-resume record, and a piece is marked complete there once
+    all its blocks are written and it has been read back and its hash
+    matches, so an interrupted download resumes where it stopped.
+    '''
+    
+    def __init__(self, loop, torrent, metainfo, directory, disk, peer_table = None, changed = None, cache = None):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop              The event loop to run in
+        @param  torrent:Torrent             The torrent, its totals are kept up to date
+        @param  metainfo:Metainfo           The torrent's metainfo, it must remain valid while in use
+        @param  directory:str               The directory to download into
+        @param  disk:DiskIO                 The disk I/O pool, it must call callbacks in `loop`
+        @param  peer_table:PeerTable?       The table the torrent's peers are listed in
+        @param  changed:(Torrent)→void?     Called when the torrent's totals have changed
+        @param  cache:BlockCache?           The block cache, its flush function must pass
+                                            a piece's blocks to the payload's `flush`
+        '''
+        self.loop = loop
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
+        self.metainfo = metainfo
+        info = metainfo.info
+        self.piece_length = info[b'piece length']
+        self.hashes = metainfo.pieces()
+        self.piece_count = metainfo.piece_count()
+        self.blocks_per_piece = (self.piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        name = bytes(info[b'name'])
+        files = [(safe_path(name, path), length) for (path, length) in metainfo.files()]
+        self.storage = Storage(directory, files, self.piece_length)
+        self.disk = disk
+        self.peer_table = peer_table
+        self.changed = changed
+        self.cache = cache
+        self.picker = PiecePicker(self.piece_count)
+        self.record = None
+        self.ready = False
+        self.downloads = {}
+        self.peers = {}
+        self.web_seeds = []
+    
+    
+    def piece_size(self, piece):
+        '''
+        @param   piece:int  The index of a piece
+        @return  :int       The size of the piece
+        '''
+        return min(self.piece_length, self.storage.total_length - piece * self.piece_length)
+    
+    
+    def has(self, piece):
+        '''
+        @param   piece:int  The index of a piece
+        @return  :bool      Whether the piece is complete
+        '''
+        return (self.picker.have & self.picker.bit(piece)) != 0
+    
+    
+    def matches(self, record):
+        '''
+        @param   record:ResumeRecord  A fast-resume record
+        @return  :bool                Whether the record has the layout of this torrent
+        '''
+        return ((record.piece_count, record.file_count, record.blocks_per_piece)
+                == (self.piece_count, len(self.storage.paths), self.blocks_per_piece))
+    
+    
+    def start(self, record, progress = None, callback = None):
+        '''
+        Find the complete pieces in a disk thread, rechecking the files that
+        have changed since they were last stamped
+        
+        @param  record:ResumeRecord                    The torrent's fast-resume record, see `matches`
+        @param  progress:(done:int, total:int)→void?   Called in the event loop with the progress of a recheck
+        @param  callback:()→void?                      Called when the payload is ready to be shared
+        '''
+        self.record = record
+        report = None
+        if progress is not None:
+            report = lambda done, total : self.loop.call_soon_threadsafe(progress, done, total)
+        files = list(zip(self.storage.paths, self.storage.lengths))
+        self.disk.submit(restore, lambda bitfield, error : self.restored(bitfield, error, callback),
+                         record, files, self.piece_length, self.hashes, None, report)
+    
+    
+    def restored(self, bitfield, error, callback):
+        '''
+        Called when the complete pieces have been found
+        
+        @param  bitfield:bytearray?  The complete pieces, in wire order
+        @param  error:OSError?       Why the pieces could not be found, all are missing then
+        @param  callback:()→void?    Called when the payload is ready to be shared
+        '''
+        if error is not None:
+            bitfield = bytes(self.picker.nbits // 8)
+        self.picker.set_have(bitfield)
+        # Blocks written before a restart need not be downloaded again
+        for (piece, blocks) in self.record.partial_pieces().items():
+            if (piece < self.piece_count) and not self.has(piece):
+                download = self.downloads[piece] = Download((self.piece_size(piece) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+                download.received = set(block * BLOCK_SIZE for block in range(download.count)
+                                        if blocks[block >> 3] & (0x80 >> (block & 7)))
+                download.flushed = download.written = len(download.received)
+                if download.written == download.count:
+                    self.verify(piece, download)
+        done = bin(self.picker.have).count('1') * self.piece_length
+        if (self.piece_count > 0) and self.has(self.piece_count - 1):
+            done -= self.piece_length - self.piece_size(self.piece_count - 1)
+        self.torrent.done = done
+        self.ready = True
+        if self.changed is not None:
+            self.changed(self.torrent)
+        if callback is not None:
+            callback()
+    
+    
+    def close(self):
+        '''
+        Stop sharing the payload, stamp its files in the fast-resume record so they
+        are not rechecked when the torrent is started again, and close them; blocks
+        that are still being written must have been waited for, blocks that are held
+        in the block cache are dropped and downloaded again
+        '''
+        self.ready = False
+        for seed in self.web_seeds:
+            seed.close()
+        self.web_seeds = []
+        if self.cache is not None:
+            self.cache.drop(self)
+        if self.record is not None:
+            self.record.stamp(self.storage.paths)
+        self.disk.close_storage(self.storage)
+    
+    
+    def connected(self, connection):
+        '''
+        Called when the handshake is complete
+        
+        @param  connection:Connection  The connection
+        '''
+        self.peers[connection] = Peer(self.picker.add_peer())
+        if self.picker.have != 0:
+            connection.send_message(MSG_BITFIELD, self.picker.to_bitfield(self.picker.have))
+    
+    
+    def message(self, connection, msg_id, payload):
+        '''
+        Called for each received message, a malformed message closes the connection
+        
+        @param  connection:Connection  The connection
+        @param  msg_id:int             The message's identifier
+        @param  payload:memoryview     The message without its length and identifier
+        '''
+        peer = self.peers.get(connection)
+        if peer is None:
+            return
+        try:
+            if msg_id == MSG_PIECE:
+                self.block_received(connection, peer, payload)
+            elif msg_id == MSG_REQUEST:
+                self.block_requested(connection, *REQUEST.unpack(payload))
+            elif msg_id == MSG_HAVE:
+                self.picker.peer_has(peer.pieces, HAVE.unpack(payload)[0])
+                self.update_progress(connection, peer)
+                self.update_interest(connection, peer)
+            elif msg_id == MSG_BITFIELD:
+                self.picker.set_bitfield(peer.pieces, payload)
+                self.update_progress(connection, peer)
+                self.update_interest(connection, peer)
+            elif msg_id == MSG_UNCHOKE:
+                self.request(connection, peer)
+            elif msg_id == MSG_CHOKE:
+                # The peer drops our requests
+                self.cancel_requests(peer)
+        except (struct.error, ValueError):
+            connection.close()
+    
+    
+    def disconnected(self, connection):
+        '''
+        Called when a connection that completed the handshake is closed
+        
+        @param  connection:Connection  The connection
+        '''
+        peer = self.peers.pop(connection, None)
+        if peer is not None:
+            self.picker.remove_peer(peer.pieces)
+            self.cancel_requests(peer)
+    
+    
+    def update_progress(self, connection, peer):
+        '''
+        Show how much of the torrent a peer has in the peer table
+        
+        @param  connection:Connection  The connection
+        @param  peer:Peer              The peer
+        '''
+        if (self.peer_table is not None) and (connection.slot is not None):
+            self.peer_table.update(connection.slot, progress = peer.pieces.count / max(self.piece_count, 1))
+    
+    
+    def update_interest(self, connection, peer):
+        '''
+        Tell a peer whether it has pieces we want, and request them
+        
+        @param  connection:Connection  The connection
+        @param  peer:Peer              The peer
+        '''
+        interested = (peer.pieces.mask & self.picker.wanted & ~self.picker.have) != 0
+        if interested != connection.am_interested:
+            connection.am_interested = interested
+            connection.send_message(MSG_INTERESTED if interested else MSG_NOT_INTERESTED)
+            if connection.slot is not None:
+                connection.engine.update_flags(connection)
+        if interested:
+            self.request(connection, peer)
+    
+    
+    def request(self, connection, peer):
+        '''
+        Request blocks from a peer until `PIPELINE` are outstanding
+        
+        @param  connection:Connection  The connection
+        @param  peer:Peer              The peer
+        '''
+        if connection.peer_choking or not self.ready:
+            return
+        while len(peer.requests) < PIPELINE:
+            block = self.next_block(peer)
+            if block is None:
+                break
+            (piece, offset) = block
+            peer.requests.add(block)
+            self.downloads[piece].requested.add(offset)
+            length = min(BLOCK_SIZE, self.piece_size(piece) - offset)
+            connection.send_message(MSG_REQUEST, REQUEST.pack(piece, offset, length))
+    
+    
+    def next_block(self, peer):
+        '''
+        Choose the next block to request from a peer, finishing started pieces first
+        
+        In endgame mode, blocks that have been requested from other peers
+        are chosen too, and cancelled at the other peers when they arrive.
+        
+        @param   peer:Peer                      The peer
+        @return  :(piece:int, offset:int)?      The block, `None` if the peer has nothing we want
+        '''
+        endgame = self.picker.endgame()
+        def free_block(piece, download):
+            for offset in range(0, download.count * BLOCK_SIZE, BLOCK_SIZE):
+                if (offset not in download.received) and ((offset not in download.requested)
+                                                          or (endgame and ((piece, offset) not in peer.requests))):
+                    return (piece, offset)
+            return None
+        mask = peer.pieces.mask
+        for (piece, download) in self.downloads.items():
+            if mask & self.picker.bit(piece):
+                block = free_block(piece, download)
+                if block is not None:
+                    return block
+        piece = self.picker.pick(peer.pieces)
+        if piece is None:
+            return None
+        download = self.downloads.get(piece)
+        if download is None:
+            download = self.downloads[piece] = Download((self.piece_size(piece) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        return free_block(piece, download)
+    
+    
+    def cancel_requests(self, peer):
+        '''
+        Forget the blocks requested from a peer, so they can be requested from others
+        
+        @param  peer:Peer  The peer
+        '''
+        for (piece, offset) in peer.requests:
+            download = self.downloads.get(piece)
+            if download is not None:
+                download.requested.discard(offset)
+                if (len(download.received) == 0) and (len(download.requested) == 0):
+                    del self.downloads[piece]
+                    self.picker.piece_abandoned(piece)
+        peer.requests.clear()
+        self.pump_web_seeds()
+    
+    
+    def block_received(self, connection, peer, payload):
+        '''
+        Write a block that a peer has sent
+        
+        @param  connection:Connection  The connection
+        @param  peer:Peer              The peer
+        @param  payload:memoryview     The payload of the PIECE message
+        '''
+        (piece, offset) = block = PIECE.unpack_from(payload)
+        if block not in peer.requests:
+            return
+        peer.requests.discard(block)
+        data = payload[PIECE.size:]
+        download = self.downloads.get(piece)
+        if (download is not None) and (offset not in download.received):
+            download.requested.discard(offset)
+            if len(data) != min(BLOCK_SIZE, self.piece_size(piece) - offset):
+                raise ValueError('block has wrong length')
+            download.received.add(offset)
+            self.torrent.downloaded += len(data)
+            if self.picker.endgame():
+                for (other, other_peer) in self.peers.items():
+                    if block in other_peer.requests:
+                        other_peer.requests.discard(block)
+                        other.send_message(MSG_CANCEL, REQUEST.pack(piece, offset, len(data)))
+            if self.cache is None:
+                self.write(piece, download, [(offset, bytes(data))])
+            else:
+                self.cache.write(self, piece, offset, bytes(data), download.count - download.flushed)
+        self.request(connection, peer)
+    
+    
+    def write(self, piece, download, blocks):
+        '''
+        Write blocks of a piece that is being downloaded
+        
+        @param  piece:int                              The index of the piece
+        @param  download:Download                      The piece's download
+        @param  blocks:list<(offset:int, data:bytes)>  The blocks
+        '''
+        download.flushed += len(blocks)
+        self.disk.write(self.storage, piece, blocks, lambda result, error : self.written(piece, download, blocks, error))
+    
+    
+    def flush(self, piece, blocks):
+        '''
+        Write blocks that have been held in the block cache
+        
+        @param  piece:int                              The index of the piece
+        @param  blocks:list<(offset:int, data:bytes)>  The blocks
+        '''
+        download = self.downloads.get(piece)
+        if download is not None:
+            self.write(piece, download, blocks)
+    
+    
+    def written(self, piece, download, blocks, error):
+        '''
+        Called when blocks have been written, records them and verifies the piece once it is complete
+        
+        @param  piece:int                              The index of the piece
+        @param  download:Download                      The piece's download
+        @param  blocks:list<(offset:int, data:bytes)>  The blocks
+        @param  error:OSError?                         Why the blocks could not be written
+        '''
+        if self.downloads.get(piece) is not download:
+            return
+        if error is not None:
+            # Download the blocks again
+            for (offset, _data) in blocks:
+                download.received.discard(offset)
+            download.flushed -= len(blocks)
+            return
+        for (offset, _data) in blocks:
+            self.record.block_done(piece, offset // BLOCK_SIZE)
+        download.written += len(blocks)
+        if download.written >= download.count:
+            self.verify(piece, download)
+    
+    
+    def verify(self, piece, download):
+        '''
+        Read back a piece whose blocks have all been written and check its hash, in a disk thread
+        
+        @param  piece:int          The index of the piece
+        @param  download:Download  The piece's download
+        '''
+        self.disk.submit(self.check_now, lambda valid, error : self.verified(piece, download, (error is None) and valid),
+                         piece)
+    
+    
+    def check_now(self, piece):
+        '''
+        Check the hash of a piece on disk, in the calling thread
+        
+        @param   piece:int  The index of the piece
+        @return  :bool      Whether the piece is correct
+        '''
+        result = self.disk.read_now(self.storage, piece, 0, self.piece_size(piece))
+        try:
+            sha1 = hashlib.sha1()
+            for view in result.views:
+                sha1.update(view)
+        finally:
+            self.disk.recycle(result.buffers)
+        return sha1.digest() == self.hashes[piece * 20 : (piece + 1) * 20]
+    
+    
+    def verified(self, piece, download, valid):
+        '''
+        Called when a downloaded piece has been checked
+        
+        @param  piece:int          The index of the piece
+        @param  download:Download  The piece's download
+        @param  valid:bool         Whether the piece is correct
+        '''
+        if self.downloads.get(piece) is not download:
+            return
+        del self.downloads[piece]
+        if valid:
+            self.picker.piece_completed(piece)
+            self.record.set_have(piece)
+            self.torrent.done += self.piece_size(piece)
+            have = HAVE.pack(piece)
+            for (connection, peer) in list(self.peers.items()):
+                connection.send_message(MSG_HAVE, have)
+                self.update_interest(connection, peer)
+        else:
+            # Forget the written blocks and download the piece again
+            self.picker.piece_abandoned(piece)
+            self.record.set_have(piece, False)
+            for (connection, peer) in list(self.peers.items()):
+                self.request(connection, peer)
+            self.pump_web_seeds()
+        if self.changed is not None:
+            self.changed(self.torrent)
+    
+    
+    def start_web_seeds(self, connector):
+        '''
+        Download missing pieces from the torrent's web seeds too, see BEP 19; the payload must be ready
+        
+        @param  connector:proxy.Connector  Opens the connections to the web seeds
+        '''
+        for url in self.metainfo.web_seeds():
+            try:
+                self.web_seeds.append(WebSeed(self.loop, connector, url, self.metainfo, self.picker, self))
+            except ValueError:
+                # HTTPS, or not a URL
+                continue
+        self.pump_web_seeds()
+    
+    
+    def pump_web_seeds(self):
+        '''
+        Let the web seeds claim pieces that have become available for downloading
+        '''
+        for seed in self.web_seeds:
+            seed.pump()
+    
+    
+    def piece(self, seed, index, data):
+        '''
+        Write a piece that a web seed has downloaded, it is checked like a piece from peers
+        
+        @param  seed:WebSeed        The web seed
+        @param  index:int           The index of the piece
+        @param  data:memoryview     The piece, only valid during the call
+        '''
+        if not self.ready or self.has(index):
+            return
+        download = self.downloads.get(index)
+        if download is None:
+            download = self.downloads[index] = Download((len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+        # Blocks that peers have already sent are kept, those still requested from peers are ignored when they arrive
+        blocks = [(offset, bytes(data[offset : offset + BLOCK_SIZE])) for offset in range(0, len(data), BLOCK_SIZE)
+                  if offset not in download.received]
+        for (offset, block) in blocks:
+            download.received.add(offset)
+            self.torrent.downloaded += len(block)
+            if self.cache is not None:
+                self.cache.write(self, index, offset, block, download.count - download.flushed)
+        if (self.cache is None) and (len(blocks) > 0):
+            self.write(index, download, blocks)
+    
+    
+    def block_requested(self, connection, piece, offset, length):
+        '''
+        Read a block that a peer has requested and send it
+        
+        @param  connection:Connection  The connection
+        @param  piece:int              The index of the piece
+        @param  offset:int             The offset of the block within the piece
+        @param  length:int             The length of the block
+        '''
+        if connection.am_choking or not (0 <= piece < self.piece_count) or not self.has(piece):
+            return
+        if not (0 < length <= MAX_REQUEST) or (offset + length > self.piece_size(piece)):
+            raise ValueError('request out of range')
+        if self.cacheable(piece, offset, length):
+            data = self.cache.get((self, piece, offset))
+            if data is not None:
+                connection.send_message(MSG_PIECE, PIECE.pack(piece, offset), data)
+                self.torrent.uploaded += len(data)
+                return
+        self.disk.read(self.storage, piece, offset, length,
+                       lambda result, error : self.block_read(connection, piece, offset, result, error))
+    
+    
+    def cacheable(self, piece, offset, length):
+        '''
+        Check whether a request can be served from the block cache
+        
+        @param   piece:int   The index of the piece
+        @param   offset:int  The offset of the requested data within the piece
+        @param   length:int  The length of the requested data
+        @return  :bool       Whether the request is for exactly one block, and there is a cache
+        '''
+        if (self.cache is None) or (offset % BLOCK_SIZE != 0):
+            return False
+        return length == min(BLOCK_SIZE, self.piece_size(piece) - offset)
+    
+    
+    def block_read(self, connection, piece, offset, result, error):
+        '''
+        Send a block that has been read for a peer
+        
+        @param  connection:Connection  The connection
+        @param  piece:int              The index of the piece
+        @param  offset:int             The offset of the block within the piece
+        @param  result:ReadResult?     The block
+        @param  error:OSError?         Why the block could not be read
+        '''
+        if (error is not None) or (connection.state != 'open') or connection.am_choking:
+            return
+        # The buffers are reused once this returns
+        data = b''.join(result.views)
+        if self.cacheable(piece, offset, len(data)):
+            self.cache.put((self, piece, offset), data)
+        connection.send_message(MSG_PIECE, PIECE.pack(piece, offset), data)
+        self.torrent.uploaded += len(data)
+
+
+if __name__ == '__main__':
+    # Download a torrent from a seeder on the loopback interface, then restart the download half way
+    import sys, time, shutil, tempfile
+    from bencode import Metainfo, encode
+    from cache import BlockCache
+    from diskio import DiskIO
+    from eventloop import EventLoop
+    from peerwire import PeerEngine
+    from peers import PeerTable
+    from resume import ResumeStore
+    from torrents import Torrent
+    
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    piece_length = 256 << 10
+    root = tempfile.mkdtemp(prefix = 'tirek-payload-')
+    try:
+        data = os.urandom(size_mib << 20)
+        lengths = [len(data) // 3, len(data) - len(data) // 3 - 12345, 12345]
+        payload_pieces = (len(data) + piece_length - 1) // piece_length
+        hashes = b''.join(hashlib.sha1(data[i : i + piece_length]).digest() for i in range(0, len(data), piece_length))
+        files = [{ b'length' : length, b'path' : [b'file%i' % i] } for (i, length) in enumerate(lengths)]
+        metainfo = Metainfo(encode({ b'info' : { b'name' : b'payload', b'piece length' : piece_length
+                                               , b'pieces' : hashes, b'files' : files } }))
+        os.makedirs(os.path.join(root, 'seed', 'payload'))
+        offset = 0
+        for (i, length) in enumerate(lengths):
+            with open(os.path.join(root, 'seed', 'payload', 'file%i' % i), 'wb') as file:
+                file.write(data[offset : offset + length])
+            offset += length
+        
+        loop = EventLoop()
+        disk = DiskIO(loop)
+        cache = BlockCache(flush = lambda payload, piece, blocks : payload.flush(piece, blocks))
+        def run_until(predicate, limit = 120):
+            deadline = time.monotonic() + limit
+            while not predicate() and time.monotonic() < deadline:
+                loop.run_once()
+        
+        def share(name, engine, port = None, table = None):
+            torrent = Torrent(metainfo.info_hash, name, len(data))
+            payload = Payload(loop, torrent, metainfo, os.path.join(root, name), disk, table, cache = cache)
+            store = ResumeStore(os.path.join(root, name + '.resume'))
+            store.open()
+            record = store.get(metainfo.info_hash)
+            if (record is None) or not payload.matches(record):
+                record = store.add(metainfo.info_hash, payload.piece_count, len(lengths), payload.blocks_per_piece)
+            checked = []
+            ready = []
+            payload.start(record, lambda done, total : checked.append(total), lambda : ready.append(True))
+            run_until(lambda : ready)
+            engine.add_torrent(metainfo.info_hash, payload)
+            if port is not None:
+                engine.connect(metainfo.info_hash, ('127.0.0.1', port))
+            return (torrent, payload, store, checked[-1] if len(checked) > 0 else 0)
+        
+        seeder = PeerEngine(loop, os.urandom(20), ignore_local = False)
+        port = seeder.listen('127.0.0.1', 0)
+        (seed, _payload, seed_store, rechecked) = share('seed', seeder)
+        assert seed.done == len(data) and rechecked == payload_pieces, 'seeder did not recheck its payload'
+        
+        leecher = PeerEngine(loop, os.urandom(20), ignore_local = False)
+        (torrent, payload, store, _rechecked) = share('leech', leecher, port)
+        start = time.monotonic()
+        run_until(lambda : torrent.done >= len(data) // 2)
+        elapsed = time.monotonic() - start
+        print('downloaded %.1f MB in %.2f s: %.1f MB/s' % (torrent.done / (1 << 20), elapsed, torrent.done / (1 << 20) / elapsed))
+        
+        # Restart the leecher, the fast-resume record keeps the pieces and blocks that were written
+        leecher.close()
+        run_until(lambda : False, 1)
+        payload.close()
+        store.close()
+        before = torrent.done
+        table = PeerTable()
+        leecher = PeerEngine(loop, os.urandom(20), ignore_local = False, peer_table = table)
+        (torrent, payload, store, rechecked) = share('leech', leecher, port, table)
+        assert torrent.done >= before, 'resumed download lost pieces'
+        print('resumed with %.1f MB of %.1f MB, rechecked %i of %i pieces' %
+              (torrent.done / (1 << 20), len(data) / (1 << 20), rechecked, payload_pieces))
+        run_until(lambda : torrent.done == len(data))
+        assert torrent.done == len(data), 'download did not complete'
+        for (i, length) in enumerate(lengths):
+            with open(os.path.join(root, 'seed', 'payload', 'file%i' % i), 'rb') as a:
+                with open(os.path.join(root, 'leech', 'payload', 'file%i' % i), 'rb') as b:
+                    assert a.read() == b.read(), 'file %i differs' % i
+        # The seeder is listed with all pieces, and the rate it was downloaded from
+        run_until(lambda : False, 1.5)
+        [slot] = table.by_torrent[metainfo.info_hash]
+        assert table.progress[slot] == 1.0, 'peer progress was not updated'
+        assert table.down_rate[slot] > 0, 'peer rate was not updated'
+        print('download complete and verified, cache hits %i, misses %i, pieces flushed %i' %
+              (cache.hits, cache.misses, cache.flushes))
+        seeder.close()
+        leecher.close()
+        store.close()
+        seed_store.close()
+        disk.close()
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,398 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import socket
+import ipaddress
+from array import array
+
+from stats import scale
+from layout import fit
+
+
+ADDRESS_LENGTH = 18
+'''
+:int  The size of a stored address: 16 bytes IPv6, or IPv4-mapped IPv6, address and 2 bytes port
+'''
+
+FLAG_LETTERS = 'DdUuIEXHLK'
+'''
+:str  Letters for the flags, in bit order
+'''
+
+FLAG_DOWNLOADING, FLAG_INTERESTED, FLAG_UPLOADING, FLAG_PEER_INTERESTED = 1, 2, 4, 8
+FLAG_INCOMING, FLAG_ENCRYPTED, FLAG_PEX, FLAG_DHT, FLAG_LSD, FLAG_SNUBBED = 16, 32, 64, 128, 256, 512
+
+
+def pack_address(address):
+    '''
+    Pack an address for storage
+    
+    @param   address:(host:str, port:int)  The address
+    @return  :bytes                        The packed address
+    '''
+    ip = ipaddress.ip_address(address[0])
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address('::ffff:' + str(ip))
+    return ip.packed + address[1].to_bytes(2, 'big')
+
+
+def unpack_address(data):
+    '''
+    Unpack a stored address
+    
+    @param   data:bytes|bytearray|memoryview  The packed address
+    @return  :(host:str, port:int)            The address
+    '''
+    ip = ipaddress.IPv6Address(bytes(data[:16]))
+    host = str(ip.ipv4_mapped) if ip.ipv4_mapped is not None else str(ip)
+    return (host, int.from_bytes(data[16 : 18], 'big'))
+
+
+CLIENTS = { b'qB' : 'qBittorrent'
+          , b'TR' : 'Transmission'
+          , b'DE' : 'Deluge'
+          , b'lt' : 'libtorrent'
+          , b'LT' : 'libtorrent'
+          , b'UT' : 'µTorrent'
+          , b'AZ' : 'Vuze'
+          , b'BI' : 'BiglyBT'
+          , b'TK' : 'tirek'
+          }
+'''
+:dict<bytes, str>  Client names by Azureus-style peer ID prefix
+'''
+
+
+def client_name(peer_id):
+    '''
+    Guess a peer's client from its peer ID
+    
+    @param   peer_id:bytes  The peer ID
+    @return  :str           The name and version of the client, empty if unknown
+    '''
+    if (len(peer_id) >= 8) and (peer_id[:1] == b'-') and (peer_id[7:8] == b'-'):
+        name = CLIENTS.get(peer_id[1 : 3], peer_id[1 : 3].decode('ascii', 'replace'))
+        version = '.'.join(chr(c) for c in peer_id[3 : 7] if chr(c).isalnum())
+        return '%s %s' % (name, version)
+    return ''
+
+
+def format_flags(flags):
+    '''
+    Format peer flags as letters
+    
+    @param   flags:int  The flags, `FLAG_*` or:ed together
+    @return  :str       The letters
+    '''
+    return ''.join(letter for (i, letter) in enumerate(FLAG_LETTERS) if flags & (1 << i))
+
+
+class PeerTable():
+    '''
+    Connected peers stored column by column
+    
+    Each peer is a slot, an index into the columns; slots of removed
+    peers are reused. Each torrent lists its peers' slots, and each slot
+    has its position in that list, so peers are removed in constant
+    time. Client names are interned, so each peer only
+    stores an index into the list of names.
+    '''
+    
+    def __init__(self, geoip = None):
+        '''
+        Constructor
+        
+        @param  geoip:GeoIP?  Country lookup for new peers
+        '''
+        self.geoip = geoip
+        self.addresses = bytearray()
+        self.clients = array('H')
+        self.flags = array('H')
+        self.progress = array('f')
+        self.down_rate = array('f')
+        self.up_rate = array('f')
+        self.countries = array('H')
+        self.versions = array('I')
+        self.positions = array('I')
+        self.client_names = ['']
+        self.client_numbers = { '' : 0 }
+        self.free = []
+        self.by_torrent = {}
+        self.torrent_of = {}
+        self.unresolved = set()
+    
+    
+    def __len__(self):
+        '''
+        @return  :int  The number of peers
+        '''
+        return len(self.torrent_of)
+    
+    
+    def add(self, torrent, address, client = '', flags = 0):
+        '''
+        Add a peer
+        
+        @param   torrent:bytes                 The infohash of the peer's torrent
+        @param   address:(host:str, port:int)  The peer's address
+        @param   client:str                    The name of the peer's client
+        @param   flags:int                     The peer's flags
+        @return  :int                          The peer's slot
+        '''
+        if client not in self.client_numbers:
+            self.client_numbers[client] = len(self.client_names)
+            self.client_names.append(client)
+        if len(self.free) > 0:
+            slot = self.free.pop()
+            self.addresses[slot * ADDRESS_LENGTH : (slot + 1) * ADDRESS_LENGTH] = pack_address(address)
+            (self.clients[slot], self.flags[slot], self.progress[slot]) = (self.client_numbers[client], flags, 0.0)
+            (self.down_rate[slot], self.up_rate[slot], self.countries[slot]) = (0.0, 0.0, 0)
+            self.versions[slot] += 1
+        else:
+            slot = len(self.flags)
+            self.addresses += pack_address(address)
+            self.clients.append(self.client_numbers[client])
+            self.flags.append(flags)
+            for column in (self.progress, self.down_rate, self.up_rate):
+                column.append(0.0)
+            self.countries.append(0)
+            self.versions.append(0)
+        slots = self.by_torrent.setdefault(torrent, [])
+        if slot < len(self.positions):
+            self.positions[slot] = len(slots)
+        else:
+            self.positions.append(len(slots))
+        slots.append(slot)
+        self.torrent_of[slot] = torrent
+        if self.geoip is not None:
+            self.unresolved.add(slot)
+        return slot
+    
+    
+    def remove(self, slot):
+        '''
+        Remove a peer
+        
+        @param  slot:int  The peer's slot
+        '''
+        torrent = self.torrent_of.pop(slot)
+        self.unresolved.discard(slot)
+        slots = self.by_torrent[torrent]
+        # Move the torrent's last peer into the removed peer's place
+        position = self.positions[slot]
+        last = slots.pop()
+        if last != slot:
+            slots[position] = last
+            self.positions[last] = position
+        if len(slots) == 0:
+            del self.by_torrent[torrent]
+        self.versions[slot] += 1
+        self.free.append(slot)
+    
+    
+    def address(self, slot):
+        '''
+        @param   slot:int               The peer's slot
+        @return  :(host:str, port:int)  The peer's address
+        '''
+        return unpack_address(self.addresses[slot * ADDRESS_LENGTH : (slot + 1) * ADDRESS_LENGTH])
+    
+    
+    def set_flags(self, slot, set_flags = 0, clear_flags = 0):
+        '''
+        Change a peer's flags
+        
+        @param  slot:int         The peer's slot
+        @param  set_flags:int    Flags to set
+        @param  clear_flags:int  Flags to clear
+        '''
+        flags = (self.flags[slot] & ~clear_flags) | set_flags
+        if flags != self.flags[slot]:
+            self.flags[slot] = flags
+            self.versions[slot] += 1
+    
+    
+    def update(self, slot, progress = None, down_rate = None, up_rate = None, country = None):
+        '''
+        Change a peer's statistics
+        
+        @param  slot:int          The peer's slot
+        @param  progress:float?   The fraction of the torrent the peer has
+        @param  down_rate:float?  The rate we download from the peer, in bytes per second
+        @param  up_rate:float?    The rate we upload to the peer, in bytes per second
+        @param  country:str?      The peer's two letter country code
+        '''
+        if progress is not None:
+            self.progress[slot] = progress
+        if down_rate is not None:
+            self.down_rate[slot] = down_rate
+        if up_rate is not None:
+            self.up_rate[slot] = up_rate
+        if country is not None:
+            self.unresolved.discard(slot)
+            self.countries[slot] = int.from_bytes(country.encode('ascii')[:2].ljust(2), 'big')
+        self.versions[slot] += 1
+    
+    
+    def resolve(self):
+        '''
+        Look up the countries of all new peers, in one bulk lookup
+        '''
+        slots = list(self.unresolved)
+        codes = self.geoip.countries([self.address(slot)[0] for slot in slots])
+        for (slot, code) in zip(slots, codes):
+            self.update(slot, country = code)
+    
+    
+    def country(self, slot):
+        '''
+        @param   slot:int  The peer's slot
+        @return  :str      The peer's two letter country code, empty if unknown
+        '''
+        code = self.countries[slot]
+        return code.to_bytes(2, 'big').decode('ascii').strip('- ') if code else ''
+    
+    
+    def bytes_per_peer(self):
+        '''
+        Get the storage size of a peer in the columns
+        
+        @return  :int  The number of bytes
+        '''
+        return ADDRESS_LENGTH + sum(column.itemsize for column in
+                                    (self.clients, self.flags, self.progress, self.down_rate,
+                                     self.up_rate, self.countries, self.versions, self.positions))
+
+
+class PeerView():
+    '''
+    Virtualized view of a torrent's peers for the Peers tab
+    '''
+    
+    def __init__(self, table):
+        '''
+        Constructor
+        
+        @param  table:PeerTable  The peers
+        '''
+        self.table = table
+        self.top = 0
+        self.rows = {}
+    
+    
+    def scroll(self, delta, torrent, height):
+        '''
+        Scroll the view
+        
+        @param  delta:int       The number of rows to scroll, negative for up
+        @param  torrent:bytes?  The infohash of the shown torrent
+        @param  height:int      The number of rows in the viewport
+        '''
+        count = len(self.table.by_torrent.get(torrent, ()))
+        self.top = min(max(self.top + delta, 0), max(count - height, 0))
+    
+    
+    def format_row(self, slot, width):
+        '''
+        Format a peer as a row
+        
+        @param   slot:int   The peer's slot
+        @param   width:int  The width of the row
+        @return  :str       The row, exactly `width` columns wide
+        '''
+        table = self.table
+        (host, port) = table.address(slot)
+        address = ('[%s]:%i' if ':' in host else '%s:%i') % (host, port)
+        columns = ' %-2s %-10s %5.1f%% %8s %8s' % ( table.country(slot)
+                                                  , format_flags(table.flags[slot])
+                                                  , 100 * table.progress[slot]
+                                                  , '%.1f %s' % scale(table.down_rate[slot])
+                                                  , '%.1f %s' % scale(table.up_rate[slot])
+                                                  )
+        left = '%-22s %s' % (address, table.client_names[table.clients[slot]])
+        if len(columns) + 22 > width:
+            columns = ''
+        return fit(fit(left, width - len(columns)) + columns, width)
+    
+    
+    def render(self, torrent, height, width):
+        '''
+        Get the rows inside the viewport, formatting only changed rows
+        
+        @param   torrent:bytes?  The infohash of the shown torrent
+        @param   height:int      The number of rows in the viewport
+        @param   width:int       The width of the viewport
+        @return  :list<str>      The rows
+        '''
+        if len(self.table.unresolved) > 0:
+            self.table.resolve()
+        slots = self.table.by_torrent.get(torrent, [])
+        self.top = min(self.top, max(len(slots) - height, 0))
+        rc = []
+        for slot in slots[self.top : self.top + height]:
+            key = (self.table.versions[slot], width)
+            cached = self.rows.get(slot)
+            if (cached is None) or (cached[0] != key):
+                cached = self.rows[slot] = (key, self.format_row(slot, width))
+            rc.append(cached[1])
+        return rc
+
+
+if __name__ == '__main__':
+    # Measure memory per peer and the cost of rendering a torrent with many peers
+    import os, sys, time, random, tracemalloc
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    (height, width) = (9, 160)
+    tracemalloc.start()
+    table = PeerTable()
+    view = PeerView(table)
+    torrent = os.urandom(20)
+    clients = ['qBittorrent 4.%i' % i for i in range(10)] + ['Transmission 3.0', 'tirek']
+    slots = [table.add(torrent, ('10.%i.%i.%i' % (i >> 16 & 255, i >> 8 & 255, i & 255), 6881),
+                       random.choice(clients), random.randrange(1 << 10)) for i in range(count)]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%i peers: %i bytes per peer in the columns, %.0f bytes per peer in total' %
+          (count, table.bytes_per_peer(), memory / count))
+    start = time.perf_counter()
+    frames = 1000
+    for _ in range(frames):
+        # A tick updates every peer's rates, but only the viewport is formatted
+        for slot in slots:
+            table.update(slot, down_rate = random.random() * 1e5)
+        view.scroll(random.randrange(-5, 6), torrent, height)
+        view.render(torrent, height, width)
+    per_frame = (time.perf_counter() - start) / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        view.render(torrent, height, width)
+    print('%.2f ms per frame updating every peer and rendering, %.1f µs per frame with no changes' %
+          (1000 * per_frame, 1e6 * (time.perf_counter() - start) / frames))
+    random.shuffle(slots)
+    start = time.perf_counter()
+    for slot in slots[: count // 2]:
+        table.remove(slot)
+    elapsed = time.perf_counter() - start
+    remaining = table.by_torrent.get(torrent, [])
+    assert all(table.positions[slot] == i for (i, slot) in enumerate(remaining)), 'peer positions are wrong'
+    for slot in slots[count // 2 :]:
+        table.remove(slot)
+    assert (len(table) == 0) and (torrent not in table.by_torrent), 'peers were left behind'
+    print('%.2f µs per peer removed' % (1e6 * elapsed / max(count // 2, 1)))
+
@@ -0,0 +1,1123 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import errno
+import socket
+import struct
+import ipaddress
+from collections import deque
+
+import instrument
+from stats import RateMeter, SAMPLE_INTERVAL
+from ratelimit import TokenBucket, ip_overhead
+from mse import Handshake, crypto_methods, obfuscated_hash
+from peers import client_name, FLAG_INCOMING, FLAG_DOWNLOADING, FLAG_INTERESTED
+from peers import FLAG_UPLOADING, FLAG_PEER_INTERESTED, FLAG_ENCRYPTED
+
+
+PROTOCOL = b'\x13BitTorrent protocol'
+'''
+:bytes  The beginning of a handshake
+'''
+
+HANDSHAKE_LENGTH = 68
+'''
+:int  The length of a handshake
+'''
+
+MSG_CHOKE, MSG_UNCHOKE, MSG_INTERESTED, MSG_NOT_INTERESTED = 0, 1, 2, 3
+MSG_HAVE, MSG_BITFIELD, MSG_REQUEST, MSG_PIECE, MSG_CANCEL = 4, 5, 6, 7, 8
+
+MSG_KEEP_ALIVE = -1
+'''
+:int  Pseudo-identifier for keep-alive messages, which have no identifier
+'''
+
+RECV_BUFFER_SIZE = 1 << 16
+'''
+:int  The initial size of a connection's receive buffer, it grows for larger messages
+'''
+
+MAX_MESSAGE_LENGTH = 1 << 21
+'''
+:int  The largest message that is accepted
+'''
+
+SEGMENT = 1 << 14
+'''
+:int  The smallest transfer that is worth waiting for when throttled,
+      unless the rate limits never allow that much at once
+'''
+
+MIN_THROTTLE_DELAY = 0.01
+'''
+:float  The shortest pause of a throttled transfer, so it never spins
+'''
+
+HANDSHAKE_TIMEOUT = 30
+'''
+:float  Seconds a connection may take to connect and complete the handshake
+'''
+
+IDLE_TIMEOUT = 180
+KEEP_ALIVE_INTERVAL = 90
+'''
+:float  Seconds without receiving anything after which a connection is closed,
+        and without sending anything after which a keep-alive is sent
+'''
+
+SWEEP_INTERVAL = 10
+'''
+:float  Seconds between checks for connections that have timed out
+'''
+
+MESSAGE_HEADER = struct.Struct('>IB')
+'''
+:Struct  The length prefix and identifier of a message
+'''
+
+MESSAGES = instrument.counter('peerwire.messages', 'Messages received from peers')
+'''
+:Counter  The number of messages received
+'''
+
+
+def is_local(host):
+    '''
+    Check whether an address is on the local network
+    
+    @param   host:str  The IP address
+    @return  :bool     Whether the address is a loopback, link-local or private address
+    '''
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return address.is_private or address.is_loopback or address.is_link_local
+
+
+class SwarmHandler():
+    '''
+    Receiver of events for the connections of one torrent
+    
+    Payloads are memoryviews into the receive buffer and are only
+    valid during the call; copy anything that shall be kept.
+    '''
+    
+    def connected(self, connection):
+        '''
+        Called when the handshake is complete
+        
+        @param  connection:Connection  The connection
+        '''
+        pass
+    
+    
+    def message(self, connection, msg_id, payload):
+        '''
+        Called for each received message
+        
+        @param  connection:Connection  The connection
+        @param  msg_id:int             The message's identifier, `MSG_KEEP_ALIVE` for keep-alives
+        @param  payload:memoryview     The message without its length and identifier
+        '''
+        pass
+    
+    
+    def disconnected(self, connection):
+        '''
+        Called when a connection that completed the handshake is closed
+        
+        @param  connection:Connection  The connection
+        '''
+        pass
+
+
+class Swarm():
+    '''
+    A torrent's connections and limits
+    '''
+    
+    def __init__(self, engine, info_hash, handler, max_connections, upload_slots, download_rate, upload_rate):
+        '''
+        Constructor
+        
+        @param  engine:PeerEngine     The engine
+        @param  info_hash:bytes       The torrent's infohash
+        @param  handler:SwarmHandler  Receiver of events
+        @param  max_connections:int?  The maximum number of connections, `None` to inherit the global limit
+        @param  upload_slots:int?     The maximum number of unchoked peers, `None` to inherit the global limit
+        @param  download_rate:float?  Download bytes per second, `None` to inherit the global limit
+        @param  upload_rate:float?    Upload bytes per second, `None` to inherit the global limit
+        '''
+        self.engine = engine
+        self.info_hash = info_hash
+        self.handler = handler
+        self.max_connections = max_connections
+        self.upload_slots = upload_slots
+        self.down = TokenBucket(download_rate, parent = engine.down)
+        self.up = TokenBucket(upload_rate, parent = engine.up)
+        self.connections = set()
+        self.unchoked = 0
+    
+    
+    def connection_limit(self):
+        '''
+        @return  :int  The maximum number of connections for the torrent
+        '''
+        return self.engine.max_connections if self.max_connections is None else self.max_connections
+    
+    
+    def slot_limit(self):
+        '''
+        @return  :int  The maximum number of unchoked peers for the torrent
+        '''
+        return self.engine.upload_slots if self.upload_slots is None else self.upload_slots
+
+
+class Connection():
+    '''
+    A connection to a peer
+    
+    Received data is read with `recv_into` into a preallocated buffer
+    and messages are handed out as memoryviews into that buffer. Data
+    to send is kept as a queue of buffers that are sent with `sendmsg`.
+    
+    An encrypted stream is decrypted in place as it is received, and
+    queued data is encrypted into one new buffer per call to `send`,
+    as the caller's buffers may be shared.
+    '''
+    
+    __slots__ = ( 'engine', 'swarm', 'sock', 'fd', 'address', 'local', 'outgoing', 'state'
+                , 'buf', 'view', 'start', 'end', 'out', 'out_bytes', 'down', 'up'
+                , 'reading', 'writing', 'read_timer', 'write_timer', 'opened', 'received', 'sent'
+                , 'peer_id', 'am_choking', 'am_interested', 'peer_choking', 'peer_interested'
+                , 'downloaded', 'uploaded', 'down_meter', 'up_meter', 'slot', 'mse', 'encrypt', 'decrypt'
+                )
+    
+    def __init__(self, engine, sock, address, outgoing):
+        '''
+        Constructor
+        
+        @param  engine:PeerEngine         The engine
+        @param  sock:socket               The non-blocking socket
+        @param  address:(host:str, ¿P?)   The peer's address
+        @param  outgoing:bool             Whether we initiated the connection
+        '''
+        self.engine = engine
+        self.swarm = None
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.local = engine.ignore_local and is_local(address[0])
+        self.outgoing = outgoing
+        self.state = 'connecting' if outgoing else 'handshake'
+        self.buf = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        self.out = deque()
+        self.out_bytes = 0
+        self.down = self.up = None
+        self.reading = self.writing = False
+        self.read_timer = self.write_timer = None
+        self.opened = self.received = self.sent = time.monotonic()
+        self.peer_id = None
+        self.am_choking = self.peer_choking = True
+        self.am_interested = self.peer_interested = False
+        self.downloaded = self.uploaded = 0
+        self.down_meter = self.up_meter = None
+        self.slot = None
+        self.mse = None
+        self.encrypt = self.decrypt = None
+    
+    
+    def attach(self, swarm):
+        '''
+        Make the connection part of a torrent's swarm
+        
+        @param  swarm:Swarm  The swarm
+        '''
+        self.swarm = swarm
+        swarm.connections.add(self)
+        self.down = TokenBucket(parent = swarm.down)
+        self.up = TokenBucket(parent = swarm.up)
+    
+    
+    def set_reading(self, reading):
+        '''
+        Start or stop watching the socket for received data
+        
+        @param  reading:bool  Whether to read
+        '''
+        if reading != self.reading:
+            self.reading = reading
+            if reading:
+                self.engine.loop.add_reader(self.fd, self.read_ready)
+            else:
+                self.engine.loop.remove_reader(self.fd)
+    
+    
+    def set_writing(self, writing):
+        '''
+        Start or stop watching the socket for room to send
+        
+        @param  writing:bool  Whether to write
+        '''
+        if writing != self.writing:
+            self.writing = writing
+            if writing:
+                self.engine.loop.add_writer(self.fd, self.write_ready)
+            else:
+                self.engine.loop.remove_writer(self.fd)
+    
+    
+    def throttle(self, bucket, wanted, now):
+        '''
+        Get the number of bytes that may be transferred, and pause the
+        transfer in that direction until more are allowed if none are
+        
+        @param   bucket:TokenBucket?  The bucket to take from, `self.down` or `self.up`,
+                                      `None` before the handshake
+        @param   wanted:int           The number of bytes wanted
+        @param   now:float            The current monotonic time
+        @return  :int                 The number of bytes that may be transferred
+        '''
+        if (bucket is None) or self.local:
+            return wanted
+        granted = bucket.consume(wanted, now)
+        # Wait for a worthwhile amount rather than transferring a trickle, but
+        # a limit below a segment per second must not be waited for in vain
+        worthwhile = max(int(min(wanted, SEGMENT, bucket.capacity())), 1)
+        if granted < worthwhile:
+            bucket.charge(-granted)
+            granted = 0
+        if granted == 0:
+            delay = max(bucket.delay(worthwhile, now), MIN_THROTTLE_DELAY)
+            if bucket is self.down:
+                self.set_reading(False)
+                if self.read_timer is None:
+                    self.read_timer = self.engine.loop.call_later(delay, self.resume_reading)
+            else:
+                self.set_writing(False)
+                if self.write_timer is None:
+                    self.write_timer = self.engine.loop.call_later(delay, self.resume_writing)
+        return granted
+    
+    
+    def resume_reading(self):
+        '''
+        Continue receiving after being throttled
+        '''
+        self.read_timer = None
+        if self.state != 'closed':
+            self.set_reading(True)
+    
+    
+    def resume_writing(self):
+        '''
+        Continue sending after being throttled
+        '''
+        self.write_timer = None
+        if self.state != 'closed':
+            self.set_writing(self.out_bytes > 0)
+    
+    
+    def read_ready(self):
+        '''
+        Receive and dispatch data
+        '''
+        now = time.monotonic()
+        wanted = len(self.buf) - self.end
+        granted = self.throttle(self.down, wanted, now)
+        if granted == 0:
+            return
+        try:
+            n = self.sock.recv_into(self.view[self.end : self.end + granted])
+        except (BlockingIOError, InterruptedError):
+            n = -1
+        except OSError:
+            n = 0
+        if n < granted and self.down is not None and not self.local:
+            # Return the tokens that were not used
+            self.down.charge(max(n, 0) - granted)
+        if n == 0:
+            self.close()
+            return
+        if n < 0:
+            return
+        self.received = now
+        if self.engine.rate_limit_overhead and (self.down is not None) and not self.local:
+            self.down.charge(ip_overhead(n))
+        if self.decrypt is not None:
+            self.decrypt.crypt(self.view[self.end : self.end + n])
+        self.end += n
+        self.downloaded += n
+        self.engine.downloaded += n
+        if self.engine.stats is not None:
+            self.engine.stats.received(n)
+        self.parse()
+    
+    
+    def parse(self):
+        '''
+        Dispatch all complete messages in the receive buffer
+        '''
+        (buf, view, pos, end) = (self.buf, self.view, self.start, self.end)
+        needed = 0
+        while self.state != 'closed':
+            if self.state == 'mse':
+                result = self.mse.receive(view, pos, end)
+                if len(self.mse.output) > 0:
+                    self.send(*self.mse.output)
+                    self.mse.output = []
+                if result is None:
+                    self.close()
+                    return
+                (pos, needed) = result
+                if not self.mse.done:
+                    break
+                (self.encrypt, self.decrypt) = self.mse.ciphers()
+                self.state = 'handshake'
+                continue
+            if self.state == 'handshake':
+                if end - pos < HANDSHAKE_LENGTH:
+                    needed = HANDSHAKE_LENGTH
+                    break
+                if view[pos : pos + 20] != PROTOCOL:
+                    # An incoming connection may start with an encryption handshake
+                    if (self.mse is None) and self.engine.accept_encrypted(self):
+                        continue
+                    self.close()
+                    return
+                if (self.mse is None) and not self.engine.accept_plaintext(self):
+                    self.close()
+                    return
+                info_hash = bytes(view[pos + 28 : pos + 48])
+                self.peer_id = bytes(view[pos + 48 : pos + 68])
+                pos += HANDSHAKE_LENGTH
+                if not self.engine.handshake_received(self, info_hash):
+                    self.close()
+                    return
+                continue
+            if end - pos < 4:
+                needed = 4
+                break
+            length = int.from_bytes(view[pos : pos + 4], 'big')
+            if length > MAX_MESSAGE_LENGTH:
+                self.close()
+                return
+            if end - pos - 4 < length:
+                needed = length + 4
+                break
+            if length == 0:
+                self.engine.message_received(self, MSG_KEEP_ALIVE, view[pos + 4 : pos + 4])
+            else:
+                self.engine.message_received(self, buf[pos + 4], view[pos + 5 : pos + 4 + length])
+            pos += 4 + length
+        if self.state == 'closed':
+            return
+        # Move the incomplete message to the front only when it does not fit where it is
+        self.start = pos
+        if pos == end:
+            (self.start, self.end) = (0, 0)
+        elif needed > len(buf):
+            self.grow(needed)
+        elif pos + needed > len(buf):
+            buf[0 : end - pos] = view[pos : end]
+            (self.start, self.end) = (0, end - pos)
+    
+    
+    def grow(self, size):
+        '''
+        Enlarge the receive buffer
+        
+        @param  size:int  The minimum size
+        '''
+        data = self.view[self.start : self.end]
+        buf = bytearray(max(size, 2 * len(self.buf)))
+        buf[0 : len(data)] = data
+        (self.end, self.start) = (len(data), 0)
+        self.view.release()
+        (self.buf, self.view) = (buf, memoryview(buf))
+    
+    
+    def send(self, *parts):
+        '''
+        Queue data for sending
+        
+        @param  parts:*bytes|memoryview  The data, the buffers must not be modified until sent
+        '''
+        if self.encrypt is not None:
+            data = bytearray(b''.join(parts))
+            self.encrypt.crypt(data)
+            parts = (data,)
+        for part in parts:
+            part = memoryview(part).cast('B')
+            self.out.append(part)
+            self.out_bytes += len(part)
+        if self.state not in ('connecting', 'closed') and self.write_timer is None:
+            self.set_writing(True)
+    
+    
+    def send_message(self, msg_id, *payload):
+        '''
+        Queue a message for sending
+        
+        @param  msg_id:int                 The message's identifier
+        @param  payload:*bytes|memoryview  The message's payload
+        '''
+        length = 1 + sum(len(memoryview(part).cast('B')) for part in payload)
+        stats = self.engine.stats
+        if (msg_id == MSG_PIECE) and (stats is not None):
+            # The block, but not the index and offset, is payload; it is counted as sent here
+            stats.payload_up.add(length - 9)
+            stats.protocol_up.add(9 - length)
+        self.send(MESSAGE_HEADER.pack(length, msg_id), *payload)
+    
+    
+    def write_ready(self):
+        '''
+        Send queued data, or complete a connection attempt
+        '''
+        if self.state == 'connecting':
+            self.engine.connect_completed(self)
+            return
+        now = time.monotonic()
+        granted = self.throttle(self.up, self.out_bytes, now)
+        if granted == 0:
+            return
+        (parts, size) = ([], 0)
+        for part in self.out:
+            if size + len(part) > granted:
+                parts.append(part[: granted - size])
+                break
+            parts.append(part)
+            size += len(part)
+            if size == granted:
+                break
+        try:
+            n = self.sock.sendmsg(parts)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        except OSError:
+            self.close()
+            return
+        if (self.up is not None) and not self.local:
+            self.up.charge(n - granted)
+            if self.engine.rate_limit_overhead:
+                self.up.charge(ip_overhead(n))
+        if n > 0:
+            self.sent = now
+        self.uploaded += n
+        self.engine.uploaded += n
+        if self.engine.stats is not None:
+            self.engine.stats.sent(n)
+        self.out_bytes -= n
+        while n > 0:
+            part = self.out[0]
+            if len(part) <= n:
+                self.out.popleft()
+                n -= len(part)
+            else:
+                self.out[0] = part[n:]
+                n = 0
+        if self.out_bytes == 0:
+            self.set_writing(False)
+    
+    
+    def close(self):
+        '''
+        Close the connection
+        '''
+        if self.state == 'closed':
+            return
+        state = self.state
+        self.state = 'closed'
+        self.set_reading(False)
+        self.set_writing(False)
+        for timer in (self.read_timer, self.write_timer):
+            if timer is not None:
+                timer.cancel()
+        self.read_timer = self.write_timer = None
+        self.sock.close()
+        self.engine.connection_closed(self, state)
+
+
+
+class PeerEngine():
+    '''
+    Peer wire protocol connections for all torrents, with limits
+    
+    Limits default to the Bandwidth preferences. Bandwidth is shaped
+    by token buckets in three levels: global, per torrent and per peer.
+    Encryption defaults to the Encryption preferences.
+    '''
+    
+    def __init__(self, loop, peer_id, max_connections = 200, upload_slots = 5, download_rate = None,
+                 upload_rate = None, max_half_open = 50, connect_rate = 20, ignore_local = True,
+                 rate_limit_overhead = True, stats = None, peer_table = None, encryption_inbound = 'forced',
+                 encryption_outbound = 'forced', encryption_level = 'full', prefer_rc4 = True, connector = None,
+                 closed = None):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop            The event loop to run in
+        @param  peer_id:bytes             Our 20 byte peer ID
+        @param  max_connections:int       The maximum number of connections
+        @param  upload_slots:int          The maximum number of unchoked peers
+        @param  download_rate:float?      Download bytes per second, `None` for unlimited
+        @param  upload_rate:float?        Upload bytes per second, `None` for unlimited
+        @param  max_half_open:int         The maximum number of pending connection attempts
+        @param  connect_rate:float        The maximum number of connection attempts per second
+        @param  ignore_local:bool         Whether peers on the local network are not rate limited
+        @param  rate_limit_overhead:bool  Whether TCP/IP overhead counts against the rate limits
+        @param  stats:Statistics?         Statistics to count transferred bytes in
+        @param  peer_table:PeerTable?     Table to list connected peers in
+        @param  encryption_inbound:str    'forced', 'enabled' or 'disabled', for incoming connections
+        @param  encryption_outbound:str   'forced', 'enabled' or 'disabled', for outgoing connections,
+                                          with 'enabled' a failed encryption handshake is retried in plaintext
+        @param  encryption_level:str      'handshake', 'full' or 'either', see `mse.crypto_methods`
+        @param  prefer_rc4:bool           Whether to encrypt the entire stream when either level is allowed
+        @param  connector:Connector?      Opens outgoing connections when it has a proxy, see `proxy.Connector`
+        @param  closed:(info_hash:bytes, address:(host:str, port:int), connected:bool)→void?
+                                          Called when a connection of a torrent closes or an outgoing
+                                          attempt fails, with whether the handshake had completed
+        '''
+        self.loop = loop
+        self.peer_id = peer_id
+        self.max_connections = max_connections
+        self.upload_slots = upload_slots
+        self.max_half_open = max_half_open
+        self.ignore_local = ignore_local
+        self.rate_limit_overhead = rate_limit_overhead
+        self.down = TokenBucket(download_rate)
+        self.up = TokenBucket(upload_rate)
+        self.attempts = TokenBucket(connect_rate, burst = max(connect_rate, 1))
+        self.swarms = {}
+        self.connections = set()
+        self.half_open = 0
+        self.unchoked = 0
+        self.listeners = []
+        self.downloaded = 0
+        self.uploaded = 0
+        self.stats = stats
+        self.peer_table = peer_table
+        self.encryption_inbound = encryption_inbound
+        self.encryption_outbound = encryption_outbound
+        self.encryption_level = encryption_level
+        self.prefer_rc4 = prefer_rc4
+        self.connector = connector
+        self.closed_callback = closed
+        self.skeys = {}
+        self.closed = False
+        self.sweep_timer = loop.call_later(SWEEP_INTERVAL, self.sweep)
+        self.rate_timer = None
+        if peer_table is not None:
+            self.rate_timer = loop.call_later(SAMPLE_INTERVAL, self.sample_rates)
+        if stats is not None:
+            stats.gauges['connections'] = lambda : len(self.connections)
+            stats.gauges['max_connections'] = lambda : self.max_connections
+    
+    
+    def add_torrent(self, info_hash, handler, max_connections = None, upload_slots = None,
+                    download_rate = None, upload_rate = None):
+        '''
+        Start accepting and making connections for a torrent
+        
+        @param   info_hash:bytes       The torrent's infohash
+        @param   handler:SwarmHandler  Receiver of events
+        @param   max_connections:int?  The maximum number of connections, `None` to inherit the global limit
+        @param   upload_slots:int?     The maximum number of unchoked peers, `None` to inherit the global limit
+        @param   download_rate:float?  Download bytes per second, `None` to inherit the global limit
+        @param   upload_rate:float?    Upload bytes per second, `None` to inherit the global limit
+        @return  :Swarm                The torrent's swarm
+        '''
+        swarm = Swarm(self, info_hash, handler, max_connections, upload_slots, download_rate, upload_rate)
+        self.swarms[info_hash] = swarm
+        self.skeys[obfuscated_hash(info_hash)] = info_hash
+        return swarm
+    
+    
+    def remove_torrent(self, info_hash):
+        '''
+        Close all connections of a torrent and stop accepting connections for it
+        
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        swarm = self.swarms.pop(info_hash)
+        del self.skeys[obfuscated_hash(info_hash)]
+        for connection in list(swarm.connections):
+            connection.close()
+    
+    
+    def listen(self, host, port):
+        '''
+        Accept incoming connections
+        
+        @param   host:str  The address to listen on
+        @param   port:int  The port to listen on, 0 for any
+        @return  :int      The port that is listened on
+        '''
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        sock.setblocking(False)
+        self.listeners.append(sock)
+        self.loop.add_reader(sock.fileno(), self.accept_ready, sock)
+        return sock.getsockname()[1]
+    
+    
+    def accept_ready(self, listener):
+        '''
+        Accept all pending incoming connections
+        
+        @param  listener:socket  The listening socket
+        '''
+        while True:
+            try:
+                (sock, address) = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if len(self.connections) >= self.max_connections:
+                sock.close()
+                continue
+            sock.setblocking(False)
+            connection = Connection(self, sock, address, False)
+            self.connections.add(connection)
+            connection.set_reading(True)
+    
+    
+    def can_connect(self, info_hash):
+        '''
+        Check whether the limits, except the attempt rate, allow a new connection
+        
+        @param   info_hash:bytes  The torrent's infohash
+        @return  :bool            Whether a connection attempt may be made
+        '''
+        swarm = self.swarms.get(info_hash)
+        return ( (swarm is not None)
+                 and (len(self.connections) < self.max_connections)
+                 and (len(swarm.connections) < swarm.connection_limit())
+                 and (self.half_open < self.max_half_open)
+               )
+    
+    
+    def connect(self, info_hash, address, plaintext = False):
+        '''
+        Start connecting to a peer, if the limits allow it
+        
+        @param   info_hash:bytes        The torrent's infohash
+        @param   address:(host:str, port:int)  The peer's address
+        @param   plaintext:bool         Whether to skip the encryption handshake even if it is enabled
+        @return  :bool                  Whether a connection attempt was started, `False` if the limits do not allow it
+        '''
+        if not self.can_connect(info_hash):
+            return False
+        if self.attempts.consume(1, time.monotonic(), partial = False) == 0:
+            return False
+        if (self.connector is not None) and (self.connector.proxy is not None):
+            # The proxy's reply completes the attempt
+            self.half_open += 1
+            self.connector.connect(address, self.tunnel_opened, info_hash, address, plaintext)
+            return True
+        sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            return False
+        connection = self.outgoing(sock, info_hash, address, plaintext)
+        self.half_open += 1
+        connection.writing = True
+        self.loop.add_writer(connection.fd, connection.write_ready)
+        return True
+    
+    
+    def outgoing(self, sock, info_hash, address, plaintext):
+        '''
+        Create an outgoing connection
+        
+        @param   sock:socket                   The non-blocking socket
+        @param   info_hash:bytes               The torrent's infohash
+        @param   address:(host:str, port:int)  The peer's address
+        @param   plaintext:bool                Whether to skip the encryption handshake even if it is enabled
+        @return  :Connection                   The connection
+        '''
+        connection = Connection(self, sock, address, True)
+        connection.attach(self.swarms[info_hash])
+        if (self.encryption_outbound != 'disabled') and not plaintext:
+            connection.mse = Handshake(True, crypto_methods(self.encryption_level), self.prefer_rc4,
+                                       info_hash, self.handshake(info_hash))
+        self.connections.add(connection)
+        return connection
+    
+    
+    def tunnel_opened(self, sock, error, info_hash, address, plaintext):
+        '''
+        Called when a connection attempt through the proxy has finished
+        
+        @param  sock:socket?                  The socket, `None` if the attempt failed
+        @param  error:str?                    Why the attempt failed
+        @param  info_hash:bytes               The torrent's infohash
+        @param  address:(host:str, port:int)  The peer's address
+        @param  plaintext:bool                Whether to skip the encryption handshake even if it is enabled
+        '''
+        self.half_open -= 1
+        if sock is None:
+            if self.closed_callback is not None:
+                self.closed_callback(info_hash, address, False)
+            return
+        if self.closed or (info_hash not in self.swarms) or (len(self.connections) >= self.max_connections):
+            sock.close()
+            return
+        connection = self.outgoing(sock, info_hash, address, plaintext)
+        connection.state = 'handshake'
+        self.start_handshake(connection)
+    
+    
+    def connect_completed(self, connection):
+        '''
+        Called when an outgoing connection attempt has finished
+        
+        @param  connection:Connection  The connection
+        '''
+        self.half_open -= 1
+        connection.state = 'handshake'
+        connection.set_writing(False)
+        if connection.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            connection.state = 'failed'
+            connection.close()
+            return
+        self.start_handshake(connection)
+    
+    
+    def start_handshake(self, connection):
+        '''
+        Start the handshake of an open outgoing connection
+        
+        @param  connection:Connection  The connection
+        '''
+        if connection.mse is not None:
+            # Our handshake is sent encrypted along with the encryption handshake
+            connection.state = 'mse'
+            connection.send(connection.mse.public())
+        else:
+            self.send_handshake(connection)
+        connection.set_reading(True)
+    
+    
+    def handshake(self, info_hash):
+        '''
+        Create our handshake
+        
+        @param   info_hash:bytes  The torrent's infohash
+        @return  :bytes           The handshake
+        '''
+        return PROTOCOL + bytes(8) + info_hash + self.peer_id
+    
+    
+    def send_handshake(self, connection):
+        '''
+        Send our handshake
+        
+        @param  connection:Connection  The connection
+        '''
+        connection.send(self.handshake(connection.swarm.info_hash))
+    
+    
+    def accept_encrypted(self, connection):
+        '''
+        Start an encryption handshake on an incoming connection that did
+        not start with a BitTorrent handshake, if the preferences allow it
+        
+        @param   connection:Connection  The connection
+        @return  :bool                  Whether the encryption handshake was started
+        '''
+        if self.encryption_inbound == 'disabled':
+            return False
+        connection.mse = Handshake(False, crypto_methods(self.encryption_level), self.prefer_rc4, skeys = self.skeys)
+        connection.state = 'mse'
+        return True
+    
+    
+    def accept_plaintext(self, connection):
+        '''
+        Check whether a connection may continue without encryption handshake
+        
+        @param   connection:Connection  The connection
+        @return  :bool                  Whether the plaintext handshake is accepted
+        '''
+        return self.encryption_inbound != 'forced' if not connection.outgoing else self.encryption_outbound != 'forced'
+    
+    
+    def handshake_received(self, connection, info_hash):
+        '''
+        Called when a peer's handshake has been received
+        
+        @param   connection:Connection  The connection
+        @param   info_hash:bytes        The infohash in the handshake
+        @return  :bool                  Whether the connection shall be kept
+        '''
+        connection.state = 'open'
+        if (connection.mse is not None) and (info_hash != connection.mse.info_hash):
+            return False
+        if connection.outgoing:
+            if info_hash != connection.swarm.info_hash:
+                return False
+        else:
+            swarm = self.swarms.get(info_hash)
+            if (swarm is None) or (len(swarm.connections) >= swarm.connection_limit()):
+                return False
+            connection.attach(swarm)
+            self.send_handshake(connection)
+        if self.peer_table is not None:
+            connection.slot = self.peer_table.add(connection.swarm.info_hash, connection.address[:2],
+                                                  client_name(connection.peer_id),
+                                                  (0 if connection.outgoing else FLAG_INCOMING)
+                                                  | (0 if connection.mse is None else FLAG_ENCRYPTED))
+            connection.down_meter = RateMeter(None)
+            connection.up_meter = RateMeter(None)
+            # Rates are measured from here, not from the first tick
+            now = time.monotonic()
+            connection.down_meter.sample(now, connection.downloaded)
+            connection.up_meter.sample(now, connection.uploaded)
+        connection.swarm.handler.connected(connection)
+        return True
+    
+    
+    def message_received(self, connection, msg_id, payload):
+        '''
+        Update the connection state and pass a message on to the torrent
+        
+        @param  connection:Connection  The connection
+        @param  msg_id:int             The message's identifier
+        @param  payload:memoryview     The message's payload
+        '''
+        MESSAGES.add()
+        if (msg_id == MSG_PIECE) and (self.stats is not None) and (len(payload) > 8):
+            # Move the block from the protocol count to the payload count
+            self.stats.payload_down.add(len(payload) - 8)
+            self.stats.protocol_down.add(8 - len(payload))
+        if msg_id == MSG_CHOKE:
+            connection.peer_choking = True
+        elif msg_id == MSG_UNCHOKE:
+            connection.peer_choking = False
+        elif msg_id == MSG_INTERESTED:
+            connection.peer_interested = True
+            self.unchoke(connection)
+        elif msg_id == MSG_NOT_INTERESTED:
+            connection.peer_interested = False
+            self.choke(connection)
+        if (msg_id <= MSG_NOT_INTERESTED) and (connection.slot is not None):
+            self.update_flags(connection)
+        connection.swarm.handler.message(connection, msg_id, payload)
+    
+    
+    def update_flags(self, connection):
+        '''
+        Update a peer's flags in the peer table
+        
+        @param  connection:Connection  The connection
+        '''
+        flags = 0
+        if connection.am_interested:
+            flags |= FLAG_INTERESTED | (0 if connection.peer_choking else FLAG_DOWNLOADING)
+        if connection.peer_interested:
+            flags |= FLAG_PEER_INTERESTED | (0 if connection.am_choking else FLAG_UPLOADING)
+        mask = FLAG_INTERESTED | FLAG_DOWNLOADING | FLAG_PEER_INTERESTED | FLAG_UPLOADING
+        self.peer_table.set_flags(connection.slot, flags, mask & ~flags)
+    
+    
+    def unchoke(self, connection):
+        '''
+        Unchoke an interested peer if there is a free upload slot
+        
+        @param  connection:Connection  The connection
+        '''
+        swarm = connection.swarm
+        if connection.am_choking and (swarm.unchoked < swarm.slot_limit()) and (self.unchoked < self.upload_slots):
+            connection.am_choking = False
+            swarm.unchoked += 1
+            self.unchoked += 1
+            connection.send_message(MSG_UNCHOKE)
+            if connection.slot is not None:
+                self.update_flags(connection)
+    
+    
+    def choke(self, connection, send = True):
+        '''
+        Choke a peer and free its upload slot
+        
+        @param  connection:Connection  The connection
+        @param  send:bool              Whether to tell the peer
+        '''
+        if not connection.am_choking:
+            connection.am_choking = True
+            connection.swarm.unchoked -= 1
+            self.unchoked -= 1
+            if send:
+                connection.send_message(MSG_CHOKE)
+            if (connection.slot is not None) and (connection.state != 'closed'):
+                self.update_flags(connection)
+        # Give the slot to another interested peer
+        for other in connection.swarm.connections:
+            if other.peer_interested and other.am_choking and (other is not connection) and (other.state == 'open'):
+                self.unchoke(other)
+                break
+    
+    
+    def connection_closed(self, connection, state):
+        '''
+        Called when a connection has been closed
+        
+        @param  connection:Connection  The connection
+        @param  state:str              The state the connection was in
+        '''
+        self.connections.discard(connection)
+        retried = False
+        if state == 'connecting':
+            self.half_open -= 1
+        elif (state == 'mse') and connection.outgoing and (self.encryption_outbound == 'enabled') and not self.closed:
+            # The peer may not support encryption
+            retried = self.connect(connection.swarm.info_hash, connection.address, plaintext = True)
+        if connection.swarm is not None:
+            if (self.closed_callback is not None) and not retried:
+                self.closed_callback(connection.swarm.info_hash, connection.address[:2], state == 'open')
+            connection.swarm.connections.discard(connection)
+            self.choke(connection, False)
+            if state == 'open':
+                connection.swarm.handler.disconnected(connection)
+        if connection.slot is not None:
+            self.peer_table.remove(connection.slot)
+            connection.slot = None
+    
+    
+    def sweep(self):
+        '''
+        Close connections that have not completed the handshake in time
+        or have gone quiet, and send keep-alives on quiet open connections
+        '''
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if connection.state != 'open':
+                # Half-open and silent incoming connections would hold their slots forever
+                if now - connection.opened > HANDSHAKE_TIMEOUT:
+                    connection.close()
+            elif now - connection.received > IDLE_TIMEOUT:
+                connection.close()
+            elif (now - connection.sent > KEEP_ALIVE_INTERVAL) and (connection.out_bytes == 0):
+                connection.sent = now
+                connection.send(bytes(4))
+        self.sweep_timer = self.loop.call_later(SWEEP_INTERVAL, self.sweep)
+    
+    
+    def sample_rates(self):
+        '''
+        Show the transfer rates of the connections in the peer table
+        '''
+        now = time.monotonic()
+        table = self.peer_table
+        for connection in self.connections:
+            slot = connection.slot
+            if slot is not None:
+                down = connection.down_meter.sample(now, connection.downloaded)
+                up = connection.up_meter.sample(now, connection.uploaded)
+                # Idle peers are not marked as changed, so their rows are not formatted again
+                if down or up or table.down_rate[slot] or table.up_rate[slot]:
+                    table.update(slot, down_rate = down, up_rate = up)
+        self.rate_timer = self.loop.call_later(SAMPLE_INTERVAL, self.sample_rates)
+    
+    
+    def close(self):
+        '''
+        Close all connections and stop listening
+        '''
+        self.closed = True
+        self.sweep_timer.cancel()
+        if self.rate_timer is not None:
+            self.rate_timer.cancel()
+        for connection in list(self.connections):
+            connection.close()
+        for sock in self.listeners:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        self.listeners = []
+
+
+if __name__ == '__main__':
+    # Benchmark: a swarm of fake peers on the loopback interface streams pieces to the engine
+    import os, sys, threading, selectors
+    from eventloop import EventLoop
+    
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    rate = float(sys.argv[3]) * (1 << 20) if len(sys.argv) > 3 else None
+    info_hash = os.urandom(20)
+    block = MESSAGE_HEADER.pack(9 + SEGMENT, MSG_PIECE) + bytes(8 + SEGMENT)
+    stream = PROTOCOL + bytes(8) + info_hash + os.urandom(20) + block * pieces
+    
+    class Counter(SwarmHandler):
+        def __init__(self):
+            self.messages = 0
+            self.closed = 0
+        def message(self, connection, msg_id, payload):
+            self.messages += 1
+            if self.messages == peers * pieces:
+                loop.stop()
+    
+    def fake_peers(port):
+        selector = selectors.DefaultSelector()
+        # Keep the sockets open, closing them with our unread handshake would reset them
+        socks = [socket.create_connection(('127.0.0.1', port)) for _ in range(peers)]
+        for sock in socks:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_WRITE, [memoryview(stream)])
+        remaining = peers
+        while remaining > 0:
+            for (key, _events) in selector.select(1):
+                data = key.data
+                try:
+                    n = key.fileobj.send(data[0][: 1 << 16])
+                except BlockingIOError:
+                    continue
+                data[0] = data[0][n:]
+                if len(data[0]) == 0:
+                    selector.unregister(key.fileobj)
+                    remaining -= 1
+        time.sleep(60)
+    
+    loop = EventLoop()
+    engine = PeerEngine(loop, os.urandom(20), max_connections = peers, download_rate = rate, ignore_local = False,
+                        encryption_inbound = 'enabled')
+    handler = Counter()
+    engine.add_torrent(info_hash, handler)
+    port = engine.listen('127.0.0.1', 0)
+    threading.Thread(target = fake_peers, args = (port,), daemon = True).start()
+    (start, cpu) = (time.monotonic(), time.process_time())
+    loop.call_later(120, loop.stop)
+    loop.run()
+    (elapsed, cpu) = (time.monotonic() - start, time.process_time() - cpu)
+    print('%i peers, %i messages, %.1f MB in %.2f s: %.1f MB/s, %.0f messages/s, %.1f ms CPU per MB (both threads)' %
+          (peers, handler.messages, engine.downloaded / (1 << 20), elapsed, engine.downloaded / (1 << 20) / elapsed,
+           handler.messages / elapsed, 1000 * cpu / max(engine.downloaded / (1 << 20), 1)))
+    engine.close()
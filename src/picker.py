@@ -0,0 +1,348 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+class PeerPieces():
+    '''
+    The pieces a peer has, as a packed bit set, and their number
+    '''
+    
+    __slots__ = ('mask', 'count')
+    
+    def __init__(self, mask):
+        '''
+        Constructor
+        
+        @param  mask:int  The pieces, see `PiecePicker.bit`
+        '''
+        self.mask = mask
+        self.count = bin(mask).count('1')
+
+
+class PiecePicker():
+    '''
+    Rarest-first piece picker
+    
+    Sets of pieces are packed into integers, in the bit order of the
+    peer wire protocol's bitfields. The availability of the pieces is
+    stored bit-sliced: plane k holds bit k of every piece's
+    availability. This costs about log₂(peers) bits per piece, and
+    adding or removing a peer's entire bitfield is a carry-propagating
+    addition over the planes, a handful of whole-set operations rather
+    than one operation per piece.
+    
+    Picking narrows the candidate set plane by plane, from the most
+    significant plane, to the candidates with the lowest availability;
+    this is a bucket lookup without visiting the pieces one by one.
+    '''
+    
+    def __init__(self, piece_count):
+        '''
+        Constructor
+        
+        @param  piece_count:int  The number of pieces in the torrent
+        '''
+        self.piece_count = piece_count
+        self.nbits = (piece_count + 7) // 8 * 8
+        self.all = ((1 << piece_count) - 1) << (self.nbits - piece_count)
+        self.planes = []
+        self.have = 0
+        self.pending = 0
+        self.wanted = self.all
+        self.priority = 0
+    
+    
+    def bit(self, index):
+        '''
+        Get the set containing only one piece
+        
+        @param   index:int  The index of the piece
+        @return  :int       The set
+        '''
+        return 1 << (self.nbits - 1 - index)
+    
+    
+    def index(self, mask):
+        '''
+        Get the first piece in a set
+        
+        @param   mask:int  The set, must not be empty
+        @return  :int      The index of the piece
+        '''
+        return self.nbits - mask.bit_length()
+    
+    
+    def from_bitfield(self, bitfield):
+        '''
+        Convert a BITFIELD message's payload to a set
+        
+        @param   bitfield:bytes|memoryview  The payload
+        @return  :int                       The set, spare bits are dropped
+        '''
+        if len(bitfield) != self.nbits // 8:
+            raise ValueError('bitfield has wrong length')
+        return int.from_bytes(bitfield, 'big') & self.all
+    
+    
+    def to_bitfield(self, mask):
+        '''
+        Convert a set to a bitfield
+        
+        @param   mask:int  The set
+        @return  :bytes    The bitfield
+        '''
+        return mask.to_bytes(self.nbits // 8, 'big')
+    
+    
+    def add(self, mask):
+        '''
+        Increase the availability of a set of pieces by one
+        
+        @param  mask:int  The pieces
+        '''
+        (planes, carry) = (self.planes, mask)
+        for k in range(len(planes)):
+            if carry == 0:
+                return
+            (planes[k], carry) = (planes[k] ^ carry, planes[k] & carry)
+        if carry != 0:
+            planes.append(carry)
+    
+    
+    def subtract(self, mask):
+        '''
+        Decrease the availability of a set of pieces by one
+        
+        @param  mask:int  The pieces, all must have non-zero availability
+        '''
+        (planes, borrow) = (self.planes, mask)
+        for k in range(len(planes)):
+            if borrow == 0:
+                break
+            (planes[k], borrow) = (planes[k] ^ borrow, borrow & ~planes[k])
+        while (len(planes) > 0) and (planes[-1] == 0):
+            planes.pop()
+    
+    
+    def availability(self, index):
+        '''
+        Get the number of connected peers that have a piece
+        
+        @param   index:int  The index of the piece
+        @return  :int       The availability
+        '''
+        shift = self.nbits - 1 - index
+        return sum(((plane >> shift) & 1) << k for (k, plane) in enumerate(self.planes))
+    
+    
+    def add_peer(self, bitfield = None):
+        '''
+        Register a connected peer
+        
+        @param   bitfield:bytes|memoryview?  The payload of the peer's BITFIELD message
+        @return  :PeerPieces                 The peer's pieces, pass to the other methods
+        '''
+        peer = PeerPieces(0 if bitfield is None else self.from_bitfield(bitfield))
+        self.add(peer.mask)
+        return peer
+    
+    
+    def set_bitfield(self, peer, bitfield):
+        '''
+        Replace the pieces a peer has, when a BITFIELD message is received
+        
+        @param  peer:PeerPieces            The peer
+        @param  bitfield:bytes|memoryview  The payload of the BITFIELD message
+        '''
+        mask = self.from_bitfield(bitfield)
+        self.subtract(peer.mask & ~mask)
+        self.add(mask & ~peer.mask)
+        peer.mask = mask
+        peer.count = bin(mask).count('1')
+    
+    
+    def peer_has(self, peer, index):
+        '''
+        Record that a peer has a piece, when a HAVE message is received
+        
+        @param  peer:PeerPieces  The peer
+        @param  index:int        The index of the piece
+        '''
+        if not (0 <= index < self.piece_count):
+            return
+        bit = self.bit(index)
+        if not (peer.mask & bit):
+            peer.mask |= bit
+            peer.count += 1
+            self.add(bit)
+    
+    
+    def remove_peer(self, peer):
+        '''
+        Unregister a disconnected peer
+        
+        @param  peer:PeerPieces  The peer
+        '''
+        self.subtract(peer.mask)
+        peer.mask = 0
+        peer.count = 0
+    
+    
+    def set_files(self, files, piece_length, first_and_last = True, wanted = None):
+        '''
+        Set which pieces are wanted and prioritised according to the files
+        
+        @param  files:list<int>         The size of each file, in order
+        @param  piece_length:int        The size of each piece but the last
+        @param  first_and_last:bool     Whether to prioritise the first and last pieces of files
+        @param  wanted:list<bool>?      Whether each file is wanted, all by default
+        '''
+        (self.wanted, self.priority, offset) = (0, 0, 0)
+        for (i, size) in enumerate(files):
+            if size > 0 and ((wanted is None) or wanted[i]):
+                (first, last) = (offset // piece_length, (offset + size - 1) // piece_length)
+                # The range first..last as a set, in bitfield order
+                self.wanted |= ((1 << (last - first + 1)) - 1) << (self.nbits - 1 - last)
+                if first_and_last:
+                    self.priority |= self.bit(first) | self.bit(last)
+            offset += size
+        self.priority &= self.wanted
+    
+    
+    def endgame(self):
+        '''
+        Check whether all missing pieces have been requested
+        
+        @return  :bool  Whether the picker is in endgame mode
+        '''
+        missing = self.wanted & ~self.have
+        return (missing != 0) and (missing & ~self.pending == 0)
+    
+    
+    def rarest(self, candidates):
+        '''
+        Narrow a set of pieces to those with the lowest availability
+        
+        @param   candidates:int  The set, must not be empty
+        @return  :int            The subset
+        '''
+        for plane in reversed(self.planes):
+            subset = candidates & ~plane
+            if subset != 0:
+                candidates = subset
+        return candidates
+    
+    
+    def pick(self, peer):
+        '''
+        Choose the next piece to download from a peer and mark it pending
+        
+        In endgame mode, pieces already requested from other peers are
+        chosen, so the last pieces are requested from several peers
+        
+        @param   peer:PeerPieces  The peer
+        @return  :int?            The index of the piece, `None` if the peer has nothing we want
+        '''
+        candidates = peer.mask & self.wanted & ~self.have
+        if candidates == 0:
+            return None
+        fresh = candidates & ~self.pending
+        if fresh != 0:
+            candidates = fresh
+        elif not self.endgame():
+            return None
+        if candidates & self.priority:
+            candidates &= self.priority
+        index = self.index(self.rarest(candidates))
+        self.pending |= self.bit(index)
+        return index
+    
+    
+    def pick_run(self, limit):
+        '''
+        Choose a run of adjacent missing pieces that are not being
+        downloaded, for a source that has every piece, and mark it pending
+        
+        @param   limit:int                   The maximum number of pieces in the run
+        @return  :(first:int, count:int)?    The run, `None` if nothing is left to pick
+        '''
+        candidates = self.wanted & ~self.have & ~self.pending
+        if candidates == 0:
+            return None
+        first = self.index((candidates & self.priority) or candidates)
+        top = self.nbits - 1 - first
+        # The run ends before the next piece that is not a candidate, spare bits are never candidates
+        gaps = ~candidates & ((1 << top) - 1)
+        count = min(top + 1 - gaps.bit_length(), limit)
+        self.pending |= ((1 << count) - 1) << (top + 1 - count)
+        return (first, count)
+    
+    
+    def piece_completed(self, index):
+        '''
+        Record that a piece has been downloaded and verified
+        
+        @param  index:int  The index of the piece
+        '''
+        bit = self.bit(index)
+        self.have |= bit
+        self.pending &= ~bit
+    
+    
+    def piece_abandoned(self, index):
+        '''
+        Make a piece available for picking again, when it fails
+        verification or its requests are cancelled
+        
+        @param  index:int  The index of the piece
+        '''
+        self.pending &= ~self.bit(index)
+    
+    
+    def set_have(self, bitfield):
+        '''
+        Set the pieces that we have, for example after a recheck
+        
+        @param  bitfield:bytes|bytearray|memoryview  The pieces, as a bitfield
+        '''
+        self.have = self.from_bitfield(bitfield)
+        self.pending &= ~self.have
+
+
+if __name__ == '__main__':
+    # Benchmark picker latency with many peers that each have a random half of the pieces
+    import os, sys, time, random
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for piece_count in (10000, 100000, 1000000):
+        picker = PiecePicker(piece_count)
+        bitfields = [os.urandom(picker.nbits // 8) for _ in range(min(peers, 64))]
+        start = time.perf_counter()
+        handles = [picker.add_peer(bitfields[i % len(bitfields)]) for i in range(peers)]
+        connect = (time.perf_counter() - start) / peers
+        start = time.perf_counter()
+        for _ in range(1000):
+            picker.peer_has(random.choice(handles), random.randrange(piece_count))
+        have = (time.perf_counter() - start) / 1000
+        start = time.perf_counter()
+        for _ in range(1000):
+            picker.pick(random.choice(handles))
+        pick = (time.perf_counter() - start) / 1000
+        print('%8i pieces, %i peers: bitfield %8.1f µs, have %6.1f µs, pick %6.1f µs, %5.1f bits per piece' %
+              (piece_count, peers, connect * 1e6, have * 1e6, pick * 1e6, len(picker.planes)))
+
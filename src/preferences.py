@@ -83,6 +83,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #       Socksv5 with authentication
 #       HTTP
 #       HTTP with authentication
+#    Proxy server ()
+#    Proxy username ()
+#    Proxy password ()
 # Bandwidth
 #    Global bandwidth usage
 #       Maximum connections (200)
@@ -117,3 +120,645 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # GeoIP database
 #    IPv4 location (/usr/share/GeoIP/GeoIP.dat)
 #    IPv6 location (/usr/share/GeoIP/GeoIPv6.dat)
+
+import os
+import time
+import errno
+import select
+import struct
+import pickle
+import threading
+from collections import namedtuple
+
+from stats import scale
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+    libc.inotify_init1, libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+_ = lambda x : x
+
+
+CACHE_VERSION = 1
+'''
+:int  The format of the cached snapshot, bump when the cache layout changes
+'''
+
+POLL_INTERVAL = 2
+'''
+:float  Seconds between checks of the preference file when inotify is unavailable
+'''
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+'''
+:int  inotify constants, see inotify(7)
+'''
+
+INOTIFY_EVENT = struct.Struct('=iIII')
+'''
+:Struct  The header of an inotify event: watch, mask, cookie and name length
+'''
+
+PROXIES = ('none', 'socks4', 'socks5', 'socks5-auth', 'http', 'http-auth')
+'''
+:tuple<str>  The proxy types
+'''
+
+ENCRYPTION_MODES = ('forced', 'enabled', 'disabled')
+'''
+:tuple<str>  The encryption policies for a direction
+'''
+
+
+Option = namedtuple('Option', ('section', 'name', 'label', 'kind', 'default', 'choices', 'none_text'),
+                    defaults = (None, None))
+'''
+A preference
+
+@variable  section:str          The subsystem that reads the preference, subscribers are notified per section
+@variable  name:str             The name of the preference, in the file and on the snapshot
+@variable  label:str            The description shown in the Preferences tab
+@variable  kind:str             The type of the value, a key in `PARSERS`
+@variable  default:¿V?          The default value
+@variable  choices:tuple<str>?  The allowed values for the ‘choice’ kind
+@variable  none_text:str?       What `None` means, `None` if the value cannot be `None`
+'''
+
+SCHEMA = [ Option('downloads', 'allocation', _('Allocation'), 'choice', 'full', ('full', 'sparse'))
+         , Option('downloads', 'prioritise_first_last', _('Prioritise first and last pieces of files'), 'bool', False)
+         , Option('downloads', 'preallocate', _('Preallocate all files'), 'bool', True)
+         , Option('downloads', 'add_paused', _('Add torrents in paused state'), 'bool', False)
+         , Option('network', 'incoming_ports', _('Incoming ports'), 'ports', None, None, _('random'))
+         , Option('network', 'outgoing_ports', _('Outgoing ports'), 'ports', None, None, _('random'))
+         , Option('network', 'interface', _('Interface'), 'str', '')
+         , Option('network', 'peer_tos', _('Peer ToS byte'), 'int', 0x00)
+         , Option('network', 'upnp', _('Universal Plug and Play'), 'bool', True)
+         , Option('network', 'natpmp', _('Network Address Translator Port Mapping Protocol'), 'bool', True)
+         , Option('network', 'pex', _('Peer Exchange'), 'bool', True)
+         , Option('network', 'lsd', _('Local Service Discovery'), 'bool', True)
+         , Option('network', 'dht', _('Distributed hash table'), 'bool', True)
+         , Option('encryption', 'encryption_inbound', _('Inbound encryption'), 'choice', 'forced', ENCRYPTION_MODES)
+         , Option('encryption', 'encryption_outbound', _('Outbound encryption'), 'choice', 'forced', ENCRYPTION_MODES)
+         , Option('encryption', 'encryption_level', _('Encryption level'), 'choice', 'full', ('handshake', 'full', 'either'))
+         , Option('encryption', 'encrypt_entire_stream', _('Encrypt entire stream'), 'bool', True)
+         , Option('proxy', 'peer_proxy', _('Peer proxy'), 'choice', 'none', PROXIES)
+         , Option('proxy', 'web_seed_proxy', _('Web seed proxy'), 'choice', 'none', PROXIES)
+         , Option('proxy', 'tracker_proxy', _('Tracker proxy'), 'choice', 'none', PROXIES)
+         , Option('proxy', 'dht_proxy', _('Distributed hash table proxy'), 'choice', 'none', PROXIES)
+         , Option('proxy', 'proxy_address', _('Proxy server'), 'str', '')
+         , Option('proxy', 'proxy_username', _('Proxy username'), 'str', '')
+         , Option('proxy', 'proxy_password', _('Proxy password'), 'secret', '')
+         , Option('bandwidth', 'max_connections', _('Maximum connections'), 'int', 200)
+         , Option('bandwidth', 'upload_slots', _('Maximum upload slots'), 'int', 5)
+         , Option('bandwidth', 'download_rate', _('Maximum download speed'), 'rate', None, None, _('unlimited'))
+         , Option('bandwidth', 'upload_rate', _('Maximum upload speed'), 'rate', None, None, _('unlimited'))
+         , Option('bandwidth', 'max_half_open', _('Maximum half-open connections'), 'int', 50)
+         , Option('bandwidth', 'connect_rate', _('Maximum connection attempts per second'), 'int', 20)
+         , Option('bandwidth', 'ignore_local', _('Ignore limits on local network'), 'bool', True)
+         , Option('bandwidth', 'rate_limit_overhead', _('Rate limit IP overhead'), 'bool', True)
+         , Option('bandwidth', 'torrent_max_connections', _('Maximum connections per torrent'), 'int', None, None, _('inherit'))
+         , Option('bandwidth', 'torrent_upload_slots', _('Maximum upload slots per torrent'), 'int', None, None, _('inherit'))
+         , Option('bandwidth', 'torrent_download_rate', _('Maximum download speed per torrent'), 'rate', None, None, _('inherit'))
+         , Option('bandwidth', 'torrent_upload_rate', _('Maximum upload speed per torrent'), 'rate', None, None, _('inherit'))
+         , Option('queue', 'queue_to_top', _('Queue new torrents to the top'), 'bool', False)
+         , Option('queue', 'active_total', _('Total active'), 'int', 27)
+         , Option('queue', 'active_downloading', _('Total active downloading'), 'int', 20)
+         , Option('queue', 'active_seeding', _('Total active seeding'), 'int', 7)
+         , Option('queue', 'ignore_slow', _('Do not count slow torrents'), 'bool', True)
+         , Option('queue', 'share_ratio_limit', _('Share ratio limit'), 'float', 2.0)
+         , Option('queue', 'seed_ratio_limit', _('Seed limit ratio'), 'float', 7.0)
+         , Option('queue', 'seed_time_limit', _('Seed limit (minutes)'), 'int', 180)
+         , Option('queue', 'stop_ratio', _('Stop seeding when share ratio reaches'), 'float', None, None, _('never'))
+         , Option('queue', 'remove_at_ratio', _('Remove torrent when share ratio is reached'), 'bool', False)
+         , Option('cache', 'cache_size', _('Cache size (blocks of 16 K)'), 'int', 512)
+         , Option('cache', 'cache_expiry', _('Cache expiry (seconds)'), 'int', 60)
+         , Option('geoip', 'geoip_ipv4', _('GeoIP database, IPv4'), 'str', '/usr/share/GeoIP/GeoIP.dat')
+         , Option('geoip', 'geoip_ipv6', _('GeoIP database, IPv6'), 'str', '/usr/share/GeoIP/GeoIPv6.dat')
+         ]
+'''
+:list<Option>  All preferences, in the order they are shown and saved
+'''
+
+SECTIONS = { 'downloads'  : _('Downloads')
+           , 'network'    : _('Network')
+           , 'encryption' : _('Encryption')
+           , 'proxy'      : _('Proxy')
+           , 'bandwidth'  : _('Bandwidth')
+           , 'queue'      : _('Queue')
+           , 'cache'      : _('Cache')
+           , 'geoip'      : _('GeoIP database')
+           }
+'''
+:dict<str, str>  The titles of the sections
+'''
+
+
+def parse_bool(text):
+    '''
+    @param   text:str  `y`, `yes`, `true`, `1`, `n`, `no`, `false` or `0`
+    @return  :bool     The value
+    '''
+    text = text.lower()
+    if text in ('y', 'yes', 'true', '1'):
+        return True
+    if text in ('n', 'no', 'false', '0'):
+        return False
+    raise ValueError(_('expected yes or no'))
+
+
+def parse_rate(text):
+    '''
+    @param   text:str  A number of bytes per second, optionally suffixed with K, M or G
+    @return  :int      The rate in bytes per second
+    '''
+    text = text.upper().replace('B/S', '').replace('B', '').strip()
+    factor = 1
+    if text[-1:] in ('K', 'M', 'G'):
+        factor = 1 << (10 * ('KMG'.index(text[-1]) + 1))
+        text = text[:-1].strip()
+    rate = int(float(text) * factor)
+    if rate <= 0:
+        raise ValueError(_('expected a positive rate'))
+    return rate
+
+
+def parse_ports(text):
+    '''
+    @param   text:str                    A port or a range of ports, for example `6881-6891`
+    @return  :(first:int, last:int)      The first and last port
+    '''
+    (first, _sep, last) = text.partition('-')
+    (first, last) = (int(first), int(last or first))
+    if not (0 <= first <= last <= 65535):
+        raise ValueError(_('expected ports between 0 and 65535'))
+    return (first, last)
+
+
+PARSERS = { 'bool'   : parse_bool
+          , 'int'    : lambda text : int(text, 0)
+          , 'float'  : float
+          , 'rate'   : parse_rate
+          , 'ports'  : parse_ports
+          , 'str'    : lambda text : text
+          , 'secret' : lambda text : text
+          , 'choice' : lambda text : text.lower()
+          }
+'''
+:dict<str, (str)→¿V?>  Value parsers by option kind, they raise `ValueError` on invalid input
+'''
+
+
+def parse_value(option, text):
+    '''
+    Parse the value of a preference
+    
+    @param   option:Option  The preference
+    @param   text:str       The value as written in the preference file
+    @return  :¿V?           The value
+    '''
+    if (option.none_text is not None) and (text.lower() in ('', option.none_text.lower())):
+        return None
+    value = PARSERS[option.kind](text)
+    if (option.choices is not None) and (value not in option.choices):
+        raise ValueError(_('expected one of: %s') % ', '.join(option.choices))
+    return value
+
+
+def format_value(option, value):
+    '''
+    Format the value of a preference, the inverse of `parse_value`
+    
+    @param   option:Option  The preference
+    @param   value:¿V?      The value
+    @return  :str           The value as it is written in the preference file
+    '''
+    if value is None:
+        return option.none_text or ''
+    if option.kind == 'bool':
+        return 'yes' if value else 'no'
+    if option.kind == 'rate':
+        (value, unit) = scale(value)
+        return '%g%s' % (round(value, 2), '' if unit == 'B' else unit[0])
+    if option.kind == 'ports':
+        return '%i-%i' % value if value[0] != value[1] else str(value[0])
+    if option.kind == 'float':
+        return '%g' % value
+    return str(value)
+
+
+class Snapshot():
+    '''
+    Immutable set of preference values, one slot per preference
+    
+    Reading a preference is a slot access rather than a dictionary
+    lookup, so hot paths can read them on every use. When the
+    preferences change a new snapshot replaces the old one.
+    '''
+    
+    __slots__ = tuple(option.name for option in SCHEMA)
+    
+    def __init__(self, values):
+        '''
+        Constructor
+        
+        @param  values:tuple<¿V?>  The values in the order of `SCHEMA`
+        '''
+        for (name, value) in zip(Snapshot.__slots__, values):
+            object.__setattr__(self, name, value)
+    
+    
+    def __setattr__(self, name, value):
+        raise AttributeError(_('preference snapshots are read-only'))
+    
+    
+    def values(self):
+        '''
+        @return  :tuple<¿V?>  The values in the order of `SCHEMA`
+        '''
+        return tuple(getattr(self, name) for name in Snapshot.__slots__)
+
+
+DEFAULTS = Snapshot(tuple(option.default for option in SCHEMA))
+'''
+:Snapshot  The default preferences
+'''
+
+SCHEMA_SIGNATURE = tuple((option.name, option.kind, option.default) for option in SCHEMA)
+'''
+:tuple  Identifies the schema in the cache, so a cache from another version is not used
+'''
+
+
+def config_home(variable, fallback):
+    '''
+    @param   variable:str  The XDG environment variable
+    @param   fallback:str  The directory under the home directory if the variable is unset
+    @return  :str          The directory for tirek's files
+    '''
+    return os.path.join(os.environ.get(variable) or os.path.join(os.path.expanduser('~'), fallback), 'tirek')
+
+
+class Preferences():
+    '''
+    The preference store
+    
+    The preferences are read from a text file with one `name = value`
+    per line. The parsed values are cached in a binary snapshot keyed by
+    the file's modification time and size, so starting does not parse the
+    text unless it has been edited. Subscribers are notified per section,
+    and only for sections where at least one value changed.
+    '''
+    
+    def __init__(self, path = None, cache_path = None):
+        '''
+        Constructor
+        
+        @param  path:str?        The preference file, `$XDG_CONFIG_HOME/tirek/preferences` by default
+        @param  cache_path:str?  The cached snapshot, `$XDG_CACHE_HOME/tirek/preferences.cache` by default
+        '''
+        self.path = path or os.path.join(config_home('XDG_CONFIG_HOME', '.config'), 'preferences')
+        self.cache_path = cache_path or os.path.join(config_home('XDG_CACHE_HOME', '.cache'), 'preferences.cache')
+        self.current = DEFAULTS
+        self.errors = []
+        self.subscribers = {}
+        self.stamp = None
+        self.watch_fd = -1
+        self.timer = None
+        self.loop = None
+        self.running = False
+        self.lock = threading.Lock()
+    
+    
+    def subscribe(self, section, callback):
+        '''
+        Get notified when preferences change
+        
+        @param  section:str?                                       The section to follow, `None` for all
+        @param  callback:(snapshot:Snapshot, changed:set<str>)→void  Called with the new snapshot and the
+                                                                   names of the changed preferences
+        '''
+        self.subscribers.setdefault(section, []).append(callback)
+    
+    
+    def file_stamp(self):
+        '''
+        @return  :(int, int, int)?  The modification time, size and inode of the file, `None` if missing
+        '''
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    
+    def parse(self, text):
+        '''
+        Parse a preference file
+        
+        @param   text:str                                      The contents of the file
+        @return  :(values:tuple<¿V?>, errors:list<str>)         The values in the order of `SCHEMA`,
+                                                               and descriptions of ignored lines
+        '''
+        index = dict((option.name, i) for (i, option) in enumerate(SCHEMA))
+        values = list(DEFAULTS.values())
+        errors = []
+        for (lineno, line) in enumerate(text.split('\n'), 1):
+            line = line.strip()
+            if (line == '') or line.startswith('#'):
+                continue
+            (name, sep, value) = line.partition('=')
+            (name, value) = (name.strip(), value.strip())
+            if (sep == '') or (name not in index):
+                errors.append(_('line %i: unknown preference: %s') % (lineno, name))
+                continue
+            try:
+                values[index[name]] = parse_value(SCHEMA[index[name]], value)
+            except ValueError as e:
+                errors.append(_('line %i: %s: %s') % (lineno, name, e))
+        return (tuple(values), errors)
+    
+    
+    def read_cache(self, stamp):
+        '''
+        Read the cached snapshot
+        
+        @param   stamp:(int, int, int)                     The stamp of the preference file
+        @return  :(tuple<¿V?>, list<str>)?                  The values and errors, `None` if the cache is stale
+        '''
+        try:
+            with open(self.cache_path, 'rb') as file:
+                (version, signature, cached_stamp, values, errors) = pickle.load(file)
+        except Exception:
+            return None
+        if (version, signature, cached_stamp) != (CACHE_VERSION, SCHEMA_SIGNATURE, stamp):
+            return None
+        return (values, errors)
+    
+    
+    def write_cache(self, stamp, values, errors):
+        '''
+        Cache the parsed preferences, failures are ignored
+        
+        @param  stamp:(int, int, int)  The stamp of the preference file
+        @param  values:tuple<¿V?>      The values in the order of `SCHEMA`
+        @param  errors:list<str>       Descriptions of ignored lines
+        '''
+        temp = '%s.%i' % (self.cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            with open(temp, 'wb') as file:
+                pickle.dump((CACHE_VERSION, SCHEMA_SIGNATURE, stamp, values, errors), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, self.cache_path)
+        except OSError:
+            pass
+    
+    
+    def load(self):
+        '''
+        Load the preferences if the file has changed since the last load,
+        and notify the subscribers of the sections that have changed
+        
+        @return  :bool  Whether any preference changed
+        '''
+        self.lock.acquire()
+        try:
+            stamp = self.file_stamp()
+            if (stamp == self.stamp) and (self.stamp is not None):
+                return False
+            if stamp is None:
+                (values, errors) = (DEFAULTS.values(), [])
+            else:
+                cached = self.read_cache(stamp)
+                if cached is None:
+                    try:
+                        with open(self.path, 'rb') as file:
+                            text = file.read().decode('utf-8', 'replace')
+                    except OSError as e:
+                        (values, errors) = (self.current.values(), [str(e)])
+                    else:
+                        (values, errors) = self.parse(text)
+                        self.write_cache(stamp, values, errors)
+                else:
+                    (values, errors) = cached
+            self.stamp = stamp
+            self.errors = errors
+            return self.replace(values)
+        finally:
+            self.lock.release()
+    
+    
+    def set(self, changes):
+        '''
+        Change preferences and save them
+        
+        @param   changes:dict<str, ¿V?>  The new values by preference name
+        @return  :bool                   Whether any preference changed
+        '''
+        self.lock.acquire()
+        try:
+            values = list(self.current.values())
+            for (i, option) in enumerate(SCHEMA):
+                if option.name in changes:
+                    values[i] = changes[option.name]
+            self.save(values)
+            self.stamp = self.file_stamp()
+            if self.stamp is not None:
+                self.write_cache(self.stamp, tuple(values), [])
+            self.errors = []
+            return self.replace(tuple(values))
+        finally:
+            self.lock.release()
+    
+    
+    def save(self, values):
+        '''
+        Write the preference file
+        
+        @param  values:tuple<¿V?>  The values in the order of `SCHEMA`
+        '''
+        lines, section = [], None
+        for (option, value) in zip(SCHEMA, values):
+            if option.section != section:
+                section = option.section
+                lines.append('%s# %s' % ('' if len(lines) == 0 else '\n', SECTIONS[section]))
+            lines.append('# %s' % option.label)
+            lines.append('%s = %s' % (option.name, format_value(option, value)))
+        temp = '%s.%i' % (self.path, os.getpid())
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        with open(temp, 'wb') as file:
+            file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        os.replace(temp, self.path)
+    
+    
+    def replace(self, values):
+        '''
+        Replace the current snapshot and notify subscribers of changed sections
+        
+        @param   values:tuple<¿V?>  The new values in the order of `SCHEMA`
+        @return  :bool              Whether any preference changed
+        '''
+        old = self.current.values()
+        changed = {}
+        for (option, before, after) in zip(SCHEMA, old, values):
+            if before != after:
+                changed.setdefault(option.section, set()).add(option.name)
+        if len(changed) == 0:
+            return False
+        snapshot = self.current = Snapshot(values)
+        for (section, names) in changed.items():
+            for callback in self.subscribers.get(section, []):
+                callback(snapshot, names)
+        for callback in self.subscribers.get(None, []):
+            callback(snapshot, set.union(*changed.values()))
+        return True
+    
+    
+    def open_watch(self):
+        '''
+        Start watching the directory of the preference file with inotify
+        
+        @return  :bool  Whether inotify is available, otherwise the file must be polled
+        '''
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        # Editors often replace the file, so the directory is watched rather than the file
+        directory = os.path.dirname(self.path)
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return False
+        self.watch_fd = fd
+        return True
+    
+    
+    def read_watch(self):
+        '''
+        Read pending inotify events, and reload if the preference file was among them
+        '''
+        basename = os.fsencode(os.path.basename(self.path))
+        affected = False
+        while True:
+            try:
+                data = os.read(self.watch_fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                length = INOTIFY_EVENT.unpack_from(data, pos)[3]
+                pos += INOTIFY_EVENT.size
+                if data[pos : pos + length].rstrip(b'\0') == basename:
+                    affected = True
+                pos += length
+        if affected:
+            self.load()
+    
+    
+    def watch(self, loop):
+        '''
+        Reload the preferences when the file changes, from an event loop
+        
+        @param  loop:EventLoop  The event loop
+        '''
+        if self.open_watch():
+            loop.add_reader(self.watch_fd, self.read_watch)
+        else:
+            def poll():
+                self.load()
+                self.timer = loop.call_later(POLL_INTERVAL, poll)
+            self.timer = loop.call_later(POLL_INTERVAL, poll)
+        self.loop = loop
+    
+    
+    def watch_thread(self):
+        '''
+        Reload the preferences when the file changes, from a daemon thread
+        '''
+        def run():
+            while self.running:
+                if self.watch_fd < 0:
+                    time.sleep(POLL_INTERVAL)
+                    self.load()
+                elif len(select.select([self.watch_fd], [], [], POLL_INTERVAL)[0]) > 0:
+                    self.read_watch()
+        self.running = True
+        self.open_watch()
+        thread = threading.Thread(target = run)
+        thread.setDaemon(True)
+        thread.start()
+    
+    
+    def stop(self):
+        '''
+        Stop watching the preference file
+        '''
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.watch_fd >= 0:
+            if self.loop is not None:
+                self.loop.remove_reader(self.watch_fd)
+                self.loop = None
+            os.close(self.watch_fd)
+            self.watch_fd = -1
+
+
+if __name__ == '__main__':
+    # Benchmark loading from text and from the cached snapshot, and reading preferences
+    import tempfile
+    directory = tempfile.mkdtemp()
+    preferences = Preferences(os.path.join(directory, 'preferences'), os.path.join(directory, 'preferences.cache'))
+    preferences.save(DEFAULTS.values())
+    
+    def measure(function, n):
+        start = time.perf_counter()
+        for _i in range(n):
+            function()
+        return (time.perf_counter() - start) / n
+    
+    def load_text():
+        preferences.stamp = None
+        with open(preferences.path, 'rb') as file:
+            preferences.parse(file.read().decode('utf-8'))
+    
+    def load_cached():
+        preferences.stamp = None
+        preferences.load()
+    
+    print('load from text: %.1f µs, from cached snapshot: %.1f µs' %
+          (1e6 * measure(load_text, 1000), 1e6 * measure(load_cached, 1000)))
+    
+    snapshot, values = preferences.current, dict((option.name, option.default) for option in SCHEMA)
+    def read_slots():
+        for _i in range(1000):
+            snapshot.upload_rate, snapshot.max_connections, snapshot.cache_size
+    def read_dict():
+        for _i in range(1000):
+            values['upload_rate'], values['max_connections'], values['cache_size']
+    print('3000 reads: %.1f µs from a snapshot, %.1f µs from a dict' %
+          (1e6 * measure(read_slots, 1000), 1e6 * measure(read_dict, 1000)))
+    
+    notified = []
+    preferences.subscribe('bandwidth', lambda snapshot, changed : notified.append(('bandwidth', changed)))
+    preferences.subscribe('cache', lambda snapshot, changed : notified.append(('cache', changed)))
+    preferences.open_watch()
+    with open(preferences.path, 'ab') as file:
+        file.write(b'upload_rate = 100K\n')
+    select.select([preferences.watch_fd], [], [], 5)
+    preferences.read_watch()
+    print('inotify: %s, notified: %s' % ('yes' if preferences.watch_fd >= 0 else 'no', notified))
+    preferences.stop()
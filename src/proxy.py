@@ -0,0 +1,509 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import errno
+import socket
+import struct
+import base64
+import ipaddress
+
+_ = lambda x : x
+
+
+PROXY_TIMEOUT = 30
+'''
+:float  Seconds before opening a connection through a proxy fails
+'''
+
+IDLE_TIMEOUT = 30
+'''
+:float  Seconds an idle connection is kept for reuse
+'''
+
+MAX_IDLE = 8
+'''
+:int  The maximum number of idle connections kept per destination
+'''
+
+SOCKS4_GRANTED = 90
+'''
+:int  The SOCKS4 reply code for a granted request
+'''
+
+SOCKS5_ERRORS = { 1 : _('General SOCKS server failure')
+                , 2 : _('Connection not allowed by ruleset')
+                , 3 : _('Network unreachable')
+                , 4 : _('Host unreachable')
+                , 5 : _('Connection refused')
+                , 6 : _('TTL expired')
+                , 7 : _('Command not supported')
+                , 8 : _('Address type not supported')
+                }
+'''
+:dict<int, str>  SOCKS5 reply codes
+'''
+
+
+class Proxy():
+    '''
+    A proxy server and how to talk to it
+    '''
+    
+    def __init__(self, kind, host, port, username = '', password = ''):
+        '''
+        Constructor
+        
+        @param  kind:str      'socks4', 'socks5', 'socks5-auth', 'http' or 'http-auth'
+        @param  host:str      The proxy's host name or address
+        @param  port:int      The proxy's port
+        @param  username:str  The user name, for the authenticated kinds and as the SOCKS4 user ID
+        @param  password:str  The password, for the authenticated kinds
+        '''
+        self.kind = kind
+        self.address = (host, port)
+        self.username = username
+        self.password = password
+    
+    
+    def authorization(self):
+        '''
+        Get the header that authenticates with an HTTP proxy
+        
+        @return  :str  The header line, empty for unauthenticated proxies
+        '''
+        if self.kind != 'http-auth':
+            return ''
+        credentials = ('%s:%s' % (self.username, self.password)).encode('utf-8')
+        return 'Proxy-Authorization: Basic %s\r\n' % base64.b64encode(credentials).decode('ascii')
+
+
+def proxy_for(p, use):
+    '''
+    Get the proxy that the preferences set for a kind of connection
+    
+    @param   p:preferences.Snapshot  The preferences
+    @param   use:str                 'peer', 'web_seed', 'tracker' or 'dht'
+    @return  :Proxy?                 The proxy, `None` for direct connections
+    '''
+    kind = getattr(p, use + '_proxy')
+    if (kind == 'none') or not p.proxy_address:
+        return None
+    (host, _sep, port) = p.proxy_address.rpartition(':')
+    if not host:
+        (host, port) = (port, '')
+    default = 8080 if kind.startswith('http') else 1080
+    return Proxy(kind, host.strip('[]'), int(port) if port.isdigit() else default, p.proxy_username, p.proxy_password)
+
+
+class Tunnel():
+    '''
+    A connection that is being opened, directly or through a proxy
+    
+    The whole negotiation with a SOCKS5 proxy, the greeting, the
+    authentication and the connect request, is sent at once and the
+    replies are read in order, so it costs one round trip rather than
+    three.
+    '''
+    
+    def __init__(self, connector, address, direct, callback, args):
+        '''
+        Constructor
+        
+        @param  connector:Connector                                 The connector
+        @param  address:(host:str, port:int)                        The destination
+        @param  direct:bool                                         Whether to connect without negotiation
+        @param  callback:(sock:socket?, error:str?, *args)→void     Called when the connection is open or failed
+        @param  args:tuple                                          Extra arguments for `callback`
+        '''
+        self.connector = connector
+        self.loop = connector.loop
+        self.address = address
+        self.callback = callback
+        self.args = args
+        proxy = connector.proxy
+        self.proxy = None if direct else proxy
+        self.replies = []
+        self.buffer = bytearray()
+        target = address if proxy is None else proxy.address
+        if self.proxy is not None:
+            error = self.negotiation()
+            if error is not None:
+                self.sock = None
+                self.loop.call_soon(self.done, error)
+                return
+        try:
+            (family, _type, _proto, _name, target) = socket.getaddrinfo(target[0], target[1], 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+        except (OSError, UnicodeError) as e:
+            self.sock = None
+            self.loop.call_soon(self.done, str(e))
+            return
+        self.sock.setblocking(False)
+        self.fd = self.sock.fileno()
+        self.timer = self.loop.call_later(PROXY_TIMEOUT, self.done, _('Connection timed out'))
+        error = self.sock.connect_ex(target)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.timer.cancel()
+            self.loop.call_soon(self.done, os.strerror(error))
+            return
+        self.loop.add_writer(self.fd, self.write_ready)
+    
+    
+    def negotiation(self):
+        '''
+        Create the request to the proxy, `self.request`, and the replies to expect
+        
+        @return  :str?  Why the destination or the credentials cannot be sent to the proxy, `None` if they can
+        '''
+        (host, port) = self.address
+        proxy = self.proxy
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        if ip is None:
+            try:
+                name = host.encode('idna')
+            except UnicodeError:
+                return _('Invalid host name: %s') % host
+        if proxy.kind == 'socks4':
+            if (ip is not None) and (ip.version != 4):
+                return _('SOCKS4 proxies cannot connect to IPv6 addresses')
+            # SOCKS4a lets the proxy look up host names
+            packed = ip.packed if ip is not None else bytes(3) + b'\x01'
+            request = struct.pack('>BBH', 4, 1, port) + packed + proxy.username.encode('utf-8') + b'\0'
+            if ip is None:
+                request += name + b'\0'
+            self.replies = [self.socks4_reply]
+        elif proxy.kind in ('socks5', 'socks5-auth'):
+            if ip is None:
+                if len(name) > 255:
+                    return _('Host name too long for SOCKS5 proxies')
+                destination = b'\x03' + bytes([len(name)]) + name
+            else:
+                destination = (b'\x01' if ip.version == 4 else b'\x04') + ip.packed
+            if proxy.kind == 'socks5':
+                request = b'\x05\x01\x00'
+                self.replies = [self.socks5_method]
+            else:
+                (user, password) = (proxy.username.encode('utf-8'), proxy.password.encode('utf-8'))
+                if (len(user) > 255) or (len(password) > 255):
+                    return _('SOCKS5 user name or password longer than 255 bytes')
+                request = b'\x05\x01\x02' + b'\x01' + bytes([len(user)]) + user + bytes([len(password)]) + password
+                self.replies = [self.socks5_method, self.socks5_auth]
+            request += b'\x05\x01\x00' + destination + struct.pack('>H', port)
+            self.replies.append(self.socks5_reply)
+        else:
+            target = '[%s]:%i' % (host, port) if ':' in host else '%s:%i' % (host, port)
+            request = ('CONNECT %s HTTP/1.1\r\nHost: %s\r\n%s\r\n' % (target, target, proxy.authorization())).encode('utf-8')
+            self.replies = [self.http_reply]
+        self.request = request
+        return None
+    
+    
+    def write_ready(self):
+        '''
+        Complete the connection to the proxy, and send the negotiation
+        '''
+        self.loop.remove_writer(self.fd)
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.done(os.strerror(error))
+            return
+        if self.proxy is None:
+            self.done(None)
+            return
+        try:
+            # The request is small enough for the socket buffer of a fresh connection
+            self.sock.send(self.request)
+        except OSError as e:
+            self.done(str(e))
+            return
+        self.loop.add_reader(self.fd, self.read_ready)
+    
+    
+    def read_ready(self):
+        '''
+        Receive replies from the proxy
+        '''
+        try:
+            data = self.sock.recv(1 << 12)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.done(str(e))
+            return
+        if len(data) == 0:
+            self.done(_('Connection closed by proxy'))
+            return
+        self.buffer += data
+        (pos, error) = (0, None)
+        while (len(self.replies) > 0) and (error is None):
+            result = self.replies[0](self.buffer, pos)
+            if result is None:
+                break
+            (pos, error) = result
+            self.replies.pop(0)
+        del self.buffer[:pos]
+        if (error is None) and (len(self.replies) == 0) and (len(self.buffer) > 0):
+            # The destination never speaks first in the protocols that are tunnelled
+            error = _('Unexpected data from proxy')
+        if (error is not None) or (len(self.replies) == 0):
+            self.done(error)
+    
+    
+    def socks4_reply(self, data, pos):
+        '''
+        @param   data:bytearray              Received data
+        @param   pos:int                     The start of the reply
+        @return  :(pos:int, error:str?)?     The end of the reply and the error, `None` if incomplete
+        '''
+        if len(data) < pos + 8:
+            return None
+        if data[pos + 1] != SOCKS4_GRANTED:
+            return (pos + 8, _('Rejected by SOCKS proxy'))
+        return (pos + 8, None)
+    
+    
+    def socks5_method(self, data, pos):
+        '''
+        @param   data:bytearray              Received data
+        @param   pos:int                     The start of the reply
+        @return  :(pos:int, error:str?)?     The end of the reply and the error, `None` if incomplete
+        '''
+        if len(data) < pos + 2:
+            return None
+        if data[pos + 1] == 0xFF:
+            return (pos + 2, _('No acceptable SOCKS authentication method'))
+        return (pos + 2, None)
+    
+    
+    def socks5_auth(self, data, pos):
+        '''
+        @param   data:bytearray              Received data
+        @param   pos:int                     The start of the reply
+        @return  :(pos:int, error:str?)?     The end of the reply and the error, `None` if incomplete
+        '''
+        if len(data) < pos + 2:
+            return None
+        if data[pos + 1] != 0:
+            return (pos + 2, _('SOCKS authentication failed'))
+        return (pos + 2, None)
+    
+    
+    def socks5_reply(self, data, pos):
+        '''
+        @param   data:bytearray              Received data
+        @param   pos:int                     The start of the reply
+        @return  :(pos:int, error:str?)?     The end of the reply and the error, `None` if incomplete
+        '''
+        if len(data) < pos + 5:
+            return None
+        length = { 1 : 4, 3 : 1 + data[pos + 4], 4 : 16 }.get(data[pos + 3], 0)
+        end = pos + 4 + length + 2
+        if len(data) < end:
+            return None
+        if data[pos + 1] != 0:
+            return (end, SOCKS5_ERRORS.get(data[pos + 1], _('Rejected by SOCKS proxy')))
+        return (end, None)
+    
+    
+    def http_reply(self, data, pos):
+        '''
+        @param   data:bytearray              Received data
+        @param   pos:int                     The start of the reply
+        @return  :(pos:int, error:str?)?     The end of the reply and the error, `None` if incomplete
+        '''
+        end = data.find(b'\r\n\r\n', pos)
+        if end < 0:
+            return None
+        status = bytes(data[pos : end]).split(b'\r\n', 1)[0].split(b' ', 2)
+        if (len(status) < 2) or (status[1] != b'200'):
+            return (end + 4, b' '.join(status[1:]).decode('latin-1') or _('Rejected by HTTP proxy'))
+        return (end + 4, None)
+    
+    
+    def done(self, error):
+        '''
+        Hand over the connection, or report the failure
+        
+        @param  error:str?  The reason the connection failed, `None` if it is open
+        '''
+        if self.callback is None:
+            return
+        (callback, self.callback) = (self.callback, None)
+        sock = self.sock
+        if sock is not None:
+            self.timer.cancel()
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            if error is not None:
+                sock.close()
+                sock = None
+        self.connector.tunnels.discard(self)
+        if error is None:
+            self.connector.opened += 1
+        callback(sock, error, *self.args)
+    
+    
+    def cancel(self):
+        '''
+        Abandon the connection attempt without calling back
+        '''
+        self.callback = None
+        if self.sock is not None:
+            self.timer.cancel()
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.sock.close()
+        self.connector.tunnels.discard(self)
+
+
+class Connector():
+    '''
+    Opens connections for one kind of use, through its proxy if any,
+    and keeps idle connections for reuse
+    
+    When `forward` is set and the proxy speaks HTTP, plain HTTP
+    requests are sent to the proxy itself with absolute URIs, so every
+    destination shares the same pool of kept-alive connections to the
+    proxy, which are opened once and authenticated per request with
+    a header. Otherwise each destination gets its own tunnel, and the
+    pool is per destination.
+    '''
+    
+    def __init__(self, loop, proxy = None, forward = False, clock = time.monotonic):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop    The event loop to run in
+        @param  proxy:Proxy?      The proxy, `None` for direct connections
+        @param  forward:bool      Whether plain HTTP is forwarded by HTTP proxies rather than tunnelled
+        @param  clock:()→float    Function that returns the current time
+        '''
+        self.loop = loop
+        self.forward = forward
+        self.clock = clock
+        self.idle = {}
+        self.tunnels = set()
+        self.timer = None
+        self.opened = 0
+        self.reused = 0
+        self.set_proxy(proxy)
+    
+    
+    def set_proxy(self, proxy):
+        '''
+        Change the proxy, idle connections are dropped and new connections use the new proxy
+        
+        @param  proxy:Proxy?  The proxy, `None` for direct connections
+        '''
+        self.proxy = proxy
+        self.forwarding = self.forward and (proxy is not None) and proxy.kind.startswith('http')
+        self.drop_idle()
+    
+    
+    def key(self, address):
+        '''
+        @param   address:(host:str, port:int)  The destination
+        @return  :(host:str, port:int)         The address the pool keeps connections for
+        '''
+        return self.proxy.address if self.forwarding else address
+    
+    
+    def connect(self, address, callback, *args):
+        '''
+        Open a connection, reusing an idle one if possible
+        
+        @param  address:(host:str, port:int)                        The destination
+        @param  callback:(sock:socket?, error:str?, *args)→void     Called, from the event loop, with the open
+                                                                    non-blocking socket or why it failed
+        @param  args:*¿A?                                           Extra arguments for `callback`
+        '''
+        idle = self.idle.get(self.key(address))
+        while idle:
+            (sock, _expires) = idle.pop()
+            try:
+                # An idle connection that is readable has been closed, or is out of step
+                sock.recv(1, socket.MSG_PEEK)
+            except (BlockingIOError, InterruptedError):
+                self.reused += 1
+                self.loop.call_soon(callback, sock, None, *args)
+                return
+            except OSError:
+                pass
+            sock.close()
+        tunnel = Tunnel(self, address, self.forwarding, callback, args)
+        if tunnel.sock is not None:
+            self.tunnels.add(tunnel)
+    
+    
+    def release(self, address, sock):
+        '''
+        Keep a connection that is no longer used, for reuse
+        
+        @param  address:(host:str, port:int)  The destination the connection was opened for
+        @param  sock:socket                   The socket, between requests
+        '''
+        idle = self.idle.setdefault(self.key(address), [])
+        idle.append((sock, self.clock() + IDLE_TIMEOUT))
+        if len(idle) > MAX_IDLE:
+            idle.pop(0)[0].close()
+        if self.timer is None:
+            self.timer = self.loop.call_later(IDLE_TIMEOUT, self.expire)
+    
+    
+    def expire(self):
+        '''
+        Close connections that have been idle for too long
+        '''
+        self.timer = None
+        now = self.clock()
+        for (key, idle) in list(self.idle.items()):
+            while idle and (idle[0][1] <= now):
+                idle.pop(0)[0].close()
+            if not idle:
+                del self.idle[key]
+        if self.idle:
+            due = min(idle[0][1] for idle in self.idle.values())
+            self.timer = self.loop.call_later(max(due - now, 0), self.expire)
+    
+    
+    def drop_idle(self):
+        '''
+        Close all idle connections
+        '''
+        for idle in self.idle.values():
+            for (sock, _expires) in idle:
+                sock.close()
+        self.idle.clear()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+    
+    
+    def close(self):
+        '''
+        Close all idle connections and abandon all connection attempts
+        '''
+        self.drop_idle()
+        for tunnel in list(self.tunnels):
+            tunnel.cancel()
@@ -0,0 +1,170 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+
+
+TCP_IP_OVERHEAD = 40
+'''
+:int  The number of bytes of TCP/IP headers per segment
+'''
+
+SEGMENT_SIZE = 1460
+'''
+:int  The assumed payload size of a TCP segment
+'''
+
+
+def ip_overhead(length):
+    '''
+    Estimate the TCP/IP overhead of transferring data
+    
+    @param   length:int  The number of bytes of payload
+    @return  :int        The estimated number of bytes of headers
+    '''
+    return -(-length // SEGMENT_SIZE) * TCP_IP_OVERHEAD
+
+
+class TokenBucket():
+    '''
+    Token bucket rate limiter that can be nested
+    
+    Tokens are refilled lazily from the time elapsed since the last
+    use, so an idle bucket costs nothing. A bucket with a parent can
+    only hand out tokens that its parent, and its parent's parent,
+    and so on, can also hand out; this gives global, per-torrent and
+    per-peer limits with a cost proportional to the depth, not to the
+    number of peers.
+    '''
+    
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'parent')
+    
+    def __init__(self, rate = None, burst = None, parent = None):
+        '''
+        Constructor
+        
+        @param  rate:float?          The number of tokens per second, `None` for unlimited
+        @param  burst:float?         The maximum number of saved tokens, one second worth by default
+        @param  parent:TokenBucket?  The enclosing bucket
+        '''
+        self.parent = parent
+        self.stamp = time.monotonic()
+        self.set_rate(rate, burst)
+    
+    
+    def set_rate(self, rate, burst = None):
+        '''
+        Change the rate of the bucket
+        
+        @param  rate:float?   The number of tokens per second, `None` for unlimited
+        @param  burst:float?  The maximum number of saved tokens, one second worth by default
+        '''
+        self.rate = rate
+        self.burst = None if rate is None else (burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+    
+    
+    def available(self, now):
+        '''
+        Get the number of tokens that can be consumed
+        
+        @param   now:float  The current monotonic time
+        @return  :float     The number of tokens, `float('inf')` if unlimited
+        '''
+        rc = float('inf')
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                tokens = min(bucket.tokens + (now - bucket.stamp) * bucket.rate, bucket.burst)
+                (bucket.tokens, bucket.stamp) = (tokens, now)
+                rc = min(rc, tokens)
+            bucket = bucket.parent
+        return rc
+    
+    
+    def capacity(self):
+        '''
+        Get the largest number of tokens that can ever be available at once
+        
+        @return  :float  The smallest burst of the bucket and its ancestors, `float('inf')` if unlimited
+        '''
+        rc = float('inf')
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                rc = min(rc, bucket.burst)
+            bucket = bucket.parent
+        return rc
+    
+    
+    def consume(self, amount, now, partial = True):
+        '''
+        Take tokens from the bucket and all its ancestors
+        
+        @param   amount:int     The number of tokens wanted
+        @param   now:float      The current monotonic time
+        @param   partial:bool   Whether fewer tokens than wanted may be taken
+        @return  :int           The number of tokens taken
+        '''
+        available = self.available(now)
+        if available < amount:
+            if not partial:
+                return 0
+            amount = max(int(available), 0)
+        if amount > 0:
+            self.charge(amount)
+        return amount
+    
+    
+    def charge(self, amount):
+        '''
+        Take tokens from the bucket and all its ancestors without
+        checking the balance, for example for protocol overhead;
+        the balance may become negative
+        
+        @param  amount:int  The number of tokens
+        '''
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                bucket.tokens -= amount
+            bucket = bucket.parent
+    
+    
+    def delay(self, amount, now):
+        '''
+        Get the time until tokens become available
+        
+        @param   amount:int  The number of tokens wanted
+        @param   now:float   The current monotonic time
+        @return  :float      The number of seconds to wait
+        '''
+        rc = 0.0
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                wanted = min(amount, bucket.burst)
+                tokens = min(bucket.tokens + (now - bucket.stamp) * bucket.rate, bucket.burst)
+                if (tokens < wanted) and (bucket.rate > 0):
+                    rc = max(rc, (wanted - tokens) / bucket.rate)
+                elif tokens < wanted:
+                    rc = float('inf')
+            bucket = bucket.parent
+        return rc
+
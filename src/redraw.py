@@ -0,0 +1,171 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+
+import instrument
+
+
+REGION_TOP = 1 << 0
+'''
+:int  The master tab bar at the top of the screen
+'''
+
+REGION_PAGE = 1 << 1
+'''
+:int  The body of the selected master tab
+'''
+
+REGION_MIDDLE = 1 << 2
+'''
+:int  The torrent information tab bar and its body
+'''
+
+REGION_BOTTOM = 1 << 3
+'''
+:int  The status bar at the bottom of the screen
+'''
+
+REGION_CLEAR = 1 << 4
+'''
+:int  The screen shall be cleared before anything is drawn
+'''
+
+REGION_ALL = REGION_TOP | REGION_PAGE | REGION_MIDDLE | REGION_BOTTOM | REGION_CLEAR
+'''
+:int  Everything on the screen
+'''
+
+HANDOFF = instrument.histogram('redraw.handoff', 'Time from marking a clean screen dirty until it is redrawn')
+'''
+:Histogram  The latency of the handoff from the marking thread to the redraw loop
+'''
+
+
+class RedrawScheduler():
+    '''
+    Coalescing collector of dirty screen regions
+    
+    Regions are marked dirty as a bit mask, so marking a region that
+    is already dirty costs nothing more. The redraw loop collects all
+    dirty regions at once, but not more often than the frame rate cap.
+    '''
+    
+    def __init__(self, fps = 30, wakeup = None):
+        '''
+        Constructor
+        
+        @param  fps:float       The maximum number of frames per second, zero for no limit
+        @param  wakeup:()→void  Function called, from the marking thread, when a region
+                                is marked dirty and no other region already was dirty
+        '''
+        self.wakeup = wakeup
+        self.cond = threading.Condition()
+        self.dirty = 0
+        self.closed = False
+        self.interval = 1 / fps if fps > 0 else 0
+        self.last_frame = 0.0
+        self.dirty_since = 0.0
+        self.marks = 0
+        self.frames = 0
+    
+    
+    def mark(self, regions):
+        '''
+        Mark regions dirty, this can be done from any thread
+        
+        @param  regions:int  The regions, `REGION_*` or:ed together
+        '''
+        self.cond.acquire()
+        try:
+            self.marks += 1
+            was_clean = self.dirty == 0
+            if was_clean:
+                self.dirty_since = time.monotonic()
+                self.cond.notify()
+            self.dirty |= regions
+        finally:
+            self.cond.release()
+        if was_clean and (self.wakeup is not None):
+            self.wakeup()
+    
+    
+    def close(self):
+        '''
+        Wake the redraw loop and make it stop waiting for regions
+        '''
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+    
+    
+    def wait(self):
+        '''
+        Wait until the next frame is due and at least one region is dirty
+        
+        @return  :int  The dirty regions, zero if closed
+        '''
+        self.cond.acquire()
+        try:
+            while (self.dirty == 0) and not self.closed:
+                self.cond.wait()
+            # Let further marks coalesce into this frame until it is due
+            delay = self.last_frame + self.interval - time.monotonic()
+            while (delay > 0) and not self.closed:
+                self.cond.wait(delay)
+                delay = self.last_frame + self.interval - time.monotonic()
+            if self.closed:
+                return 0
+            regions, self.dirty = self.dirty, 0
+            self.last_frame = time.monotonic()
+            self.frames += 1
+            HANDOFF.record(self.last_frame - self.dirty_since)
+            return regions
+        finally:
+            self.cond.release()
+    
+    
+    def take(self):
+        '''
+        Collect the dirty regions without waiting, for use in an event loop
+        
+        @return  :(regions:int, delay:float)  The dirty regions, or zero if none are dirty or
+                                              the next frame is not yet due, and the number
+                                              of seconds until the next frame is due
+        '''
+        self.cond.acquire()
+        try:
+            if self.closed or (self.dirty == 0):
+                return (0, 0.0)
+            now = time.monotonic()
+            delay = self.last_frame + self.interval - now
+            if delay > 0:
+                return (0, delay)
+            regions, self.dirty = self.dirty, 0
+            self.last_frame = now
+            self.frames += 1
+            HANDOFF.record(now - self.dirty_since)
+            return (regions, 0.0)
+        finally:
+            self.cond.release()
+
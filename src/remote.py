@@ -0,0 +1,540 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import stat
+import errno
+import socket
+import struct
+import threading
+
+from stats import Snapshot
+from torrents import SORT_COLUMNS
+
+_ = lambda x : x
+
+HEADER = struct.Struct('<IB')
+'''
+:Struct  The header of a message: the length of the payload, and the type of the message
+'''
+
+MAX_MESSAGE_LENGTH = 1 << 24
+'''
+:int  The longest accepted payload
+'''
+
+MSG_VIEW = 1
+'''
+:int  Client to daemon: the size of a view changed, payload `VIEW`
+'''
+
+MSG_MOVE = 2
+'''
+:int  Client to daemon: move the selection in, or scroll, a view, payload `MOVE`
+'''
+
+MSG_SORT = 3
+'''
+:int  Client to daemon: sort the torrents by another column, payload an index in `SORT_COLUMNS`
+'''
+
+MSG_FILTER = 4
+'''
+:int  Client to daemon: only show torrents in a state, payload a signed byte, -1 for all
+'''
+
+MSG_ADD = 5
+'''
+:int  Client to daemon: add a torrent, payload `ADD` followed by the download directory,
+      in the file system's encoding, and the contents of the torrent file
+'''
+
+MSG_ROWS = 16
+'''
+:int  Daemon to client: changed rows of a view, payload `ROWS` followed by `ROW`s with text
+'''
+
+MSG_STATS = 17
+'''
+:int  Daemon to client: new statistics, payload `STATS`
+'''
+
+MSG_PROGRESS = 18
+'''
+:int  Daemon to client: progress of a recheck, payload `PROGRESS`
+'''
+
+VIEW_TORRENTS = 0
+'''
+:int  The view of the torrent list
+'''
+
+VIEW_PEERS = 1
+'''
+:int  The view of the selected torrent's peers
+'''
+
+VIEW_TRACKERS = 2
+'''
+:int  The view of the trackers
+'''
+
+VIEW = struct.Struct('<BHH')
+'''
+:Struct  View, height and width
+'''
+
+MOVE = struct.Struct('<Bi')
+'''
+:Struct  View and number of rows
+'''
+
+ROWS = struct.Struct('<BHH')
+'''
+:Struct  View, number of rows in the view, and number of following changed rows
+'''
+
+ROW = struct.Struct('<HBH')
+'''
+:Struct  Index of the row, whether it is selected, and the length of its UTF-8 text
+'''
+
+STATS = struct.Struct('<IIddddI')
+'''
+:Struct  The fields of a `stats.Snapshot`, in order
+'''
+
+PROGRESS = struct.Struct('<II')
+'''
+:Struct  The number of checked pieces, and the number of pieces to check
+'''
+
+
+ADD = struct.Struct('<H')
+'''
+:Struct  The length of the download directory
+'''
+
+
+def socket_path():
+    '''
+    @return  :str  The path of the daemon's socket, in `$XDG_RUNTIME_DIR/tirek` or `/tmp/tirek-$UID`
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'tirek', 'socket')
+    return os.path.join('/tmp', 'tirek-%i' % os.getuid(), 'socket')
+
+
+def private_directory(directory, create = True):
+    '''
+    Create a directory, and check that it is private, `OSError` is raised if it is not;
+    the fallback for the socket is in /tmp, where another user could have created it first
+    
+    @param  directory:str  The directory
+    @param  create:bool    Whether to create the directory if it is missing
+    '''
+    if create:
+        try:
+            os.makedirs(directory, mode = 0o700)
+            os.chmod(directory, 0o700)
+        except FileExistsError:
+            pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise OSError(errno.ENOTDIR, _('Not a directory'), directory)
+    if info.st_uid != os.getuid():
+        raise OSError(errno.EPERM, _('Owned by another user'), directory)
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        raise OSError(errno.EPERM, _('Accessible by other users'), directory)
+
+
+def pack(msg_type, *parts):
+    '''
+    Frame a message
+    
+    @param   msg_type:int        The type of the message, `MSG_*`
+    @param   parts:*bytes        The payload
+    @return  :bytes              The message
+    '''
+    payload = b''.join(parts)
+    return HEADER.pack(len(payload), msg_type) + payload
+
+
+class MessageReader():
+    '''
+    Splits a byte stream into messages
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.buffer = bytearray()
+    
+    
+    def feed(self, data):
+        '''
+        Add received data
+        
+        @param   data:bytes                       The received data
+        @return  :list<(msg_type:int, payload:bytes)>  The completed messages
+        '''
+        buf = self.buffer
+        buf += data
+        messages, pos = [], 0
+        while len(buf) - pos >= HEADER.size:
+            (length, msg_type) = HEADER.unpack_from(buf, pos)
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError('message too long')
+            if len(buf) - pos - HEADER.size < length:
+                break
+            pos += HEADER.size
+            messages.append((msg_type, bytes(buf[pos : pos + length])))
+            pos += length
+        del buf[:pos]
+        return messages
+
+
+def encode_rows(view, rows, previous):
+    '''
+    Create a message with the rows of a view that have changed
+    
+    @param   view:int                             The view, `VIEW_*`
+    @param   rows:list<(row:str, selected:bool)>  The rows in the view
+    @param   previous:list<(str, bool)>           The rows last sent
+    @return  :bytes?                              The message, `None` if nothing changed
+    '''
+    changed = [i for (i, row) in enumerate(rows) if (i >= len(previous)) or (previous[i] != row)]
+    if (len(changed) == 0) and (len(rows) == len(previous)):
+        return None
+    parts = [ROWS.pack(view, len(rows), len(changed))]
+    for i in changed:
+        text = rows[i][0].encode('utf-8')
+        parts.append(ROW.pack(i, rows[i][1], len(text)))
+        parts.append(text)
+    return pack(MSG_ROWS, *parts)
+
+
+def decode_rows(payload, views):
+    '''
+    Apply a message with changed rows
+    
+    @param   payload:bytes                              The payload of the message
+    @param   views:list<list<(row:str, selected:bool)>>  The rows by view, the changed view is replaced
+    @return  :int                                       The changed view
+    '''
+    (view, count, changed) = ROWS.unpack_from(payload, 0)
+    rows = (views[view] + [('', False)] * count)[:count]
+    pos = ROWS.size
+    for _i in range(changed):
+        (index, selected, length) = ROW.unpack_from(payload, pos)
+        pos += ROW.size
+        rows[index] = (payload[pos : pos + length].decode('utf-8', 'replace'), selected != 0)
+        pos += length
+    views[view] = rows
+    return view
+
+
+class RemoteTorrents():
+    '''
+    Stands in for a `torrents.TorrentList` when the torrents are in a daemon
+    
+    The daemon knows the selection, so `selected` is always `None`.
+    '''
+    
+    def __init__(self, session):
+        '''
+        Constructor
+        
+        @param  session:RemoteSession  The connection to the daemon
+        '''
+        self.session = session
+        self.column = 'name'
+        self.state_filter = None
+        self.selected = None
+    
+    
+    def set_sort(self, column):
+        '''
+        @param  column:str  The column, an element in `SORT_COLUMNS`
+        '''
+        self.column = column
+        self.session.send(MSG_SORT, bytes([SORT_COLUMNS.index(column)]))
+    
+    
+    def set_filter(self, state_filter):
+        '''
+        @param  state_filter:int?  The state, `None` for all
+        '''
+        self.state_filter = state_filter
+        self.session.send(MSG_FILTER, struct.pack('<b', -1 if state_filter is None else state_filter))
+    
+    
+    def move(self, delta):
+        '''
+        @param  delta:int  The number of rows to move, negative for up
+        '''
+        self.session.send(MSG_MOVE, MOVE.pack(VIEW_TORRENTS, delta))
+    
+    
+    def render(self, height, width):
+        '''
+        @param   height:int                       The number of rows in the viewport
+        @param   width:int                        The width of the viewport
+        @return  :list<(row:str, selected:bool)>  The rows last received
+        '''
+        self.session.set_view(VIEW_TORRENTS, height, width)
+        return self.session.views[VIEW_TORRENTS][:height]
+
+
+class RemotePeers():
+    '''
+    Stands in for a `peers.PeerView` when the peers are in a daemon
+    
+    The daemon shows the peers of the torrent selected in its
+    torrent list, so the `torrent` arguments are ignored.
+    '''
+    
+    def __init__(self, session):
+        '''
+        Constructor
+        
+        @param  session:RemoteSession  The connection to the daemon
+        '''
+        self.session = session
+    
+    
+    def scroll(self, delta, torrent, height):
+        '''
+        @param  delta:int       The number of rows to scroll, negative for up
+        @param  torrent:bytes?  Ignored
+        @param  height:int      Ignored, the daemon knows the height
+        '''
+        self.session.send(MSG_MOVE, MOVE.pack(VIEW_PEERS, delta))
+    
+    
+    def render(self, torrent, height, width):
+        '''
+        @param   torrent:bytes?  Ignored
+        @param   height:int      The number of rows in the viewport
+        @param   width:int       The width of the viewport
+        @return  :list<str>      The rows last received
+        '''
+        self.session.set_view(VIEW_PEERS, height, width)
+        return [row for (row, _selected) in self.session.views[VIEW_PEERS][:height]]
+
+
+class RemoteTrackers():
+    '''
+    Stands in for a `trackers.TrackerView` when the trackers are in a daemon
+    '''
+    
+    def __init__(self, session):
+        '''
+        Constructor
+        
+        @param  session:RemoteSession  The connection to the daemon
+        '''
+        self.session = session
+    
+    
+    def render(self, height, width):
+        '''
+        @param   height:int                       The number of rows in the viewport
+        @param   width:int                        The width of the viewport
+        @return  :list<(row:str, selected:bool)>  The rows last received
+        '''
+        self.session.set_view(VIEW_TRACKERS, height, width)
+        return self.session.views[VIEW_TRACKERS][:height]
+
+
+class RemoteSession():
+    '''
+    Client side of a connection to a daemon
+    
+    It stands in for `stats.Statistics` in the interface, and its
+    `torrents`, `peers` and `trackers` stand in for the torrent list,
+    peer view and tracker view. The daemon only sends the rows that are visible, and only
+    when they change.
+    '''
+    
+    def __init__(self, sock):
+        '''
+        Constructor
+        
+        @param  sock:socket  The connected socket
+        '''
+        self.sock = sock
+        self.reader = MessageReader()
+        self.views = [[], [], []]
+        self.sizes = [None, None, None]
+        self.snapshot = Snapshot(0, 0, 0.0, 0.0, 0.0, 0.0, 0)
+        self.listeners = []
+        self.updated = None
+        self.progress = None
+        self.closed = None
+        self.torrents = RemoteTorrents(self)
+        self.peers = RemotePeers(self)
+        self.trackers = RemoteTrackers(self)
+        self.loop = None
+        self.running = False
+        self.lock = threading.Lock()
+    
+    
+    def send(self, msg_type, payload):
+        '''
+        Send a message to the daemon
+        
+        @param  msg_type:int    The type of the message, `MSG_*`
+        @param  payload:bytes   The payload
+        '''
+        self.lock.acquire()
+        try:
+            self.sock.sendall(pack(msg_type, payload))
+        except OSError:
+            pass
+        finally:
+            self.lock.release()
+    
+    
+    def set_view(self, view, height, width):
+        '''
+        Tell the daemon the size of a view, if it has changed
+        
+        @param  view:int    The view, `VIEW_*`
+        @param  height:int  The number of rows
+        @param  width:int   The width of the rows
+        '''
+        if self.sizes[view] != (height, width):
+            self.sizes[view] = (height, width)
+            self.send(MSG_VIEW, VIEW.pack(view, height, width))
+    
+    
+    def add_torrent(self, data, directory):
+        '''
+        Ask the daemon to add a torrent
+        
+        @param  data:bytes      The contents of the torrent file
+        @param  directory:str   The directory to download into
+        '''
+        directory = os.fsencode(directory)
+        if len(directory) > 0xFFFF:
+            raise ValueError('download directory name too long')
+        if ADD.size + len(directory) + len(data) > MAX_MESSAGE_LENGTH:
+            raise ValueError('torrent file too large')
+        self.send(MSG_ADD, ADD.pack(len(directory)) + directory + bytes(data))
+    
+    
+    def close(self):
+        '''
+        Stop receiving updates and disconnect from the daemon
+        '''
+        self.stop()
+        self.sock.close()
+    
+    
+    def received(self, data):
+        '''
+        Apply data received from the daemon
+        
+        @param  data:bytes  The data
+        '''
+        for (msg_type, payload) in self.reader.feed(data):
+            if msg_type == MSG_ROWS:
+                view = decode_rows(payload, self.views)
+                if self.updated is not None:
+                    self.updated(view)
+            elif msg_type == MSG_STATS:
+                self.snapshot = Snapshot(*STATS.unpack(payload))
+                for listener in self.listeners:
+                    listener(self.snapshot)
+            elif msg_type == MSG_PROGRESS:
+                if self.progress is not None:
+                    self.progress(*PROGRESS.unpack(payload))
+    
+    
+    def read_ready(self):
+        '''
+        Read from the daemon, the socket must be readable
+        '''
+        try:
+            data = self.sock.recv(1 << 16)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''
+        if len(data) == 0:
+            self.stop()
+            if self.closed is not None:
+                self.closed()
+            return
+        self.received(data)
+    
+    
+    def start(self, loop):
+        '''
+        Receive updates in an event loop
+        
+        @param  loop:EventLoop  The event loop
+        '''
+        self.loop = loop
+        loop.add_reader(self.sock.fileno(), self.read_ready)
+    
+    
+    def start_thread(self):
+        '''
+        Receive updates in a daemon thread
+        '''
+        def run():
+            while self.running:
+                self.read_ready()
+        self.running = True
+        thread = threading.Thread(target = run)
+        thread.setDaemon(True)
+        thread.start()
+    
+    
+    def stop(self):
+        '''
+        Stop receiving updates
+        '''
+        self.running = False
+        if self.loop is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.loop = None
+
+
+def connect(path = None):
+    '''
+    Connect to a running daemon
+    
+    @param   path:str?        The daemon's socket, `socket_path()` by default
+    @return  :RemoteSession?  The connection, `None` if no daemon is running
+    '''
+    path = path or socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Do not trust a socket that another user could have put there
+        private_directory(os.path.dirname(path), False)
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return RemoteSession(sock)
@@ -0,0 +1,540 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import mmap
+import time
+import struct
+import threading
+
+from verify import Verifier
+from preferences import config_home
+
+
+MAGIC = b'tirek-fr'
+'''
+:bytes  Identifies a fast-resume file
+'''
+
+VERSION = 1
+'''
+:int  The layout of the fast-resume file
+'''
+
+SYNC_INTERVAL = 30
+'''
+:float  Seconds between flushes of changed records to disk
+'''
+
+PARTIAL_SLOTS = 16
+'''
+:int  The number of partially downloaded pieces whose blocks are remembered per torrent
+'''
+
+FILE_HEADER = struct.Struct('<8sII')
+'''
+:Struct  The header of the file: magic, version and the end of the last record
+'''
+
+RECORD_HEADER = struct.Struct('<20sIIII')
+'''
+:Struct  The header of a record: infohash (zeroes when the record is free), length of
+         the record, piece count, file count, and blocks per piece
+'''
+
+FILE_ENTRY = struct.Struct('<Qq')
+'''
+:Struct  A file in a record: size, and modification time in nanoseconds (-1 if never stamped)
+'''
+
+PARTIAL_PIECE = struct.Struct('<i')
+'''
+:Struct  The header of a partial piece slot: the index of the piece, -1 when the slot is free
+'''
+
+FREE = bytes(20)
+'''
+:bytes  The infohash of a free record
+'''
+
+
+def record_length(piece_count, file_count, blocks_per_piece):
+    '''
+    Calculate the size of a record
+    
+    @param   piece_count:int       The number of pieces in the torrent
+    @param   file_count:int        The number of files in the torrent
+    @param   blocks_per_piece:int  The number of blocks in a piece
+    @return  :int                  The size of the record, a multiple of 8
+    '''
+    length = RECORD_HEADER.size + file_count * FILE_ENTRY.size + (piece_count + 7) // 8
+    length += PARTIAL_SLOTS * (PARTIAL_PIECE.size + (blocks_per_piece + 7) // 8)
+    return (length + 7) & ~7
+
+
+def file_stamp(path):
+    '''
+    @param   path:str                   The path of a file
+    @return  :(size:int, mtime_ns:int)  The size and modification time of the file, (0, -1) if missing
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, -1)
+    return (st.st_size, st.st_mtime_ns)
+
+
+class ResumeRecord():
+    '''
+    The fast-resume state of a torrent, read and written in place in the mapped file
+    '''
+    
+    __slots__ = ('store', 'info_hash', 'offset', 'length', 'piece_count', 'file_count', 'blocks_per_piece',
+                 'files_offset', 'bitfield_offset', 'partial_offset', 'partial_size')
+    
+    def __init__(self, store, offset):
+        '''
+        Constructor
+        
+        @param  store:ResumeStore  The store with the record
+        @param  offset:int         The position of the record in the file
+        '''
+        self.store = store
+        self.offset = offset
+        (self.info_hash, self.length, self.piece_count, self.file_count,
+         self.blocks_per_piece) = RECORD_HEADER.unpack_from(store.map, offset)
+        self.files_offset = offset + RECORD_HEADER.size
+        self.bitfield_offset = self.files_offset + self.file_count * FILE_ENTRY.size
+        self.partial_offset = self.bitfield_offset + (self.piece_count + 7) // 8
+        self.partial_size = PARTIAL_PIECE.size + (self.blocks_per_piece + 7) // 8
+    
+    
+    def has(self, piece):
+        '''
+        @param   piece:int  The index of a piece
+        @return  :bool      Whether the piece is complete
+        '''
+        return (self.store.map[self.bitfield_offset + (piece >> 3)] & (0x80 >> (piece & 7))) != 0
+    
+    
+    def set_have(self, piece, have = True):
+        '''
+        Mark a piece as complete or incomplete, and forget its partial state
+        
+        @param  piece:int   The index of the piece
+        @param  have:bool   Whether the piece is complete
+        '''
+        m, pos = self.store.map, self.bitfield_offset + (piece >> 3)
+        if have:
+            m[pos] |= 0x80 >> (piece & 7)
+        else:
+            m[pos] &= ~(0x80 >> (piece & 7)) & 255
+        slot = self.find_partial(piece)
+        if slot is not None:
+            PARTIAL_PIECE.pack_into(m, slot, -1)
+        self.store.dirty = True
+    
+    
+    def bitfield(self):
+        '''
+        @return  :bytes  The bitfield of complete pieces, in wire order
+        '''
+        return self.store.map[self.bitfield_offset : self.partial_offset]
+    
+    
+    def set_bitfield(self, bitfield):
+        '''
+        Replace the bitfield of complete pieces
+        
+        @param  bitfield:bytes  The bitfield, in wire order
+        '''
+        self.store.map[self.bitfield_offset : self.partial_offset] = bytes(bitfield)
+        self.store.dirty = True
+    
+    
+    def files(self):
+        '''
+        @return  :list<(size:int, mtime_ns:int)>  The recorded size and modification time of each file
+        '''
+        return [FILE_ENTRY.unpack_from(self.store.map, self.files_offset + i * FILE_ENTRY.size)
+                for i in range(self.file_count)]
+    
+    
+    def stamp(self, paths, indices = None):
+        '''
+        Record the current size and modification time of files
+        
+        @param  paths:list<str>     The paths of all files in the torrent
+        @param  indices:itr<int>?   The files to stamp, `None` for all
+        '''
+        for i in (range(self.file_count) if indices is None else indices):
+            FILE_ENTRY.pack_into(self.store.map, self.files_offset + i * FILE_ENTRY.size, *file_stamp(paths[i]))
+        self.store.dirty = True
+    
+    
+    def changed_files(self, paths):
+        '''
+        Find files that have been modified, resized or never stamped
+        
+        @param   paths:list<str>  The paths of all files in the torrent
+        @return  :list<int>       The indices of the changed files
+        '''
+        return [i for (i, entry) in enumerate(self.files()) if (entry[1] < 0) or (entry != file_stamp(paths[i]))]
+    
+    
+    def find_partial(self, piece):
+        '''
+        @param   piece:int  The index of a piece
+        @return  :int?      The position of the piece's partial slot, `None` if it has none
+        '''
+        m = self.store.map
+        for pos in range(self.partial_offset, self.partial_offset + PARTIAL_SLOTS * self.partial_size, self.partial_size):
+            if PARTIAL_PIECE.unpack_from(m, pos)[0] == piece:
+                return pos
+        return None
+    
+    
+    def block_done(self, piece, block):
+        '''
+        Remember that a block in an incomplete piece has been written
+        
+        @param   piece:int  The index of the piece
+        @param   block:int  The index of the block in the piece
+        @return  :bool      Whether it was remembered, `False` if all partial slots are taken
+        '''
+        m = self.store.map
+        slot = self.find_partial(piece)
+        if slot is None:
+            slot = self.find_partial(-1)
+            if slot is None:
+                return False
+            PARTIAL_PIECE.pack_into(m, slot, piece)
+            m[slot + PARTIAL_PIECE.size : slot + self.partial_size] = bytes(self.partial_size - PARTIAL_PIECE.size)
+        m[slot + PARTIAL_PIECE.size + (block >> 3)] |= 0x80 >> (block & 7)
+        self.store.dirty = True
+        return True
+    
+    
+    def partial_pieces(self):
+        '''
+        @return  :dict<int, bytes>  The bitmap of written blocks by incomplete piece
+        '''
+        m, pieces = self.store.map, {}
+        for pos in range(self.partial_offset, self.partial_offset + PARTIAL_SLOTS * self.partial_size, self.partial_size):
+            piece = PARTIAL_PIECE.unpack_from(m, pos)[0]
+            if piece >= 0:
+                pieces[piece] = m[pos + PARTIAL_PIECE.size : pos + self.partial_size]
+        return pieces
+    
+    
+    def forget_partial(self, first, last):
+        '''
+        Forget the partial state of a range of pieces
+        
+        @param  first:int  The index of the first piece
+        @param  last:int   The index of the piece after the last piece
+        '''
+        m = self.store.map
+        for pos in range(self.partial_offset, self.partial_offset + PARTIAL_SLOTS * self.partial_size, self.partial_size):
+            if first <= PARTIAL_PIECE.unpack_from(m, pos)[0] < last:
+                PARTIAL_PIECE.pack_into(m, pos, -1)
+                self.store.dirty = True
+
+
+class ResumeStore():
+    '''
+    Fast-resume state of all torrents in one memory-mapped file
+    
+    Records are updated in place and the mapping is flushed
+    periodically, so completing a piece costs a bit flip rather
+    than a rewrite of a file.
+    '''
+    
+    def __init__(self, path = None, sync_interval = SYNC_INTERVAL):
+        '''
+        Constructor
+        
+        @param  path:str?            The file, `$XDG_DATA_HOME/tirek/resume` by default
+        @param  sync_interval:float  Seconds between flushes
+        '''
+        self.path = path or os.path.join(config_home('XDG_DATA_HOME', os.path.join('.local', 'share')), 'resume')
+        self.sync_interval = sync_interval
+        self.fd = -1
+        self.map = None
+        self.end = FILE_HEADER.size
+        self.records = {}
+        self.free = []
+        self.dirty = False
+        self.timer = None
+        self.running = False
+        self.lock = threading.Lock()
+    
+    
+    def open(self):
+        '''
+        Open the file, or create it, and index its records
+        '''
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        size = os.fstat(self.fd).st_size
+        if size < FILE_HEADER.size:
+            size = 1 << 16
+            os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            FILE_HEADER.pack_into(self.map, 0, MAGIC, VERSION, FILE_HEADER.size)
+        else:
+            self.map = mmap.mmap(self.fd, size)
+        (magic, version, self.end) = FILE_HEADER.unpack_from(self.map, 0)
+        if (magic, version) != (MAGIC, VERSION) or not (FILE_HEADER.size <= self.end <= size):
+            raise ValueError('%s: not a fast-resume file of a supported version' % self.path)
+        offset = FILE_HEADER.size
+        while offset < self.end:
+            (info_hash, length) = RECORD_HEADER.unpack_from(self.map, offset)[:2]
+            if length < RECORD_HEADER.size:
+                break
+            if info_hash == FREE:
+                self.free.append((offset, length))
+            else:
+                self.records[info_hash] = ResumeRecord(self, offset)
+            offset += length
+    
+    
+    def get(self, info_hash):
+        '''
+        @param   info_hash:bytes  The infohash of a torrent
+        @return  :ResumeRecord?   The torrent's record, `None` if it has none
+        '''
+        return self.records.get(info_hash)
+    
+    
+    def add(self, info_hash, piece_count, file_count, blocks_per_piece):
+        '''
+        Create a record for a torrent, replacing any existing record; its
+        files are unstamped, so the first restore rechecks the torrent
+        
+        @param   info_hash:bytes       The infohash of the torrent
+        @param   piece_count:int       The number of pieces in the torrent
+        @param   file_count:int        The number of files in the torrent
+        @param   blocks_per_piece:int  The number of blocks in a piece
+        @return  :ResumeRecord         The new record
+        '''
+        length = record_length(piece_count, file_count, blocks_per_piece)
+        self.lock.acquire()
+        try:
+            self.remove(info_hash)
+            for (i, (offset, free_length)) in enumerate(self.free):
+                if free_length == length:
+                    del self.free[i]
+                    break
+            else:
+                offset = self.end
+                if offset + length > len(self.map):
+                    self.grow(offset + length)
+                self.end = offset + length
+                FILE_HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.end)
+            m = self.map
+            m[offset : offset + length] = bytes(length)
+            RECORD_HEADER.pack_into(m, offset, info_hash, length, piece_count, file_count, blocks_per_piece)
+            record = self.records[info_hash] = ResumeRecord(self, offset)
+            for i in range(file_count):
+                FILE_ENTRY.pack_into(m, record.files_offset + i * FILE_ENTRY.size, 0, -1)
+            for i in range(PARTIAL_SLOTS):
+                PARTIAL_PIECE.pack_into(m, record.partial_offset + i * record.partial_size, -1)
+            self.dirty = True
+            return record
+        finally:
+            self.lock.release()
+    
+    
+    def remove(self, info_hash):
+        '''
+        Delete the record of a torrent, if it has one
+        
+        @param  info_hash:bytes  The infohash of the torrent
+        '''
+        record = self.records.pop(info_hash, None)
+        if record is not None:
+            self.map[record.offset : record.offset + 20] = FREE
+            self.free.append((record.offset, record.length))
+            self.dirty = True
+    
+    
+    def grow(self, size):
+        '''
+        Enlarge the file and remap it
+        
+        @param  size:int  The minimum size
+        '''
+        new_size = len(self.map)
+        while new_size < size:
+            new_size *= 2
+        os.ftruncate(self.fd, new_size)
+        self.map.resize(new_size)
+    
+    
+    def sync(self):
+        '''
+        Flush changes to disk
+        '''
+        if self.dirty and (self.map is not None):
+            self.dirty = False
+            self.map.flush()
+    
+    
+    def start(self, loop):
+        '''
+        Flush periodically from an event loop
+        
+        @param  loop:EventLoop  The event loop
+        '''
+        def tick():
+            self.sync()
+            self.timer = loop.call_later(self.sync_interval, tick)
+        self.timer = loop.call_later(self.sync_interval, tick)
+    
+    
+    def start_thread(self):
+        '''
+        Flush periodically from a daemon thread
+        '''
+        def run():
+            while self.running:
+                time.sleep(self.sync_interval)
+                self.sync()
+        self.running = True
+        thread = threading.Thread(target = run)
+        thread.setDaemon(True)
+        thread.start()
+    
+    
+    def stop(self):
+        '''
+        Stop flushing periodically
+        '''
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+    
+    
+    def close(self):
+        '''
+        Flush and close the file
+        '''
+        self.stop()
+        if self.map is not None:
+            self.dirty = True
+            self.sync()
+            self.map.close()
+            self.map = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.records.clear()
+        self.free.clear()
+
+
+def restore(record, files, piece_length, hashes, workers = None, progress = None):
+    '''
+    Get the complete pieces of a torrent when it is started, trusting the
+    fast-resume record for files that have not changed since they were
+    stamped, and rechecking the pieces of the files that have
+    
+    @param   record:ResumeRecord                     The torrent's record
+    @param   files:list<(path:str, length:int)>      The files in the payload, in order
+    @param   piece_length:int                        The size of each piece but the last
+    @param   hashes:bytes|memoryview                 The concatenated SHA-1 hashes of the pieces
+    @param   workers:int?                            The number of threads for rechecking
+    @param   progress:(done:int, total:int)→void?    Called with the progress of rechecking
+    @return  :bytearray                              Bitfield of complete pieces, in wire order
+    '''
+    paths = [path for (path, _length) in files]
+    bitfield = bytearray(record.bitfield())
+    changed = record.changed_files(paths)
+    if len(changed) == 0:
+        return bitfield
+    verifier = Verifier(files, piece_length, hashes, workers, progress)
+    ranges = []
+    for (first, last) in sorted(verifier.file_pieces(i) for i in changed):
+        if (len(ranges) > 0) and (first <= ranges[-1][1]):
+            ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+        elif first < last:
+            ranges.append((first, last))
+    checked = verifier.run(ranges)
+    for (first, last) in ranges:
+        for piece in range(first, last):
+            bit = 0x80 >> (piece & 7)
+            bitfield[piece >> 3] = (bitfield[piece >> 3] & ~bit) | (checked[piece >> 3] & bit)
+        record.forget_partial(first, last)
+    record.set_bitfield(bitfield)
+    record.stamp(paths, changed)
+    return bitfield
+
+
+if __name__ == '__main__':
+    # Benchmark starting 20000 torrents, one of which has a modified file
+    import sys, hashlib, tempfile
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    piece_length = 1 << 18
+    torrents = []
+    for n in range(count):
+        # Two files per torrent; the payload is not written, as
+        # restoring an unchanged torrent must not read it
+        files = [(os.path.join(directory, '%i.%i' % (n, i)), 3 * piece_length) for i in range(2)]
+        for (path, length) in files:
+            with open(path, 'wb') as file:
+                file.truncate(length)
+        torrents.append((os.urandom(20), files))
+    
+    store = ResumeStore(os.path.join(directory, 'resume'))
+    store.open()
+    start = time.perf_counter()
+    for (info_hash, files) in torrents:
+        record = store.add(info_hash, 6, 2, piece_length >> 14)
+        record.set_bitfield(b'\xfc')
+        record.stamp([path for (path, _length) in files])
+        record.block_done(0, 3)
+    store.close()
+    print('%i torrents: created records in %.0f ms, %i bytes' %
+          (count, 1000 * (time.perf_counter() - start), os.stat(store.path).st_size))
+    
+    # Modify the second file of the first torrent, with valid data
+    (path, length) = torrents[0][1][1]
+    data = os.urandom(length)
+    with open(path, 'wb') as file:
+        file.write(data)
+    hashes = bytes(60) + b''.join(hashlib.sha1(data[i : i + piece_length]).digest()
+                                  for i in range(0, length, piece_length))
+    
+    start = time.perf_counter()
+    store = ResumeStore(os.path.join(directory, 'resume'))
+    store.open()
+    opened = time.perf_counter()
+    complete, rechecked = 0, [0]
+    def progress(done, total):
+        rechecked[0] += done == total
+    for (info_hash, files) in torrents:
+        bitfield = restore(store.get(info_hash), files, piece_length,
+                           hashes if info_hash == torrents[0][0] else bytes(120), progress = progress)
+        complete += sum(bin(byte).count('1') for byte in bitfield)
+    end = time.perf_counter()
+    store.close()
+    print('restart: opened in %.0f ms, restored in %.0f ms, %i complete pieces, %i torrent(s) rechecked' %
+          (1000 * (opened - start), 1000 * (end - opened), complete, rechecked[0]))
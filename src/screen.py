@@ -0,0 +1,392 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+
+from layout import char_width
+
+
+ATTR_BOLD = 1 << 0
+'''
+:int  Attribute bit for bold text
+'''
+
+ATTR_REVERSE = 1 << 1
+'''
+:int  Attribute bit for reverse video
+'''
+
+ATTR_FG_SHIFT = 4
+'''
+:int  The position of the foreground colour in an attribute, 0 is the default colour
+'''
+
+ATTR_BG_SHIFT = 8
+'''
+:int  The position of the background colour in an attribute, 0 is the default colour
+'''
+
+ATTR_COLOUR_MASK = 15
+'''
+:int  The mask for a colour in an attribute after it has been shifted down
+'''
+
+RUN_GAP = 4
+'''
+:int  Unchanged cells between two changed runs that are cheaper to rewrite than to jump over
+'''
+
+
+def attr_to_sgr(attr):
+    '''
+    Create the escape sequence that selects an attribute
+    
+    @param   attr:int  The attribute
+    @return  :str      Select graphic rendition sequence, resets everything not in `attr`
+    '''
+    params = ['0']
+    if attr & ATTR_BOLD:
+        params.append('1')
+    if attr & ATTR_REVERSE:
+        params.append('7')
+    fg = (attr >> ATTR_FG_SHIFT) & ATTR_COLOUR_MASK
+    if fg != 0:
+        params.append(str(29 + fg))
+    bg = (attr >> ATTR_BG_SHIFT) & ATTR_COLOUR_MASK
+    if bg != 0:
+        params.append(str(39 + bg))
+    return '\033[%sm' % ';'.join(params)
+
+
+def apply_sgr(attr, params):
+    '''
+    Update an attribute with the parameters of a select graphic rendition sequence
+    
+    @param   attr:int     The current attribute
+    @param   params:str   The parameters of the sequence, without the CSI and the ‘m’
+    @return  :int         The new attribute
+    '''
+    for param in (params.split(';') if params else ['0']):
+        p = int(param) if param.isdigit() else 0
+        if p == 0:
+            attr = 0
+        elif p == 1:
+            attr |= ATTR_BOLD
+        elif p == 22:
+            attr &= ~ATTR_BOLD
+        elif p == 7:
+            attr |= ATTR_REVERSE
+        elif p == 27:
+            attr &= ~ATTR_REVERSE
+        elif 30 <= p <= 37:
+            attr = (attr & ~(ATTR_COLOUR_MASK << ATTR_FG_SHIFT)) | ((p - 29) << ATTR_FG_SHIFT)
+        elif p == 39:
+            attr &= ~(ATTR_COLOUR_MASK << ATTR_FG_SHIFT)
+        elif 40 <= p <= 47:
+            attr = (attr & ~(ATTR_COLOUR_MASK << ATTR_BG_SHIFT)) | ((p - 39) << ATTR_BG_SHIFT)
+        elif p == 49:
+            attr &= ~(ATTR_COLOUR_MASK << ATTR_BG_SHIFT)
+    return attr
+
+
+class Screen():
+    '''
+    Double-buffered model of the terminal
+    
+    Text, including the subset of escape sequences that the interface
+    uses, is fed into the next frame. On refresh the next frame is
+    compared against the previous frame, and only changed runs of cells
+    are sent to the terminal, in one write.
+    '''
+    
+    def __init__(self, height, width, fd = 1):
+        '''
+        Constructor
+        
+        @param  height:int  The height of the terminal
+        @param  width:int   The width of the terminal
+        @param  fd:int      The file descriptor of the terminal
+        '''
+        self.fd = fd
+        self.bytes_total = 0
+        self.bytes_last = 0
+        self.frames = 0
+        self.frame_time_total = 0.0
+        self.frame_time_last = 0.0
+        self.resize(height, width)
+    
+    
+    def resize(self, height, width):
+        '''
+        Change the size of the screen, the next refresh will repaint everything
+        
+        @param  height:int  The new height of the terminal
+        @param  width:int   The new width of the terminal
+        '''
+        self.height, self.width = max(height, 0), max(width, 0)
+        self.chars = [[' '] * self.width for _ in range(self.height)]
+        self.attrs = [[0] * self.width for _ in range(self.height)]
+        self.front_chars = None
+        self.front_attrs = None
+        self.scrolls = []
+        self.y, self.x, self.attr = 0, 0, 0
+    
+    
+    def invalidate(self):
+        '''
+        Forget what is on the terminal, the next refresh will repaint everything
+        '''
+        self.front_chars = None
+        self.front_attrs = None
+        self.scrolls = []
+    
+    
+    def scroll(self, top, bottom, count):
+        '''
+        Scroll a range of lines, in both frames
+        
+        The terminal is scrolled with a scroll region on the next refresh,
+        so only the lines that are exposed need to be sent, once they have
+        been written to the next frame. The exposed lines are blank until then.
+        
+        @param  top:int     The first line of the region, zero-based
+        @param  bottom:int  The last line of the region, zero-based, inclusive
+        @param  count:int   The number of lines to scroll up, negative to scroll down
+        '''
+        top, bottom = max(top, 0), min(bottom, self.height - 1)
+        if (count == 0) or (abs(count) > bottom - top):
+            return
+        buffers = [self.chars, self.attrs]
+        if self.front_chars is not None:
+            buffers += [self.front_chars, self.front_attrs]
+            self.scrolls.append('\033[%i;%ir\033[%i%s' % (top + 1, bottom + 1, abs(count), 'S' if count > 0 else 'T'))
+        for buffer in buffers:
+            blank = ' ' if isinstance(buffer[top][0], str) else 0
+            exposed = [[blank] * self.width for _ in range(abs(count))]
+            if count > 0:
+                buffer[top : bottom + 1] = buffer[top + count : bottom + 1] + exposed
+            else:
+                buffer[top : bottom + 1] = exposed + buffer[top : bottom + 1 + count]
+    
+    
+    def clear(self):
+        '''
+        Blank the next frame and move the cursor to the top left corner
+        '''
+        for y in range(self.height):
+            self.clear_line(y)
+        self.y, self.x = 0, 0
+    
+    
+    def clear_line(self, y):
+        '''
+        Blank a line in the next frame
+        
+        @param  y:int  The line, zero-based
+        '''
+        if 0 <= y < self.height:
+            self.chars[y][:] = [' '] * self.width
+            self.attrs[y][:] = [0] * self.width
+    
+    
+    def feed(self, text):
+        '''
+        Write text to the next frame
+        
+        Supported escape sequences are cursor positioning (CSI H),
+        erase display (CSI 2 J), erase line (CSI 2 K) and select
+        graphic rendition (CSI m). Other sequences are ignored.
+        
+        @param  text:str  The text to write
+        '''
+        i, n = 0, len(text)
+        while i < n:
+            j = text.find('\033', i)
+            if j < 0:
+                j = n
+            if j > i:
+                self.put(text[i : j])
+            if j == n:
+                break
+            # Parse control sequence introduced at `j`
+            if j + 1 < n and text[j + 1] == '[':
+                k = j + 2
+                while k < n and not ('@' <= text[k] <= '~'):
+                    k += 1
+                if k == n:
+                    break
+                params, final = text[j + 2 : k], text[k]
+                if final == 'm':
+                    self.attr = apply_sgr(self.attr, params)
+                elif final in 'Hf':
+                    pos = (params.split(';') + ['', ''])[:2]
+                    self.y = (int(pos[0]) if pos[0].isdigit() else 1) - 1
+                    self.x = (int(pos[1]) if pos[1].isdigit() else 1) - 1
+                elif final == 'J' and params == '2':
+                    self.clear()
+                elif final == 'K' and params == '2':
+                    self.clear_line(self.y)
+                i = k + 1
+            else:
+                i = j + 2
+    
+    
+    def put(self, text):
+        '''
+        Write plain text, without escape sequences, to the next frame
+        
+        A wide character takes two cells, the second of which is held by
+        an empty string. Combining characters join the preceding cell.
+        
+        @param  text:str  The text to write, may contain line feeds
+        '''
+        lines = text.split('\n')
+        for index, line in enumerate(lines):
+            if index > 0:
+                self.y, self.x = self.y + 1, 0
+            if not line.isascii():
+                line = self.cells(line)
+            while line:
+                if self.x >= self.width:
+                    self.y, self.x = self.y + 1, 0
+                if not (0 <= self.y < self.height):
+                    break
+                part = line[: self.width - self.x]
+                if (len(part) < len(line)) and (line[len(part)] == ''):
+                    # Do not split a wide character over two lines
+                    part = part[:-1]
+                    if len(part) == 0:
+                        self.chars[self.y][self.x] = ' '
+                        self.attrs[self.y][self.x] = self.attr
+                        self.x = self.width
+                        continue
+                line = line[len(part):]
+                end = self.x + len(part)
+                row = self.chars[self.y]
+                if (row[self.x] == '') and (self.x > 0):
+                    # Blank the wide character that is being overwritten by half
+                    row[self.x - 1] = ' '
+                if (end < self.width) and (row[end] == ''):
+                    row[end] = ' '
+                self.chars[self.y][self.x : end] = part
+                self.attrs[self.y][self.x : end] = [self.attr] * len(part)
+                self.x = end
+    
+    
+    def cells(self, text):
+        '''
+        Split non-ASCII text into cells
+        
+        @param   text:str    The text, without escape sequences and line feeds
+        @return  :list<str>  One string per cell, the second cell of a wide character is empty
+        '''
+        cells = []
+        for c in text:
+            width = char_width(c)
+            if width == 0:
+                if cells:
+                    cells[-1 if cells[-1] != '' else -2] += c
+            else:
+                cells.append(c)
+                if width == 2:
+                    cells.append('')
+        return cells
+    
+    
+    def render(self):
+        '''
+        Build the output that turns the previous frame into the next frame
+        
+        @return  :str  The text to send to the terminal
+        '''
+        out = []
+        if self.front_chars is None:
+            # The terminal is cleared, so only non-blank cells need to be sent
+            self.front_chars = [[' '] * self.width for _ in range(self.height)]
+            self.front_attrs = [[0] * self.width for _ in range(self.height)]
+            out.append('\033[0m\033[H\033[2J')
+            self.scrolls = []
+        cur_attr = None
+        if self.scrolls:
+            # Exposed lines are filled with the current background
+            out.append('\033[0m')
+            out.extend(self.scrolls)
+            out.append('\033[r')
+            self.scrolls = []
+            cur_attr = 0
+        for y in range(self.height):
+            chars, attrs = self.chars[y], self.attrs[y]
+            front_chars, front_attrs = self.front_chars[y], self.front_attrs[y]
+            if chars == front_chars and attrs == front_attrs:
+                continue
+            x, width = 0, self.width
+            while x < width:
+                # Find the start of the next changed run
+                while x < width and chars[x] == front_chars[x] and attrs[x] == front_attrs[x]:
+                    x += 1
+                if x == width:
+                    break
+                start, gap = x, 0
+                # Extend the run while it is not separated by a long unchanged gap
+                end = x
+                while x < width and gap <= RUN_GAP:
+                    if chars[x] == front_chars[x] and attrs[x] == front_attrs[x]:
+                        gap += 1
+                    else:
+                        gap, end = 0, x + 1
+                    x += 1
+                x = end
+                if (chars[start] == '') and (start > 0):
+                    # Redraw the whole wide character
+                    start -= 1
+                out.append('\033[%i;%iH' % (y + 1, start + 1))
+                for i in range(start, end):
+                    if chars[i] == '':
+                        continue
+                    if attrs[i] != cur_attr:
+                        cur_attr = attrs[i]
+                        out.append(attr_to_sgr(cur_attr))
+                    out.append(chars[i])
+            front_chars[:] = chars
+            front_attrs[:] = attrs
+        if cur_attr is not None and cur_attr != 0:
+            out.append('\033[0m')
+        if self.height > 0 and self.width > 0 and len(out) > 0:
+            out.append('\033[%i;%iH' % (min(self.y, self.height - 1) + 1, min(self.x, self.width - 1) + 1))
+        return ''.join(out)
+    
+    
+    def refresh(self):
+        '''
+        Send the changes since the last refresh to the terminal
+        
+        @return  :int  The number of bytes written
+        '''
+        start = time.perf_counter()
+        data = self.render().encode('utf-8')
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self.fd, view):]
+        self.frame_time_last = time.perf_counter() - start
+        self.frame_time_total += self.frame_time_last
+        self.bytes_last = len(data)
+        self.bytes_total += len(data)
+        self.frames += 1
+        return len(data)
@@ -0,0 +1,250 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+from array import array
+from collections import namedtuple
+
+
+SAMPLE_INTERVAL = 1.0
+'''
+:float  The number of seconds between samples
+'''
+
+RATE_WINDOW = 5
+'''
+:int  The number of samples rates are averaged over
+'''
+
+
+class Counter():
+    '''
+    Monotonic counter that any thread can add to without locking
+    
+    Each thread adds to its own cell, which no other thread writes to;
+    the cells are only summed when the counter is sampled.
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.local = threading.local()
+        self.cells = []
+        self.lock = threading.Lock()
+    
+    
+    def add(self, amount):
+        '''
+        Add to the counter
+        
+        @param  amount:int  The amount to add
+        '''
+        try:
+            self.local.cell[0] += amount
+        except AttributeError:
+            cell = self.local.cell = [amount]
+            # Only registering a new thread's cell requires the lock
+            self.lock.acquire()
+            try:
+                self.cells.append(cell)
+            finally:
+                self.lock.release()
+    
+    
+    def value(self):
+        '''
+        Get the sum of all additions
+        
+        @return  :int  The value of the counter
+        '''
+        return sum(cell[0] for cell in self.cells)
+
+
+class RateMeter():
+    '''
+    Sliding-window rate of a counter, from a fixed-size ring of samples
+    '''
+    
+    __slots__ = ('counter', 'values', 'times', 'index', 'filled')
+    
+    def __init__(self, counter, window = RATE_WINDOW):
+        '''
+        Constructor
+        
+        @param  counter:Counter?  The counter, `None` if its values are passed to `sample`
+        @param  window:int        The number of samples in the window
+        '''
+        self.counter = counter
+        self.values = array('d', [0.0] * (window + 1))
+        self.times = array('d', [0.0] * (window + 1))
+        self.index = 0
+        self.filled = 0
+    
+    
+    def sample(self, now, value = None):
+        '''
+        Record the counter's current value
+        
+        @param   now:float   The current time
+        @param   value:int?  The value, read from the counter by default
+        @return  :float      The rate over the window, per second
+        '''
+        self.index = (self.index + 1) % len(self.values)
+        self.values[self.index] = self.counter.value() if value is None else value
+        self.times[self.index] = now
+        self.filled = min(self.filled + 1, len(self.values))
+        if self.filled < 2:
+            return 0.0
+        oldest = (self.index + len(self.values) - self.filled + 1) % len(self.values)
+        elapsed = now - self.times[oldest]
+        return (self.values[self.index] - self.values[oldest]) / elapsed if elapsed > 0 else 0.0
+
+
+Snapshot = namedtuple('Snapshot', ( 'connections', 'max_connections', 'down_rate', 'up_rate'
+                                  , 'protocol_down_rate', 'protocol_up_rate', 'dht_nodes'
+                                  ))
+'''
+Statistics at a point in time, rates are in bytes per second
+'''
+
+
+class Statistics():
+    '''
+    Transfer counters, rates and gauges for the status bar
+    
+    Network and disk code add to the counters; a timer samples the
+    counters and gauges into an immutable snapshot, which is all that
+    rendering reads.
+    '''
+    
+    def __init__(self, interval = SAMPLE_INTERVAL, window = RATE_WINDOW):
+        '''
+        Constructor
+        
+        @param  interval:float  The number of seconds between samples
+        @param  window:int      The number of samples rates are averaged over
+        '''
+        self.interval = interval
+        self.payload_down = Counter()
+        self.payload_up = Counter()
+        self.protocol_down = Counter()
+        self.protocol_up = Counter()
+        self.meters = [RateMeter(counter, window) for counter in
+                       (self.payload_down, self.payload_up, self.protocol_down, self.protocol_up)]
+        self.gauges = { 'connections'     : lambda : 0
+                      , 'max_connections' : lambda : 0
+                      , 'dht_nodes'       : lambda : 0
+                      }
+        self.snapshot = Snapshot(0, 0, 0.0, 0.0, 0.0, 0.0, 0)
+        self.listeners = []
+        self.timer = None
+        self.running = False
+    
+    
+    def received(self, total, payload = 0):
+        '''
+        Count received bytes
+        
+        @param  total:int    The number of bytes received
+        @param  payload:int  The number of those bytes that were torrent data
+        '''
+        if payload:
+            self.payload_down.add(payload)
+        self.protocol_down.add(total - payload)
+    
+    
+    def sent(self, total, payload = 0):
+        '''
+        Count sent bytes
+        
+        @param  total:int    The number of bytes sent
+        @param  payload:int  The number of those bytes that were torrent data
+        '''
+        if payload:
+            self.payload_up.add(payload)
+        self.protocol_up.add(total - payload)
+    
+    
+    def sample(self):
+        '''
+        Sample all counters and gauges into a new snapshot, and notify listeners
+        '''
+        now = time.monotonic()
+        rates = [meter.sample(now) for meter in self.meters]
+        gauges = self.gauges
+        snapshot = Snapshot(gauges['connections'](), gauges['max_connections'](), rates[0], rates[1],
+                            rates[2], rates[3], gauges['dht_nodes']())
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        if changed:
+            for listener in self.listeners:
+                listener(snapshot)
+    
+    
+    def start(self, loop):
+        '''
+        Sample periodically from an event loop
+        
+        @param  loop:EventLoop  The event loop
+        '''
+        def tick():
+            self.sample()
+            self.timer = loop.call_later(self.interval, tick)
+        self.timer = loop.call_later(self.interval, tick)
+    
+    
+    def start_thread(self):
+        '''
+        Sample periodically from a daemon thread
+        '''
+        def run():
+            while self.running:
+                time.sleep(self.interval)
+                self.sample()
+        self.running = True
+        thread = threading.Thread(target = run)
+        thread.setDaemon(True)
+        thread.start()
+    
+    
+    def stop(self):
+        '''
+        Stop sampling
+        '''
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def scale(rate):
+    '''
+    Select a unit for a rate
+    
+    @param   rate:float               The rate in bytes per second
+    @return  :(value:float, unit:str)  The rate in the unit, and the unit
+    '''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if rate < 1024:
+            return (rate, unit)
+        rate /= 1024
+    return (rate, 'TB')
+
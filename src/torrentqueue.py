@@ -0,0 +1,660 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import threading
+
+from stats import RateMeter, SAMPLE_INTERVAL
+from torrents import STATES
+
+
+DOWNLOADING = 0
+'''
+:int  The kind of torrents that are incomplete
+'''
+
+SEEDING = 1
+'''
+:int  The kind of torrents that are complete
+'''
+
+STATE_DOWNLOADING = STATES.index('Downloading')
+STATE_SEEDING = STATES.index('Seeding')
+STATE_QUEUED = STATES.index('Queued')
+STATE_PAUSED = STATES.index('Paused')
+'''
+:int  Indices in `torrents.STATES`
+'''
+
+SLOW_RATE = 2048
+'''
+:float  Bytes per second, downloaded and uploaded, under which an active torrent is slow
+'''
+
+SLOW_GRACE = 60
+'''
+:float  Seconds after a torrent is started before it can be considered slow
+'''
+
+
+class Transferred():
+    '''
+    Counter of all bytes transferred by a torrent, for a `stats.RateMeter`
+    '''
+    
+    __slots__ = ('torrent',)
+    
+    def __init__(self, torrent):
+        '''
+        Constructor
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        self.torrent = torrent
+    
+    
+    def value(self):
+        '''
+        @return  :int  The number of bytes downloaded and uploaded
+        '''
+        return self.torrent.downloaded + self.torrent.uploaded
+
+
+class Entry():
+    '''
+    A torrent in the queue
+    '''
+    
+    __slots__ = ('torrent', 'position', 'kind', 'key', 'heap', 'index', 'active', 'slow', 'started',
+                 'seeding', 'seeded', 'meter', 'rate', 'stalled')
+    
+    def __init__(self, torrent, position):
+        '''
+        Constructor
+        
+        @param  torrent:Torrent  The torrent
+        @param  position:int     The position in the queue, lower is started first
+        '''
+        self.torrent = torrent
+        self.position = position
+        self.kind = SEEDING if torrent.done >= torrent.size else DOWNLOADING
+        self.key = None
+        self.heap = None
+        self.index = -1
+        self.active = False
+        self.slow = False
+        self.started = 0.0
+        self.seeding = None
+        self.seeded = 0.0
+        self.meter = None
+        self.rate = 0.0
+        self.stalled = False
+    
+    
+    def seed_time(self, now):
+        '''
+        @param   now:float  The current time
+        @return  :float     The number of seconds the torrent has been seeded, in total
+        '''
+        return self.seeded + (0.0 if self.seeding is None else now - self.seeding)
+
+
+class IndexedHeap():
+    '''
+    Binary heap of entries that knows each entry's position, so
+    that any entry can be removed or re-keyed in logarithmic time
+    '''
+    
+    def __init__(self, largest_first = False):
+        '''
+        Constructor
+        
+        @param  largest_first:bool  Whether the root is the entry with the largest key
+        '''
+        self.entries = []
+        self.largest_first = largest_first
+    
+    
+    def __len__(self):
+        '''
+        @return  :int  The number of entries
+        '''
+        return len(self.entries)
+    
+    
+    def before(self, a, b):
+        '''
+        @param   a:Entry  An entry
+        @param   b:Entry  Another entry
+        @return  :bool    Whether `a` belongs closer to the root than `b`
+        '''
+        return (a.key > b.key) if self.largest_first else (a.key < b.key)
+    
+    
+    def peek(self):
+        '''
+        @return  :Entry?  The root, `None` if the heap is empty
+        '''
+        return self.entries[0] if len(self.entries) > 0 else None
+    
+    
+    def push(self, entry):
+        '''
+        Insert an entry
+        
+        @param  entry:Entry  The entry, its `key` must be set
+        '''
+        entry.heap = self
+        entry.index = len(self.entries)
+        self.entries.append(entry)
+        self.sift_up(entry.index)
+    
+    
+    def pop(self):
+        '''
+        Remove the root
+        
+        @return  :Entry  The root
+        '''
+        entry = self.entries[0]
+        self.remove(entry)
+        return entry
+    
+    
+    def remove(self, entry):
+        '''
+        Remove an entry
+        
+        @param  entry:Entry  The entry
+        '''
+        entries, i = self.entries, entry.index
+        last = entries.pop()
+        if last is not entry:
+            entries[i] = last
+            last.index = i
+            self.sift_up(i)
+            self.sift_down(last.index)
+        entry.heap = None
+        entry.index = -1
+    
+    
+    def update(self, entry):
+        '''
+        Restore the heap after an entry's key has changed
+        
+        @param  entry:Entry  The entry
+        '''
+        self.sift_up(entry.index)
+        self.sift_down(entry.index)
+    
+    
+    def sift_up(self, i):
+        '''
+        Move an entry towards the root until the heap is ordered
+        
+        @param  i:int  The entry's index
+        '''
+        entries = self.entries
+        entry = entries[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if not self.before(entry, entries[parent]):
+                break
+            entries[i] = entries[parent]
+            entries[i].index = i
+            i = parent
+        entries[i] = entry
+        entry.index = i
+    
+    
+    def sift_down(self, i):
+        '''
+        Move an entry away from the root until the heap is ordered
+        
+        @param  i:int  The entry's index
+        '''
+        entries, n = self.entries, len(self.entries)
+        entry = entries[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if (child + 1 < n) and self.before(entries[child + 1], entries[child]):
+                child += 1
+            if not self.before(entries[child], entry):
+                break
+            entries[i] = entries[child]
+            entries[i].index = i
+            i = child
+        entries[i] = entry
+        entry.index = i
+
+
+class QueueScheduler():
+    '''
+    Decides which torrents are active, according to the Queue preferences
+    
+    Waiting torrents are kept in a heap with the best first, and
+    counted active torrents in a heap with the worst first, one pair
+    per kind. A change to one torrent only re-keys it and compares the
+    roots, so it costs logarithmic time in the number of torrents.
+    Active torrents that are slow are set aside and not counted against
+    the download and seed limits, but they still count against the
+    total, and the slowest are queued to stay within it. A torrent that
+    was queued for being slow waits behind those that were not, until
+    it is started again, so stalled torrents take turns.
+    '''
+    
+    def __init__(self, preferences, changed = None, finished = None, clock = time.monotonic):
+        '''
+        Constructor
+        
+        @param  preferences:preferences.Snapshot           The preferences
+        @param  changed:(torrent:Torrent)→void?            Called when a torrent is started or queued
+        @param  finished:(torrent:Torrent, remove:bool)→void?  Called when a torrent reaches the share
+                                                           ratio at which it is stopped, and whether it
+                                                           shall be removed
+        @param  clock:()→float                             Function that returns the current time
+        '''
+        self.preferences = preferences
+        self.changed = changed
+        self.finished = finished
+        self.clock = clock
+        self.entries = {}
+        self.waiting = (IndexedHeap(), IndexedHeap())
+        self.active = (IndexedHeap(True), IndexedHeap(True))
+        self.slow = set()
+        self.top = 0
+        self.bottom = -1
+        self.timer = None
+        self.running = False
+        self.lock = threading.RLock()
+    
+    
+    def configure(self, preferences, changed = None):
+        '''
+        Apply new preferences, can be used as a subscriber to the ‘queue’ section
+        
+        @param  preferences:preferences.Snapshot  The preferences
+        @param  changed:set<str>?                 The names of the changed preferences
+        '''
+        self.lock.acquire()
+        try:
+            self.preferences = preferences
+            now = self.clock()
+            for entry in list(self.entries.values()):
+                # Without slow torrents, none wait behind the others for being slow
+                entry.stalled = entry.stalled and preferences.ignore_slow
+                self.rekey(entry, now)
+            if not preferences.ignore_slow:
+                for entry in list(self.slow):
+                    self.set_slow(entry, False)
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def seed_class(self, entry, now):
+        '''
+        Rank a complete torrent, lower is seeded first
+        
+        @param   entry:Entry  The torrent's entry
+        @param   now:float    The current time
+        @return  :int         0 if below the share ratio limit, 2 if past the seed ratio
+                              or time limit, otherwise 1
+        '''
+        p, ratio = self.preferences, entry.torrent.ratio()
+        if ratio < p.share_ratio_limit:
+            return 0
+        if (ratio >= p.seed_ratio_limit) or (entry.seed_time(now) >= 60 * p.seed_time_limit):
+            return 2
+        return 1
+    
+    
+    def rekey(self, entry, now):
+        '''
+        Recalculate an entry's key and its place in its heap
+        
+        @param  entry:Entry  The entry
+        @param  now:float    The current time
+        '''
+        if entry.kind == DOWNLOADING:
+            key = (entry.stalled, entry.position)
+        else:
+            key = (entry.stalled, self.seed_class(entry, now), entry.position)
+        if key != entry.key:
+            entry.key = key
+            if entry.heap is not None:
+                entry.heap.update(entry)
+    
+    
+    def add(self, torrent):
+        '''
+        Queue a torrent, at the top or bottom depending on the preferences
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        self.lock.acquire()
+        try:
+            if self.preferences.queue_to_top:
+                self.top -= 1
+                position = self.top
+            else:
+                self.bottom += 1
+                position = self.bottom
+            entry = self.entries[torrent.info_hash] = Entry(torrent, position)
+            self.rekey(entry, self.clock())
+            self.waiting[entry.kind].push(entry)
+            self.set_state(entry)
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def remove(self, torrent):
+        '''
+        Remove a torrent from the queue, for example when it is paused or deleted
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(torrent.info_hash, None)
+            if entry is None:
+                return
+            if entry.heap is not None:
+                entry.heap.remove(entry)
+            self.slow.discard(entry)
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def move(self, torrent, top):
+        '''
+        Move a torrent to the top or bottom of the queue
+        
+        @param  torrent:Torrent  The torrent
+        @param  top:bool         Whether to move it to the top, rather than the bottom
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries[torrent.info_hash]
+            if top:
+                self.top -= 1
+                entry.position = self.top
+            else:
+                self.bottom += 1
+                entry.position = self.bottom
+            self.rekey(entry, self.clock())
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def update(self, torrent):
+        '''
+        Re-evaluate a torrent after its progress or share ratio has changed
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(torrent.info_hash)
+            if entry is None:
+                return
+            now = self.clock()
+            p = self.preferences
+            kind = SEEDING if torrent.done >= torrent.size else DOWNLOADING
+            if kind != entry.kind:
+                # The torrent completed, or was found to be incomplete when it was rechecked
+                heap = entry.heap
+                if heap is not None:
+                    heap.remove(entry)
+                entry.kind = kind
+                entry.key = None
+                self.rekey(entry, now)
+                if heap is not None:
+                    (self.active if entry.active else self.waiting)[kind].push(entry)
+                self.set_state(entry)
+            else:
+                self.rekey(entry, now)
+            if (kind == SEEDING) and (p.stop_ratio is not None) and (torrent.ratio() >= p.stop_ratio):
+                self.remove(torrent)
+                torrent.state = STATE_PAUSED
+                if self.changed is not None:
+                    self.changed(torrent)
+                if self.finished is not None:
+                    self.finished(torrent, p.remove_at_ratio)
+                return
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def capacity(self, kind):
+        '''
+        @param   kind:int  `DOWNLOADING` or `SEEDING`
+        @return  :int      The number of counted active torrents of the kind that are allowed
+        '''
+        p = self.preferences
+        if kind == DOWNLOADING:
+            return max(min(p.active_downloading, p.active_total), 0)
+        return max(min(p.active_seeding, p.active_total - len(self.active[DOWNLOADING])), 0)
+    
+    
+    def rebalance(self):
+        '''
+        Start and queue torrents until the best torrents are active within the limits
+        '''
+        now = self.clock()
+        for kind in (DOWNLOADING, SEEDING):
+            waiting, active, capacity = self.waiting[kind], self.active[kind], self.capacity(kind)
+            while len(active) > capacity:
+                self.set_active(active.peek(), False, now)
+            while (len(waiting) > 0) and (len(active) < capacity):
+                self.set_active(waiting.peek(), True, now)
+            while (len(waiting) > 0) and (len(active) > 0) and (waiting.peek().key < active.peek().key):
+                self.set_active(active.peek(), False, now)
+                self.set_active(waiting.peek(), True, now)
+        # Slow torrents may only use what the counted torrents leave of the total
+        spare = max(self.preferences.active_total - len(self.active[DOWNLOADING]) - len(self.active[SEEDING]), 0)
+        while len(self.slow) > spare:
+            entry = min(self.slow, key = lambda e : (e.rate, -e.position))
+            self.set_slow(entry, False)
+            entry.stalled = True
+            self.rekey(entry, now)
+            self.set_active(entry, False, now)
+    
+    
+    def set_active(self, entry, active, now):
+        '''
+        Start or queue a torrent
+        
+        @param  entry:Entry   The torrent's entry
+        @param  active:bool   Whether to start it
+        @param  now:float     The current time
+        '''
+        entry.heap.remove(entry)
+        entry.active = active
+        if active and entry.stalled:
+            entry.stalled = False
+            self.rekey(entry, now)
+        (self.active if active else self.waiting)[entry.kind].push(entry)
+        if active:
+            entry.started = now
+            entry.meter = RateMeter(Transferred(entry.torrent))
+            entry.meter.sample(now)
+        self.set_state(entry)
+    
+    
+    def set_slow(self, entry, slow):
+        '''
+        Stop or start counting an active torrent against the limits
+        
+        @param  entry:Entry  The torrent's entry
+        @param  slow:bool    Whether the torrent is slow
+        '''
+        entry.slow = slow
+        if slow:
+            entry.heap.remove(entry)
+            self.slow.add(entry)
+        else:
+            self.slow.discard(entry)
+            self.active[entry.kind].push(entry)
+    
+    
+    def set_state(self, entry):
+        '''
+        Show whether a torrent is active, and track its seeding time
+        
+        @param  entry:Entry  The torrent's entry
+        '''
+        torrent = entry.torrent
+        seeding = entry.active and (entry.kind == SEEDING)
+        if seeding and (entry.seeding is None):
+            entry.seeding = self.clock()
+        elif (not seeding) and (entry.seeding is not None):
+            entry.seeded = entry.seed_time(self.clock())
+            entry.seeding = None
+        if not entry.active:
+            state = STATE_QUEUED
+        else:
+            state = STATE_SEEDING if entry.kind == SEEDING else STATE_DOWNLOADING
+        if torrent.state != state:
+            torrent.state = state
+            if self.changed is not None:
+                self.changed(torrent)
+    
+    
+    def sample(self):
+        '''
+        Measure the active torrents' rates, and re-evaluate which are
+        slow and which seeds have reached their time limit
+        '''
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            ignore_slow = self.preferences.ignore_slow
+            for entry in [e for kind in (DOWNLOADING, SEEDING) for e in self.active[kind].entries] + list(self.slow):
+                rate = entry.rate = entry.meter.sample(now)
+                if entry.kind == SEEDING:
+                    self.rekey(entry, now)
+                slow = ignore_slow and (now - entry.started >= SLOW_GRACE) and (rate < SLOW_RATE)
+                if slow != entry.slow:
+                    self.set_slow(entry, slow)
+            self.rebalance()
+        finally:
+            self.lock.release()
+    
+    
+    def start(self, loop):
+        '''
+        Sample periodically from an event loop
+        
+        @param  loop:EventLoop  The event loop
+        '''
+        def tick():
+            self.sample()
+            self.timer = loop.call_later(SAMPLE_INTERVAL, tick)
+        self.timer = loop.call_later(SAMPLE_INTERVAL, tick)
+    
+    
+    def start_thread(self):
+        '''
+        Sample periodically from a daemon thread
+        '''
+        def run():
+            while self.running:
+                time.sleep(SAMPLE_INTERVAL)
+                self.sample()
+        self.running = True
+        thread = threading.Thread(target = run)
+        thread.setDaemon(True)
+        thread.start()
+    
+    
+    def stop(self):
+        '''
+        Stop sampling
+        '''
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+if __name__ == '__main__':
+    # Benchmark a queue of 50000 torrents with random progress and transfers
+    import os, sys, random
+    from torrents import Torrent
+    from preferences import DEFAULTS
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    now = [0.0]
+    changes = [0]
+    def changed(torrent):
+        changes[0] += 1
+    scheduler = QueueScheduler(DEFAULTS, changed, clock = lambda : now[0])
+    torrents = [Torrent(os.urandom(20), 'torrent %i' % i, 1 << 30) for i in range(count)]
+    for torrent in random.sample(torrents, count // 2):
+        torrent.done = torrent.size
+    start = time.perf_counter()
+    for torrent in torrents:
+        scheduler.add(torrent)
+    print('%i torrents queued in %.0f ms, %i active' %
+          (count, 1000 * (time.perf_counter() - start), sum(map(len, scheduler.active))))
+    
+    updates = 100000
+    start = time.perf_counter()
+    for _i in range(updates):
+        torrent = random.choice(torrents)
+        if torrent.done < torrent.size:
+            torrent.done = min(torrent.done + (1 << 28), torrent.size)
+            torrent.downloaded = torrent.done
+        else:
+            torrent.uploaded += random.randrange(1 << 30)
+        scheduler.update(torrent)
+    elapsed = time.perf_counter() - start
+    print('%.1f µs per update, %i state changes' % (1e6 * elapsed / updates, changes[0]))
+    
+    start = time.perf_counter()
+    for _i in range(100):
+        now[0] += SAMPLE_INTERVAL
+        for heap in scheduler.active:
+            for entry in random.sample(heap.entries, len(heap.entries) // 2):
+                entry.torrent.uploaded += 1 << 20
+        scheduler.sample()
+    print('%.1f µs per sample, %i active of which %i slow' % (1e4 * (time.perf_counter() - start),
+                                                                sum(map(len, scheduler.active)) + len(scheduler.slow),
+                                                                len(scheduler.slow)))
+    
+    # An hour with thousands of stalled downloads, which take turns within the total
+    scheduler = QueueScheduler(DEFAULTS, clock = lambda : now[0])
+    stalled = [Torrent(os.urandom(20), 'stalled %i' % i, 1 << 30) for i in range(2000)]
+    for torrent in stalled:
+        scheduler.add(torrent)
+    tried = set()
+    for _i in range(3600):
+        now[0] += SAMPLE_INTERVAL
+        scheduler.sample()
+        active = sum(map(len, scheduler.active)) + len(scheduler.slow)
+        assert active <= DEFAULTS.active_total, '%i torrents active' % active
+        tried.update(entry.torrent.info_hash for entry in scheduler.active[DOWNLOADING].entries)
+    print('%i stalled torrents: at most %i active, %i were tried in an hour' %
+          (len(stalled), DEFAULTS.active_total, len(tried)))
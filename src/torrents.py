@@ -0,0 +1,429 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+
+from stats import scale
+from layout import fit
+
+_ = lambda x : x
+
+
+STATES = [ _('Downloading')
+         , _('Seeding')
+         , _('Queued')
+         , _('Paused')
+         , _('Checking')
+         , _('Error')
+         ]
+'''
+:list<str>  The states a torrent can be in
+'''
+
+SORT_COLUMNS = ('name', 'state', 'ratio', 'speed')
+'''
+:tuple<str>  The columns the list can be sorted by
+'''
+
+
+class Torrent():
+    '''
+    A torrent and its current statistics
+    '''
+    
+    __slots__ = ( 'number', 'info_hash', 'name', 'state', 'size', 'done'
+                , 'downloaded', 'uploaded', 'down_rate', 'up_rate', 'version'
+                )
+    
+    def __init__(self, info_hash, name, size, state = 0):
+        '''
+        Constructor
+        
+        @param  info_hash:bytes  The torrent's infohash
+        @param  name:str         The torrent's name
+        @param  size:int         The size of the torrent's payload
+        @param  state:int        The torrent's state, an index in `STATES`
+        '''
+        self.number = -1
+        self.info_hash = info_hash
+        self.name = name
+        self.state = state
+        self.size = size
+        self.done = 0
+        self.downloaded = 0
+        self.uploaded = 0
+        self.down_rate = 0.0
+        self.up_rate = 0.0
+        self.version = 0
+    
+    
+    def ratio(self):
+        '''
+        @return  :float  The share ratio
+        '''
+        return self.uploaded / max(self.downloaded, self.done, 1)
+
+
+def sort_key(torrent, column):
+    '''
+    Create a torrent's position key in a sorted index
+    
+    @param   torrent:Torrent  The torrent
+    @param   column:str       The column to sort by, an element in `SORT_COLUMNS`
+    @return  :tuple           The key
+    '''
+    if column == 'name':
+        key = torrent.name.casefold()
+    elif column == 'state':
+        key = torrent.state
+    elif column == 'ratio':
+        key = -torrent.ratio()
+    else:
+        key = -(torrent.down_rate + torrent.up_rate)
+    return (key, torrent.number)
+
+
+class SortedIndex():
+    '''
+    Torrents in a state sorted by a column, updated one torrent at a time
+    '''
+    
+    def __init__(self, column, state_filter, torrents):
+        '''
+        Constructor
+        
+        @param  column:str             The column to sort by
+        @param  state_filter:int?      The state of the indexed torrents, `None` for all
+        @param  torrents:itr<Torrent>  The torrents
+        '''
+        self.column = column
+        self.state_filter = state_filter
+        self.keys = {t.number : sort_key(t, column) for t in torrents if self.includes(t)}
+        self.entries = sorted(self.keys.values())
+    
+    
+    def __len__(self):
+        '''
+        @return  :int  The number of indexed torrents
+        '''
+        return len(self.entries)
+    
+    
+    def subset(self, state_filter, torrents):
+        '''
+        Create the index of the torrents in a state by walking this index,
+        which must include all torrents, so nothing has to be sorted
+        
+        @param   state_filter:int             The state
+        @param   torrents:dict<int, Torrent>  The torrents by number
+        @return  :SortedIndex                 The index of the torrents in the state
+        '''
+        index = SortedIndex(self.column, state_filter, ())
+        index.entries = [key for key in self.entries if torrents[key[-1]].state == state_filter]
+        index.keys = {key[-1] : key for key in index.entries}
+        return index
+    
+    
+    def includes(self, torrent):
+        '''
+        Check whether a torrent belongs in the index
+        
+        @param   torrent:Torrent  The torrent
+        @return  :bool            Whether the torrent is in the index's state
+        '''
+        return (self.state_filter is None) or (torrent.state == self.state_filter)
+    
+    
+    def insert(self, torrent):
+        '''
+        Add a torrent, if it is in the index's state
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        if self.includes(torrent):
+            key = self.keys[torrent.number] = sort_key(torrent, self.column)
+            bisect.insort(self.entries, key)
+    
+    
+    def remove(self, torrent):
+        '''
+        Remove a torrent, if it is in the index
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        key = self.keys.pop(torrent.number, None)
+        if key is not None:
+            del self.entries[bisect.bisect_left(self.entries, key)]
+    
+    
+    def update(self, torrent):
+        '''
+        Move a torrent whose statistics have changed, adding or removing
+        it if it has entered or left the index's state
+        
+        @param   torrent:Torrent  The torrent
+        @return  :bool            Whether the torrent moved
+        '''
+        key = sort_key(torrent, self.column) if self.includes(torrent) else None
+        if key == self.keys.get(torrent.number):
+            return False
+        self.remove(torrent)
+        self.insert(torrent)
+        return True
+    
+    
+    def position(self, number):
+        '''
+        Find a torrent in the index
+        
+        @param   number:int  The torrent's number
+        @return  :int        The torrent's position
+        '''
+        return bisect.bisect_left(self.entries, self.keys[number])
+
+
+class TorrentList():
+    '''
+    Virtualized list of torrents for the Torrents tab
+    
+    Only rows inside the viewport are formatted, and formatted rows
+    are cached until their torrent changes. There is a sort index for
+    each column and state filter, they are built when first used and
+    then updated incrementally as torrents change, so changing back to
+    a column or filter is free.
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.torrents = {}
+        self.next_number = 0
+        self.column = 'name'
+        self.state_filter = None
+        self.indexes = {}
+        self.rows = {}
+        self.selected = None
+        self.top = 0
+    
+    
+    def index(self, column = None):
+        '''
+        Get a sort index, building it if necessary
+        
+        @param   column:str?    The column, the current sort column by default
+        @return  :SortedIndex   The index of the torrents that match the current filter
+        '''
+        key = (column or self.column, self.state_filter)
+        if key not in self.indexes:
+            everything = self.indexes.get((key[0], None))
+            if everything is not None:
+                self.indexes[key] = everything.subset(key[1], self.torrents)
+            else:
+                self.indexes[key] = SortedIndex(key[0], key[1], self.torrents.values())
+        return self.indexes[key]
+    
+    
+    def add(self, torrent):
+        '''
+        Add a torrent
+        
+        A torrent that is already numbered keeps its number, so that
+        several lists can show the same torrents, as long as they are
+        numbered by one owner
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        if torrent.number < 0:
+            torrent.number = self.next_number
+        self.next_number = max(self.next_number, torrent.number + 1)
+        self.torrents[torrent.number] = torrent
+        for index in self.indexes.values():
+            index.insert(torrent)
+        if self.selected is None:
+            self.selected = torrent.number
+    
+    
+    def remove(self, torrent):
+        '''
+        Remove a torrent
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        if self.selected == torrent.number:
+            self.move(1)
+            if self.selected == torrent.number:
+                self.move(-1)
+            if self.selected == torrent.number:
+                self.selected = None
+        del self.torrents[torrent.number]
+        self.rows.pop(torrent.number, None)
+        for index in self.indexes.values():
+            index.remove(torrent)
+    
+    
+    def changed(self, torrent):
+        '''
+        Update the list after a torrent's statistics have changed
+        
+        @param  torrent:Torrent  The torrent
+        '''
+        torrent.version += 1
+        self.rows.pop(torrent.number, None)
+        for index in self.indexes.values():
+            index.update(torrent)
+    
+    
+    def set_sort(self, column):
+        '''
+        Sort by another column
+        
+        @param  column:str  The column, an element in `SORT_COLUMNS`
+        '''
+        self.column = column
+    
+    
+    def set_filter(self, state_filter):
+        '''
+        Only show torrents in a specific state
+        
+        @param  state_filter:int?  The state, `None` for all
+        '''
+        if state_filter != self.state_filter:
+            self.state_filter = state_filter
+            self.top = 0
+            index = self.index()
+            if (self.selected is not None) and (self.selected not in index.keys):
+                self.selected = index.entries[0][-1] if len(index) > 0 else None
+    
+    
+    def __len__(self):
+        '''
+        @return  :int  The number of torrents shown
+        '''
+        return len(self.index())
+    
+    
+    def move(self, delta):
+        '''
+        Move the selection
+        
+        @param  delta:int  The number of rows to move, negative for up
+        '''
+        index = self.index()
+        if len(index) == 0:
+            self.selected = None
+            return
+        position = 0 if (self.selected not in index.keys) else index.position(self.selected)
+        position = min(max(position + delta, 0), len(index) - 1)
+        self.selected = index.entries[position][-1]
+    
+    
+    def format_row(self, torrent, width):
+        '''
+        Format a torrent as a row
+        
+        @param   torrent:Torrent  The torrent
+        @param   width:int        The width of the row
+        @return  :str             The row, exactly `width` columns wide
+        '''
+        columns = ' %-11s %5.1f%% %6.2f %8s %8s' % ( STATES[torrent.state][:11]
+                                                    , 100 * torrent.done / max(torrent.size, 1)
+                                                    , torrent.ratio()
+                                                    , '%.1f %s' % scale(torrent.down_rate)
+                                                    , '%.1f %s' % scale(torrent.up_rate)
+                                                    )
+        if len(columns) + 10 > width:
+            columns = ''
+        return fit(fit(torrent.name, width - len(columns)) + columns, width)
+    
+    
+    def render(self, height, width):
+        '''
+        Get the rows inside the viewport
+        
+        @param   height:int                   The number of rows in the viewport
+        @param   width:int                    The width of the viewport
+        @return  :list<(row:str, selected:bool)>  The rows
+        '''
+        index = self.index()
+        if self.selected in index.keys:
+            position = index.position(self.selected)
+            # Scroll only as much as needed to keep the selection visible
+            if position < self.top:
+                self.top = position
+            elif position >= self.top + height:
+                self.top = position - height + 1
+        self.top = max(min(self.top, len(index) - height), 0)
+        rc = []
+        for key in index.entries[self.top : self.top + height]:
+            number = key[-1]
+            row = self.rows.get(number)
+            if (row is None) or (row[0] != width):
+                row = self.rows[number] = (width, self.format_row(self.torrents[number], width))
+            rc.append((row[1], number == self.selected))
+        return rc
+
+
+if __name__ == '__main__':
+    # Benchmark sorting, updating, scrolling and rendering a large list
+    import os, sys, time, random
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    (height, width) = (40, 160)
+    view = TorrentList()
+    torrents = [Torrent(os.urandom(20), 'torrent %i' % random.randrange(1 << 30), random.randrange(1 << 34),
+                        random.randrange(len(STATES))) for _ in range(count)]
+    start = time.perf_counter()
+    for torrent in torrents:
+        view.add(torrent)
+    for column in SORT_COLUMNS:
+        view.index(column)
+    print('%i torrents: added and indexed by %i columns in %.1f ms' %
+          (count, len(SORT_COLUMNS), 1000 * (time.perf_counter() - start)))
+    
+    def frame():
+        for torrent in random.sample(torrents, 100):
+            torrent.down_rate = random.random() * (1 << 20)
+            torrent.uploaded += random.randrange(1 << 20)
+            view.changed(torrent)
+        view.move(random.randrange(-30, 30))
+        return view.render(height, width)
+    
+    for column in SORT_COLUMNS:
+        view.set_sort(column)
+        start = time.perf_counter()
+        for _ in range(100):
+            frame()
+        print('sorted by %-5s: %.2f ms per frame with 100 changed torrents, scrolling and rendering' %
+              (column, 10 * (time.perf_counter() - start)))
+    start = time.perf_counter()
+    view.set_filter(1)
+    view.render(height, width)
+    print('first filter change: %.1f ms' % (1000 * (time.perf_counter() - start)))
+    for _ in range(10):
+        frame()
+    start = time.perf_counter()
+    view.set_filter(None)
+    view.render(height, width)
+    view.set_filter(1)
+    view.render(height, width)
+    print('filter changes back and forth: %.3f ms' % (1000 * (time.perf_counter() - start)))
+    expected = sorted(sort_key(t, view.column) for t in torrents if t.state == 1)
+    assert view.index().entries == expected, 'filtered index is out of order'
+
@@ -0,0 +1,1215 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import heapq
+import errno
+import random
+import socket
+import struct
+from collections import deque
+from urllib.parse import urlsplit, quote_from_bytes
+
+import instrument
+from bencode import BencodeError, decode
+
+_ = lambda x : x
+
+
+UDP_PROTOCOL_ID = 0x41727101980
+'''
+:int  The magic number in UDP tracker connect requests, see BEP 15
+'''
+
+ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE, ACTION_ERROR = range(4)
+'''
+:int  UDP tracker actions
+'''
+
+EVENTS = { None : 0, 'completed' : 1, 'started' : 2, 'stopped' : 3 }
+'''
+:dict<str?, int>  UDP tracker event codes by event
+'''
+
+MAX_SCRAPE = 74
+'''
+:int  The maximum number of infohashes in one scrape request
+'''
+
+CONNECTION_LIFETIME = 60
+'''
+:float  Seconds a UDP tracker connection ID may be used
+'''
+
+UDP_TIMEOUT = 15
+'''
+:float  Seconds before the first retransmission of a UDP request, doubled for each retry
+'''
+
+UDP_RETRIES = 3
+'''
+:int  The number of times a UDP request is retransmitted before it fails
+'''
+
+HTTP_TIMEOUT = 30
+'''
+:float  Seconds before an HTTP request fails
+'''
+
+MAX_CONCURRENT = { 'udp' : 32, 'http' : 4 }
+'''
+:dict<str, int>  The maximum number of concurrent requests per tracker, by scheme;
+                 for HTTP this is also the number of kept-alive connections
+'''
+
+DEFAULT_INTERVAL = 30 * 60
+MIN_INTERVAL = 60
+'''
+:float  Announce intervals used when the tracker does not give one, and the shortest accepted
+'''
+
+JITTER = 0.1
+'''
+:float  Announce times are spread randomly by up to this fraction of the interval
+'''
+
+STARTUP_SPREAD = 5 * 60
+'''
+:float  Seconds over which the first announces of torrents added at the same time are spread
+'''
+
+RETRY_BASE = 60
+MAX_RETRY = 60 * 60
+'''
+:float  Delay after the first failure, doubled for each failure up to the maximum
+'''
+
+SCRAPE_INTERVAL = 15 * 60
+'''
+:float  Seconds between scrapes of all torrents on a tracker
+'''
+
+REQUESTS = instrument.counter('trackers.requests', 'Announces and scrapes sent to trackers')
+FAILURES = instrument.counter('trackers.failures', 'Announces that failed')
+'''
+:Counter  Tracker requests, and failed announces
+'''
+
+
+class Status():
+    '''
+    A torrent on a tracker
+    '''
+    
+    __slots__ = ('tracker', 'info_hash', 'seeders', 'leechers', 'completed', 'interval', 'due', 'event',
+                 'working', 'fails', 'message')
+    
+    def __init__(self, tracker, info_hash):
+        '''
+        Constructor
+        
+        @param  tracker:Tracker  The tracker
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        self.tracker = tracker
+        self.info_hash = info_hash
+        self.seeders = self.leechers = self.completed = 0
+        self.interval = DEFAULT_INTERVAL
+        self.due = None
+        self.event = 'started'
+        self.working = None
+        self.fails = 0
+        self.message = ''
+
+
+class Tracker():
+    '''
+    A tracker, and its queue of requests
+    
+    Requests are announces of one torrent or scrapes of up to
+    `MAX_SCRAPE` torrents; at most `MAX_CONCURRENT` run at a time.
+    '''
+    
+    def __init__(self, pool, url):
+        '''
+        Constructor
+        
+        @param  pool:TrackerPool  The pool
+        @param  url:str           The announce URL
+        '''
+        self.pool = pool
+        self.url = url
+        self.parts = urlsplit(url)
+        self.address = None
+        self.resolve_after = 0.0
+        self.statuses = {}
+        self.pending = deque()
+        self.in_flight = 0
+        self.limit = MAX_CONCURRENT.get(self.parts.scheme, 4)
+        self.requests = 0
+        self.working = 0
+        self.failing = 0
+        self.seeders = 0
+        self.leechers = 0
+        self.message = ''
+    
+    
+    def resolve(self):
+        '''
+        Look up the tracker's address, once it has been found
+        
+        @return  :(host:str, port:int)?  The address, `None` if it cannot be resolved
+        '''
+        if (self.address is None) and (self.pool.clock() >= self.resolve_after):
+            default = 80 if self.parts.scheme == 'http' else 0
+            try:
+                info = socket.getaddrinfo(self.parts.hostname, self.parts.port or default, socket.AF_INET)
+                self.address = info[0][4]
+            except (OSError, UnicodeError, ValueError) as e:
+                # Failures are remembered so the lookup is not repeated for every torrent
+                self.message = str(e)
+                self.resolve_after = self.pool.clock() + RETRY_BASE
+        return self.address
+    
+    
+    def submit(self, kind, statuses):
+        '''
+        Queue a request
+        
+        @param  kind:str                `announce` or `scrape`
+        @param  statuses:list<Status>   The torrents, one for announces
+        '''
+        REQUESTS.add()
+        self.pending.append((kind, statuses, 0))
+        self.pump()
+    
+    
+    def finish(self):
+        '''
+        Note that a request has completed, and start the next
+        '''
+        self.in_flight -= 1
+        self.pump()
+    
+    
+    def fail_all(self, message):
+        '''
+        Fail all queued requests
+        
+        @param  message:str  The reason
+        '''
+        while len(self.pending) > 0:
+            (kind, statuses, _attempt) = self.pending.popleft()
+            self.pool.failed(kind, statuses, message)
+    
+    
+    def pump(self):
+        '''
+        Start queued requests while there is capacity
+        '''
+        raise NotImplementedError()
+    
+    
+    def close(self):
+        '''
+        Cancel all requests and close all sockets
+        '''
+        self.pending.clear()
+
+
+class UDPTracker(Tracker):
+    '''
+    A tracker speaking the UDP tracker protocol
+    
+    The connection ID is reused for every request until it expires,
+    and scrapes carry up to `MAX_SCRAPE` infohashes per packet.
+    '''
+    
+    def __init__(self, pool, url):
+        '''
+        Constructor
+        
+        @param  pool:TrackerPool  The pool
+        @param  url:str           The announce URL
+        '''
+        Tracker.__init__(self, pool, url)
+        self.sock = None
+        self.connection_id = None
+        self.connection_expires = 0.0
+        self.connecting = None
+        self.transactions = {}
+        self.packets = 0
+        self.connects = 0
+    
+    
+    def open(self):
+        '''
+        Create the socket, if it has not been created
+        
+        @return  :bool  Whether the socket is ready
+        '''
+        if self.sock is None:
+            if self.resolve() is None:
+                return False
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.sock.connect(self.address)
+            self.pool.loop.add_reader(self.sock.fileno(), self.read_ready)
+        return True
+    
+    
+    def transaction(self):
+        '''
+        @return  :int  A new, unused transaction ID
+        '''
+        while True:
+            tid = random.getrandbits(32)
+            if (tid not in self.transactions) and (tid != self.connecting):
+                return tid
+    
+    
+    def send(self, packet):
+        '''
+        Send a packet
+        
+        @param  packet:bytes  The packet
+        '''
+        self.packets += 1
+        try:
+            self.sock.send(packet)
+        except OSError:
+            pass
+    
+    
+    def pump(self):
+        if not self.open():
+            self.fail_all(self.message)
+            return
+        now = self.pool.clock()
+        if (self.connection_id is None) or (now >= self.connection_expires):
+            self.connection_id = None
+            if (self.connecting is None) and (len(self.pending) > 0):
+                self.connect(0)
+            return
+        while (len(self.pending) > 0) and (self.in_flight < self.limit):
+            (kind, statuses, attempt) = self.pending.popleft()
+            self.in_flight += 1
+            self.requests += 1
+            self.request(self.transaction(), kind, statuses, attempt)
+    
+    
+    def connect(self, attempt):
+        '''
+        Request a connection ID
+        
+        @param  attempt:int  The number of previous attempts
+        '''
+        tid = self.connecting = self.transaction()
+        self.connects += 1
+        self.transactions[tid] = (None, None, attempt, self.pool.loop.call_later(UDP_TIMEOUT * 2 ** attempt, self.timeout, tid))
+        self.send(struct.pack('>QII', UDP_PROTOCOL_ID, ACTION_CONNECT, tid))
+    
+    
+    def request(self, tid, kind, statuses, attempt):
+        '''
+        Send an announce or scrape
+        
+        @param  tid:int                 The transaction ID
+        @param  kind:str                `announce` or `scrape`
+        @param  statuses:list<Status>   The torrents
+        @param  attempt:int             The number of previous attempts
+        '''
+        timer = self.pool.loop.call_later(UDP_TIMEOUT * 2 ** attempt, self.timeout, tid)
+        self.transactions[tid] = (kind, statuses, attempt, timer)
+        if kind == 'scrape':
+            self.send(struct.pack('>QII', self.connection_id, ACTION_SCRAPE, tid) +
+                      b''.join(status.info_hash for status in statuses))
+        else:
+            status = statuses[0]
+            (downloaded, left, uploaded) = self.pool.progress(status.info_hash)
+            self.send(struct.pack('>QII20s20sQQQIIIiH', self.connection_id, ACTION_ANNOUNCE, tid,
+                                  status.info_hash, self.pool.peer_id, downloaded, left, uploaded,
+                                  EVENTS[status.event], 0, self.pool.key, -1, self.pool.port))
+    
+    
+    def timeout(self, tid):
+        '''
+        Retransmit or give up on a request
+        
+        @param  tid:int  The transaction ID
+        '''
+        (kind, statuses, attempt, _timer) = self.transactions.pop(tid)
+        if kind is None:
+            self.connecting = None
+            if attempt + 1 < UDP_RETRIES:
+                self.connect(attempt + 1)
+            else:
+                self.message = _('Connection timed out')
+                self.fail_all(self.message)
+        elif attempt + 1 < UDP_RETRIES:
+            # The connection ID may have expired at the tracker
+            self.connection_id = None
+            self.pending.appendleft((kind, statuses, attempt + 1))
+            self.in_flight -= 1
+            self.pump()
+        else:
+            self.pool.failed(kind, statuses, _('Request timed out'))
+            self.finish()
+    
+    
+    def read_ready(self):
+        '''
+        Receive and handle all pending datagrams
+        '''
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if len(data) < 8:
+                continue
+            (action, tid) = struct.unpack_from('>II', data)
+            transaction = self.transactions.pop(tid, None)
+            if transaction is None:
+                continue
+            (kind, statuses, _attempt, timer) = transaction
+            timer.cancel()
+            try:
+                self.handle(action, data, kind, statuses)
+            except struct.error:
+                if kind is None:
+                    self.connecting = None
+                    self.message = _('Malformed response')
+                    self.fail_all(self.message)
+                else:
+                    self.pool.failed(kind, statuses, _('Malformed response'))
+                    self.finish()
+    
+    
+    def handle(self, action, data, kind, statuses):
+        '''
+        Handle a response
+        
+        @param  action:int              The action of the response
+        @param  data:bytes              The response
+        @param  kind:str?               `announce`, `scrape`, or `None` for connect
+        @param  statuses:list<Status>?  The torrents of the request
+        '''
+        if action == ACTION_ERROR:
+            message = data[8:].decode('utf-8', 'replace')
+            if kind is None:
+                self.connecting = None
+                self.message = message
+                self.fail_all(message)
+            else:
+                self.pool.failed(kind, statuses, message)
+                self.finish()
+        elif kind is None:
+            self.connection_id = struct.unpack_from('>Q', data, 8)[0]
+            self.connection_expires = self.pool.clock() + CONNECTION_LIFETIME
+            self.connecting = None
+            self.pump()
+        elif kind == 'announce':
+            (interval, leechers, seeders) = struct.unpack_from('>III', data, 8)
+            peers = [(socket.inet_ntoa(data[i : i + 4]), struct.unpack_from('>H', data, i + 4)[0])
+                     for i in range(20, len(data) - 5, 6)]
+            self.pool.announced(statuses[0], interval, seeders, leechers, peers)
+            self.finish()
+        else:
+            for (i, status) in enumerate(statuses):
+                (seeders, completed, leechers) = struct.unpack_from('>III', data, 8 + 12 * i)
+                self.pool.scraped(status, seeders, completed, leechers)
+            self.finish()
+    
+    
+    def close(self):
+        Tracker.close(self)
+        for (_kind, _statuses, _attempt, timer) in self.transactions.values():
+            timer.cancel()
+        self.transactions.clear()
+        if self.sock is not None:
+            self.pool.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+
+class HTTPConnection():
+    '''
+    A kept-alive connection to an HTTP tracker, running one request at a time
+    
+    When the pool's connector has a proxy the connection is opened
+    through it, and the tracker's host name is resolved by the proxy.
+    '''
+    
+    def __init__(self, tracker):
+        '''
+        Constructor
+        
+        @param  tracker:HTTPTracker  The tracker
+        '''
+        self.tracker = tracker
+        self.loop = tracker.pool.loop
+        self.connected = False
+        self.request = None
+        self.out = b''
+        self.buffer = bytearray()
+        self.timer = None
+        connector = tracker.pool.connector
+        self.forwarding = (connector is not None) and connector.forwarding
+        self.authorization = connector.proxy.authorization() if self.forwarding else ''
+        if (connector is not None) and (connector.proxy is not None):
+            self.sock = None
+            connector.connect((tracker.parts.hostname, tracker.parts.port or 80), self.opened)
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.fd = self.sock.fileno()
+        error = self.sock.connect_ex(tracker.address)
+        if error not in (0, errno.EINPROGRESS):
+            raise OSError(error, os.strerror(error))
+        self.loop.add_writer(self.fd, self.write_ready)
+    
+    
+    def opened(self, sock, error):
+        '''
+        Called when the connection through the proxy is open or has failed
+        
+        @param  sock:socket?  The socket
+        @param  error:str?    Why the connection failed
+        '''
+        if self not in self.tracker.connections:
+            if sock is not None:
+                sock.close()
+            return
+        if sock is None:
+            self.fail(error)
+            return
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.write_ready()
+    
+    
+    def start(self, kind, statuses, path):
+        '''
+        Send a request
+        
+        @param  kind:str                `announce` or `scrape`
+        @param  statuses:list<Status>   The torrents
+        @param  path:str                The path and query of the request
+        '''
+        self.request = (kind, statuses)
+        host = self.tracker.parts.netloc
+        if self.forwarding:
+            # HTTP proxies are sent the whole URL
+            path = '%s://%s%s' % (self.tracker.parts.scheme, host, path)
+        self.out = ('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: tirek\r\nAccept-Encoding: identity\r\n'
+                    '%sConnection: keep-alive\r\n\r\n' % (path, host, self.authorization)).encode('ascii')
+        self.timer = self.loop.call_later(HTTP_TIMEOUT, self.fail, _('Request timed out'))
+        if self.connected:
+            self.write_ready()
+    
+    
+    def write_ready(self):
+        '''
+        Complete the connection, or send more of the request
+        '''
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                self.fail(os.strerror(error))
+                return
+            self.connected = True
+            self.loop.add_reader(self.fd, self.read_ready)
+        try:
+            sent = self.sock.send(self.out) if len(self.out) > 0 else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            self.fail(str(e))
+            return
+        self.out = self.out[sent:]
+        if len(self.out) > 0:
+            self.loop.add_writer(self.fd, self.write_ready)
+        else:
+            self.loop.remove_writer(self.fd)
+            if self.request is None:
+                self.tracker.idle(self)
+    
+    
+    def read_ready(self):
+        '''
+        Receive more of the response
+        '''
+        try:
+            data = self.sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.fail(str(e))
+            return
+        if len(data) == 0:
+            # A response without a length ends when the connection is closed
+            if (self.request is None) or not self.parse(True):
+                self.fail(_('Connection closed by tracker'))
+            return
+        self.buffer += data
+        self.parse(False)
+    
+    
+    def parse(self, closed):
+        '''
+        Handle the response if it is complete
+        
+        @param   closed:bool  Whether the tracker has closed the connection
+        @return  :bool        Whether a response was handled
+        '''
+        buf = self.buffer
+        end = buf.find(b'\r\n\r\n')
+        if end < 0:
+            return False
+        lines = bytes(buf[:end]).decode('latin-1').split('\r\n')
+        headers = dict((name.strip().lower(), value.strip()) for (name, _sep, value) in
+                       (line.partition(':') for line in lines[1:]))
+        status = lines[0].split(' ', 2)
+        pos = end + 4
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                line_end = buf.find(b'\r\n', pos)
+                if line_end < 0:
+                    return False
+                size = int(bytes(buf[pos : line_end]).split(b';')[0], 16)
+                if len(buf) < line_end + 2 + size + 2:
+                    return False
+                body += buf[line_end + 2 : line_end + 2 + size]
+                pos = line_end + 2 + size + 2
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if len(buf) < pos + length:
+                return False
+            body = buf[pos : pos + length]
+            pos += length
+        elif closed:
+            body = buf[pos:]
+            pos = len(buf)
+        else:
+            return False
+        del buf[:pos]
+        (kind, statuses) = self.request
+        self.request = None
+        self.timer.cancel()
+        keep_alive = not closed and (headers.get('connection', '').lower() != 'close')
+        if (len(status) < 2) or (status[1] != '200'):
+            self.tracker.pool.failed(kind, statuses, ' '.join(status[1:]))
+        else:
+            self.tracker.handle(kind, statuses, bytes(body))
+        if keep_alive:
+            self.tracker.idle(self)
+        else:
+            self.close()
+            self.tracker.finish()
+        return True
+    
+    
+    def fail(self, message):
+        '''
+        Close the connection and fail its request
+        
+        @param  message:str  The reason
+        '''
+        request = self.request
+        busy = self not in self.tracker.idle_connections
+        self.request = None
+        self.close()
+        if request is not None:
+            self.tracker.pool.failed(request[0], request[1], message)
+        elif not self.connected:
+            # Do not reconnect over and over to an unreachable tracker
+            self.tracker.message = message
+            self.tracker.fail_all(message)
+        if busy:
+            self.tracker.finish()
+    
+    
+    def close(self):
+        '''
+        Close the connection
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sock is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.sock.close()
+            self.sock = None
+        self.tracker.connections.discard(self)
+        self.tracker.idle_connections.discard(self)
+
+
+class HTTPTracker(Tracker):
+    '''
+    A tracker speaking HTTP
+    
+    Up to `MAX_CONCURRENT` connections are kept alive and reused,
+    and scrapes ask for up to `MAX_SCRAPE` infohashes at once.
+    '''
+    
+    def __init__(self, pool, url):
+        '''
+        Constructor
+        
+        @param  pool:TrackerPool  The pool
+        @param  url:str           The announce URL
+        '''
+        Tracker.__init__(self, pool, url)
+        self.connections = set()
+        self.idle_connections = set()
+        self.opened = 0
+        path = self.parts.path or '/'
+        (head, _sep, last) = path.rpartition('/')
+        self.scrape_path = (head + '/' + last.replace('announce', 'scrape', 1)) if last.startswith('announce') else None
+    
+    
+    def path(self, kind, statuses):
+        '''
+        Create the path and query of a request
+        
+        @param   kind:str                `announce` or `scrape`
+        @param   statuses:list<Status>   The torrents
+        @return  :str                    The path and query
+        '''
+        query = [self.parts.query] if self.parts.query else []
+        if kind == 'scrape':
+            query += ['info_hash=' + quote_from_bytes(status.info_hash, safe = '') for status in statuses]
+            return '%s?%s' % (self.scrape_path, '&'.join(query))
+        status, pool = statuses[0], self.pool
+        (downloaded, left, uploaded) = pool.progress(status.info_hash)
+        query += [ 'info_hash=' + quote_from_bytes(status.info_hash, safe = '')
+                 , 'peer_id=' + quote_from_bytes(pool.peer_id, safe = '')
+                 , 'port=%i' % pool.port
+                 , 'uploaded=%i' % uploaded
+                 , 'downloaded=%i' % downloaded
+                 , 'left=%i' % left
+                 , 'compact=1'
+                 , 'key=%08x' % pool.key
+                 ]
+        if status.event is not None:
+            query.append('event=' + status.event)
+        return '%s?%s' % (self.parts.path or '/', '&'.join(query))
+    
+    
+    def submit(self, kind, statuses):
+        if (kind == 'scrape') and (self.scrape_path is None):
+            return
+        Tracker.submit(self, kind, statuses)
+    
+    
+    def pump(self):
+        connector = self.pool.connector
+        proxied = (connector is not None) and (connector.proxy is not None)
+        if not proxied and (self.resolve() is None):
+            self.fail_all(self.message)
+            return
+        while (len(self.pending) > 0) and (len(self.idle_connections) > 0):
+            connection = self.idle_connections.pop()
+            (kind, statuses, _attempt) = self.pending.popleft()
+            self.in_flight += 1
+            self.requests += 1
+            connection.start(kind, statuses, self.path(kind, statuses))
+        # Connections that are being established will take a queued request each
+        connecting = sum(1 for connection in self.connections if not connection.connected)
+        while (len(self.pending) > connecting) and (len(self.connections) < self.limit):
+            try:
+                connection = HTTPConnection(self)
+            except OSError as e:
+                self.message = str(e)
+                self.fail_all(self.message)
+                return
+            self.opened += 1
+            self.connections.add(connection)
+            self.in_flight += 1
+            connecting += 1
+    
+    
+    def idle(self, connection):
+        '''
+        Give a connection its next request, or keep it for later
+        
+        @param  connection:HTTPConnection  A connection without a request
+        '''
+        if len(self.pending) > 0:
+            (kind, statuses, _attempt) = self.pending.popleft()
+            self.requests += 1
+            connection.start(kind, statuses, self.path(kind, statuses))
+        else:
+            self.in_flight -= 1
+            self.idle_connections.add(connection)
+    
+    
+    def handle(self, kind, statuses, body):
+        '''
+        Handle a response body
+        
+        @param  kind:str                `announce` or `scrape`
+        @param  statuses:list<Status>   The torrents
+        @param  body:bytes              The bencoded response
+        '''
+        try:
+            # Malformed bodies, including ones nested deeply to exhaust the stack, raise BencodeError
+            response = decode(body)
+            if b'failure reason' in response:
+                self.pool.failed(kind, statuses, bytes(response[b'failure reason']).decode('utf-8', 'replace'))
+            elif kind == 'scrape':
+                files = response.get(b'files', {})
+                for status in statuses:
+                    entry = files.get(status.info_hash)
+                    if entry is not None:
+                        self.pool.scraped(status, entry.get(b'complete', 0), entry.get(b'downloaded', 0),
+                                          entry.get(b'incomplete', 0))
+            else:
+                peers = response.get(b'peers', b'')
+                if isinstance(peers, list):
+                    peers = [(bytes(peer[b'ip']).decode('ascii', 'replace'), peer[b'port']) for peer in peers
+                             if isinstance(peer[b'port'], int) and (0 < peer[b'port'] < 65536)]
+                else:
+                    peers = bytes(peers)
+                    peers = [(socket.inet_ntoa(peers[i : i + 4]), struct.unpack_from('>H', peers, i + 4)[0])
+                             for i in range(0, len(peers) - 5, 6)]
+                self.pool.announced(statuses[0], response.get(b'interval', DEFAULT_INTERVAL),
+                                    response.get(b'complete', 0), response.get(b'incomplete', 0), peers)
+        except (BencodeError, AttributeError, KeyError, TypeError, ValueError, OSError):
+            self.pool.failed(kind, statuses, _('Malformed response'))
+    
+    
+    def close(self):
+        Tracker.close(self)
+        for connection in list(self.connections):
+            connection.request = None
+            connection.close()
+
+
+TRACKER_CLASSES = { 'udp' : UDPTracker, 'http' : HTTPTracker }
+'''
+:dict<str, type>  Tracker implementations by URL scheme
+'''
+
+
+class TrackerPool():
+    '''
+    All trackers, and the schedule of announces and scrapes
+    
+    Each tracker exists once however many torrents use it, so
+    connections and connection IDs are shared between torrents.
+    Announces are kept in a heap by due time, behind one timer.
+    '''
+    
+    def __init__(self, loop, peer_id, port, progress, peers_found = None, clock = time.monotonic,
+                 startup_spread = STARTUP_SPREAD, connector = None):
+        '''
+        Constructor
+        
+        @param  loop:EventLoop                                            The event loop to run in
+        @param  peer_id:bytes                                             Our peer ID
+        @param  port:int                                                  The port we accept peers on
+        @param  progress:(info_hash:bytes)→(downloaded:int, left:int, uploaded:int)
+                                                                          Function that gets a torrent's
+                                                                          transfer totals
+        @param  peers_found:(info_hash:bytes, peers:list<(host:str, port:int)>)→void?
+                                                                          Called with peers from announces
+        @param  clock:()→float                                            Function that returns the current time
+        @param  startup_spread:float                                      Seconds over which first announces
+                                                                          are spread
+        @param  connector:Connector?                                      Opens HTTP tracker connections,
+                                                                          through the tracker proxy if any
+        '''
+        self.loop = loop
+        self.peer_id = peer_id
+        self.port = port
+        self.progress = progress
+        self.peers_found = peers_found
+        self.clock = clock
+        self.startup_spread = startup_spread
+        self.connector = connector
+        self.key = random.getrandbits(32)
+        self.trackers = {}
+        self.torrents = {}
+        self.schedule = []
+        self.sequence = 0
+        self.timer = None
+        self.timer_due = None
+        self.scrape_timer = self.loop.call_later(SCRAPE_INTERVAL, self.scrape_all)
+        self.version = 0
+    
+    
+    def add_torrent(self, info_hash, urls):
+        '''
+        Add a torrent, its first announces are spread over the startup period
+        
+        @param  info_hash:bytes  The torrent's infohash
+        @param  urls:list<str>   The announce URLs of the torrent's trackers
+        '''
+        now = self.clock()
+        statuses = self.torrents[info_hash] = []
+        for url in urls:
+            tracker = self.trackers.get(url)
+            if tracker is None:
+                cls = TRACKER_CLASSES.get(urlsplit(url).scheme)
+                if cls is None:
+                    continue
+                tracker = self.trackers[url] = cls(self, url)
+            status = tracker.statuses[info_hash] = Status(tracker, info_hash)
+            statuses.append(status)
+            self.reschedule(status, now + random.uniform(0, self.startup_spread))
+        self.version += 1
+    
+    
+    def remove_torrent(self, info_hash):
+        '''
+        Remove a torrent, and tell trackers that have it that it has stopped
+        
+        @param  info_hash:bytes  The torrent's infohash
+        '''
+        for status in self.torrents.pop(info_hash, []):
+            status.due = None
+            del status.tracker.statuses[info_hash]
+            if status.working:
+                status.tracker.working -= 1
+                status.event = 'stopped'
+                status.tracker.submit('announce', [status])
+            elif status.working is False:
+                status.tracker.failing -= 1
+            status.tracker.seeders -= status.seeders
+            status.tracker.leechers -= status.leechers
+        self.version += 1
+    
+    
+    def announce(self, info_hash, event = None):
+        '''
+        Announce a torrent to all its trackers now
+        
+        @param  info_hash:bytes  The torrent's infohash
+        @param  event:str?       `started`, `completed`, `stopped`, or `None`
+        '''
+        for status in self.torrents.get(info_hash, []):
+            status.event = event
+            status.due = None
+            status.tracker.submit('announce', [status])
+    
+    
+    def reschedule(self, status, due):
+        '''
+        Schedule a torrent's next announce to a tracker
+        
+        @param  status:Status  The torrent on the tracker
+        @param  due:float      The time of the announce
+        '''
+        status.due = due
+        self.sequence += 1
+        heapq.heappush(self.schedule, (due, self.sequence, status))
+        if (self.timer_due is None) or (due < self.timer_due):
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer_due = due
+            self.timer = self.loop.call_later(max(due - self.clock(), 0), self.run_due)
+    
+    
+    def run_due(self):
+        '''
+        Submit all announces that are due
+        '''
+        self.timer = self.timer_due = None
+        now, schedule = self.clock(), self.schedule
+        while (len(schedule) > 0) and (schedule[0][0] <= now):
+            (due, _seq, status) = heapq.heappop(schedule)
+            # Entries of rescheduled or removed torrents are left in the heap and skipped
+            if status.due == due:
+                status.due = None
+                status.tracker.submit('announce', [status])
+        # Failures while submitting may already have set a timer
+        if (len(schedule) > 0) and (self.timer is None):
+            self.timer_due = schedule[0][0]
+            self.timer = self.loop.call_later(max(self.timer_due - now, 0), self.run_due)
+    
+    
+    def scrape_all(self):
+        '''
+        Scrape all torrents on all trackers, in batches
+        '''
+        for tracker in self.trackers.values():
+            statuses = list(tracker.statuses.values())
+            for i in range(0, len(statuses), MAX_SCRAPE):
+                tracker.submit('scrape', statuses[i : i + MAX_SCRAPE])
+        self.scrape_timer = self.loop.call_later(SCRAPE_INTERVAL, self.scrape_all)
+    
+    
+    def set_working(self, status, working, message = ''):
+        '''
+        Record whether a tracker works for a torrent
+        
+        @param  status:Status  The torrent on the tracker
+        @param  working:bool   Whether the last request succeeded
+        @param  message:str    The error message, if it failed
+        '''
+        tracker = status.tracker
+        if status.working is not None:
+            if status.working:
+                tracker.working -= 1
+            else:
+                tracker.failing -= 1
+        status.working = working
+        status.message = message
+        if working:
+            tracker.working += 1
+            status.fails = 0
+        else:
+            tracker.failing += 1
+            tracker.message = message
+            status.fails += 1
+        self.version += 1
+    
+    
+    def set_counts(self, status, seeders, completed, leechers):
+        '''
+        Record a torrent's swarm size
+        
+        @param  status:Status    The torrent on the tracker
+        @param  seeders:int      The number of seeders
+        @param  completed:int    The number of completed downloads
+        @param  leechers:int     The number of leechers
+        '''
+        tracker = status.tracker
+        tracker.seeders += seeders - status.seeders
+        tracker.leechers += leechers - status.leechers
+        (status.seeders, status.completed, status.leechers) = (seeders, completed, leechers)
+    
+    
+    def announced(self, status, interval, seeders, leechers, peers):
+        '''
+        Handle a successful announce
+        
+        @param  status:Status                     The torrent on the tracker
+        @param  interval:int                      Seconds until the next announce
+        @param  seeders:int                       The number of seeders
+        @param  leechers:int                      The number of leechers
+        @param  peers:list<(host:str, port:int)>  Peers of the torrent
+        '''
+        if status.event == 'stopped':
+            return
+        self.set_counts(status, seeders, status.completed, leechers)
+        self.set_working(status, True)
+        status.event = None
+        status.interval = max(interval, MIN_INTERVAL)
+        if status.tracker.statuses.get(status.info_hash) is status:
+            self.reschedule(status, self.clock() + status.interval * random.uniform(1 - JITTER, 1 + JITTER))
+        if (self.peers_found is not None) and (len(peers) > 0):
+            self.peers_found(status.info_hash, peers)
+    
+    
+    def scraped(self, status, seeders, completed, leechers):
+        '''
+        Handle a scrape result
+        
+        @param  status:Status   The torrent on the tracker
+        @param  seeders:int     The number of seeders
+        @param  completed:int   The number of completed downloads
+        @param  leechers:int    The number of leechers
+        '''
+        if status.tracker.statuses.get(status.info_hash) is status:
+            self.set_counts(status, seeders, completed, leechers)
+            self.version += 1
+    
+    
+    def failed(self, kind, statuses, message):
+        '''
+        Handle a failed request
+        
+        @param  kind:str                `announce` or `scrape`
+        @param  statuses:list<Status>   The torrents of the request
+        @param  message:str             The reason
+        '''
+        if kind != 'announce':
+            return
+        status = statuses[0]
+        if (status.event == 'stopped') or (status.tracker.statuses.get(status.info_hash) is not status):
+            return
+        FAILURES.add()
+        self.set_working(status, False, message)
+        delay = min(RETRY_BASE << min(status.fails - 1, 16), MAX_RETRY)
+        self.reschedule(status, self.clock() + delay * random.uniform(1 - JITTER, 1 + JITTER))
+    
+    
+    def close(self):
+        '''
+        Cancel all timers and requests, and close all connections
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.scrape_timer.cancel()
+        for tracker in self.trackers.values():
+            tracker.close()
+
+
+class TrackerView():
+    '''
+    The trackers as rows, for the States and trackers tab
+    '''
+    
+    def __init__(self, pool):
+        '''
+        Constructor
+        
+        @param  pool:TrackerPool?  The trackers
+        '''
+        self.pool = pool
+        self.cache = None
+    
+    
+    def render(self, height, width):
+        '''
+        Get the rows inside the viewport
+        
+        @param   height:int                       The number of rows in the viewport
+        @param   width:int                        The width of the viewport
+        @return  :list<(row:str, selected:bool)>  The rows
+        '''
+        if (self.pool is None) or (height <= 0):
+            return []
+        key = (self.pool.version, height, width)
+        if (self.cache is not None) and (self.cache[0] == key):
+            return self.cache[1]
+        columns = lambda url, *values : (url[: max(width - 50, 10)].ljust(max(width - 50, 10)) +
+                                         ' %8s %8s %8s %8s %8s' % values)[:width]
+        rows = [(columns(_('Tracker'), _('Torrents'), _('Working'), _('Failing'), _('Seeders'), _('Leechers')), False)]
+        for tracker in sorted(self.pool.trackers.values(), key = lambda t : t.url)[: height - 1]:
+            rows.append((columns(tracker.url, len(tracker.statuses), tracker.working, tracker.failing,
+                                 tracker.seeders, tracker.leechers), False))
+        self.cache = (key, rows)
+        return rows
+
+
+if __name__ == '__main__':
+    # Announce and scrape many torrents against stand-in trackers on the loopback interface
+    import sys
+    from urllib.parse import unquote_to_bytes
+    from bencode import encode
+    from eventloop import EventLoop
+    
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop = EventLoop()
+    served = { 'udp packets' : 0, 'udp connects' : 0, 'http connections' : 0, 'http requests' : 0 }
+    peer = socket.inet_aton('127.0.0.2') + struct.pack('>H', 6881)
+    
+    udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_server.bind(('127.0.0.1', 0))
+    udp_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    udp_server.setblocking(False)
+    
+    def udp_ready():
+        while True:
+            try:
+                (data, address) = udp_server.recvfrom(65536)
+            except BlockingIOError:
+                return
+            served['udp packets'] += 1
+            (action, tid) = struct.unpack_from('>II', data, 8)
+            if action == ACTION_CONNECT:
+                served['udp connects'] += 1
+                reply = struct.pack('>IIQ', action, tid, random.getrandbits(64))
+            elif action == ACTION_ANNOUNCE:
+                reply = struct.pack('>IIIII', action, tid, 1800, 3, 5) + peer
+            else:
+                reply = struct.pack('>II', action, tid) + struct.pack('>III', 5, 10, 3) * ((len(data) - 16) // 20)
+            udp_server.sendto(reply, address)
+    
+    http_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    http_server.bind(('127.0.0.1', 0))
+    http_server.listen(64)
+    http_server.setblocking(False)
+    
+    def http_accept():
+        (sock, _address) = http_server.accept()
+        sock.setblocking(True)
+        served['http connections'] += 1
+        buffer = bytearray()
+        def ready():
+            data = sock.recv(1 << 16)
+            if len(data) == 0:
+                loop.remove_reader(sock.fileno())
+                sock.close()
+                return
+            buffer.extend(data)
+            while b'\r\n\r\n' in buffer:
+                (head, _sep, rest) = bytes(buffer).partition(b'\r\n\r\n')
+                buffer[:] = rest
+                served['http requests'] += 1
+                path = head.split(b' ')[1]
+                if path.startswith(b'/scrape'):
+                    hashes = [unquote_to_bytes(h[len(b'info_hash='):]) for h in path.split(b'?')[1].split(b'&')]
+                    body = encode({ b'files' : dict((h, { b'complete' : 5, b'downloaded' : 10, b'incomplete' : 3 })
+                                                    for h in hashes) })
+                else:
+                    body = encode({ b'interval' : 1800, b'complete' : 5, b'incomplete' : 3, b'peers' : peer })
+                sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n%s' % (len(body), body))
+        loop.add_reader(sock.fileno(), ready)
+    
+    loop.add_reader(udp_server.fileno(), udp_ready)
+    loop.add_reader(http_server.fileno(), http_accept)
+    
+    hashes = [os.urandom(20) for _ in range(count)]
+    found = []
+    pool = TrackerPool(loop, b'-TK0000-' + os.urandom(12), 6881, lambda info_hash : (0, 1 << 30, 0),
+                       peers_found = lambda info_hash, peers : found.append(len(peers)), startup_spread = 0)
+    urls = [ 'udp://127.0.0.1:%i/announce' % udp_server.getsockname()[1]
+           , 'http://127.0.0.1:%i/announce' % http_server.getsockname()[1]
+           ]
+    
+    def run_until(predicate, limit = 120):
+        deadline = time.monotonic() + limit
+        while not predicate() and time.monotonic() < deadline:
+            loop.run_once()
+    
+    start = time.perf_counter()
+    for info_hash in hashes:
+        pool.add_torrent(info_hash, urls)
+    run_until(lambda : sum(t.working + t.failing for t in pool.trackers.values()) == 2 * count)
+    elapsed = time.perf_counter() - start
+    print('%i torrents on 2 trackers announced in %.2f s, %i peer lists found' % (count, elapsed, len(found)))
+    for tracker in pool.trackers.values():
+        print('  %-30s working %6i  failing %4i' % (tracker.url, tracker.working, tracker.failing))
+    print('  udp: %i connects, %i packets (one connect per announce would need %i packets)' %
+          (served['udp connects'], served['udp packets'], 2 * count))
+    print('  http: %i connections, %i requests (one connection per request)' %
+          (served['http connections'], served['http requests']))
+    
+    served.update(dict.fromkeys(served, 0))
+    start = time.perf_counter()
+    pool.scrape_all()
+    run_until(lambda : all(t.in_flight == 0 and len(t.pending) == 0 for t in pool.trackers.values()))
+    print('scrape of %i torrents on 2 trackers in %.2f s: %i udp packets, %i http requests (%i without batching)' %
+          (count, time.perf_counter() - start, served['udp packets'], served['http requests'], 2 * count))
+    print('  seeders %s, leechers %s' % ([t.seeders for t in pool.trackers.values()],
+                                          [t.leechers for t in pool.trackers.values()]))
+    pool.close()
@@ -0,0 +1,287 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import mmap
+import bisect
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+
+
+PIECES_PER_TASK = 16
+'''
+:int  The number of consecutive pieces each worker task verifies
+'''
+
+HASHING = instrument.histogram('verify.task', 'Time to verify the pieces of one worker task')
+'''
+:Histogram  The time each worker task takes
+'''
+
+
+class PayloadFile():
+    '''
+    A file in a torrent's payload, mapped into memory for verification
+    '''
+    
+    def __init__(self, path, length):
+        '''
+        Constructor
+        
+        @param  path:str    The path of the file
+        @param  length:int  The size the file shall have
+        '''
+        self.path = path
+        self.length = length
+        self.map = None
+        self.view = None
+        self.extents = None
+    
+    
+    def open(self):
+        '''
+        Map the file and find the parts of it that have been written
+        '''
+        if self.length == 0:
+            return
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            size = os.fstat(fd).st_size
+            if size < self.length:
+                return
+            self.extents = data_extents(fd, self.length)
+            self.map = mmap.mmap(fd, self.length, access = mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        finally:
+            os.close(fd)
+    
+    
+    def close(self):
+        '''
+        Unmap the file
+        '''
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = self.map = None
+    
+    
+    def has_data(self, offset, length):
+        '''
+        Check whether a span of the file is completely written
+        
+        @param   offset:int  The start of the span
+        @param   length:int  The length of the span
+        @return  :bool       Whether the span can be complete, `False` if it lies at least
+                             partially in a hole or the file is missing or too short
+        '''
+        if length == 0:
+            return True
+        if self.view is None:
+            return False
+        if self.extents is None:
+            return True
+        # The last extent starting at or before the offset must cover the span
+        i = bisect.bisect_right(self.extents, (offset, float('inf'))) - 1
+        return (i >= 0) and (self.extents[i][1] >= offset + length)
+
+
+def data_extents(fd, length):
+    '''
+    Find the parts of a file that are not holes
+    
+    @param   fd:int                         The file descriptor of the file
+    @param   length:int                     The number of bytes to examine
+    @return  :list<(start:int, end:int)>?  The written parts, `None` if this cannot be
+                                            determined, then all data shall be assumed written
+    '''
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    extents = []
+    pos = 0
+    try:
+        while pos < length:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError:
+                # No more data after `pos` (ENXIO)
+                break
+            if start >= length:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), length)
+            extents.append((start, end))
+            pos = end
+    except OSError:
+        return None
+    return extents
+
+
+class Verifier():
+    '''
+    Recheck of a torrent's payload against its piece hashes
+    
+    Pieces are hashed from memory mapped files by a pool of threads;
+    `hashlib` releases the GIL while hashing, so all cores are used.
+    Pieces that span files are hashed span by span without copying.
+    '''
+    
+    def __init__(self, files, piece_length, hashes, workers = None, progress = None):
+        '''
+        Constructor
+        
+        @param  files:list<(path:str, length:int)>    The files in the payload, in order
+        @param  piece_length:int                      The size of each piece but the last
+        @param  hashes:bytes|memoryview               The concatenated SHA-1 hashes of the pieces
+        @param  workers:int?                          The number of threads, `None` for one per CPU
+        @param  progress:(done:int, total:int)→void?  Function called from worker threads
+                                                      whenever more pieces have been checked
+        '''
+        self.files = [PayloadFile(path, length) for (path, length) in files]
+        self.starts = []
+        total = 0
+        for f in self.files:
+            self.starts.append(total)
+            total += f.length
+        self.total_length = total
+        self.piece_length = piece_length
+        self.hashes = memoryview(hashes)
+        self.piece_count = len(self.hashes) // 20
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = progress
+        self.done = 0
+        self.total = self.piece_count
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.bitfield = bytearray((self.piece_count + 7) // 8)
+    
+    
+    def spans(self, index):
+        '''
+        Get the parts of files that make up a piece
+        
+        @param   index:int                                     The index of the piece
+        @return  :itr<(file:PayloadFile, offset:int, length:int)>  The spans, in order
+        '''
+        start = index * self.piece_length
+        end = min(start + self.piece_length, self.total_length)
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < end:
+            f = self.files[i]
+            offset = start - self.starts[i]
+            length = min(f.length - offset, end - start)
+            if length > 0:
+                yield (f, offset, length)
+                start += length
+            i += 1
+    
+    
+    def file_pieces(self, index):
+        '''
+        Get the pieces that overlap with a file
+        
+        @param   index:int                    The index of the file
+        @return  :(first:int, last:int)       The first piece and the piece after the last piece
+        '''
+        start = self.starts[index]
+        end = start + self.files[index].length
+        if start == end:
+            return (0, 0)
+        return (start // self.piece_length, min((end - 1) // self.piece_length + 1, self.piece_count))
+    
+    
+    def check_piece(self, index):
+        '''
+        Verify one piece
+        
+        @param   index:int  The index of the piece
+        @return  :bool      Whether the piece is complete and correct
+        '''
+        spans = list(self.spans(index))
+        # Do not hash pieces that are partially in holes or missing files
+        for (f, offset, length) in spans:
+            if not f.has_data(offset, length):
+                return False
+        sha1 = hashlib.sha1()
+        for (f, offset, length) in spans:
+            sha1.update(f.view[offset : offset + length])
+        return sha1.digest() == self.hashes[index * 20 : (index + 1) * 20]
+    
+    
+    def check_pieces(self, first, last):
+        '''
+        Verify a range of pieces and record the result
+        
+        @param  first:int  The index of the first piece
+        @param  last:int   The index of the piece after the last piece
+        '''
+        start = HASHING.start()
+        valid = [index for index in range(first, last) if not self.cancelled and self.check_piece(index)]
+        HASHING.stop(start)
+        self.lock.acquire()
+        try:
+            for index in valid:
+                self.bitfield[index >> 3] |= 0x80 >> (index & 7)
+            self.done += last - first
+            done = self.done
+        finally:
+            self.lock.release()
+        if self.progress is not None:
+            self.progress(done, self.total)
+    
+    
+    def run(self, ranges = None):
+        '''
+        Verify all pieces, or some ranges of pieces
+        
+        @param   ranges:list<(first:int, last:int)>?  The ranges of pieces to check, `None` for all,
+                                                     `last` is the index of the piece after the range
+        @return  :bytearray                          Bitfield of the valid pieces, with the first piece
+                                                     in the most significant bit of the first byte, as
+                                                     in the peer wire protocol, unchecked pieces are unset
+        '''
+        if ranges is None:
+            ranges = [(0, self.piece_count)]
+        self.total = sum(last - first for (first, last) in ranges)
+        for f in self.files:
+            f.open()
+        try:
+            with ThreadPoolExecutor(max_workers = self.workers) as pool:
+                tasks = [pool.submit(self.check_pieces, start, min(start + PIECES_PER_TASK, last))
+                         for (first, last) in ranges
+                         for start in range(first, last, PIECES_PER_TASK)]
+                for task in tasks:
+                    task.result()
+        finally:
+            for f in self.files:
+                f.close()
+        return self.bitfield
+    
+    
+    def cancel(self):
+        '''
+        Stop verifying, pieces that have not been checked are reported as invalid
+        '''
+        self.cancelled = True
+
@@ -0,0 +1,760 @@
+# -*- python -*-
+'''
+tirek — A torrent client with a terminal user interface
+Copyright © 2014  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import socket
+from collections import deque
+from urllib.parse import urlsplit, quote_from_bytes
+
+import instrument
+from diskio import Storage
+
+_ = lambda x : x
+
+
+MAX_RANGE = 4 << 20
+'''
+:int  The largest number of bytes asked for at once, adjacent missing pieces
+      are merged into one range request up to this size
+'''
+
+PIPELINE = 4
+'''
+:int  The number of requests sent ahead on a connection
+'''
+
+CONNECTIONS = 2
+'''
+:int  The number of connections per web seed
+'''
+
+HEADER_BUFFER = 1 << 14
+'''
+:int  The number of bytes read at a time outside response bodies
+'''
+
+MAX_HEADER = 1 << 16
+'''
+:int  The largest accepted response header
+'''
+
+RETRY_BASE = 60
+MAX_RETRY = 60 * 60
+'''
+:float  Delay after the first failure, doubled for each failure up to the maximum
+'''
+
+REQUESTS = instrument.counter('webseed.requests', 'Range requests sent to web seeds')
+RECEIVED = instrument.counter('webseed.received', 'Payload bytes received from web seeds')
+'''
+:Counter  Web seed requests and payload
+'''
+
+
+class WebSeedHandler():
+    '''
+    Receiver of the pieces that a web seed downloads
+    
+    The handler checks the pieces and tells the picker whether they
+    are complete or abandoned, and calls `WebSeed.pump` when pieces
+    become available for downloading again.
+    '''
+    
+    def piece(self, seed, index, data):
+        '''
+        Called when a piece has been downloaded
+        
+        @param  seed:WebSeed        The web seed
+        @param  index:int           The index of the piece
+        @param  data:memoryview     The piece, only valid during the call
+        '''
+        pass
+    
+    
+    def failed(self, seed, message):
+        '''
+        Called when the web seed fails, its pieces have been abandoned and it will be retried later
+        
+        @param  seed:WebSeed  The web seed
+        @param  message:str   The reason
+        '''
+        pass
+
+
+class Request():
+    '''
+    A range of one file
+    '''
+    
+    __slots__ = ('path', 'offset', 'length', 'start')
+    
+    def __init__(self, path, offset, length, start):
+        '''
+        Constructor
+        
+        @param  path:str     The URL path of the file, quoted
+        @param  offset:int   The offset of the range in the file
+        @param  length:int   The length of the range
+        @param  start:int    The offset of the range in the torrent's payload
+        '''
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.start = start
+
+
+class WebSeedConnection():
+    '''
+    A kept-alive connection to a web seed, with pipelined requests
+    
+    Response bodies are received directly into the piece buffers.
+    '''
+    
+    def __init__(self, seed):
+        '''
+        Constructor
+        
+        @param  seed:WebSeed  The web seed
+        '''
+        self.seed = seed
+        self.loop = seed.loop
+        self.sock = None
+        self.requests = deque()
+        self.out = bytearray()
+        self.head = bytearray()
+        self.position = 0
+        self.body_left = 0
+        self.in_body = False
+        self.closed = False
+        seed.connector.connect(seed.address, self.opened)
+    
+    
+    def opened(self, sock, error):
+        '''
+        Called when the connection is open or has failed
+        
+        @param  sock:socket?  The socket
+        @param  error:str?    Why the connection failed
+        '''
+        if self.closed:
+            if sock is not None:
+                sock.close()
+            return
+        if sock is None:
+            self.seed.fail(error)
+            return
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.loop.add_reader(self.fd, self.read_ready)
+        self.write_ready()
+    
+    
+    def add(self, request):
+        '''
+        Send a request
+        
+        @param  request:Request  The request
+        '''
+        seed = self.seed
+        REQUESTS.add()
+        self.requests.append(request)
+        target = seed.target(request.path)
+        self.out += ('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: tirek\r\nRange: bytes=%i-%i\r\n'
+                     'Accept-Encoding: identity\r\n%sConnection: keep-alive\r\n\r\n' %
+                     (target, seed.parts.netloc, request.offset, request.offset + request.length - 1,
+                      seed.authorization)).encode('utf-8')
+        if self.sock is not None:
+            self.write_ready()
+    
+    
+    def write_ready(self):
+        '''
+        Send queued requests
+        '''
+        try:
+            sent = self.sock.send(self.out) if len(self.out) > 0 else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            self.lost(str(e))
+            return
+        del self.out[:sent]
+        if len(self.out) > 0:
+            self.loop.add_writer(self.fd, self.write_ready)
+        else:
+            self.loop.remove_writer(self.fd)
+    
+    
+    def read_ready(self):
+        '''
+        Receive responses
+        '''
+        try:
+            if self.in_body and (len(self.head) == 0):
+                view = self.seed.destination(self.position, self.body_left)
+                n = self.sock.recv_into(view)
+                if n > 0:
+                    self.advance(n)
+            else:
+                data = self.sock.recv(HEADER_BUFFER)
+                n = len(data)
+                self.head += data
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.lost(str(e))
+            return
+        if n == 0:
+            self.lost(_('Connection closed by web seed'))
+            return
+        self.process()
+    
+    
+    def process(self):
+        '''
+        Handle the buffered part of the responses
+        '''
+        while not self.closed:
+            if self.in_body:
+                if len(self.head) == 0:
+                    return
+                n = min(len(self.head), self.body_left)
+                self.seed.write(self.position, memoryview(self.head)[:n])
+                del self.head[:n]
+                self.advance(n)
+                continue
+            end = self.head.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.head) > MAX_HEADER:
+                    self.seed.fail(_('Malformed response'))
+                return
+            if len(self.requests) == 0:
+                self.seed.fail(_('Unexpected response'))
+                return
+            error = self.response(bytes(self.head[:end]).decode('latin-1'))
+            del self.head[:end + 4]
+            if error is not None:
+                self.seed.fail(error)
+                return
+    
+    
+    def response(self, header):
+        '''
+        Start receiving a response
+        
+        @param   header:str  The status line and headers
+        @return  :str?       Why the response is not acceptable, `None` if it is
+        '''
+        lines = header.split('\r\n')
+        headers = dict((name.strip().lower(), value.strip()) for (name, _sep, value) in
+                       (line.partition(':') for line in lines[1:]))
+        status = lines[0].split(' ', 2)
+        request = self.requests[0]
+        if (len(status) < 2) or (status[1] not in ('200', '206')):
+            return ' '.join(status[1:]) or _('Malformed response')
+        if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+            return _('Unsupported transfer encoding')
+        length = int(headers.get('content-length', '-1')) if headers.get('content-length', '').isdigit() else -1
+        if status[1] == '206':
+            (unit, _sep, span) = headers.get('content-range', '').partition(' ')
+            (first, _sep, last) = span.partition('/')[0].partition('-')
+            if (unit != 'bytes') or (first != str(request.offset)) or (last != str(request.offset + request.length - 1)):
+                return _('Wrong range in response')
+        elif request.offset != 0:
+            # The server ignores ranges; only a whole file is acceptable
+            return _('Ranges not supported')
+        if length != request.length:
+            return _('Wrong length of response')
+        if headers.get('connection', '').lower() == 'close':
+            # No more responses will come; what is not answered is asked again elsewhere
+            self.seed.requeue(list(self.requests)[1:])
+            while len(self.requests) > 1:
+                self.requests.pop()
+            self.seed.connections.discard(self)
+        (self.position, self.body_left, self.in_body) = (request.start, length, True)
+        if length == 0:
+            self.advance(0)
+        return None
+    
+    
+    def advance(self, n):
+        '''
+        Note that part of a response body has been stored
+        
+        @param  n:int  The number of bytes
+        '''
+        self.seed.stored(self.position, n)
+        self.position += n
+        self.body_left -= n
+        if self.body_left == 0:
+            self.in_body = False
+            self.requests.popleft()
+            self.seed.answered += 1
+            if len(self.requests) > 0:
+                self.seed.pump()
+            elif self in self.seed.connections:
+                self.seed.idle(self)
+            else:
+                # The server closes the connection after this response
+                self.close()
+                self.seed.pump()
+    
+    
+    def lost(self, message):
+        '''
+        Handle a closed or broken connection; unanswered requests are
+        asked again on another connection, unless nothing was answered
+        
+        @param  message:str  The reason
+        '''
+        requests = list(self.requests)
+        if self.in_body:
+            # Continue the interrupted request where it stopped
+            done = self.position - requests[0].start
+            (requests[0].offset, requests[0].length, requests[0].start) = (requests[0].offset + done, requests[0].length - done, self.position)
+        answered = self.seed.answered
+        self.close()
+        if len(requests) == 0:
+            return
+        if answered == 0:
+            self.seed.fail(message)
+            return
+        self.seed.requeue(requests)
+        self.seed.pump()
+    
+    
+    def close(self):
+        '''
+        Close the connection
+        '''
+        self.closed = True
+        self.requests.clear()
+        if self.sock is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.sock.close()
+            self.sock = None
+        self.seed.connections.discard(self)
+
+
+class WebSeed():
+    '''
+    A web seed of one torrent, see BEP 19
+    
+    Adjacent missing pieces are merged into runs of up to `MAX_RANGE`
+    bytes, and each run is asked for with one range request per file
+    it covers. Requests are pipelined on a few kept-alive connections
+    that are opened through a `proxy.Connector`.
+    '''
+    
+    def __init__(self, loop, connector, url, metainfo, picker, handler, clock = time.monotonic):
+        '''
+        Constructor, `ValueError` is raised if the URL is not an HTTP URL
+        
+        @param  loop:EventLoop              The event loop to run in
+        @param  connector:proxy.Connector   Opens the connections
+        @param  url:str                     The URL of the web seed, HTTPS is not supported
+        @param  metainfo:bencode.Metainfo   The torrent
+        @param  picker:PiecePicker          The torrent's piece picker
+        @param  handler:WebSeedHandler      Receiver of the pieces
+        @param  clock:()→float              Function that returns the current time
+        '''
+        self.loop = loop
+        self.connector = connector
+        self.url = url
+        self.parts = urlsplit(url)
+        if (self.parts.scheme != 'http') or not self.parts.hostname:
+            raise ValueError('unsupported web seed URL: %s' % url)
+        self.address = (self.parts.hostname, self.parts.port or 80)
+        self.picker = picker
+        self.handler = handler
+        self.clock = clock
+        self.piece_length = metainfo.info[b'piece length']
+        name = quote_from_bytes(bytes(metainfo.info[b'name']))
+        base = self.parts.path or '/'
+        files = []
+        for (path, length) in metainfo.files():
+            if len(path) == 0:
+                # A single file torrent, the URL is the file unless it is a directory
+                files.append((base + name if base.endswith('/') else base, length))
+            else:
+                prefix = base if base.endswith('/') else base + '/'
+                files.append((prefix + name + '/' + '/'.join(quote_from_bytes(part) for part in path), length))
+        self.storage = Storage('', files, self.piece_length)
+        self.total_length = self.storage.total_length
+        self.connections = set()
+        self.queue = deque()
+        self.pieces = {}
+        self.claimed = set()
+        self.answered = 0
+        self.fails = 0
+        self.retry_timer = None
+        self.message = ''
+        self.received = 0
+        self.set_connector(connector)
+    
+    
+    def set_connector(self, connector):
+        '''
+        Change the connector, for example when the proxy preferences change
+        
+        @param  connector:proxy.Connector  Opens the connections
+        '''
+        self.connector = connector
+        self.authorization = connector.proxy.authorization() if connector.forwarding else ''
+    
+    
+    def target(self, path):
+        '''
+        Get the request target of a file
+        
+        @param   path:str  The URL path of the file
+        @return  :str      The path, or the whole URL when requests go through an HTTP proxy
+        '''
+        if self.connector.forwarding:
+            return '%s://%s%s' % (self.parts.scheme, self.parts.netloc, path)
+        return path
+    
+    
+    def piece_size(self, index):
+        '''
+        @param   index:int  The index of a piece
+        @return  :int       The size of the piece
+        '''
+        return min(self.piece_length, self.total_length - index * self.piece_length)
+    
+    
+    def destination(self, position, limit):
+        '''
+        Get the buffer to receive part of the payload in
+        
+        @param   position:int    The offset in the payload
+        @param   limit:int       The largest number of bytes wanted
+        @return  :memoryview     The part of the piece's buffer from the offset, up to the limit
+        '''
+        index = position // self.piece_length
+        buffer = self.pieces.get(index)
+        if buffer is None:
+            buffer = self.pieces[index] = [bytearray(self.piece_size(index)), 0]
+        offset = position - index * self.piece_length
+        return memoryview(buffer[0])[offset : offset + limit]
+    
+    
+    def write(self, position, data):
+        '''
+        Copy received payload into the piece buffers, without storing it
+        
+        @param  position:int        The offset in the payload
+        @param  data:memoryview     The data
+        '''
+        while len(data) > 0:
+            view = self.destination(position, len(data))
+            view[:] = data[: len(view)]
+            (position, data) = (position + len(view), data[len(view):])
+    
+    
+    def stored(self, position, n):
+        '''
+        Note that received payload is in the piece buffers, and hand
+        over the pieces that are complete
+        
+        @param  position:int  The offset in the payload
+        @param  n:int         The number of bytes
+        '''
+        RECEIVED.add(n)
+        self.received += n
+        end = position + n
+        while position < end:
+            index = position // self.piece_length
+            part = min(end, (index + 1) * self.piece_length) - position
+            buffer = self.pieces[index]
+            buffer[1] += part
+            position += part
+            if buffer[1] == len(buffer[0]):
+                del self.pieces[index]
+                self.claimed.discard(index)
+                self.fails = 0
+                self.handler.piece(self, index, memoryview(buffer[0]))
+    
+    
+    def requeue(self, requests):
+        '''
+        Ask for requests again, ahead of the queue
+        
+        @param  requests:list<Request>  The requests, in order
+        '''
+        self.queue.extendleft(reversed(requests))
+    
+    
+    def idle(self, connection):
+        '''
+        Give a connection more requests, or keep it for later
+        
+        @param  connection:WebSeedConnection  A connection without requests
+        '''
+        self.pump()
+        if (len(connection.requests) == 0) and not connection.closed:
+            # Hand the connection back to the connector so it can be reused later
+            self.connections.discard(connection)
+            if connection.sock is not None:
+                self.loop.remove_reader(connection.fd)
+                self.loop.remove_writer(connection.fd)
+                self.connector.release(self.address, connection.sock)
+                connection.sock = None
+            connection.closed = True
+    
+    
+    def pump(self):
+        '''
+        Claim missing pieces and keep the connections busy
+        '''
+        if self.retry_timer is not None:
+            return
+        in_flight = len(self.queue) + sum(len(connection.requests) for connection in self.connections)
+        while in_flight < CONNECTIONS * PIPELINE:
+            run = self.picker.pick_run(max(MAX_RANGE // self.piece_length, 1))
+            if run is None:
+                break
+            (first, count) = run
+            self.claimed.update(range(first, first + count))
+            start = first * self.piece_length
+            length = min(count * self.piece_length, self.total_length - start)
+            for (path, offset, span) in self.storage.spans(start, length):
+                self.queue.append(Request(path, offset, span, start))
+                start += span
+                in_flight += 1
+        for connection in list(self.connections):
+            while (len(self.queue) > 0) and (len(connection.requests) < PIPELINE):
+                connection.add(self.queue.popleft())
+        while (len(self.queue) > 0) and (len(self.connections) < CONNECTIONS):
+            connection = WebSeedConnection(self)
+            self.connections.add(connection)
+            while (len(self.queue) > 0) and (len(connection.requests) < PIPELINE):
+                connection.add(self.queue.popleft())
+    
+    
+    def fail(self, message):
+        '''
+        Stop downloading, abandon the claimed pieces and try again later
+        
+        @param  message:str  The reason
+        '''
+        self.message = message
+        self.stop()
+        delay = min(RETRY_BASE * 2 ** self.fails, MAX_RETRY)
+        self.fails += 1
+        self.retry_timer = self.loop.call_later(delay, self.retry)
+        self.handler.failed(self, message)
+    
+    
+    def retry(self):
+        '''
+        Start downloading again after a failure
+        '''
+        self.retry_timer = None
+        self.pump()
+    
+    
+    def stop(self):
+        '''
+        Close the connections and abandon the claimed pieces
+        '''
+        for connection in list(self.connections):
+            connection.close()
+        self.queue.clear()
+        self.pieces.clear()
+        for index in self.claimed:
+            self.picker.piece_abandoned(index)
+        self.claimed.clear()
+    
+    
+    def close(self):
+        '''
+        Stop downloading for good
+        '''
+        self.stop()
+        if self.retry_timer is not None:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+
+
+if __name__ == '__main__':
+    # Benchmark: download a torrent from a stand-in web seed on the loopback interface,
+    # directly and through stand-in SOCKS5 and HTTP proxies
+    import os, sys, hashlib, threading
+    from urllib.parse import unquote
+    from bencode import encode, Metainfo
+    from picker import PiecePicker
+    from eventloop import EventLoop
+    from proxy import Connector, Proxy
+    
+    size = int(sys.argv[1]) * (1 << 20) if len(sys.argv) > 1 else 256 << 20
+    piece_length = 1 << 18
+    sizes = [size // 2, size // 3, size - size // 2 - size // 3]
+    payload = os.urandom(size)
+    hashes = b''.join(hashlib.sha1(payload[i : i + piece_length]).digest() for i in range(0, size, piece_length))
+    info = { b'name' : b'bench', b'piece length' : piece_length, b'pieces' : hashes
+           , b'files' : [{ b'path' : [b'part %i' % i], b'length' : n } for (i, n) in enumerate(sizes)]
+           }
+    metainfo = Metainfo(encode({ b'info' : info }))
+    contents, offset = {}, 0
+    for (i, n) in enumerate(sizes):
+        contents['/seed/bench/part %i' % i] = memoryview(payload)[offset : offset + n]
+        offset += n
+    served = { 'connections' : 0, 'requests' : 0 }
+    
+    def read_head(sock, buf):
+        while b'\r\n\r\n' not in buf:
+            data = sock.recv(1 << 16)
+            if not data:
+                return None
+            buf += data
+        end = buf.index(b'\r\n\r\n')
+        head = bytes(buf[:end]).decode('latin-1')
+        del buf[:end + 4]
+        return head
+    
+    def serve_seed(sock):
+        served['connections'] += 1
+        buf = bytearray()
+        with sock:
+            while True:
+                head = read_head(sock, buf)
+                if head is None:
+                    return
+                served['requests'] += 1
+                lines = head.split('\r\n')
+                target = unquote(lines[0].split(' ')[1])
+                if '://' in target:
+                    target = '/' + target.split('://', 1)[1].split('/', 1)[1]
+                (first, last) = [line for line in lines if line.lower().startswith('range:')][0].split('=')[1].split('-')
+                (first, last) = (int(first), int(last))
+                data = contents[target]
+                sock.sendall(('HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %i-%i/%i\r\n'
+                              'Content-Length: %i\r\n\r\n' % (first, last, len(data), last - first + 1)).encode())
+                sock.sendall(data[first : last + 1])
+    
+    def relay(source, sink):
+        try:
+            while True:
+                data = source.recv(1 << 16)
+                if not data:
+                    break
+                sink.sendall(data)
+        except OSError:
+            pass
+        sink.close()
+    
+    def serve_socks5(sock):
+        buf = bytearray()
+        while len(buf) < 3 + 10:
+            buf += sock.recv(1 << 16)
+        # greeting, then the connect request with an IPv4 address
+        port = int.from_bytes(buf[11:13], 'big')
+        upstream = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'\x05\x00' + b'\x05\x00\x00\x01' + bytes(6))
+        threading.Thread(target = relay, args = (upstream, sock), daemon = True).start()
+        relay(sock, upstream)
+    
+    def serve_http_proxy(sock):
+        # Forwards requests with absolute URIs over one upstream connection per client connection
+        buf, upstream, upbuf = bytearray(), None, bytearray()
+        with sock:
+            while True:
+                head = read_head(sock, buf)
+                if head is None:
+                    return
+                target = head.split(' ')[1]
+                port = int(target.split('://', 1)[1].split('/', 1)[0].split(':')[1])
+                if upstream is None:
+                    upstream = socket.create_connection(('127.0.0.1', port))
+                upstream.sendall((head + '\r\n\r\n').encode('latin-1'))
+                reply = read_head(upstream, upbuf)
+                length = int([line for line in reply.split('\r\n') if line.lower().startswith('content-length:')][0].split(':')[1])
+                sock.sendall((reply + '\r\n\r\n').encode('latin-1'))
+                while length > 0:
+                    if len(upbuf) == 0:
+                        upbuf += upstream.recv(1 << 20)
+                    n = min(length, len(upbuf))
+                    sock.sendall(upbuf[:n])
+                    del upbuf[:n]
+                    length -= n
+    
+    def server(serve):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(64)
+        def accept():
+            while True:
+                (sock, _address) = listener.accept()
+                threading.Thread(target = serve, args = (sock,), daemon = True).start()
+        threading.Thread(target = accept, daemon = True).start()
+        return listener.getsockname()[1]
+    
+    seed_port = server(serve_seed)
+    socks_port = server(serve_socks5)
+    http_port = server(serve_http_proxy)
+    
+    class Checker(WebSeedHandler):
+        def __init__(self, picker):
+            self.picker = picker
+            self.pieces = 0
+            self.failure = None
+        def piece(self, seed, index, data):
+            if hashlib.sha1(data).digest() != hashes[index * 20 : index * 20 + 20]:
+                self.picker.piece_abandoned(index)
+                return
+            self.picker.piece_completed(index)
+            self.pieces += 1
+        def failed(self, seed, message):
+            self.failure = message
+    
+    def run(label, proxy, max_range, pipeline):
+        # Two torrents in a row from the same host, the second reuses the first's idle connections
+        global MAX_RANGE, PIPELINE
+        (MAX_RANGE, PIPELINE) = (max_range, pipeline)
+        (served['connections'], served['requests']) = (0, 0)
+        loop = EventLoop()
+        connector = Connector(loop, proxy, forward = True)
+        start = time.perf_counter()
+        for _torrent in range(2):
+            picker = PiecePicker(metainfo.piece_count())
+            checker = Checker(picker)
+            seed = WebSeed(loop, connector, 'http://127.0.0.1:%i/seed/' % seed_port, metainfo, picker, checker)
+            seed.pump()
+            while (checker.pieces < metainfo.piece_count()) and (checker.failure is None):
+                loop.run_once()
+                if time.perf_counter() - start > 120:
+                    checker.failure = 'timed out'
+            seed.close()
+            if checker.failure is not None:
+                break
+        elapsed = time.perf_counter() - start
+        print('%-40s %7.1f MB/s  %4i requests  %i connections, %i reused%s' %
+              (label, 2 * size / elapsed / 1e6, served['requests'], connector.opened, connector.reused,
+               '  FAILED: ' + checker.failure if checker.failure else ''), flush = True)
+        connector.close()
+        loop.close()
+    
+    (merged, pipelined) = (MAX_RANGE, PIPELINE)
+    for (label, proxy) in (('direct', None), ('socks5', Proxy('socks5', '127.0.0.1', socks_port)),
+                           ('http forward', Proxy('http', '127.0.0.1', http_port))):
+        run('%s, per piece, one at a time' % label, proxy, piece_length, 1)
+        run('%s, per piece, pipelined' % label, proxy, piece_length, pipelined)
+        run('%s, merged ranges, pipelined' % label, proxy, merged, pipelined)